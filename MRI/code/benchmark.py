@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Benchmark of the conversion pipeline on a synthetic cohort, without /mridata/cbu or a SLURM cluster.
+#
+# The run command generates a cohort of CamCAN-like DICOM sessions (see synthetic_dicoms.py) in a work folder, and times,
+# one after the other:
+#   - 'inventory_cold' and 'inventory_warm': indexing the DICOM folders of the cohort from scratch, then again with nothing
+#     changed (see dicom_inventory.py)
+#   - 'discovery': reading the seqinfo of every session from the DICOM headers (see dicom_discover.py)
+#   - 'matching': running the heuristic's infotodict over all the sessions (the time of one pass, the mean of --repeats passes)
+#   - 'conversion': converting the cohort with the local executor, as the launchers do with EXECUTOR = 'local' (a task
+#     manifest and heudiconv_script.sh, one task per subject). The time spent in each phase of the conversion (seqinfo,
+#     dcm2niix, bids, ...) is summed over the subjects from the metrics of the tasks (see task_metrics.py).
+# The results are written as a JSON file (with the configuration, the versions of the packages and the git commit of the
+# code), and two results files can be compared to check a change for regressions.
+#
+# The cohort is only generated again when its configuration changes, and the BIDS folder is converted from scratch on
+# each run.
+#
+# Usage:
+#   python benchmark.py run [--subjects <n>] [--runs <n>] [--volumes <n>] [--cancelled <n>] [--slices <n>] [--matrix <n>]
+#                           [--heuristic <heuristic_file>] [--shards <n>] [--workers <n>] [--processes <n>]
+#                           [--compression-threads <n>] [--repeats <n>] [--output <results.json>] <work_dir>
+#   python benchmark.py compare <results.json> <results.json>
+#
+# It is assumed that you run this in the 'heudiconv' conda environment (with dcm2niix on the PATH).
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To handle the file paths
+import sys # To exit with an error status
+import json # To read and write the results
+import time # To time the steps
+import shutil # To clear the work folder
+import socket # To record where the benchmark ran
+import argparse # To parse the command line arguments
+import platform # To record the Python version
+import subprocess # To read the git commit and the dcm2niix version
+from contextlib import contextmanager # To time the steps with 'with' blocks
+
+import pydicom # To record its version
+import heudiconv # To record its version
+
+import synthetic_dicoms # To generate the cohort (synthetic_dicoms.py, in the same folder as this script)
+import dicom_inventory # To index the DICOM folders (dicom_inventory.py, in the same folder as this script)
+import dicom_discover # To read the seqinfo of the sessions (dicom_discover.py, in the same folder as this script)
+import convert_session # To load the heuristic (convert_session.py, in the same folder as this script)
+import conversion_manifest # To write the manifest records of the subjects (conversion_manifest.py, in the same folder as this script)
+import execution_backends # To pack the subjects into tasks (execution_backends.py, in the same folder as this script)
+import task_manifest # To run the conversion tasks (task_manifest.py, in the same folder as this script)
+import task_metrics # To read the phases of the conversion (task_metrics.py, in the same folder as this script)
+
+# Folder with the conversion scripts
+CODE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Heuristic matching the synthetic sessions
+DEFAULT_HEURISTIC = os.path.join(CODE_PATH, 'bids_heuristic_sbref.py')
+
+# Steps timed by the run command, in order
+STEPS = ('generate', 'inventory_cold', 'inventory_warm', 'discovery', 'matching', 'conversion')
+
+# Options of the cohort (the cohort is generated again when one of them changes)
+COHORT_OPTIONS = ('subjects', 'runs', 'volumes', 'cancelled', 'slices', 'matrix', 'seed')
+
+# --------------------------------------------------------------------------------------
+# timed: Times a block of code as the step called name, into the timings dictionary.
+# --------------------------------------------------------------------------------------
+@contextmanager
+def timed(timings, name):
+    start = time.perf_counter()
+    yield
+    timings[name] = round(time.perf_counter() - start, 4)
+    print(f"{name}: {timings[name]:.2f} s")
+
+# --------------------------------------------------------------------------------------
+# versions: The versions of the packages and programs the pipeline runs with, and the git commit of the code.
+# --------------------------------------------------------------------------------------
+def versions():
+    found = {'python': platform.python_version(), 'pydicom': pydicom.__version__, 'heudiconv': heudiconv.__version__}
+    for name, command in (('dcm2niix', ['dcm2niix', '--version']), ('git_commit', ['git', '-C', CODE_PATH, 'rev-parse', 'HEAD'])):
+        try:
+            output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout
+            found[name] = output.strip().splitlines()[-1] if output.strip() else None
+        except OSError:
+            found[name] = None
+    return found
+
+# --------------------------------------------------------------------------------------
+# prepare_cohort: Generates the synthetic cohort in {work_dir}/dicoms, unless it is already there with the same options.
+# Returns the subject list (subject IDs to CBU codes), the dicom paths and whether the cohort was generated.
+# --------------------------------------------------------------------------------------
+def prepare_cohort(work_dir, options, n_processes):
+    dicom_root = os.path.join(work_dir, 'dicoms')
+    cohort_file = os.path.join(dicom_root, 'cohort.json')
+    cohort = {name: options[name] for name in COHORT_OPTIONS}
+    if os.path.isfile(cohort_file):
+        with open(cohort_file) as f:
+            saved = json.load(f)
+        if saved['options'] == cohort:
+            return saved['subject_list'], saved['dicom_paths'], False
+    shutil.rmtree(dicom_root, ignore_errors=True)
+    subject_list, dicom_paths = synthetic_dicoms.generate_cohort(
+        dicom_root, options['subjects'], n_processes=n_processes, n_runs=options['runs'], n_volumes=options['volumes'],
+        n_cancelled=options['cancelled'], n_slices=options['slices'], matrix=options['matrix'], seed=options['seed'])
+    with open(cohort_file, 'w') as f:
+        json.dump({'options': cohort, 'subject_list': subject_list, 'dicom_paths': dicom_paths}, f, indent=2)
+    return subject_list, dicom_paths, True
+
+# --------------------------------------------------------------------------------------
+# convert_cohort: Converts the subjects into output_path with the local executor, as the launchers do (one task per subject).
+# Returns the job ID and the list of failed tasks.
+# --------------------------------------------------------------------------------------
+def convert_cohort(subject_list, dicom_paths, inventory, heuristic_file, output_path, n_shards, n_workers, compression):
+    log_path = os.path.join(output_path, 'job_logs')
+    manifest_path = os.path.join(output_path, '.bids_conversion', 'manifest')
+    inventory_path = os.path.join(output_path, '.bids_conversion', 'dicom_inventory')
+    os.makedirs(log_path)
+    # The conversion tasks read the series folders from the snapshot of the inventory in the output folder
+    for dicom_path in dicom_paths:
+        dicom_inventory.write_snapshot(inventory_path, dicom_path, inventory[os.path.normpath(dicom_path)])
+
+    heuristic_sha = conversion_manifest.heuristic_hash(heuristic_file)
+    entries = []
+    for subject_id, dicom_path in zip(subject_list, dicom_paths):
+        fingerprint = conversion_manifest.session_fingerprint(inventory[os.path.normpath(dicom_path)])
+        conversion_manifest.write_record(manifest_path, conversion_manifest.new_record(
+            subject_id, None, dicom_path, fingerprint, heuristic_file, heuristic_sha))
+        entries.append({
+            'subject_id': subject_id, 'session_id': None, 'dicom_path': dicom_path,
+            'n_bytes': sum(series['n_bytes'] for series in fingerprint.values()),
+            'n_files': sum(series['n_files'] for series in fingerprint.values()),
+            'max_series_bytes': max((series['n_bytes'] for series in fingerprint.values()), default=0),
+            'n_shards': n_shards, 'stage': 0,
+        })
+
+    task_manifest_file = task_manifest.new_task_manifest(os.path.join(output_path, '.bids_conversion', 'tasks'))
+    task_manifest.write_tasks(task_manifest_file, execution_backends.pack_tasks([entry['n_bytes'] for entry in entries]), entries)
+    task_manifest.write_job(
+        task_manifest_file,
+        os.path.join(CODE_PATH, 'heudiconv_script.sh'),
+        [heuristic_file, output_path, CODE_PATH, manifest_path, inventory_path],
+        'local', log_path, {'max_workers': n_workers, 'cpus': n_shards}, manifest_path, compression=compression,
+    )
+    executor, job_id = task_manifest.submit(task_manifest_file)
+    return job_id, executor.report(job_id)
+
+# --------------------------------------------------------------------------------------
+# conversion_phases: Sums the time of each conversion phase over the subjects of a job (see task_metrics.py).
+# --------------------------------------------------------------------------------------
+def conversion_phases(log_path, job_id):
+    records = task_metrics.read_records(log_path, [job_id])
+    subjects = [s for record in records for s in record['subjects']]
+    phases = {}
+    for phase in task_metrics.PHASES:
+        times = [s['phases'][phase] for s in subjects if phase in s['phases']]
+        if times:
+            phases[phase] = round(sum(times), 4)
+    return {
+        'phases': phases,
+        'n_subjects_done': sum(s['status'] == 'done' for s in subjects),
+        'n_series': sum(len(s['series']) for s in subjects),
+        'output_bytes': sum(s.get('output_bytes', 0) for s in subjects),
+        'peak_rss_mb': max((max(r['peak_rss_mb'].values()) for r in records), default=None),
+    }
+
+# --------------------------------------------------------------------------------------
+# run_benchmark: Runs the steps of the benchmark in work_dir (see the top of this file) and returns the results.
+# options holds the command line options of the run command.
+# --------------------------------------------------------------------------------------
+def run_benchmark(work_dir, options):
+    work_dir = os.path.abspath(work_dir)
+    heuristic_file = os.path.abspath(options['heuristic'])
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'hostname': socket.gethostname(),
+        'n_cpus': os.cpu_count(),
+        'versions': versions(),
+        'config': dict(options, heuristic=heuristic_file),
+        'timings': {},
+    }
+    timings = results['timings']
+
+    start = time.perf_counter()
+    subject_list, dicom_paths, generated = prepare_cohort(work_dir, options, options['processes'])
+    if generated:
+        timings['generate'] = round(time.perf_counter() - start, 4)
+        print(f"generate: {timings['generate']:.2f} s")
+    else:
+        print(f"Reusing the cohort in {work_dir}/dicoms")
+
+    index_file = os.path.join(work_dir, 'dicom_inventory.sqlite')
+    inventory_path = os.path.join(work_dir, 'dicom_inventory')
+    if os.path.isfile(index_file):
+        os.remove(index_file)
+    shutil.rmtree(inventory_path, ignore_errors=True)
+    with timed(timings, 'inventory_cold'):
+        dicom_inventory.refresh_inventory(index_file, dicom_paths, inventory_path=inventory_path)
+    with timed(timings, 'inventory_warm'):
+        inventory = dicom_inventory.refresh_inventory(index_file, dicom_paths, inventory_path=inventory_path)
+
+    sessions = [(subject_id, None, dicom_path) for subject_id, dicom_path in zip(subject_list, dicom_paths)]
+    with timed(timings, 'discovery'):
+        discovered = dicom_discover.discover_cohort(sessions, options['processes'], inventory_path)
+
+    fingerprints = [conversion_manifest.session_fingerprint(inventory[os.path.normpath(dicom_path)]) for dicom_path in dicom_paths]
+    results['cohort'] = {
+        'n_sessions': len(sessions),
+        'n_series': sum(len(seqinfos) for _, _, seqinfos in discovered),
+        'n_files': sum(series['n_files'] for fingerprint in fingerprints for series in fingerprint.values()),
+        'n_bytes': sum(series['n_bytes'] for fingerprint in fingerprints for series in fingerprint.values()),
+    }
+
+    # The heuristic is loaded before the timing, and each pass goes through all the sessions
+    heuristic = convert_session.load_heuristic(heuristic_file)
+    start = time.perf_counter()
+    for _ in range(options['repeats']):
+        assignments = [heuristic.infotodict(seqinfos) for _, _, seqinfos in discovered]
+    timings['matching'] = round((time.perf_counter() - start) / options['repeats'], 6)
+    print(f"matching: {timings['matching'] * 1000:.2f} ms per pass")
+    results['matching'] = {
+        'repeats': options['repeats'],
+        'series_per_key': {key[0]: sum(len(info[key]) for info in assignments) for key in assignments[0]} if assignments else {},
+    }
+
+    output_path = os.path.join(work_dir, 'bids')
+    shutil.rmtree(output_path, ignore_errors=True)
+    compression = {'level': 6, 'threads': options['compression_threads']} if options['compression_threads'] else None
+    with timed(timings, 'conversion'):
+        job_id, failed = convert_cohort(subject_list, dicom_paths, inventory, heuristic_file, output_path,
+                                        options['shards'], options['workers'], compression)
+    results['conversion'] = dict(conversion_phases(os.path.join(output_path, 'job_logs'), job_id), job_id=job_id, failed_tasks=failed)
+    return results
+
+# --------------------------------------------------------------------------------------
+# flatten_timings: The timings of a results file, with the conversion phases as 'conversion.<phase>'.
+# --------------------------------------------------------------------------------------
+def flatten_timings(results):
+    timings = dict(results['timings'])
+    for phase, seconds in results.get('conversion', {}).get('phases', {}).items():
+        timings[f"conversion.{phase}"] = seconds
+    return timings
+
+# --------------------------------------------------------------------------------------
+# compare_results: Returns the lines of the comparison of two results files (the ratio is after / before).
+# --------------------------------------------------------------------------------------
+def compare_results(before, after):
+    lines = []
+    for name in ('config', 'cohort'):
+        if before.get(name) != after.get(name):
+            lines.append(f"Warning: the {name} of the two runs differ, the timings may not be comparable")
+    for name in ('git_commit', 'heudiconv', 'dcm2niix'):
+        lines.append(f"{name}: {before['versions'].get(name)} -> {after['versions'].get(name)}")
+    lines.append('')
+    lines.append(f"{'step':<24}{'before (s)':>12}{'after (s)':>12}{'ratio':>8}")
+    before_timings, after_timings = flatten_timings(before), flatten_timings(after)
+    for name in sorted(set(before_timings) | set(after_timings), key=lambda n: (STEPS.index(n.split('.')[0]), n)):
+        old, new = before_timings.get(name), after_timings.get(name)
+        ratio = f"{new / old:>8.2f}" if old and new is not None else f"{'-':>8}"
+        lines.append(f"{name:<24}{'-' if old is None else f'{old:.4f}':>12}{'-' if new is None else f'{new:.4f}':>12}{ratio}")
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the conversion pipeline on a synthetic cohort.")
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run', help="generate the cohort and time the pipeline on it")
+    run_parser.add_argument('work_dir', help="folder for the cohort, the BIDS output and the results")
+    run_parser.add_argument('--subjects', type=int, default=4, help="number of subjects (default: %(default)s)")
+    run_parser.add_argument('--runs', type=int, default=2, help="number of BOLD runs per session (default: %(default)s)")
+    run_parser.add_argument('--volumes', type=int, default=110, help="number of volumes per BOLD run (default: %(default)s)")
+    run_parser.add_argument('--cancelled', type=int, default=1, help="number of cancelled runs per session (default: %(default)s)")
+    run_parser.add_argument('--slices', type=int, default=16, help="number of slices of the BOLD volumes (default: %(default)s)")
+    run_parser.add_argument('--matrix', type=int, default=32, help="in-plane matrix size (default: %(default)s)")
+    run_parser.add_argument('--seed', type=int, default=0, help="seed of the cohort (default: %(default)s)")
+    run_parser.add_argument('--heuristic', default=DEFAULT_HEURISTIC, help="heuristic file (default: %(default)s)")
+    run_parser.add_argument('--shards', type=int, default=1, help="number of shards per subject (default: %(default)s)")
+    run_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="number of conversion tasks running at the same time (default: %(default)s)")
+    run_parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="number of processes of the generation and discovery (default: %(default)s)")
+    run_parser.add_argument('--compression-threads', type=int, default=None, help="compress the NIfTI files after the conversion with this many threads (see nifti_compress.py)")
+    run_parser.add_argument('--repeats', type=int, default=100, help="number of passes of the matching (default: %(default)s)")
+    run_parser.add_argument('--output', help="results file to write (default: <work_dir>/benchmark_<date>_<time>.json)")
+    compare_parser = commands.add_parser('compare', help="compare the timings of two results files")
+    compare_parser.add_argument('before', help="results file of the reference run")
+    compare_parser.add_argument('after', help="results file of the run to check")
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        print('\n'.join(compare_results(before, after)))
+        sys.exit(0)
+    if args.command != 'run':
+        parser.print_help()
+        sys.exit(1)
+    if not os.path.isfile(args.heuristic):
+        sys.stderr.write(f"Heuristic file not found: {args.heuristic}. Exiting...\n")
+        sys.exit(1)
+
+    options = {name: value for name, value in vars(args).items() if name not in ('command', 'work_dir', 'output')}
+    results = run_benchmark(args.work_dir, options)
+    output_file = args.output or os.path.join(args.work_dir, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output_file}")
+    if results['conversion']['failed_tasks']:
+        sys.stderr.write(f"{len(results['conversion']['failed_tasks'])} conversion tasks failed, see {args.work_dir}/bids/job_logs\n")
+        sys.exit(1)
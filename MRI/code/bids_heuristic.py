@@ -4,61 +4,51 @@
 # heudiconv -d /path/to/dicoms/{subject}/*/*/*.dcm -s 001 -f bids_heuristic.py -c dcm2niix -b -o /path/to/bids
 # 
 # see https://heudiconv.readthedocs.io/en/latest/heuristics.html
+#
+# The series are assigned to the conversion keys by the rule table below (see heuristic_rules.py,
+# which must be in the same folder as this file).
 
-# --------------------------------------------------------------------------------------
-# create_key: A common helper function used to create the conversion key in infotodict. 
-# But it is not used directly by HeuDiConv.
-# --------------------------------------------------------------------------------------
-def create_key(template, outtype=('nii.gz',), annotation_classes=None):
-    if template is None or not template:
-        raise ValueError('Template must be a valid format string')
-    return template, outtype, annotation_classes
-# --------------------------------------------------------------------------------------
+import os
+import sys
 
-# --------------------------------------------------------------------------------------
-# infotodict: A function to assist in creating the dictionary, and to be used inside heudiconv.
-# This is a required function for heudiconv to run.
-#
-# seqinfo is a record of DICOM's passed in by heudiconv. Each item in seqinfo contains DICOM metadata 
-# that can be used to isolate the series, and assign it to a conversion key.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from heuristic_rules import create_key, RuleSet
 
 # --------------------------------------------------------------------------------------
-def infotodict(seqinfo):
-
-    # Specify the conversion template for each series following the BIDS format.
-    # See https://bids-specification.readthedocs.io/en/stable/04-modality-specific-files/01-magnetic-resonance-imaging-data.html
-    
+# The conversion template for each series following the BIDS format.
+# See https://bids-specification.readthedocs.io/en/stable/04-modality-specific-files/01-magnetic-resonance-imaging-data.html
+# --------------------------------------------------------------------------------------
+KEYS = {
     # The structural/anatomical scan
-    anat = create_key(
-        'sub-{subject}/anat/sub-{subject}_ses-{_T1w'
-        )
-    
+    'anat': create_key('sub-{subject}/anat/sub-{subject}_T1w'),
+
     # The fieldmap scans
-    
+
     # The functional scans
     # You need to specify the task name in the filename. It must be a single string of letters WITHOUT spaces, underscores, or dashes!
-    
-    # Create the dictionary that will be returned by this function.
-    info = {
-        anat: [], 
-        }
+}
+
+# --------------------------------------------------------------------------------------
+# The rules assigning the DICOM series to the conversion keys. Each item in seqinfo (passed in by heudiconv)
+# contains DICOM metadata that can be used to isolate the series (protocol_name, dim3, dim4, ...).
+# See bids_heuristic_sbref.py for the rules of the fieldmaps and functional runs.
+# --------------------------------------------------------------------------------------
+RULES = [
+    # Structural
+    {'key': 'anat', 'protocol': 'MPRAGE'},
+
+    # Field map Magnitude (the fieldmap with the largest dim3 is the magnitude, the other is the phase)
 
-    # Loop through all the DICOM series and assign them to the appropriate conversion key.
-    for s in seqinfo:
-        # Uniquelly identify each series
-        
-        # Structural
-        if "MPRAGE" in s.protocol_name:
-            info[anat].append(s.series_id)
-            
-        # Field map Magnitude (the fieldmap with the largest dim3 is the magnitude, the other is the phase)
-            
-        # Field map PhaseDiff
+    # Field map PhaseDiff
 
-        # Functional Bold
-            
-    # Return the dictionary
-    return info
+    # Functional Bold
+]
+
+# --------------------------------------------------------------------------------------
+# infotodict: A function to assist in creating the dictionary, and to be used inside heudiconv.
+# This is a required function for heudiconv to run.
+# --------------------------------------------------------------------------------------
+infotodict = RuleSet(KEYS, RULES).infotodict
 
 # --------------------------------------------------------------------------------------
 # Dictionary to specify options to populate the 'IntendedFor' field of the fmap jsons.
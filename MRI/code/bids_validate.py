@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Checks the converted BIDS dataset, subject by subject (or session by session), without the Node bids-validator.
+#
+# Each subject (or session) marked as 'done' in the conversion manifest (see conversion_manifest.py) is checked for:
+#   - file naming: every file of its anat, func, fmap, ... folders is named sub-<label>[_ses-<label>]_<entities>_<suffix>
+#     with the subject and session of its folder, known entities in the BIDS order, and a suffix of its datatype
+#   - sidecars: every NIfTI file has a readable JSON sidecar (with the top-level sidecars it inherits, e.g.
+#     task-<name>_bold.json) holding the keys BIDS requires for its suffix (REQUIRED_KEYS), each _sbref has the
+#     image it is the reference of (e.g. the _bold run with the same entities), every file named in the IntendedFor
+#     of the fieldmaps exists and, if the heuristic populates IntendedFor, the fieldmaps have some
+#   - completeness: every series that the heuristic's infotodict assigns a conversion key to was converted. The
+#     seqinfo of the subject is read from the DICOM headers as in dicom_discover.py (and cached there, so it is only
+#     read again once the DICOM files changed). NIfTI files that no conversion key accounts for are reported too.
+#   - scans.tsv: every file it lists exists, and every NIfTI file of the subject is listed in it
+# Files matching a pattern of the .bidsignore file of the dataset are not checked, as with the bids-validator.
+#
+# The subjects are checked in parallel with a process pool. The result of each subject is kept in
+# {OUTPUT_PATH}/.bids_conversion/validation.json, with a signature of its files (names, sizes and modification times),
+# its manifest record and the heuristic: the subjects whose signature did not change since the last run are not checked
+# again, so checking the dataset after converting a few more subjects only costs a walk of the others.
+#
+# The launchers run this once all the conversions of a submission are done (see VALIDATE_BIDS in the launchers).
+#
+# Usage:
+#   python bids_validate.py [--heuristic <heuristic_file>] [--inventory <inventory_path>] [--processes <n>] [--force] <bids_path>
+#
+# It is assumed that you run this in the 'heudiconv' conda environment.
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To walk the BIDS folders
+import re # To check the entities
+import sys # To exit with an error status
+import csv # To read the scans.tsv files
+import json # To read the sidecars and the manifest records
+import time # To timestamp the results
+import fnmatch # To match the .bidsignore patterns
+import hashlib # To sign the files of each subject
+import logging # To log the progress
+import argparse # To parse the command line arguments
+from concurrent.futures import ProcessPoolExecutor # To check the subjects in parallel
+
+import conversion_manifest # To find the converted subjects and hash the heuristic (conversion_manifest.py, in the same folder as this script)
+import conversion_queue # To write the results atomically (conversion_queue.py, in the same folder as this script)
+import convert_session # To load the heuristic and plan its conversion keys (convert_session.py, in the same folder as this script)
+import dicom_discover # To read the seqinfo of the subjects (dicom_discover.py, in the same folder as this script)
+
+logger = logging.getLogger('bids_conversion')
+
+# Default number of processes checking the subjects
+DEFAULT_PROCESSES = os.cpu_count() or 1
+
+# Entities of the raw data, in the order they must appear in the file names
+ENTITIES = ('sub', 'ses', 'sample', 'task', 'tracksys', 'acq', 'nuc', 'voi', 'ce', 'trc', 'stain', 'rec', 'dir', 'run',
+            'mod', 'echo', 'flip', 'inv', 'mt', 'part', 'proc', 'hemi', 'space', 'split', 'recording', 'chunk')
+
+# Entities whose value is a number
+INDEX_ENTITIES = ('run', 'echo', 'flip', 'inv', 'split', 'chunk')
+
+# Suffixes allowed in each datatype folder (None: any suffix)
+DATATYPE_SUFFIXES = {
+    'anat': ('T1w', 'T2w', 'PDw', 'T2starw', 'FLAIR', 'inplaneT1', 'inplaneT2', 'PDT2', 'angio', 'T1map', 'T2map',
+             'T2starmap', 'R1map', 'R2map', 'R2starmap', 'PDmap', 'MTRmap', 'MTsat', 'UNIT1', 'T1rho', 'MWFmap', 'MTVmap',
+             'Chimap', 'S0map', 'M0map', 'MP2RAGE', 'MESE', 'MEGRE', 'VFA', 'IRT1', 'MPM', 'MTS', 'MTR', 'defacemask'),
+    'func': ('bold', 'cbv', 'phase', 'sbref', 'noRF', 'events', 'physio', 'stim'),
+    'fmap': ('phasediff', 'phase1', 'phase2', 'magnitude', 'magnitude1', 'magnitude2', 'fieldmap', 'epi', 'sbref',
+             'TB1DAM', 'TB1EPI', 'TB1AFI', 'TB1TFL', 'TB1RFM', 'TB1SRGE', 'TB1map', 'RB1COR', 'RB1map', 'm0scan'),
+    'dwi': ('dwi', 'sbref', 'physio', 'stim'),
+    'perf': ('asl', 'm0scan', 'aslcontext', 'noRF', 'physio', 'stim'),
+    'beh': None,
+}
+
+# Extensions of the files of the datatype folders
+EXTENSIONS = ('.nii.gz', '.nii', '.json', '.tsv', '.tsv.gz', '.bval', '.bvec')
+NIFTI_EXTENSIONS = ('.nii.gz', '.nii')
+
+# Sidecar keys that BIDS requires, by datatype and suffix
+REQUIRED_KEYS = {
+    ('func', 'bold'): ('RepetitionTime', 'TaskName'),
+    ('func', 'cbv'): ('RepetitionTime', 'TaskName'),
+    ('func', 'phase'): ('RepetitionTime', 'TaskName'),
+    ('fmap', 'phasediff'): ('EchoTime1', 'EchoTime2'),
+    ('fmap', 'phase1'): ('EchoTime',),
+    ('fmap', 'phase2'): ('EchoTime',),
+    ('fmap', 'fieldmap'): ('Units',),
+    ('fmap', 'epi'): ('PhaseEncodingDirection', 'TotalReadoutTime'),
+    ('perf', 'asl'): ('ArterialSpinLabelingType', 'PostLabelingDelay', 'BackgroundSuppression', 'M0Type',
+                      'TotalAcquiredPairs', 'RepetitionTimePreparation'),
+}
+
+# Entities that heudiconv adds to a conversion key when a series gives several files (echoes, magnitude and phase, coils)
+SPLIT_ENTITIES = re.compile(r'_(echo|part|ch)-[a-zA-Z0-9]+')
+SPLIT_SUFFIXES = re.compile(r'_(magnitude|phase)[12]$')
+
+# Suffix that heudiconv's reproin heuristic adds to the conversion key of a series converted again (e.g. _bold__dup-01)
+DUP_SUFFIX = re.compile(r'__dup-?\d+$')
+
+# --------------------------------------------------------------------------------------
+# split_name: Splits a file name into its entities (an ordered list of (key, value) pairs), suffix and extension.
+# Returns None if the name is not made of key-value entities followed by a suffix.
+# --------------------------------------------------------------------------------------
+def split_name(name):
+    stem, dot, extension = name.partition('.')
+    parts = stem.split('_')
+    entities = []
+    for part in parts[:-1]:
+        key, dash, value = part.partition('-')
+        if not dash or not key or not value.isalnum() or not key.isalnum():
+            return None
+        entities.append((key, value))
+    if not parts[-1].isalnum():
+        return None
+    return entities, parts[-1], dot + extension
+
+# --------------------------------------------------------------------------------------
+# read_bidsignore: Returns the patterns of the .bidsignore file of the dataset (an empty list if there is none).
+# --------------------------------------------------------------------------------------
+def read_bidsignore(output_path):
+    path = os.path.join(output_path, '.bidsignore')
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+# --------------------------------------------------------------------------------------
+# ignored: True if the file (path relative to the BIDS root) matches a pattern of the .bidsignore file.
+# --------------------------------------------------------------------------------------
+def ignored(rel_path, patterns):
+    for pattern in patterns:
+        anchored = pattern.startswith('/')
+        pattern = pattern.strip('/')
+        candidates = (pattern, f"{pattern}/*") if anchored else (pattern, f"{pattern}/*", f"*/{pattern}", f"*/{pattern}/*")
+        if any(fnmatch.fnmatch(rel_path, candidate) for candidate in candidates):
+            return True
+    return False
+
+# --------------------------------------------------------------------------------------
+# session_files: Lists the files of a subject (or session) folder, relative to the BIDS root, with their size and
+# modification time. The files directly in the subject folder of a session (e.g. sub-<label>_sessions.tsv) are included.
+# --------------------------------------------------------------------------------------
+def session_files(output_path, session_rel):
+    files = []
+    session_path = os.path.join(output_path, session_rel)
+    for folder, _, names in os.walk(session_path):
+        for name in names:
+            path = os.path.join(folder, name)
+            st = os.stat(path)
+            files.append((os.path.relpath(path, output_path).replace(os.sep, '/'), st.st_size, st.st_mtime_ns))
+    if os.path.dirname(session_rel):
+        with os.scandir(os.path.join(output_path, os.path.dirname(session_rel))) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    st = entry.stat()
+                    files.append((f"{os.path.dirname(session_rel)}/{entry.name}", st.st_size, st.st_mtime_ns))
+    return sorted(files)
+
+# --------------------------------------------------------------------------------------
+# top_level_sidecars: Reads the sidecars at the root of the dataset (e.g. task-video_bold.json), which the files of
+# all the subjects inherit. Returns a list of (name, contents) pairs, with None for the files that cannot be read.
+# --------------------------------------------------------------------------------------
+def top_level_sidecars(output_path):
+    sidecars = []
+    for name in sorted(os.listdir(output_path)):
+        if name.endswith('.json') and split_name(name) is not None and os.path.isfile(os.path.join(output_path, name)):
+            try:
+                with open(os.path.join(output_path, name)) as f:
+                    sidecars.append((name, json.load(f)))
+            except ValueError:
+                sidecars.append((name, None))
+    return sidecars
+
+# --------------------------------------------------------------------------------------
+# signature: Hash of everything the result of a subject depends on: its files, its manifest record, the heuristic
+# and the top-level files of the dataset.
+# --------------------------------------------------------------------------------------
+def signature(files, record, heuristic_sha, top_files):
+    data = [files, record.get('inputs'), record.get('heuristic_sha256'), record.get('status'), heuristic_sha, top_files]
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+# --------------------------------------------------------------------------------------
+# inherited_sidecar: The sidecar of a NIfTI file merged with the sidecars it inherits from the dataset, subject and
+# session folders (the ones with the same suffix, whose entities are all entities of the file). The deepest wins.
+# sidecars maps the path (relative to the BIDS root) of every sidecar read to its contents.
+# --------------------------------------------------------------------------------------
+def inherited_sidecar(rel_path, entities, suffix, sidecars):
+    merged = {}
+    own_entities = set(entities)
+    folders = rel_path.split('/')[:-1]
+    for depth in range(len(folders) + 1):
+        prefix = '/'.join(folders[:depth])
+        for path, contents in sidecars:
+            if os.path.dirname(path) != prefix or not isinstance(contents, dict):
+                continue
+            parts = split_name(os.path.basename(path))
+            if parts is not None and parts[1] == suffix and set(parts[0]) <= own_entities:
+                merged.update(contents)
+    return merged
+
+# --------------------------------------------------------------------------------------
+# expected_prefixes: Runs the heuristic on the seqinfo of a subject (and session) and returns the NIfTI files
+# (paths relative to the BIDS root, without extension) that heudiconv names after its conversion keys.
+# --------------------------------------------------------------------------------------
+def expected_prefixes(heuristic, seqinfos, subject_id, session_id):
+    prefixes = set()
+    for unit in convert_session.plan_units(heuristic, seqinfos):
+        if not any(outtype in ('nii', 'nii.gz') for outtype in unit['outtype']):
+            continue
+        parameters = {key: value for key, value in unit['item'].items() if key != 'item'} if isinstance(unit['item'], dict) else {}
+        subject, session = convert_session.bids_label(subject_id), session_id and convert_session.bids_label(session_id)
+        parameters.update(
+            subject=subject,
+            session=f"ses-{session}",
+            bids_subject_session_prefix=f"sub-{subject}" + (f"_ses-{session}" if session else ''),
+            bids_subject_session_dir=f"sub-{subject}" + (f"/ses-{session}" if session else ''),
+        )
+        prefixes.add(unit['template'].format(**parameters))
+    return prefixes
+
+# --------------------------------------------------------------------------------------
+# converted_prefix: The conversion key a NIfTI file (path relative to the BIDS root, without extension) was named
+# after, without the entities and suffix numbers heudiconv adds when a series gives several files.
+# --------------------------------------------------------------------------------------
+def converted_prefix(stem):
+    dup = DUP_SUFFIX.search(stem)
+    dup = dup.group(0) if dup else ''
+    stem = stem[:len(stem) - len(dup)]
+    return SPLIT_SUFFIXES.sub(lambda match: f"_{match.group(1)}", SPLIT_ENTITIES.sub('', stem)) + dup
+
+# --------------------------------------------------------------------------------------
+# named_after: True if a NIfTI file (path relative to the BIDS root, without extension) was named after the conversion
+# key prefix, with or without a __dup suffix (see DUP_SUFFIX).
+# --------------------------------------------------------------------------------------
+def named_after(stem, prefix):
+    converted = converted_prefix(stem)
+    return converted == prefix or DUP_SUFFIX.sub('', converted) == prefix
+
+# --------------------------------------------------------------------------------------
+# check_names: Checks the names of the files of a datatype folder (see the top of this file).
+# Returns the errors and the parsed names of the files, {rel_path: (entities, suffix, extension)}.
+# --------------------------------------------------------------------------------------
+def check_names(rel_paths, subject_id, session_id):
+    errors = []
+    parsed = {}
+    subject_id, session_id = convert_session.bids_label(subject_id), session_id and convert_session.bids_label(session_id)
+    for rel_path in rel_paths:
+        datatype, name = rel_path.split('/')[-2:]
+        parts = split_name(name)
+        if parts is None or parts[2] not in EXTENSIONS:
+            errors.append(f"{rel_path}: not a BIDS file name")
+            continue
+        entities, suffix, extension = parts
+        keys = [key for key, _ in entities]
+        problems = []
+        if entities[:1] != [('sub', subject_id)]:
+            problems.append(f"does not start with sub-{subject_id}")
+        if session_id and ('ses', session_id) not in entities:
+            problems.append(f"has no ses-{session_id}")
+        unknown = [key for key in keys if key not in ENTITIES]
+        if unknown:
+            problems.append(f"unknown entities {', '.join(unknown)}")
+        elif keys != sorted(keys, key=ENTITIES.index) or len(set(keys)) != len(keys):
+            problems.append(f"entities not in the BIDS order ({'_'.join(ENTITIES[ENTITIES.index(k)] for k in sorted(set(keys), key=ENTITIES.index))})")
+        problems.extend(f"{key}-{value} is not a number" for key, value in entities if key in INDEX_ENTITIES and not value.isdigit())
+        suffixes = DATATYPE_SUFFIXES.get(datatype)
+        if datatype not in DATATYPE_SUFFIXES:
+            problems.append(f"unknown datatype folder {datatype}")
+        elif suffixes is not None and suffix not in suffixes:
+            problems.append(f"suffix {suffix} is not a {datatype} suffix")
+        if problems:
+            errors.append(f"{rel_path}: {'; '.join(problems)}")
+        parsed[rel_path] = parts
+    return errors, parsed
+
+# --------------------------------------------------------------------------------------
+# check_session: Checks one subject (or session) (see the top of this file). Run in the process pool.
+# Returns its label and (errors, warnings).
+# --------------------------------------------------------------------------------------
+def check_session(task):
+    output_path, record, heuristic_file, inventory_path, top_sidecars, patterns = task
+    subject_id, session_id = record['subject_id'], record.get('session_id')
+    session_rel = convert_session.session_folder(subject_id, session_id).replace(os.sep, '/')
+    errors = []
+    warnings = []
+    files = [path for path, _, _ in session_files(output_path, session_rel) if not ignored(path, patterns)]
+    if not files:
+        return session_rel, ([f"{session_rel}: no files (converted, but missing from {output_path})"], [])
+
+    # File names
+    data_files = [path for path in files if path.count('/') == session_rel.count('/') + 2]
+    name_errors, parsed = check_names(data_files, subject_id, session_id)
+    errors.extend(name_errors)
+
+    # Sidecars
+    sidecars = [(name, contents) for name, contents in top_sidecars]
+    for path in files:
+        if path.endswith('.json'):
+            try:
+                with open(os.path.join(output_path, path)) as f:
+                    sidecars.append((path, json.load(f)))
+            except ValueError as e:
+                errors.append(f"{path}: not a JSON file ({e})")
+    own_sidecars = dict(sidecars)
+    niftis = {path: parts for path, parts in parsed.items() if parts[2] in NIFTI_EXTENSIONS}
+    images = {}
+    for path, (entities, suffix, extension) in niftis.items():
+        stem = path[:-len(extension)]
+        datatype = path.split('/')[-2]
+        images.setdefault((os.path.dirname(path), tuple(entities)), set()).add(suffix)
+        if f"{stem}.json" not in files:
+            errors.append(f"{path}: no JSON sidecar")
+        sidecar = inherited_sidecar(path, entities, suffix, sidecars)
+        missing = [key for key in REQUIRED_KEYS.get((datatype, suffix), ()) if key not in sidecar]
+        if missing:
+            errors.append(f"{path}: required sidecar keys missing: {', '.join(missing)}")
+        if datatype == 'dwi' and suffix == 'dwi':
+            for bfile in (f"{stem}.bval", f"{stem}.bvec"):
+                if bfile not in files:
+                    errors.append(f"{path}: {os.path.basename(bfile)} missing")
+    for (folder, entities), suffixes in images.items():
+        if 'sbref' in suffixes and not suffixes - {'sbref'}:
+            errors.append(f"{folder}/{'_'.join(f'{k}-{v}' for k, v in entities)}_sbref: no image with the same entities for this sbref")
+
+    # IntendedFor of the fieldmaps
+    heuristic = convert_session.load_heuristic(heuristic_file)
+    fieldmaps = [path for path in niftis if path.split('/')[-2] == 'fmap']
+    with_intended_for = 0
+    for path in fieldmaps:
+        intended_for = own_sidecars.get(f"{path[:-len(niftis[path][2])]}.json")
+        intended_for = intended_for.get('IntendedFor') if isinstance(intended_for, dict) else None
+        if not intended_for:
+            continue
+        with_intended_for += 1
+        for target in [intended_for] if isinstance(intended_for, str) else intended_for:
+            target_rel = target[len('bids::'):] if target.startswith('bids::') else f"{session_rel.split('/')[0]}/{target}"
+            if not os.path.isfile(os.path.join(output_path, target_rel)):
+                errors.append(f"{path}: IntendedFor {target} does not exist")
+    targets = [path for path in niftis if path.split('/')[-2] in ('func', 'dwi', 'perf')]
+    if getattr(heuristic, 'POPULATE_INTENDED_FOR_OPTS', None) is not None and fieldmaps and targets and not with_intended_for:
+        errors.append(f"{session_rel}: no fieldmap has an IntendedFor, although the heuristic populates it")
+
+    # Completeness against the heuristic
+    dicom_path = record.get('dicom_path')
+    if dicom_path and os.path.isdir(dicom_path):
+        seqinfos = dicom_discover.cached_session(os.path.join(output_path, '.bids_conversion', 'seqinfo'), subject_id, session_id,
+                                                 dicom_path, record.get('inputs'), inventory_path)
+        expected = expected_prefixes(heuristic, seqinfos, subject_id, session_id)
+        converted = {path[:-len(parts[2])] for path, parts in niftis.items()}
+        for prefix in sorted(expected):
+            if not any(named_after(stem, prefix) for stem in converted):
+                errors.append(f"{prefix}: expected from the heuristic, but not converted")
+        for stem in sorted(converted):
+            if not any(named_after(stem, prefix) for prefix in expected):
+                warnings.append(f"{stem}: not expected from the heuristic")
+    else:
+        warnings.append(f"{session_rel}: DICOM folder {dicom_path} not found, the series were not checked against the heuristic")
+
+    # scans.tsv
+    scans_file = f"{session_rel}/{session_rel.replace('/', '_')}_scans.tsv"
+    if scans_file not in files:
+        errors.append(f"{scans_file}: missing")
+    else:
+        with open(os.path.join(output_path, scans_file), newline='') as f:
+            listed = {row['filename'] for row in csv.DictReader(f, delimiter='\t') if row.get('filename')}
+        for name in sorted(listed):
+            if f"{session_rel}/{name}" not in files:
+                errors.append(f"{scans_file}: {name} does not exist")
+        for path in sorted(niftis):
+            if path[len(session_rel) + 1:] not in listed:
+                warnings.append(f"{path}: not listed in {os.path.basename(scans_file)}")
+    return session_rel, (errors, warnings)
+
+# --------------------------------------------------------------------------------------
+# validate_dataset: Checks the subjects (or sessions) of the dataset whose signature changed since the last run
+# (all of them with force=True), in n_processes processes. The heuristic is the one each subject was converted with,
+# unless heuristic_file is given. Returns the results of all the subjects, {label: {'signature', 'validated',
+# 'errors', 'warnings'}}, and the labels of the ones checked by this run.
+# --------------------------------------------------------------------------------------
+def validate_dataset(output_path, heuristic_file=None, inventory_path=None, n_processes=DEFAULT_PROCESSES, force=False):
+    state_file = os.path.join(output_path, '.bids_conversion', 'validation.json')
+    manifest_path = os.path.join(output_path, '.bids_conversion', 'manifest')
+    previous = {}
+    if os.path.isfile(state_file) and not force:
+        with open(state_file) as f:
+            previous = json.load(f)
+
+    top_sidecars = top_level_sidecars(output_path)
+    top_files = []
+    for name, _ in top_sidecars:
+        st = os.stat(os.path.join(output_path, name))
+        top_files.append((name, st.st_size, st.st_mtime_ns))
+    patterns = read_bidsignore(output_path)
+    heuristic_shas = {}
+    results = {}
+    tasks = []
+    checked = []
+    for name in sorted(os.listdir(manifest_path)) if os.path.isdir(manifest_path) else []:
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(manifest_path, name)) as f:
+            record = json.load(f)
+        if record.get('status') != 'done':
+            continue
+        session_rel = convert_session.session_folder(record['subject_id'], record.get('session_id')).replace(os.sep, '/')
+        record_heuristic = heuristic_file or record['heuristic_file']
+        if record_heuristic not in heuristic_shas:
+            heuristic_shas[record_heuristic] = conversion_manifest.heuristic_hash(record_heuristic)
+        files = session_files(output_path, session_rel) if os.path.isdir(os.path.join(output_path, session_rel)) else []
+        sha = signature(files, record, heuristic_shas[record_heuristic], top_files + [patterns])
+        if session_rel in previous and previous[session_rel]['signature'] == sha:
+            results[session_rel] = previous[session_rel]
+            continue
+        results[session_rel] = {'signature': sha}
+        checked.append(session_rel)
+        tasks.append((output_path, record, record_heuristic, inventory_path, top_sidecars, patterns))
+
+    logger.info(f"{len(results)} converted subjects (or sessions): {len(tasks)} to check, {len(results) - len(tasks)} unchanged")
+    with ProcessPoolExecutor(max_workers=max(1, min(n_processes, len(tasks) or 1))) as pool:
+        for session_rel, (errors, warnings) in pool.map(check_session, tasks):
+            results[session_rel].update(validated=time.strftime('%Y-%m-%dT%H:%M:%S'), errors=errors, warnings=warnings)
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    conversion_queue.write_json(state_file, results)
+    return results, checked
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the converted subjects of a BIDS dataset (only the ones that changed since the last run).")
+    parser.add_argument('bids_path', help="BIDS output folder (OUTPUT_PATH of the launchers)")
+    parser.add_argument('--heuristic', help="heuristic to check the series against (default: the one each subject was converted with)")
+    parser.add_argument('--inventory', help="DICOM inventory written by the launchers (default: the one in <bids_path>/.bids_conversion)")
+    parser.add_argument('--processes', type=int, default=DEFAULT_PROCESSES, help="number of processes (default: %(default)s)")
+    parser.add_argument('--force', action='store_true', help="check all the subjects again")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    inventory_path = args.inventory or os.path.join(args.bids_path, '.bids_conversion', 'dicom_inventory')
+    results, checked = validate_dataset(args.bids_path, args.heuristic, inventory_path if os.path.isdir(inventory_path) else None,
+                                        args.processes, args.force)
+    for session_rel, result in sorted(results.items()):
+        for error in result['errors']:
+            print(f"ERROR\t{error}")
+        for warning in result['warnings']:
+            print(f"WARNING\t{warning}")
+    n_invalid = sum(bool(result['errors']) for result in results.values())
+    print(f"{len(results)} subjects (or sessions) checked ({len(checked)} in this run): {n_invalid} with errors, "
+          f"{sum(bool(result['warnings']) for result in results.values())} with warnings")
+    sys.exit(1 if n_invalid else 0)
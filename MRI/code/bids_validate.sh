@@ -0,0 +1,58 @@
+#!/bin/bash
+
+# ============================================================
+# This script checks the converted BIDS dataset once the conversions of a submission are done (see bids_validate.py).
+# The launchers submit it as a single task that waits for the conversion jobs (see VALIDATE_BIDS in the launchers).
+#
+# Usage: sbatch bids_validate.sh <code_path> <output_path> <heuristic_file> <inventory_path> [<n_processes>]
+#
+# Arguments:
+#   <code_path> is the folder with the conversion scripts (bids_validate.py)
+#   <output_path> is the BIDS output folder
+#   <heuristic_file> is the heudiconv heuristic the series are checked against
+#   <inventory_path> is the snapshot of the DICOM inventory written by the launcher (see dicom_inventory.py)
+#   <n_processes> is the number of subjects checked at the same time (default: 1)
+#
+# Notes:
+#   Only the subjects (or sessions) that changed since the last check are checked again. The errors and warnings are
+#   written to the output file of the task, and kept for each subject in <output_path>/.bids_conversion/validation.json.
+#   The task fails if any subject of the dataset has errors.
+#
+# Example usage:
+#   sbatch --cpus-per-task=4 bids_validate.sh /path/to/code /path/to/output /path/to/heuristic.py /path/to/output/.bids_conversion/dicom_inventory 4
+#
+# It is assumed that you have a conda environment called 'heudiconv' available (check with 'conda env list').
+# If not, create a conda environment with the heudiconv and dcm2niix packages installed.
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Parse the arguments passed to the script
+# ------------------------------------------------------------
+CODE_PATH="${1}"
+OUTPUT_PATH="${2}"
+HEURISTIC_FILE="${3}"
+INVENTORY_PATH="${4}"
+N_PROCESSES="${5:-1}"
+
+# ------------------------------------------------------------
+# Activate the heudiconv environment
+# ------------------------------------------------------------
+conda activate heudiconv
+
+# ------------------------------------------------------------
+# Check the subjects that changed since the last check
+# ------------------------------------------------------------
+python "${CODE_PATH}/bids_validate.py" \
+    --heuristic "${HEURISTIC_FILE}" \
+    --inventory "${INVENTORY_PATH}" \
+    --processes "${N_PROCESSES}" \
+    "${OUTPUT_PATH}"
+validate_status=$?
+
+# ------------------------------------------------------------
+# Deactivate the heudiconv environment
+# ------------------------------------------------------------
+conda deactivate
+
+exit ${validate_status}
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Keeps a manifest of what has been converted for each subject (and session).
+# For every subject/session, a small JSON record is written into the manifest folder holding:
+#   - a fingerprint of the DICOM inputs (series directories, their SeriesInstanceUID,
+#     number of files, total size and latest modification time)
+#   - the hash of the heuristic file used for the conversion (and of the local modules it imports, e.g. heuristic_rules.py)
+#   - the status of the conversion ('submitted', 'done' or 'failed')
+#
+# The launchers (dicom_to_bids_multiple_subjects*.py) use these records to only submit the
+# subjects whose inputs or heuristic changed since their last successful conversion (a subject submitted with the
+# same inputs and heuristic is taken as in progress, until SUBMITTED_TIMEOUT_HOURS have passed),
+# and the jobs (run_task.py) mark their subject as 'done' or 'failed' when they finish. A job only marks the record
+# it was submitted for: the task manifests carry the hash of the inputs and heuristic of each subject (see
+# submission_hash), and a record submitted again since (with other inputs or another heuristic) is left alone.
+#
+# Usage (e.g. to mark a subject by hand):
+#   python conversion_manifest.py <done|failed> <manifest_path> <subject_id> [<session_id>]
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To write the records
+import ast # To find the local modules imported by the heuristic
+import sys # To read the command line arguments
+import json # To read and write the records
+import hashlib # To hash the heuristic file
+import time # To timestamp the records
+
+# Number of hours after which a record still 'submitted' is taken as abandoned (e.g. its job was cancelled before
+# it started) and its subject submitted again
+SUBMITTED_TIMEOUT_HOURS = 48
+
+# Format of the timestamps of the records
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# --------------------------------------------------------------------------------------
+# heuristic_modules: The local modules the heuristic file imports (e.g. heuristic_rules.py), and the ones they
+# import in turn: the .py files of the folder of the heuristic file named by its import statements.
+# --------------------------------------------------------------------------------------
+def heuristic_modules(heuristic_file):
+    folder = os.path.dirname(os.path.abspath(heuristic_file))
+    modules = []
+    to_read = [heuristic_file]
+    while to_read:
+        with open(to_read.pop(), 'rb') as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module_file = os.path.join(folder, f"{name.split('.')[0]}.py")
+                if os.path.isfile(module_file) and module_file not in modules and module_file != os.path.abspath(heuristic_file):
+                    modules.append(module_file)
+                    to_read.append(module_file)
+    return sorted(modules)
+
+# --------------------------------------------------------------------------------------
+# heuristic_hash: Returns the SHA-256 of the heuristic file and of the local modules it imports (see
+# heuristic_modules), so that a changed heuristic (or rule engine) triggers a new conversion of every subject.
+# A heuristic without local modules has the SHA-256 of its file.
+# --------------------------------------------------------------------------------------
+def heuristic_hash(heuristic_file):
+    sha = hashlib.sha256()
+    for path in [heuristic_file] + heuristic_modules(heuristic_file):
+        if path != heuristic_file:
+            sha.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+# --------------------------------------------------------------------------------------
+# session_fingerprint: Summarises the DICOM inputs of one subject/session.
+#
+# series is the list of series folders of the subject/session, as returned by the DICOM inventory
+# (see dicom_inventory.py). The fingerprint maps each series folder (relative to the subject's DICOM path)
+# to its SeriesInstanceUID, number of files, total size in bytes and latest modification time,
+# so any added, removed or replaced file changes the fingerprint (a file rewritten in place is only seen once its
+# folder changes, see dicom_inventory.py).
+# --------------------------------------------------------------------------------------
+def session_fingerprint(series):
+    return {
+        s['folder']: {
+            'series_uid': s['series_uid'],
+            'n_files': s['n_files'],
+            'n_bytes': s['n_bytes'],
+            'mtime': s['last_modified'],
+        }
+        for s in series
+    }
+
+# --------------------------------------------------------------------------------------
+# submission_hash: The SHA-256 of the DICOM inputs (see session_fingerprint) and heuristic hash of a submission,
+# given to the jobs so that they only mark the record they were submitted for (see mark_status).
+# --------------------------------------------------------------------------------------
+def submission_hash(fingerprint, heuristic_sha):
+    return hashlib.sha256(json.dumps([fingerprint, heuristic_sha], sort_keys=True).encode()).hexdigest()
+
+# --------------------------------------------------------------------------------------
+# record_file: Path of the manifest record of a subject (and session).
+# --------------------------------------------------------------------------------------
+def record_file(manifest_path, subject_id, session_id=None):
+    name = f"sub-{subject_id}"
+    if session_id:
+        name += f"_ses-{session_id}"
+    return os.path.join(manifest_path, f"{name}.json")
+
+# --------------------------------------------------------------------------------------
+# load_record: Returns the manifest record of a subject (and session), or None if it was never submitted.
+# --------------------------------------------------------------------------------------
+def load_record(manifest_path, subject_id, session_id=None):
+    path = record_file(manifest_path, subject_id, session_id)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+# --------------------------------------------------------------------------------------
+# write_record: Writes the manifest record of a subject (and session).
+# The record is written to a temporary file first and then renamed, so that a job that is
+# killed half-way never leaves a truncated record behind.
+# --------------------------------------------------------------------------------------
+def write_record(manifest_path, record):
+    os.makedirs(manifest_path, exist_ok=True)
+    path = record_file(manifest_path, record['subject_id'], record.get('session_id'))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+# --------------------------------------------------------------------------------------
+# needs_conversion: Returns the reason why a subject (and session) has to be (re)converted,
+# or None if its last conversion finished successfully with the same inputs and heuristic, or if it was submitted
+# with the same inputs and heuristic less than submitted_timeout_hours ago (its conversion is in progress).
+# --------------------------------------------------------------------------------------
+def needs_conversion(record, fingerprint, heuristic_sha, submitted_timeout_hours=SUBMITTED_TIMEOUT_HOURS):
+    if record is None:
+        return 'not converted yet'
+    if record.get('heuristic_sha256') != heuristic_sha:
+        return 'heuristic changed'
+    if record.get('inputs') != fingerprint:
+        return 'DICOM inputs changed'
+    if record.get('status') == 'submitted':
+        age_hours = (time.time() - time.mktime(time.strptime(record['updated'], TIME_FORMAT))) / 3600
+        if age_hours < submitted_timeout_hours:
+            return None
+        return f"submitted {age_hours:.0f} hours ago and not finished"
+    if record.get('status') != 'done':
+        return f"previous conversion {record.get('status', 'unknown')}"
+    return None
+
+# --------------------------------------------------------------------------------------
+# new_record: Creates the record of a subject (and session) that is about to be submitted.
+# --------------------------------------------------------------------------------------
+def new_record(subject_id, session_id, dicom_path, fingerprint, heuristic_file, heuristic_sha):
+    return {
+        'subject_id': subject_id,
+        'session_id': session_id,
+        'dicom_path': dicom_path,
+        'inputs': fingerprint,
+        'heuristic_file': heuristic_file,
+        'heuristic_sha256': heuristic_sha,
+        'status': 'submitted',
+        'updated': time.strftime(TIME_FORMAT),
+    }
+
+# --------------------------------------------------------------------------------------
+# mark_status: Updates the status of an existing record (called by the job scripts).
+# If submission is given (see submission_hash), the record is only updated if it is still the one of that
+# submission. Returns whether the record was updated.
+# --------------------------------------------------------------------------------------
+def mark_status(manifest_path, subject_id, session_id, status, submission=None):
+    record = load_record(manifest_path, subject_id, session_id)
+    if record is None:
+        sys.stderr.write(f"No manifest record for subject {subject_id} (session {session_id}). Skipping...\n")
+        return False
+    if submission and submission_hash(record.get('inputs'), record.get('heuristic_sha256')) != submission:
+        sys.stderr.write(f"The manifest record of subject {subject_id} (session {session_id}) was submitted again "
+                         f"since. Skipping...\n")
+        return False
+    record['status'] = status
+    record['updated'] = time.strftime(TIME_FORMAT)
+    write_record(manifest_path, record)
+    return True
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5) or sys.argv[1] not in ('done', 'failed'):
+        sys.stderr.write("Usage: conversion_manifest.py <done|failed> <manifest_path> <subject_id> [<session_id>]\n")
+        sys.exit(1)
+    session = sys.argv[4] if len(sys.argv) == 5 else None
+    mark_status(sys.argv[2], sys.argv[3], session, sys.argv[1])
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# File-based queue of conversions, for the long-lived workers of conversion_worker.py.
+#
+# Instead of one array task per group of subjects (see task_manifest.py), the launchers can put the subjects
+# (or sessions) to convert into a queue folder on the shared file system, {OUTPUT_PATH}/.bids_conversion/queue:
+#   - config.json: what the workers need to convert them (heuristic file, output path, conversion manifest,
+#     DICOM inventory, job logs folder, I/O budget and compression of the NIfTI files)
+#   - pending/<n_bytes>_<subject>[_ses-<session>].json: one file per conversion waiting for a worker, with the same
+#     fields as a row of a task manifest (see task_manifest.TASK_COLUMNS)
+#   - running/, done/, failed/: the conversions being converted, and the ones that finished (with their result:
+#     worker, start and end time, and status)
+#
+# The workers (see conversion_worker.py) take the largest pending conversion by renaming its file from pending/ to
+# running/, which only one worker can do, so the fast and slow subjects are balanced between the workers as they go
+# instead of being fixed by task ID in advance. While converting, a worker touches the file of its conversion every
+# HEARTBEAT_SECONDS: a conversion whose file has not been touched for STALE_SECONDS (e.g. its worker was killed) is
+# put back into pending/ by the other workers.
+#
+# The queue only needs the standard library, so the launchers can fill it without heudiconv.
+#
+# Usage:
+#   python conversion_queue.py status <queue_path>
+#       prints the number of conversions in each state, and the running ones
+#   python conversion_queue.py retry <queue_path>
+#       puts the failed conversions back into the queue
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To handle the queue files
+import sys # To read the command line arguments
+import json # To read and write the queue files
+import time # To wait for new conversions and time the heartbeats
+import socket # To name the temporary files
+import logging # To log the abandoned conversions
+
+logger = logging.getLogger('bids_conversion')
+
+# States of the conversions, and the folder of each
+STATES = ('pending', 'running', 'done', 'failed')
+
+# Seconds between two touches of the file of a running conversion, and after which a conversion whose file was not
+# touched is considered abandoned by its worker
+HEARTBEAT_SECONDS = 60
+STALE_SECONDS = 10 * HEARTBEAT_SECONDS
+
+# --------------------------------------------------------------------------------------
+# state_folder: Folder of the conversions in a state.
+# --------------------------------------------------------------------------------------
+def state_folder(queue_path, state):
+    return os.path.join(queue_path, state)
+
+# --------------------------------------------------------------------------------------
+# write_json: Writes a JSON file atomically (into a temporary file renamed into place).
+# --------------------------------------------------------------------------------------
+def write_json(path, data):
+    tmp_file = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_file, path)
+
+# --------------------------------------------------------------------------------------
+# write_config: Creates the queue folder and saves what the workers need to convert its conversions.
+# --------------------------------------------------------------------------------------
+def write_config(queue_path, heuristic_file, output_path, manifest_path, inventory_path, log_path, io_slots=None,
+                 compression=None):
+    for state in STATES:
+        os.makedirs(state_folder(queue_path, state), exist_ok=True)
+    write_json(os.path.join(queue_path, 'config.json'), {
+        'heuristic_file': heuristic_file,
+        'output_path': output_path,
+        'manifest_path': manifest_path,
+        'inventory_path': inventory_path,
+        'log_path': log_path,
+        'io_slots': io_slots,
+        'compression': compression,
+    })
+
+# --------------------------------------------------------------------------------------
+# read_config: Returns the configuration of a queue, as saved by write_config.
+# --------------------------------------------------------------------------------------
+def read_config(queue_path):
+    with open(os.path.join(queue_path, 'config.json')) as f:
+        return json.load(f)
+
+# --------------------------------------------------------------------------------------
+# entry_name: Name of the queue file of a conversion. The names start with the size of the DICOM files,
+# so that sorting them in reverse puts the largest conversions first.
+# --------------------------------------------------------------------------------------
+def entry_name(entry):
+    label = f"sub-{entry['subject_id']}" + (f"_ses-{entry['session_id']}" if entry.get('session_id') else '')
+    return f"{int(entry.get('n_bytes') or 0):015d}_{label}.json"
+
+# --------------------------------------------------------------------------------------
+# enqueue: Adds conversions to the queue (dictionaries with the fields of a task manifest row). A conversion of the
+# same subject (and session) still waiting in the queue is replaced.
+# --------------------------------------------------------------------------------------
+def enqueue(queue_path, entries):
+    pending = state_folder(queue_path, 'pending')
+    waiting = {name.split('_', 1)[1]: name for name in os.listdir(pending) if name.endswith('.json')}
+    for entry in entries:
+        name = entry_name(entry)
+        if name.split('_', 1)[1] in waiting:
+            try:
+                os.remove(os.path.join(pending, waiting[name.split('_', 1)[1]]))
+            except FileNotFoundError:
+                pass # taken by a worker in the meantime
+        write_json(os.path.join(pending, name), dict(entry, enqueued=time.strftime('%Y-%m-%dT%H:%M:%S')))
+
+# --------------------------------------------------------------------------------------
+# claim: Takes the largest pending conversion for a worker. Returns the name of its file and the conversion,
+# or None if the queue is empty.
+# --------------------------------------------------------------------------------------
+def claim(queue_path):
+    pending = state_folder(queue_path, 'pending')
+    running = state_folder(queue_path, 'running')
+    for name in sorted((name for name in os.listdir(pending) if name.endswith('.json')), reverse=True):
+        try:
+            os.rename(os.path.join(pending, name), os.path.join(running, name))
+            # The file keeps its modification time when renamed: touch it so that it is not seen as stale
+            os.utime(os.path.join(running, name))
+            with open(os.path.join(running, name)) as f:
+                return name, json.load(f)
+        except FileNotFoundError:
+            continue # taken by another worker
+    return None
+
+# --------------------------------------------------------------------------------------
+# finish: Moves a running conversion to done/ or failed/ (depending on its status), with its result.
+# --------------------------------------------------------------------------------------
+def finish(queue_path, name, entry, status, result):
+    write_json(os.path.join(state_folder(queue_path, status), name), dict(entry, **result, status=status))
+    try:
+        os.remove(os.path.join(state_folder(queue_path, 'running'), name))
+    except FileNotFoundError:
+        pass # put back into the queue as stale in the meantime
+
+# --------------------------------------------------------------------------------------
+# requeue_stale: Puts the running conversions whose file was not touched for stale_seconds back into the queue.
+# Returns their names.
+# --------------------------------------------------------------------------------------
+def requeue_stale(queue_path, stale_seconds=STALE_SECONDS):
+    running = state_folder(queue_path, 'running')
+    requeued = []
+    for name in os.listdir(running):
+        try:
+            if time.time() - os.stat(os.path.join(running, name)).st_mtime > stale_seconds:
+                os.rename(os.path.join(running, name), os.path.join(state_folder(queue_path, 'pending'), name))
+                requeued.append(name)
+        except FileNotFoundError:
+            continue
+    for name in requeued:
+        logger.warning(f"Conversion {name} was abandoned by its worker, put back into the queue")
+    return requeued
+
+# --------------------------------------------------------------------------------------
+# retry_failed: Puts the failed conversions back into the queue. Returns their number.
+# --------------------------------------------------------------------------------------
+def retry_failed(queue_path):
+    failed = state_folder(queue_path, 'failed')
+    entries = []
+    for name in os.listdir(failed):
+        with open(os.path.join(failed, name)) as f:
+            entry = json.load(f)
+        entries.append({key: value for key, value in entry.items() if key not in ('status', 'worker', 'started', 'finished')})
+        os.remove(os.path.join(failed, name))
+    enqueue(queue_path, entries)
+    return len(entries)
+
+# --------------------------------------------------------------------------------------
+# submit_workers: Starts n_workers workers on the queue with an executor (see execution_backends.py), as one job of
+# heudiconv_worker.sh (in code_path). Returns the job ID.
+# --------------------------------------------------------------------------------------
+def submit_workers(executor, code_path, queue_path, n_workers):
+    return executor.submit(os.path.join(code_path, 'heudiconv_worker.sh'), [code_path, queue_path], list(range(n_workers)))
+
+# --------------------------------------------------------------------------------------
+# queue_status: Returns the names of the conversions in each state.
+# --------------------------------------------------------------------------------------
+def queue_status(queue_path):
+    return {state: sorted(name for name in os.listdir(state_folder(queue_path, state)) if name.endswith('.json'))
+            for state in STATES}
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'status':
+        status = queue_status(sys.argv[2])
+        print(', '.join(f"{len(status[state])} {state}" for state in STATES))
+        for name in status['running']:
+            print(f"running\t{name}")
+    elif len(sys.argv) == 3 and sys.argv[1] == 'retry':
+        print(f"{retry_failed(sys.argv[2])} failed conversions put back into the queue")
+    else:
+        sys.stderr.write("Usage: conversion_queue.py status <queue_path>\n"
+                         "       conversion_queue.py retry <queue_path>\n")
+        sys.exit(1)
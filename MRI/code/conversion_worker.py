@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Long-lived conversion worker, fed by a queue folder on the shared file system (see conversion_queue.py).
+#
+# Instead of starting one process per task (which activates conda and imports heudiconv every time), a worker is
+# started once per node (or a few times on a workstation, see heudiconv_worker.sh). It imports heudiconv and loads the
+# heuristic once, then takes the largest pending conversion of the queue, converts it in the same way as a task would
+# (see run_task.convert_subject: the manifest record of the subject is marked and its metrics recorded), reports the
+# result into the queue (done/ or failed/), and takes the next one, until the queue has been empty for idle_seconds.
+#
+# A worker stops taking conversions if the heuristic file changes, as it would keep the old heuristic loaded.
+# Each worker writes its metrics (see task_metrics.py) next to its log files, as
+# heudiconv_worker_job_<job_id>_<task_id>.metrics.json.
+#
+# Usage (from heudiconv_worker.sh, in the 'heudiconv' conda environment):
+#   python conversion_worker.py <queue_path> [<idle_seconds>]
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To handle the queue files
+import sys # To read the command line arguments
+import time # To wait for new conversions
+import socket # To name the worker
+import logging # To log what the worker does
+import threading # To touch the file of the conversion being converted
+
+import conversion_queue # To take the conversions and report their results (conversion_queue.py, in the same folder as this script)
+import conversion_manifest # To know whether the heuristic changed (conversion_manifest.py, in the same folder as this script)
+import run_task # To convert the subjects (run_task.py, in the same folder as this script)
+import task_metrics # To record the performance of the worker (task_metrics.py, in the same folder as this script)
+import execution_backends # To name the metrics file like the worker's log files (execution_backends.py, in the same folder as this script)
+
+logger = logging.getLogger('bids_conversion')
+
+# Seconds between two looks at an empty queue, and after which a worker with nothing to do stops
+POLL_SECONDS = 10
+IDLE_SECONDS = 60
+
+# --------------------------------------------------------------------------------------
+# Heartbeat: Touches the file of the running conversion of the worker (path) every HEARTBEAT_SECONDS, until stopped.
+# --------------------------------------------------------------------------------------
+class Heartbeat(threading.Thread):
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.path = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(conversion_queue.HEARTBEAT_SECONDS):
+            path = self.path
+            if path is not None:
+                try:
+                    os.utime(path)
+                except FileNotFoundError:
+                    pass
+
+# --------------------------------------------------------------------------------------
+# run_worker: Converts the conversions of the queue until it has been empty for idle_seconds (see the top of this file).
+# Returns the number of conversions that failed.
+# --------------------------------------------------------------------------------------
+def run_worker(queue_path, idle_seconds=IDLE_SECONDS):
+    config = conversion_queue.read_config(queue_path)
+    job_id = os.environ.get('SLURM_ARRAY_JOB_ID', socket.gethostname())
+    task_id = os.environ.get('SLURM_ARRAY_TASK_ID', str(os.getpid()))
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    metrics = task_metrics.TaskMetrics(job_id, task_id)
+    metrics.instrument_heudiconv()
+    metrics_file = execution_backends.log_file(config['log_path'], 'heudiconv_worker', job_id, task_id, 'metrics.json')
+    heuristic_sha = conversion_manifest.heuristic_hash(config['heuristic_file'])
+    heartbeat = Heartbeat()
+    heartbeat.start()
+    logger.info(f"Worker {worker} started on queue {queue_path}")
+
+    n_done = n_failed = 0
+    idle_since = time.time()
+    while True:
+        if conversion_manifest.heuristic_hash(config['heuristic_file']) != heuristic_sha:
+            logger.warning(f"The heuristic file {config['heuristic_file']} changed: stopping (start new workers to use it)")
+            break
+        conversion_queue.requeue_stale(queue_path)
+        claimed = conversion_queue.claim(queue_path)
+        if claimed is None:
+            if time.time() - idle_since >= idle_seconds:
+                break
+            time.sleep(POLL_SECONDS)
+            continue
+
+        name, entry = claimed
+        heartbeat.path = os.path.join(conversion_queue.state_folder(queue_path, 'running'), name)
+        started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        status = run_task.convert_subject(metrics, entry, config['heuristic_file'], config['output_path'],
+                                          config['manifest_path'], config['inventory_path'], config.get('io_slots'),
+                                          config.get('compression'))
+        heartbeat.path = None
+        conversion_queue.finish(queue_path, name, entry, status, {'worker': worker, 'started': started, 'finished': time.strftime('%Y-%m-%dT%H:%M:%S')})
+        run_task.write_metrics(metrics, metrics_file)
+        n_done += status == 'done'
+        n_failed += status == 'failed'
+        idle_since = time.time()
+
+    heartbeat.stopped.set()
+    logger.info(f"Worker {worker} stopped: {n_done} converted, {n_failed} failed")
+    return n_failed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.stderr.write("Usage: conversion_worker.py <queue_path> [<idle_seconds>]\n")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    idle_seconds = float(sys.argv[2]) if len(sys.argv) == 3 else IDLE_SECONDS
+    sys.exit(1 if run_worker(sys.argv[1], idle_seconds) else 0)
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Converts one subject (and session) from DICOM to BIDS with heudiconv, splitting the work into shards
+# that are converted in parallel.
+#
+# The session is converted in three steps:
+#   1) Plan: the series of the session are discovered from their headers (see dicom_discover.py) and the
+#      project's heuristic (infotodict) is run on them once, to know the conversion key (BIDS file name) of
+#      every series. The series are then split into shards of similar size (number of DICOM files).
+#   2) Convert: each shard is converted by its own heudiconv (and dcm2niix) process, in parallel, into its
+#      own temporary folder. heuristic_wrapper.py makes sure each shard names its series exactly as the
+#      conversion of the whole session would (e.g. run numbers).
+#   3) Merge: the files of all the shards are moved into the BIDS folder, their scans.tsv files are merged,
+#      what heudiconv keeps about the conversion (.heudiconv/<subject>/[ses-<session>/]info) is merged as the
+#      conversion of the whole session would have written it, the top-level BIDS files and participants.tsv are
+#      updated, and the IntendedFor fields of the fieldmaps are populated for the whole session (if
+#      POPULATE_INTENDED_FOR_OPTS is in the heuristic).
+#
+# With compression (--compression-threads), dcm2niix writes uncompressed NIfTI files in the shards, and the files of the
+# whole session are compressed in parallel after the merge (see nifti_compress.py).
+#
+# Usage:
+#   python convert_session.py --subject <subject_id> [--session <session_id>] --heuristic <heuristic_file>
+#                             --output <output_path> [--shards <n>] [--inventory <inventory_path>]
+#                             [--compression-threads <n>] [--compression-level <1-9>] <dicom_path>
+#
+# It is assumed that you run this in the 'heudiconv' conda environment.
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To handle the file paths
+import re # To fill in the run numbers of the conversion keys
+import sys # To exit with an error status
+import csv # To merge the scans.tsv files
+import json # To write the conversion plan and the dcm2niix configuration, and to read the filegroup.json files of the shards
+import shutil # To remove the temporary folders
+import logging # To log what is done
+import argparse # To parse the command line arguments
+import tempfile # To write the dcm2niix configuration and the conversion plans
+import contextlib # To write uncompressed NIfTI files in a 'with' block
+import importlib.util # To load the project's heuristic
+from concurrent.futures import ProcessPoolExecutor # To convert the shards in parallel
+
+import filelock # To update the top-level BIDS files safely when several sessions finish at the same time
+from heudiconv.main import workflow # To run heudiconv without going through its command line
+from heudiconv.bids import add_participant_record, populate_bids_templates, populate_intended_for
+from heudiconv.utils import SeqInfo, save_json, write_config # To write the .heudiconv info of the whole session (see merge_heudiconv_info)
+import heudiconv.convert # To write uncompressed NIfTI files (see uncompressed_outputs)
+
+import dicom_discover # To discover the series of the session (dicom_discover.py, in the same folder as this script)
+import dicom_duplicates # To count the series folders of the inputs (dicom_duplicates.py, in the same folder as this script)
+import task_metrics # To time the steps of the conversion (task_metrics.py, in the same folder as this script)
+import nifti_compress # To compress the NIfTI files of the session (nifti_compress.py, in the same folder as this script)
+
+# Heuristic passed to heudiconv for the shards
+WRAPPER_HEURISTIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'heuristic_wrapper.py')
+
+# Lock file used by heudiconv for the top-level BIDS files
+LOCKFILE = 'heudiconv.lock'
+
+# Fields of the conversion key templates that depend on the position of the series within its key
+ITEM_FIELDS = re.compile(r'\{(item|subindex|seqitem)(![rsa])?(:[^{}]*)?\}')
+
+logger = logging.getLogger('bids_conversion')
+
+# Heuristic modules already loaded in this process, by file: (modification time, module)
+_heuristics = {}
+
+# --------------------------------------------------------------------------------------
+# load_heuristic: Loads the project's heuristic file as a module. The module is kept for the next subjects
+# converted by the same process (e.g. a task or a worker, see conversion_queue.py), and loaded again if the file changed.
+# --------------------------------------------------------------------------------------
+def load_heuristic(heuristic_file):
+    mtime = os.stat(heuristic_file).st_mtime
+    if heuristic_file in _heuristics and _heuristics[heuristic_file][0] == mtime:
+        return _heuristics[heuristic_file][1]
+    spec = importlib.util.spec_from_file_location('project_heuristic', heuristic_file)
+    heuristic = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(heuristic)
+    _heuristics[heuristic_file] = (mtime, heuristic)
+    return heuristic
+
+# --------------------------------------------------------------------------------------
+# bids_label: A subject (or session) ID as heudiconv writes it in the BIDS names, with only its letters and digits
+# (e.g. 13_TRIO_1 is converted into sub-13TRIO1).
+# --------------------------------------------------------------------------------------
+def bids_label(label):
+    return ''.join(c for c in str(label) if c.isalnum())
+
+# --------------------------------------------------------------------------------------
+# session_folder: The BIDS folder of a subject (and session), relative to the BIDS root.
+# --------------------------------------------------------------------------------------
+def session_folder(subject_id, session_id=None):
+    if session_id:
+        return os.path.join(f"sub-{bids_label(subject_id)}", f"ses-{bids_label(session_id)}")
+    return f"sub-{bids_label(subject_id)}"
+
+# --------------------------------------------------------------------------------------
+# bake_template: Fills in the {item}, {subindex} and {seqitem} fields of a conversion key template,
+# leaving the other fields (e.g. {subject}, {session}) for heudiconv.
+# --------------------------------------------------------------------------------------
+def bake_template(template, item, subindex, seqitem):
+    values = {'item': item, 'subindex': subindex, 'seqitem': seqitem}
+
+    def fill(match):
+        field = '{0' + (match.group(2) or '') + (match.group(3) or '') + '}'
+        return field.format(values[match.group(1)]).replace('{', '{{').replace('}', '}}')
+
+    return ITEM_FIELDS.sub(fill, template)
+
+# --------------------------------------------------------------------------------------
+# plan_units: Runs the heuristic's infotodict on the seqinfo of the whole session and returns one
+# conversion unit per series, with its conversion key (template with the run number filled in).
+# --------------------------------------------------------------------------------------
+def plan_units(heuristic, seqinfos):
+    units = []
+    for key, items in heuristic.infotodict(seqinfos).items():
+        if not items:
+            continue
+        template, outtype = key[0], key[1]
+        annotation_classes = key[2] if len(key) > 2 else None
+        outtype = [outtype] if isinstance(outtype, str) else list(outtype)
+        for idx, itemgroup in enumerate(items):
+            if not isinstance(itemgroup, list):
+                itemgroup = [itemgroup]
+            for subindex, item in enumerate(itemgroup):
+                series_id = item['item'] if isinstance(item, dict) else item
+                units.append({
+                    'template': bake_template(template, idx + 1, subindex + 1, series_id),
+                    'outtype': outtype,
+                    'annotation_classes': annotation_classes,
+                    'item': item,
+                    'series_id': series_id,
+                })
+    return units
+
+# --------------------------------------------------------------------------------------
+# unit_group: The units that have to be converted in the same shard. heudiconv only copies the echo times of the
+# magnitude files into the phasediff sidecar if they are converted together, so the fieldmaps with the same name
+# up to their suffix (e.g. sub-{subject}_acq-func for _magnitude and _phasediff) go together. Every other unit
+# is a group of its own.
+# --------------------------------------------------------------------------------------
+def unit_group(index, unit):
+    if os.path.basename(os.path.dirname(unit['template'])) == 'fmap':
+        return unit['template'].rsplit('_', 1)[0]
+    return index
+
+# --------------------------------------------------------------------------------------
+# split_shards: Splits the conversion units into (at most) n_shards shards of similar size,
+# assigning the largest groups of units (see unit_group) first, each to the shard with the fewest DICOM files so far.
+# --------------------------------------------------------------------------------------
+def split_shards(units, series_files, n_shards):
+    groups = {}
+    for index, unit in enumerate(units):
+        groups.setdefault(unit_group(index, unit), []).append(unit)
+    shards = [[] for _ in range(max(1, n_shards))]
+    sizes = [0] * len(shards)
+    for group in sorted(groups.values(), key=lambda g: -sum(series_files.get(u['series_id'], 0) for u in g)):
+        smallest = sizes.index(min(sizes))
+        shards[smallest].extend(group)
+        sizes[smallest] += sum(series_files.get(u['series_id'], 0) for u in group)
+    return [shard for shard in shards if shard]
+
+# --------------------------------------------------------------------------------------
+# uncompressed_outputs: While the block runs, heudiconv (in this process) has dcm2niix write uncompressed .nii files
+# for the series whose outtype is 'nii.gz', to be compressed afterwards (see nifti_compress.compress_session).
+# Yields the list that the output prefixes of those series (relative to outdir) are added to.
+# --------------------------------------------------------------------------------------
+@contextlib.contextmanager
+def uncompressed_outputs(outdir):
+    prefixes = []
+    original_convert = heudiconv.convert.convert
+    fd, dcmconfig = tempfile.mkstemp(prefix='dcm2niix_', suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'compress': 'n'}, f)
+
+    def convert(items, *args, **kwargs):
+        uncompressed = []
+        for prefix, outtypes, item_dicoms in items:
+            outtypes = (outtypes,) if isinstance(outtypes, str) else tuple(outtypes)
+            if 'nii.gz' in outtypes:
+                outtypes = tuple(dict.fromkeys('nii' if outtype == 'nii.gz' else outtype for outtype in outtypes))
+                prefixes.append(os.path.relpath(prefix, outdir))
+            uncompressed.append((prefix, outtypes, item_dicoms))
+        kwargs['dcmconfig'] = dcmconfig
+        return original_convert(uncompressed, *args, **kwargs)
+
+    heudiconv.convert.convert = convert
+    try:
+        yield prefixes
+    finally:
+        heudiconv.convert.convert = original_convert
+        os.remove(dcmconfig)
+
+# --------------------------------------------------------------------------------------
+# run_heudiconv: Runs heudiconv (with dcm2niix) on a list of DICOM files or series folders.
+# With intended_for=False, the heuristic is run through heuristic_wrapper.py, without its POPULATE_INTENDED_FOR_OPTS,
+# so that heudiconv does not populate the IntendedFor fields (they are left to the IntendedFor stage, see intended_for.py).
+# --------------------------------------------------------------------------------------
+def run_heudiconv(files, subject_id, session_id, heuristic_file, outdir, bids_options=None, overwrite=True, intended_for=True):
+    if not intended_for:
+        fd, plan_file = tempfile.mkstemp(prefix='plan_', suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'heuristic_file': os.path.abspath(heuristic_file), 'units': None}, f)
+        try:
+            with wrapped_plan(plan_file):
+                run_heudiconv(files, subject_id, session_id, WRAPPER_HEURISTIC, outdir, bids_options, overwrite)
+        finally:
+            os.remove(plan_file)
+        return
+    workflow(
+        files=list(files),
+        subjs=[subject_id],
+        session=session_id,
+        heuristic=heuristic_file,
+        outdir=outdir,
+        converter='dcm2niix',
+        bids_options=[] if bids_options is None else bids_options,
+        overwrite=overwrite,
+    )
+
+# --------------------------------------------------------------------------------------
+# wrapped_plan: While the block runs, heuristic_wrapper.py reads the conversion plan in plan_file.
+# --------------------------------------------------------------------------------------
+@contextlib.contextmanager
+def wrapped_plan(plan_file):
+    previous = os.environ.get('BIDS_CONVERSION_PLAN')
+    os.environ['BIDS_CONVERSION_PLAN'] = plan_file
+    # heudiconv imports the heuristic by its module name: make sure this plan is read
+    sys.modules.pop(os.path.splitext(os.path.basename(WRAPPER_HEURISTIC))[0], None)
+    try:
+        yield
+    finally:
+        sys.modules.pop(os.path.splitext(os.path.basename(WRAPPER_HEURISTIC))[0], None)
+        if previous is None:
+            del os.environ['BIDS_CONVERSION_PLAN']
+        else:
+            os.environ['BIDS_CONVERSION_PLAN'] = previous
+
+# --------------------------------------------------------------------------------------
+# convert_shard: Converts one shard into its own folder (run in a separate process).
+# The top-level BIDS files are not written ('notop'), they are written once when merging.
+# Returns the folder and, if compress is False, the prefixes of the uncompressed NIfTI files (see uncompressed_outputs).
+# --------------------------------------------------------------------------------------
+def convert_shard(plan_file, inputs, subject_id, session_id, shard_outdir, compress=True):
+    with wrapped_plan(plan_file):
+        if compress:
+            run_heudiconv(inputs, subject_id, session_id, WRAPPER_HEURISTIC, shard_outdir, bids_options=['notop'])
+            return shard_outdir, None
+        with uncompressed_outputs(shard_outdir) as prefixes:
+            run_heudiconv(inputs, subject_id, session_id, WRAPPER_HEURISTIC, shard_outdir, bids_options=['notop'])
+    return shard_outdir, prefixes
+
+# --------------------------------------------------------------------------------------
+# merge_scans: Merges scans.tsv files into target (rows of the later files replace the rows of the same
+# file in the earlier ones), sorted by acquisition time as heudiconv does.
+# --------------------------------------------------------------------------------------
+def merge_scans(scans_files, target):
+    header = None
+    rows = {}
+    for scans_file in [target] + list(scans_files):
+        if not os.path.isfile(scans_file):
+            continue
+        with open(scans_file) as f:
+            reader = csv.reader(f, delimiter='\t')
+            file_header = next(reader, None)
+            header = header or file_header
+            for row in reader:
+                if row:
+                    rows[row[0]] = row
+    if header is None:
+        return
+    tmp_target = f"{target}.{os.getpid()}.tmp"
+    with open(tmp_target, 'w') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(header)
+        writer.writerows(sorted(rows.values(), key=lambda row: (row[1:2], row[0])))
+    os.replace(tmp_target, target)
+
+# --------------------------------------------------------------------------------------
+# merge_shard: Moves the files converted by one shard into the BIDS folder of the session and
+# returns its scans.tsv files (merged afterwards by merge_scans).
+# --------------------------------------------------------------------------------------
+def merge_shard(shard_outdir, outdir, session_rel):
+    scans_files = []
+    shard_session = os.path.join(shard_outdir, session_rel)
+    for folder, _, files in os.walk(shard_session):
+        target_folder = os.path.join(outdir, session_rel, os.path.relpath(folder, shard_session))
+        for name in files:
+            if name.endswith('_scans.tsv'):
+                scans_files.append(os.path.join(folder, name))
+                continue
+            os.makedirs(target_folder, exist_ok=True)
+            os.replace(os.path.join(folder, name), os.path.join(target_folder, name))
+    return scans_files
+
+# --------------------------------------------------------------------------------------
+# merge_heudiconv_info: Merges the .heudiconv info folders of the shards into outdir, as the heudiconv of the whole
+# session would have written them: dicominfo.tsv lists all the series of the session (seqinfos, including the ones no
+# shard converted), the filegroup.json files of the shards are merged (the DICOM files of each converted series),
+# heuristic.py is a copy of the project's heuristic (the shards ran heuristic_wrapper.py) and the conversion tables
+# (*.auto.txt, *.edit.txt) are those of the whole session. The other files are taken from the first shard.
+# --------------------------------------------------------------------------------------
+def merge_heudiconv_info(shard_outdirs, outdir, heuristic_file, heuristic, seqinfos):
+    info_files = {}
+    for shard_outdir in shard_outdirs:
+        for folder, _, files in os.walk(os.path.join(shard_outdir, '.heudiconv')):
+            for name in files:
+                info_files.setdefault(os.path.relpath(os.path.join(folder, name), shard_outdir), []).append(os.path.join(folder, name))
+    for rel_path, paths in info_files.items():
+        target = os.path.join(outdir, rel_path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        name = os.path.basename(rel_path)
+        if name.startswith('dicominfo') and name.endswith('.tsv'):
+            with open(target, 'w') as f:
+                f.write('\t'.join(SeqInfo._fields) + '\n')
+                for s in seqinfos:
+                    f.write('\t'.join(str(getattr(s, field, None)) for field in SeqInfo._fields) + '\n')
+        elif name.startswith('filegroup') and name.endswith('.json'):
+            filegroup = {}
+            for path in paths:
+                with open(path) as f:
+                    filegroup.update(json.load(f))
+            save_json(target, filegroup)
+        elif name == 'heuristic.py':
+            shutil.copyfile(heuristic_file, target)
+        elif name.endswith('.auto.txt') or name.endswith('.edit.txt'):
+            write_config(target, heuristic.infotodict(seqinfos))
+        else:
+            shutil.copyfile(paths[0], target)
+
+# --------------------------------------------------------------------------------------
+# finalise_session: Writes what heudiconv would write once per session: the participants.tsv record,
+# the top-level BIDS files and (unless intended_for is False) the IntendedFor fields of the fieldmaps.
+# --------------------------------------------------------------------------------------
+def finalise_session(outdir, subject_id, session_id, heuristic, seqinfos, intended_for=True):
+    with filelock.SoftFileLock(os.path.join(outdir, LOCKFILE)):
+        if seqinfos:
+            add_participant_record(outdir, subject_id, seqinfos[0].patient_age, seqinfos[0].patient_sex)
+        populate_bids_templates(outdir, getattr(heuristic, 'DEFAULT_FIELDS', {}))
+
+    intended_for_opts = getattr(heuristic, 'POPULATE_INTENDED_FOR_OPTS', None)
+    if intended_for and intended_for_opts is not None:
+        populate_intended_for(os.path.join(outdir, session_folder(subject_id, session_id)), **intended_for_opts)
+
+# --------------------------------------------------------------------------------------
+# convert_session: Converts one subject (and session) in n_shards parallel shards (see the top of this file).
+# The series folders are read from the DICOM inventory (or found by walking dicom_path) unless series_folders is given
+# (series folders, or the inputs left by dicom_duplicates.drop_duplicates: series folders and files).
+# With compression ({'level', 'threads'}), the NIfTI files are compressed after the merge (see nifti_compress.py).
+# With intended_for=False, the IntendedFor fields are left to the IntendedFor stage (see intended_for.py).
+# --------------------------------------------------------------------------------------
+def convert_session(dicom_path, subject_id, session_id, heuristic_file, outdir, n_shards, inventory_path=None, series_folders=None,
+                    compression=None, intended_for=True):
+    heuristic_file = os.path.abspath(heuristic_file)
+    outdir = os.path.abspath(outdir)
+    session_rel = session_folder(subject_id, session_id)
+
+    # 1) Plan
+    with task_metrics.phase('discovery'):
+        found = dicom_discover.discover_session(dicom_path, series_folders, inventory_path, with_folders=True)
+    seqinfos = [s for s, _ in found]
+    task_metrics.record(n_series_folders=len(dicom_duplicates.input_folders({path for _, inputs in found for path in inputs})))
+    heuristic = load_heuristic(heuristic_file)
+    units = plan_units(heuristic, seqinfos)
+    series_files = {s.series_id: s.series_files for s in seqinfos}
+    series_inputs = {}
+    for s, inputs in found:
+        series_inputs.setdefault(s.series_id, set()).update(inputs)
+    shards = split_shards(units, series_files, n_shards)
+    logger.info(f"{session_rel}: {len(seqinfos)} series, {len(units)} to convert in {len(shards)} shards")
+
+    work_dir = os.path.join(outdir, '.bids_conversion', 'shards', session_rel.replace(os.sep, '_'))
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+
+    tasks = []
+    for i, shard in enumerate(shards):
+        plan_file = os.path.join(work_dir, f"shard-{i}.json")
+        with open(plan_file, 'w') as f:
+            json.dump({'heuristic_file': heuristic_file, 'units': shard}, f, indent=2)
+        inputs = sorted(set.union(*(series_inputs[unit['series_id']] for unit in shard)))
+        tasks.append((plan_file, inputs, subject_id, session_id, os.path.join(work_dir, f"shard-{i}"), compression is None))
+
+    # 2) Convert
+    with task_metrics.phase('shards'), ProcessPoolExecutor(max_workers=len(tasks) or 1) as pool:
+        futures = [pool.submit(convert_shard, *task) for task in tasks]
+        results = [future.result() for future in futures]
+
+    # 3) Merge
+    with task_metrics.phase('bids'):
+        scans_files = []
+        for shard_outdir, _ in results:
+            scans_files.extend(merge_shard(shard_outdir, outdir, session_rel))
+        subject_ses = session_rel.replace(os.sep, '_')
+        merge_scans(scans_files, os.path.join(outdir, session_rel, f"{subject_ses}_scans.tsv"))
+        merge_heudiconv_info([shard_outdir for shard_outdir, _ in results], outdir, heuristic_file, heuristic, seqinfos)
+    if compression is not None:
+        with task_metrics.phase('compress'):
+            nifti_compress.compress_session(outdir, session_rel, compression['level'], compression['threads'],
+                                            [prefix for _, prefixes in results for prefix in prefixes])
+    with task_metrics.phase('bids'):
+        finalise_session(outdir, subject_id, session_id, heuristic, seqinfos, intended_for)
+
+    shutil.rmtree(work_dir)
+    try:
+        os.rmdir(os.path.dirname(work_dir))
+    except OSError:
+        pass # other sessions are being converted
+    logger.info(f"{session_rel}: converted into {outdir}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert one subject (and session) from DICOM to BIDS in parallel shards.")
+    parser.add_argument('dicom_path', help="path to the DICOM files of the subject (and session)")
+    parser.add_argument('--subject', required=True, help="subject ID")
+    parser.add_argument('--session', help="session ID")
+    parser.add_argument('--heuristic', required=True, help="heudiconv heuristic file")
+    parser.add_argument('--output', required=True, help="BIDS output folder")
+    parser.add_argument('--shards', type=int, default=os.cpu_count() or 1, help="number of shards converted in parallel (default: %(default)s)")
+    parser.add_argument('--inventory', help="DICOM inventory written by the launchers (see dicom_inventory.py)")
+    parser.add_argument('--compression-threads', type=int, help="compress the NIfTI files after the conversion with this many threads (see nifti_compress.py)")
+    parser.add_argument('--compression-level', type=int, default=nifti_compress.DEFAULT_LEVEL, choices=range(1, 10), help="gzip level (default: %(default)s)")
+    args = parser.parse_args()
+    compression = {'level': args.compression_level, 'threads': args.compression_threads} if args.compression_threads else None
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    try:
+        convert_session(args.dicom_path, args.subject, args.session, args.heuristic, args.output, args.shards, args.inventory,
+                        compression=compression)
+    except Exception:
+        logger.exception(f"Conversion of {session_folder(args.subject, args.session)} failed")
+        sys.exit(1)
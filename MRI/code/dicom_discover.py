@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# This script is used to discover the DICOM series of many subjects (and sessions) at once,
+# without running a full heudiconv pass on each of them.
+#
+# Instead of reading every DICOM file, only the headers that are needed are read (stopping before the
+# pixel data): for each series folder, the first and the last file. If both belong to the same series
+# and their instance numbers span the files of the folder, the folder is taken as one series and its number
+# of files gives the remaining dimension (dim3 for 2D series such as the MPRAGE, dim4 for mosaic series such
+# as the BOLD runs). The other folders (several or interleaved series, several echoes such as the fieldmap
+# magnitude) are read file by file (see folder_seqinfos).
+#
+# The subjects are processed in parallel with a process pool, and the result is written as one
+# cohort-wide table with the same columns as heudiconv's dicominfo.tsv (protocol_name, dim3, dim4,
+# series_id, ...), preceded by the subject and session IDs.
+#
+# Usage:
+#   python dicom_discover.py [--output <table.tsv>] [--processes <n>] [--inventory <inventory_path>]
+#                            <subject_id>[:<session_id>]=<dicom_path> [...]
+#
+# It is assumed that you run this in the 'heudiconv' conda environment (which provides pydicom and nibabel).
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To list the DICOM folders
+import sys # To write errors
+import ast # To read the image_type column back
+import json # To hash the fingerprint of the cached sessions
+import hashlib # To name the cached sessions
+import argparse # To parse the command line arguments
+import warnings # To silence nibabel's warning about its DICOM readers
+from collections import namedtuple # For the seqinfo records
+from concurrent.futures import ProcessPoolExecutor # To discover the subjects in parallel
+
+import pydicom # To read the DICOM headers
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', UserWarning)
+    from nibabel.nicom import dicomwrappers # To get the image shape (including Siemens mosaics) from the headers
+
+import dicom_inventory # To reuse the series folders found by the launchers (dicom_inventory.py, in the same folder as this script)
+import dicom_duplicates # To leave out the duplicated DICOM files (dicom_duplicates.py, in the same folder as this script)
+
+# --------------------------------------------------------------------------------------
+# SeqInfo: one entry per DICOM series, with the same fields (and order) as heudiconv's seqinfo,
+# so that the heuristics' infotodict can be run on it.
+# --------------------------------------------------------------------------------------
+SeqInfo = namedtuple('SeqInfo', [
+    'total_files_till_now', 'example_dcm_file', 'series_id', 'dcm_dir_name', 'series_files',
+    'unspecified', 'dim1', 'dim2', 'dim3', 'dim4', 'TR', 'TE', 'protocol_name',
+    'is_motion_corrected', 'is_derived', 'patient_id', 'study_description',
+    'referring_physician_name', 'series_description', 'sequence_name', 'image_type',
+    'accession_number', 'patient_age', 'patient_sex', 'date', 'series_uid', 'time',
+])
+
+# Columns of the cohort table
+TABLE_COLUMNS = ('subject', 'session') + SeqInfo._fields
+
+# Types of the numeric and boolean seqinfo fields, to read the cohort table back
+INT_FIELDS = ('total_files_till_now', 'series_files', 'dim1', 'dim2', 'dim3', 'dim4')
+FLOAT_FIELDS = ('TR', 'TE')
+BOOL_FIELDS = ('is_motion_corrected', 'is_derived')
+OPTIONAL_FIELDS = ('patient_id', 'study_description', 'accession_number', 'patient_age', 'patient_sex',
+                   'date', 'series_uid', 'time')
+
+# SOP classes that heudiconv ignores
+IGNORED_SOP_CLASSES = ('Raw Data Storage', 'Grayscale Softcopy Presentation State Storage')
+
+# Default number of processes used to discover the subjects
+DEFAULT_PROCESSES = os.cpu_count() or 1
+
+# --------------------------------------------------------------------------------------
+# read_header: Reads the header of a DICOM file (stopping before the pixel data) and wraps it
+# with nibabel, which knows how to get the image shape of Siemens mosaics.
+# Returns None if the file is not a DICOM image that heudiconv would convert.
+# --------------------------------------------------------------------------------------
+def read_header(dicom_file):
+    try:
+        dcm = pydicom.dcmread(dicom_file, stop_before_pixels=True, force=True)
+        mw = dicomwrappers.wrapper_from_data(dcm)
+        if 'SeriesNumber' not in dcm:
+            return None
+    except Exception as e:
+        sys.stderr.write(f"Ignoring {dicom_file}: {e}\n")
+        return None
+    sop_class = dcm.get('SOPClassUID')
+    if sop_class is not None and getattr(sop_class, 'name', '') in IGNORED_SOP_CLASSES:
+        return None
+    if mw.image_shape is None:
+        return None
+    return mw
+
+# --------------------------------------------------------------------------------------
+# text: Converts an optional DICOM value to a plain string (or None), so the seqinfo entries
+# do not hold pydicom objects.
+# --------------------------------------------------------------------------------------
+def text(value):
+    return None if value is None else str(value)
+
+# --------------------------------------------------------------------------------------
+# series_key: The (series number, protocol name) pair that heudiconv uses to sort and name the series.
+# --------------------------------------------------------------------------------------
+def series_key(mw):
+    return int(mw.dcm_data.SeriesNumber), str(mw.dcm_data.get('ProtocolName', ''))
+
+# --------------------------------------------------------------------------------------
+# create_seqinfo: Creates the seqinfo entry of a series from the header of one of its files
+# and its list of files, as heudiconv does.
+# --------------------------------------------------------------------------------------
+def create_seqinfo(mw, series_files):
+    dcm = mw.dcm_data
+    size = list(mw.image_shape) + [len(series_files)]
+    if len(size) < 4:
+        size.append(1)
+    image_type = tuple(str(x) for x in dcm.get('ImageType', ()))
+    series_number, protocol_name = series_key(mw)
+    sequence_name = ''
+    for tag in ((0x18, 0x24), (0x19, 0x109C), (0x18, 0x9005)):
+        if tag in dcm and dcm[tag].value:
+            sequence_name = str(dcm[tag].value)
+            break
+    date, time = dcm.get('AcquisitionDate'), dcm.get('AcquisitionTime')
+    if not (date and time):
+        date, time = dcm.get('SeriesDate'), dcm.get('SeriesTime')
+    return SeqInfo(
+        total_files_till_now=0, # filled in by discover_session
+        example_dcm_file=os.path.basename(series_files[0]),
+        series_id=f"{series_number}-{protocol_name}",
+        dcm_dir_name=os.path.basename(os.path.dirname(series_files[0])),
+        series_files=len(series_files),
+        unspecified='',
+        dim1=size[0],
+        dim2=size[1],
+        dim3=size[2],
+        dim4=size[3],
+        TR=float(dcm.get('RepetitionTime', -1000)) / 1000,
+        TE=float(dcm.get('EchoTime', -1)),
+        protocol_name=protocol_name,
+        is_motion_corrected='MOCO' in image_type,
+        is_derived='derived' in [x.lower() for x in image_type],
+        patient_id=text(dcm.get('PatientID')),
+        study_description=text(dcm.get('StudyDescription')),
+        referring_physician_name=str(dcm.get('ReferringPhysicianName', '')),
+        series_description=str(dcm.get('SeriesDescription', '')),
+        sequence_name=sequence_name,
+        image_type=image_type,
+        accession_number=text(dcm.get('AccessionNumber')),
+        patient_age=text(dcm.get('PatientAge')),
+        patient_sex=text(dcm.get('PatientSex')),
+        date=str(date) if date else None,
+        series_uid=text(dcm.get('SeriesInstanceUID')),
+        time=str(time) if time else None,
+    )
+
+# --------------------------------------------------------------------------------------
+# instance_number: The InstanceNumber of a file (None if it has none).
+# --------------------------------------------------------------------------------------
+def instance_number(mw):
+    try:
+        return int(mw.dcm_data.InstanceNumber)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+# --------------------------------------------------------------------------------------
+# folder_series: Returns the series found in one folder (or in the given files of the folder), as a list of
+# (series_key, header, files) sorted by series key, the header being the one the series is described by.
+#
+# If the first and the last file are in the same series as heudiconv sees it (nibabel's series signature: same
+# SeriesInstanceUID, echo, image type, shape, ...) and their instance numbers span exactly the number of files
+# in the folder, the whole folder is taken as that series (only two headers are read). Otherwise (several series,
+# interleaved series, several echoes, missing instance numbers or unreadable files) every header of the folder is
+# read and the files are grouped as heudiconv does.
+# --------------------------------------------------------------------------------------
+def folder_series(folder, dicom_files=None):
+    if dicom_files is None:
+        dicom_files = dicom_duplicates.folder_files(folder)
+    else:
+        dicom_files = sorted(dicom_files)
+    if not dicom_files:
+        return []
+
+    first = read_header(dicom_files[0])
+    last = read_header(dicom_files[-1]) if len(dicom_files) > 1 else first
+    if first is not None and last is not None and series_key(first) == series_key(last) and first.is_same_series(last):
+        first_number, last_number = instance_number(first), instance_number(last)
+        if len(dicom_files) == 1 or (first_number is not None and last_number is not None
+                                     and last_number - first_number + 1 == len(dicom_files)):
+            return [(series_key(first), first, dicom_files)]
+
+    # Read the folder file by file. As in heudiconv, the files of a series (series number and protocol name) may have
+    # several signatures (e.g. one per echo), and the series is described by the first file of its last signature.
+    signatures = []
+    representatives = {}
+    series_files = {}
+    for dicom_file in dicom_files:
+        mw = read_header(dicom_file)
+        if mw is None:
+            continue
+        key = series_key(mw)
+        new_signature = not any(mw.is_same_series(other) for other in signatures)
+        if new_signature:
+            signatures.append(mw)
+        if new_signature or key not in representatives:
+            representatives[key] = mw
+        series_files.setdefault(key, []).append(dicom_file)
+    return [(key, representatives[key], files) for key, files in sorted(series_files.items())]
+
+# --------------------------------------------------------------------------------------
+# folder_seqinfos: Returns the seqinfo entries of the series found in one folder (see folder_series).
+# --------------------------------------------------------------------------------------
+def folder_seqinfos(folder, dicom_files=None):
+    return [create_seqinfo(mw, files) for _, mw, files in folder_series(folder, dicom_files)]
+
+# --------------------------------------------------------------------------------------
+# discover_session: Returns the seqinfo entries of one subject (and session), sorted by series
+# number as heudiconv does.
+#
+# series_folders is the list of series folders of the subject, or the inputs of its conversion (series folders and
+# files, see dicom_duplicates.drop_duplicates). If not given, they are read from the DICOM inventory (if
+# inventory_path is given and knows the subject), or found by walking dicom_path.
+# A series found in several folders (e.g. the files of a series sent twice that are not exact duplicates) is one
+# series, as heudiconv groups the files of all the folders.
+# With with_folders=True, a list of (seqinfo, inputs) pairs is returned instead, inputs being the series folders of
+# the seqinfo (or the files of the folders that were given), as a tuple.
+# --------------------------------------------------------------------------------------
+def discover_session(dicom_path, series_folders=None, inventory_path=None, with_folders=False):
+    if not series_folders:
+        series_folders = dicom_inventory.series_folders(inventory_path, dicom_path)
+
+    series = {}
+    for folder, files in dicom_duplicates.input_folders(series_folders):
+        inputs = (folder,) if files is None else tuple(files)
+        for key, mw, dicom_files in folder_series(folder, files):
+            if key in series:
+                series[key][1].extend(dicom_files)
+                series[key][2].extend(inputs)
+            else:
+                series[key] = (mw, list(dicom_files), list(inputs))
+    found = [(create_seqinfo(mw, dicom_files), tuple(inputs)) for _, (mw, dicom_files, inputs) in sorted(series.items())]
+
+    total_files = 0
+    for i, (s, inputs) in enumerate(found):
+        total_files += s.series_files
+        found[i] = (s._replace(total_files_till_now=total_files), inputs)
+    if with_folders:
+        return found
+    return [s for s, _ in found]
+
+# --------------------------------------------------------------------------------------
+# _discover_session_task: discover_session for the process pool (returns the session too).
+# --------------------------------------------------------------------------------------
+def _discover_session_task(task):
+    subject_id, session_id, dicom_path, inventory_path = task
+    return subject_id, session_id, discover_session(dicom_path, inventory_path=inventory_path)
+
+# --------------------------------------------------------------------------------------
+# discover_cohort: Discovers many subjects (and sessions) in parallel.
+#
+# sessions is a list of (subject_id, session_id, dicom_path) tuples (session_id can be None).
+# Returns a list of (subject_id, session_id, seqinfos) tuples, in the same order.
+# --------------------------------------------------------------------------------------
+def discover_cohort(sessions, n_processes=DEFAULT_PROCESSES, inventory_path=None):
+    tasks = [(subject_id, session_id, dicom_path, inventory_path) for subject_id, session_id, dicom_path in sessions]
+    with ProcessPoolExecutor(max_workers=n_processes) as pool:
+        return list(pool.map(_discover_session_task, tasks))
+
+# --------------------------------------------------------------------------------------
+# write_cohort_table: Writes the seqinfo entries of all subjects into one tab-separated table.
+# --------------------------------------------------------------------------------------
+def write_cohort_table(table_file, results):
+    with open(table_file, 'w') as f:
+        f.write('\t'.join(TABLE_COLUMNS) + '\n')
+        for subject_id, session_id, seqinfos in results:
+            for s in seqinfos:
+                values = [subject_id, session_id or ''] + ['' if v is None else str(v) for v in s]
+                f.write('\t'.join(values) + '\n')
+
+# --------------------------------------------------------------------------------------
+# read_cohort_table: Reads a table written by write_cohort_table back.
+# Returns a dictionary mapping (subject_id, session_id) to the list of seqinfo entries.
+# --------------------------------------------------------------------------------------
+def read_cohort_table(table_file):
+    sessions = {}
+    with open(table_file) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        for line in f:
+            row = dict(zip(header, line.rstrip('\n').split('\t')))
+            fields = {}
+            for name in SeqInfo._fields:
+                value = row.get(name, '')
+                if name in INT_FIELDS:
+                    value = int(value)
+                elif name in FLOAT_FIELDS:
+                    value = float(value)
+                elif name in BOOL_FIELDS:
+                    value = value == 'True'
+                elif name == 'image_type':
+                    value = ast.literal_eval(value) if value else ()
+                elif value == '' and name in OPTIONAL_FIELDS:
+                    value = None
+                fields[name] = value
+            key = (row['subject'], row['session'] or None)
+            sessions.setdefault(key, []).append(SeqInfo(**fields))
+    return sessions
+
+# --------------------------------------------------------------------------------------
+# cached_session: discover_session for a subject (and session) whose DICOM inputs have the given fingerprint
+# (see conversion_manifest.session_fingerprint), with the duplicated DICOM files left out as in the conversion
+# (see dicom_duplicates.py). The result is kept in cache_path, in a table named after the fingerprint,
+# so that the headers are only read again once the DICOM inputs changed.
+# --------------------------------------------------------------------------------------
+def cached_session(cache_path, subject_id, session_id, dicom_path, fingerprint, inventory_path=None):
+    label = f"sub-{subject_id}" + (f"_ses-{session_id}" if session_id else '')
+    digest = hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:12]
+    table_file = os.path.join(cache_path, f"{label}_{digest}.tsv")
+    if os.path.isfile(table_file):
+        return read_cohort_table(table_file).get((subject_id, session_id), [])
+
+    series_folders = dicom_inventory.series_folders(inventory_path, dicom_path)
+    inputs, _ = dicom_duplicates.drop_duplicates(series_folders, inventory_path, dicom_path)
+    seqinfos = discover_session(dicom_path, inputs)
+    os.makedirs(cache_path, exist_ok=True)
+    # The tables of earlier inputs of the session are replaced
+    for name in os.listdir(cache_path):
+        if name.startswith(f"{label}_") and len(name) == len(os.path.basename(table_file)):
+            os.remove(os.path.join(cache_path, name))
+    tmp_file = f"{table_file}.{os.getpid()}.tmp"
+    write_cohort_table(tmp_file, [(subject_id, session_id, seqinfos)])
+    os.replace(tmp_file, table_file)
+    return seqinfos
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Header-only discovery of the DICOM series of many subjects.")
+    parser.add_argument('sessions', nargs='+', metavar='SUBJECT[:SESSION]=DICOM_PATH',
+                        help="subject ID (and session ID) and the path to its DICOM files")
+    parser.add_argument('--output', default='dicominfo_cohort.tsv', help="cohort table to write (default: %(default)s)")
+    parser.add_argument('--processes', type=int, default=DEFAULT_PROCESSES, help="number of processes (default: %(default)s)")
+    parser.add_argument('--inventory', help="DICOM inventory written by the launchers (see dicom_inventory.py)")
+    args = parser.parse_args()
+
+    sessions = []
+    for spec in args.sessions:
+        ids, _, dicom_path = spec.partition('=')
+        subject_id, _, session_id = ids.partition(':')
+        if not dicom_path or not os.path.isdir(dicom_path):
+            sys.stderr.write(f"Dicom path not found: {dicom_path}. Exiting...\n")
+            sys.exit(1)
+        sessions.append((subject_id, session_id or None, dicom_path))
+
+    results = discover_cohort(sessions, args.processes, args.inventory)
+    write_cohort_table(args.output, results)
+    for subject_id, session_id, seqinfos in results:
+        print(f"Subject {subject_id}" + (f" session {session_id}" if session_id else '') + f": {len(seqinfos)} series")
+    print(f"Cohort table written to {args.output}")
@@ -1,11 +1,15 @@
 #!/bin/bash
 
 # ============================================================
-# This script is used to discover DICOM files using HeuDiConv.
+# This script is used to discover the DICOM series of one or more subjects.
 #
 # Usage: ./dicom_discover.sh
-# 
-# It is assumed that you have a conda environment called 'heudiconv' available (check with 'conda env list'). 
+#
+# It runs dicom_discover.py, which only reads the DICOM headers it needs (one or two files per series
+# folder) instead of running a full heudiconv pass, and writes the series of all the subjects
+# (protocol_name, dim3, dim4, series_id, ...) into one table: ${OUTPUT_PATH}/dicominfo_cohort.tsv
+#
+# It is assumed that you have a conda environment called 'heudiconv' available (check with 'conda env list').
 # If not, create a conda environment with the heudiconv and dcm2niix packages installed.
 #
 # ============================================================
@@ -14,14 +18,19 @@
 PROJECT_PATH='/imaging/projects/cbu/CamCAN_harmonisation/'
 #add bin to path directory
 
-# Path to the raw DICOM files
-DICOM_PATH='/mridata/cbu/CBU140905_CAMCAN_CALIBRATIONS'
+# Location of the discovery script (dicom_discover.py)
+CODE_PATH="${PROJECT_PATH}/AllCode/BIDS_conversion/MRI/code"
 
 # Location of the output data (it will be created if it doesn't exist)
 OUTPUT_PATH="${PROJECT_PATH}/imaging/TravelingHeads_BIDS"
 
-# Subject ID
-SUBJECT_ID='13'
+# Subject IDs and the paths to their raw DICOM files (same order in both lists).
+# To discover a session, use "<subject_id>:<session_id>" as the subject ID.
+SUBJECT_IDS=('13')
+DICOM_PATHS=('/mridata/cbu/CBU140905_CAMCAN_CALIBRATIONS')
+
+# Number of subjects discovered in parallel
+N_PROCESSES=4
 
 # ------------------------------------------------------------
 # Activate the heudiconv environment
@@ -29,16 +38,19 @@ SUBJECT_ID='13'
 conda activate heudiconv
 
 # ------------------------------------------------------------
-# Run the heudiconv
+# Run the discovery
 # ------------------------------------------------------------
-heudiconv \
-    --files "${DICOM_PATH}"/*/*/*.dcm \
-    --outdir "${OUTPUT_PATH}" \
-    --heuristic convertall \
-    --subjects "${SUBJECT_ID}" \
-    --converter none \
-    --bids \
-    --overwrite
+mkdir -p "${OUTPUT_PATH}"
+
+SESSIONS=()
+for i in "${!SUBJECT_IDS[@]}"; do
+    SESSIONS+=("${SUBJECT_IDS[$i]}=${DICOM_PATHS[$i]}")
+done
+
+python "${CODE_PATH}/dicom_discover.py" \
+    --output "${OUTPUT_PATH}/dicominfo_cohort.tsv" \
+    --processes "${N_PROCESSES}" \
+    "${SESSIONS[@]}"
 # ------------------------------------------------------------
 
 # Deactivate the heudiconv environment
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Finds the DICOM files that were sent twice to the DICOM store, so that they are only converted once.
+#
+# Re-exports and re-sends from the scanner leave a second copy of a series (or of some of its files) in another series
+# folder of the subject, or next to the original files in the same folder. heudiconv then converts it twice (e.g. as
+# run-01 and run-02), collides on the file names, or stacks the same image twice. Before a subject is converted
+# (see run_task.py), its series folders are checked:
+#   - the folders are grouped by SeriesInstanceUID, as recorded in the DICOM inventory (see dicom_inventory.py).
+#     The other folders are only suspected of holding duplicates if the instance numbers of their first and last
+#     file do not span their number of files. A subject without duplicates costs two header reads per series folder.
+#   - the folders sharing a SeriesInstanceUID with another folder, and the suspected folders, are read: the
+#     SOPInstanceUID of each file (header only). In each group of folders, the folder with the most files comes first,
+#     and a file is an exact duplicate if a file before it has the same SOPInstanceUID and the same bytes.
+#   - the exact duplicates are left out of the inputs given to heudiconv (which accepts both folders and files): a
+#     folder without duplicates is given as a folder, a folder with only duplicates is dropped, and a folder with some
+#     duplicates is replaced by its other files. Files sharing a SOPInstanceUID but not their bytes are kept (and
+#     reported): leaving them out would lose images.
+# The duplicates found are logged and recorded in the metrics of the subject (see task_metrics.py).
+#
+# Usage (to check subjects before converting them):
+#   python dicom_duplicates.py <inventory_path> <dicom_path> [<dicom_path> ...]
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To list the series folders
+import sys # To read the command line arguments
+import filecmp # To compare the duplicated files
+import logging # To report the duplicates
+from concurrent.futures import ThreadPoolExecutor # To read the headers in parallel
+
+import dicom_inventory # To group the series folders by SeriesInstanceUID (dicom_inventory.py, in the same folder as this script)
+
+# pydicom is only needed to read the SOPInstanceUID of the duplicated series (as in dicom_inventory.py)
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+logger = logging.getLogger('bids_conversion')
+
+# Number of threads reading the headers (bound by the latency of the file system)
+DEFAULT_THREADS = 8
+
+# --------------------------------------------------------------------------------------
+# read_sop_uid: Returns the SOPInstanceUID of a DICOM file, reading only its header (None if it cannot be read).
+# --------------------------------------------------------------------------------------
+def read_sop_uid(dicom_file):
+    try:
+        dcm = pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=['SOPInstanceUID'])
+    except Exception:
+        return None
+    return str(dcm.get('SOPInstanceUID', '')) or None
+
+# --------------------------------------------------------------------------------------
+# folder_files: The DICOM files of a series folder, sorted.
+# --------------------------------------------------------------------------------------
+def folder_files(folder):
+    return sorted(entry.path for entry in os.scandir(folder)
+                  if entry.name.endswith(dicom_inventory.DICOM_EXTENSION) and entry.is_file())
+
+# --------------------------------------------------------------------------------------
+# read_instance_number: Returns the InstanceNumber of a DICOM file, reading only its header (None if it cannot be read).
+# --------------------------------------------------------------------------------------
+def read_instance_number(dicom_file):
+    try:
+        dcm = pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=['InstanceNumber'])
+        return int(dcm.InstanceNumber)
+    except Exception:
+        return None
+
+# --------------------------------------------------------------------------------------
+# folder_summaries: The SeriesInstanceUID and number of files of each series folder, from the DICOM inventory (the
+# first file of the folders that are not in it is read). Returns a list of (folder, series_uid, n_files).
+# --------------------------------------------------------------------------------------
+def folder_summaries(series_folders, inventory_path=None, dicom_path=None):
+    known = {}
+    if inventory_path and dicom_path:
+        root = os.path.normpath(dicom_path)
+        known = {os.path.join(root, s['folder']): s for s in dicom_inventory.read_inventory(inventory_path, root)}
+    summaries = []
+    for folder in series_folders:
+        series = known.get(os.path.normpath(folder))
+        if series is not None and series['series_uid']:
+            summaries.append((folder, series['series_uid'], series['n_files']))
+        else:
+            files = folder_files(folder)
+            summaries.append((folder, dicom_inventory.read_series_uid(files[0]) if files else None, len(files)))
+    return summaries
+
+# --------------------------------------------------------------------------------------
+# series_groups: Groups series folders by SeriesInstanceUID (see folder_summaries). Returns the groups of more than
+# one folder, each sorted by decreasing number of files.
+# --------------------------------------------------------------------------------------
+def series_groups(summaries):
+    groups = {}
+    for folder, series_uid, n_files in summaries:
+        if series_uid:
+            groups.setdefault(series_uid, []).append((folder, n_files))
+    return [[folder for folder, _ in sorted(group, key=lambda item: (-item[1], item[0]))]
+            for group in groups.values() if len(group) > 1]
+
+# --------------------------------------------------------------------------------------
+# suspected_folder: Whether a series folder may hold duplicates of its own files: the instance numbers of its first
+# and last file do not span its number of files (or cannot be read).
+# --------------------------------------------------------------------------------------
+def suspected_folder(folder, pool):
+    files = folder_files(folder)
+    if len(files) < 2:
+        return False
+    first_number, last_number = pool.map(read_instance_number, [files[0], files[-1]])
+    return first_number is None or last_number is None or last_number - first_number + 1 != len(files)
+
+# --------------------------------------------------------------------------------------
+# check_group: Checks a group of folders (see the top of this file).
+# Returns a dictionary mapping the folders with duplicates to their files that are kept, and the report of the group:
+# a list of {'folder', 'status', 'n_files', 'n_duplicates', 'n_conflicts', 'duplicate_of'}, with status 'dropped'
+# (only exact duplicates), 'partial' (some exact duplicates) or 'conflict' (a SOPInstanceUID with other bytes).
+# --------------------------------------------------------------------------------------
+def check_group(folders, pool):
+    kept_files = {}
+    replaced = {}
+    report = []
+    for folder in folders:
+        files = folder_files(folder)
+        sop_uids = list(pool.map(read_sop_uid, files))
+        kept = []
+        conflicts = 0
+        duplicate_of = set()
+        for dicom_file, sop_uid in zip(files, sop_uids):
+            original = kept_files.get(sop_uid) if sop_uid is not None else None
+            if original is None:
+                if sop_uid is not None:
+                    kept_files[sop_uid] = dicom_file
+                kept.append(dicom_file)
+            elif filecmp.cmp(original, dicom_file, shallow=False):
+                duplicate_of.add(os.path.dirname(original))
+            else:
+                conflicts += 1
+                kept.append(dicom_file)
+        duplicates = len(files) - len(kept)
+        if duplicates:
+            replaced[folder] = kept
+        status = 'conflict' if conflicts else 'dropped' if files and not kept else 'partial' if duplicates else None
+        if status is not None:
+            report.append({'folder': folder, 'status': status, 'n_files': len(files), 'n_duplicates': duplicates,
+                           'n_conflicts': conflicts, 'duplicate_of': sorted(duplicate_of)})
+    return replaced, report
+
+# --------------------------------------------------------------------------------------
+# drop_duplicates: Returns the inputs of the conversion of a subject, without its exact duplicate files, and the report
+# of the duplicates found (see check_group). The inputs are the series folders, in order, except that a folder with
+# duplicates is replaced by its files that are kept (none if they are all duplicates).
+# The SeriesInstanceUID of the folders is read from the DICOM inventory when it knows dicom_path.
+# --------------------------------------------------------------------------------------
+def drop_duplicates(series_folders, inventory_path=None, dicom_path=None, n_threads=DEFAULT_THREADS):
+    if pydicom is None:
+        logger.warning("pydicom is not available to find the duplicated DICOM files: all the files are converted")
+        return list(series_folders), []
+
+    summaries = folder_summaries(series_folders, inventory_path, dicom_path)
+    groups = series_groups(summaries)
+    grouped = {folder for group in groups for folder in group}
+    replaced = {}
+    report = []
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        groups += [[folder] for folder, _, n_files in summaries
+                   if folder not in grouped and n_files > 1 and suspected_folder(folder, pool)]
+        for folders in groups:
+            group_replaced, group_report = check_group(folders, pool)
+            replaced.update(group_replaced)
+            report.extend(group_report)
+    for entry in report:
+        if entry['status'] == 'dropped':
+            logger.warning(f"Not converting {entry['folder']}: its {entry['n_files']} files are exact duplicates of "
+                           f"files in {', '.join(entry['duplicate_of'])}")
+        elif entry['status'] == 'partial':
+            logger.warning(f"{entry['folder']}: not converting {entry['n_duplicates']} of its {entry['n_files']} files, "
+                           f"exact duplicates of files in {', '.join(entry['duplicate_of'])}")
+        else:
+            logger.warning(f"{entry['folder']}: {entry['n_conflicts']} of its files have the SOPInstanceUID of another file "
+                           f"of the series but other contents: converted anyway, check the series "
+                           f"({entry['n_duplicates']} exact duplicates not converted)")
+    inputs = []
+    for folder in series_folders:
+        inputs.extend(replaced.get(folder, [folder]))
+    return inputs, report
+
+# --------------------------------------------------------------------------------------
+# input_folders: Groups the inputs of a conversion (see drop_duplicates) by series folder. Returns a list of
+# (folder, files), in order, with files None for the folders given whole.
+# --------------------------------------------------------------------------------------
+def input_folders(inputs):
+    folders = {}
+    for path in inputs:
+        if os.path.isdir(path):
+            folders[path] = None
+        else:
+            folders.setdefault(os.path.dirname(path), []).append(path)
+    return list(folders.items())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.stderr.write("Usage: dicom_duplicates.py <inventory_path> <dicom_path> [<dicom_path> ...]\n")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    for dicom_path in sys.argv[2:]:
+        series_folders = dicom_inventory.series_folders(sys.argv[1], dicom_path)
+        inputs, report = drop_duplicates(series_folders, sys.argv[1], dicom_path)
+        print(f"{dicom_path}: {len(series_folders)} series folders, "
+              f"{sum(entry['status'] == 'dropped' for entry in report)} duplicated folders dropped, "
+              f"{sum(entry['n_duplicates'] for entry in report)} duplicated files left out, "
+              f"{sum(entry['status'] == 'conflict' for entry in report)} folders with conflicting files")
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Inventory of the DICOM folders of all subjects, cached in a local SQLite index.
+#
+# The subject folders (e.g. /mridata/cbu/{cbu_code}_{PROJECT_CODE}) are walked in parallel with a
+# thread pool and os.scandir. For every folder holding DICOM files (a series folder), the index records
+# the number of files, their total size, their latest modification time and the SeriesInstanceUID.
+#
+# The index is refreshed incrementally: each folder is stat-ed, but only listed again (and its DICOM files stat-ed)
+# if its modification time changed since the previous walk, and the header of a series is only read again if its
+# files changed. Refreshing an unchanged cohort therefore costs one stat per folder, and no listing or DICOM read.
+# Adding, removing or renaming a file changes the modification time of its folder, but rewriting a file in place
+# does not: such a file is not detected until its folder changes (or the index is removed). A folder whose
+# modification time is too close to the time it was listed (see MTIME_GRANULARITY) is listed again on the next
+# refresh, since a file added in the same tick would not have changed it.
+#
+# The SQLite index is only used by the process refreshing it (the launcher, or the watch mode), on the local disk
+# of the host it runs on (see local_index_file): SQLite's locking is not safe on a shared (network) file system.
+# After each refresh, the series folders of every subject folder refreshed are written into a snapshot folder on the
+# shared file system, as one small JSON file per subject folder, renamed into place. The jobs (run_task.py, running
+# on other nodes) read the series folders of their subject from that snapshot, instead of globbing the DICOM tree
+# again, and never open the index.
+#
+# Usage:
+#   python dicom_inventory.py refresh <index_file> <inventory_path> <dicom_path> [<dicom_path> ...]
+#   python dicom_inventory.py series-folders <inventory_path> <dicom_path>
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To walk the DICOM folders
+import sys # To read the command line arguments
+import json # To store the list of subfolders of each folder and write the snapshot
+import time # To tell when a folder was listed
+import getpass # To name the local index after the user
+import hashlib # To name the local index and the snapshot files
+import sqlite3 # For the index
+import tempfile # To find the local disk for the index
+from concurrent.futures import ThreadPoolExecutor # To walk the subject folders in parallel
+
+# pydicom is only needed to read the SeriesInstanceUID of each series.
+# It is available in the heudiconv environment, but the launchers may run without it.
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+# Extension of the DICOM files
+DICOM_EXTENSION = '.dcm'
+
+# Number of threads used to walk the subject folders. Walking is bound by the latency of the
+# (network) file system, not by the CPU, so this can be larger than the number of cores.
+DEFAULT_THREADS = 16
+
+# Resolution (in seconds) of the modification times of the folders, on the coarsest file system expected (NFS servers
+# may store whole seconds). A folder modified less than this before it was listed is listed again on the next refresh.
+MTIME_GRANULARITY = 2
+
+# Columns of the 'folders' table, in order
+FOLDER_COLUMNS = ('path', 'root', 'mtime', 'subfolders', 'n_files', 'n_bytes', 'last_modified', 'series_uid')
+
+# --------------------------------------------------------------------------------------
+# local_index_file: The SQLite index of the BIDS dataset in output_path, on the local disk (in $TMPDIR, or /tmp).
+# Losing it (e.g. when /tmp is cleared) only means that the next refresh reads the SeriesInstanceUIDs again.
+# --------------------------------------------------------------------------------------
+def local_index_file(output_path):
+    key = hashlib.sha1(os.path.abspath(output_path).rstrip(os.sep).encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"bids_conversion_{getpass.getuser()}", f"dicom_inventory_{key}.sqlite")
+
+# --------------------------------------------------------------------------------------
+# open_index: Opens (and creates if needed) the SQLite index.
+# --------------------------------------------------------------------------------------
+def open_index(index_file):
+    os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+    connection = sqlite3.connect(index_file)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS folders ("
+        "path TEXT PRIMARY KEY, root TEXT, mtime REAL, subfolders TEXT, "
+        "n_files INTEGER, n_bytes INTEGER, last_modified REAL, series_uid TEXT)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS folders_root ON folders (root)")
+    return connection
+
+# --------------------------------------------------------------------------------------
+# read_series_uid: Returns the SeriesInstanceUID of a DICOM file, reading only its header.
+# Returns None if pydicom is not available or the file cannot be read.
+# --------------------------------------------------------------------------------------
+def read_series_uid(dicom_file):
+    if pydicom is None:
+        return None
+    try:
+        dcm = pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=['SeriesInstanceUID'])
+    except Exception:
+        return None
+    return str(dcm.get('SeriesInstanceUID', '')) or None
+
+# --------------------------------------------------------------------------------------
+# list_folder: Lists one folder and summarises the DICOM files it holds. The SeriesInstanceUID of the
+# known record of the folder (from the previous walk) is kept if its files did not change.
+#
+# mtime is the modification time of the folder, stat-ed before listing it. It is recorded as None if it is within
+# MTIME_GRANULARITY of the listing, so that the folder is listed again on the next refresh.
+# --------------------------------------------------------------------------------------
+def list_folder(path, root, mtime, known=None):
+    listed_at = time.time()
+    subfolders = []
+    dicom_files = []
+    n_bytes = 0
+    last_modified = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.name)
+            elif entry.name.endswith(DICOM_EXTENSION) and entry.is_file():
+                st = entry.stat()
+                dicom_files.append(entry.name)
+                n_bytes += st.st_size
+                last_modified = max(last_modified, st.st_mtime)
+    unchanged = known is not None and (known['n_files'], known['n_bytes'], known['last_modified']) == (len(dicom_files), n_bytes, last_modified)
+    if unchanged:
+        series_uid = known['series_uid']
+    else:
+        series_uid = read_series_uid(os.path.join(path, min(dicom_files))) if dicom_files else None
+    return {
+        'path': path,
+        'root': root,
+        'mtime': mtime if listed_at - mtime >= MTIME_GRANULARITY else None,
+        'subfolders': sorted(subfolders),
+        'n_files': len(dicom_files),
+        'n_bytes': n_bytes,
+        'last_modified': last_modified,
+        'series_uid': series_uid,
+    }
+
+# --------------------------------------------------------------------------------------
+# walk_root: Walks one subject folder. The folders whose modification time did not change keep their record
+# from the previous walk (without being listed), and their subfolders are stat-ed from it.
+#
+# known maps the folder paths to their records from the previous walk. Returns the records of all
+# the folders found under root, or None if root does not exist.
+# --------------------------------------------------------------------------------------
+def walk_root(root, known):
+    try:
+        root_mtime = os.stat(root).st_mtime
+    except FileNotFoundError:
+        return None
+    records = []
+    stack = [(root, root_mtime)]
+    while stack:
+        path, mtime = stack.pop()
+        record = known.get(path)
+        if record is None or record['mtime'] != mtime:
+            try:
+                record = list_folder(path, root, mtime, record)
+            except FileNotFoundError:
+                # Removed since its parent was listed
+                continue
+        records.append(record)
+        for name in record['subfolders']:
+            subfolder = os.path.join(path, name)
+            try:
+                stack.append((subfolder, os.stat(subfolder).st_mtime))
+            except FileNotFoundError:
+                # Removed since the folder was listed
+                continue
+    return records
+
+# --------------------------------------------------------------------------------------
+# iter_series_folders: Walks a DICOM folder without the index, yielding each folder that holds DICOM files
+# as soon as it is found. Any layout is accepted (series folders at any depth), and only directory entries are
+# read (no stat of the DICOM files).
+# --------------------------------------------------------------------------------------
+def iter_series_folders(root):
+    stack = [root]
+    while stack:
+        path = stack.pop()
+        subfolders = []
+        has_dicom = False
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders.append(entry.path)
+                    elif not has_dicom and entry.name.endswith(DICOM_EXTENSION):
+                        has_dicom = True
+        except FileNotFoundError:
+            # Removed since its parent was listed
+            continue
+        if has_dicom:
+            yield path
+        stack.extend(sorted(subfolders, reverse=True))
+
+# --------------------------------------------------------------------------------------
+# load_records: Returns the records stored in the index for one subject folder.
+# --------------------------------------------------------------------------------------
+def load_records(connection, root):
+    rows = connection.execute(
+        f"SELECT {', '.join(FOLDER_COLUMNS)} FROM folders WHERE root = ?", (root,))
+    records = {}
+    for row in rows:
+        record = dict(zip(FOLDER_COLUMNS, row))
+        record['subfolders'] = json.loads(record['subfolders'])
+        records[record['path']] = record
+    return records
+
+# --------------------------------------------------------------------------------------
+# series_summary: Turns the folder records of one subject folder into its list of series folders,
+# sorted by path. Each series folder is given relative to the subject folder.
+# --------------------------------------------------------------------------------------
+def series_summary(root, records):
+    series = []
+    for record in sorted(records, key=lambda r: r['path']):
+        if record['n_files'] == 0:
+            continue
+        series.append({
+            'folder': os.path.relpath(record['path'], root),
+            'series_uid': record['series_uid'],
+            'n_files': record['n_files'],
+            'n_bytes': record['n_bytes'],
+            'last_modified': record['last_modified'],
+        })
+    return series
+
+# --------------------------------------------------------------------------------------
+# snapshot_file: The file of a subject folder in the snapshot folder inventory_path.
+# --------------------------------------------------------------------------------------
+def snapshot_file(inventory_path, root):
+    root = os.path.normpath(root)
+    key = hashlib.sha1(root.encode()).hexdigest()[:16]
+    return os.path.join(inventory_path, f"{os.path.basename(root)}_{key}.json")
+
+# --------------------------------------------------------------------------------------
+# write_snapshot: Writes the series folders of one subject folder into the snapshot folder (into a temporary file
+# renamed into place, so that the jobs never read a partial file). The file is removed if series is None.
+# --------------------------------------------------------------------------------------
+def write_snapshot(inventory_path, root, series):
+    path = snapshot_file(inventory_path, root)
+    if series is None:
+        if os.path.isfile(path):
+            os.remove(path)
+        return
+    os.makedirs(inventory_path, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'root': os.path.normpath(root), 'series': series}, f)
+    os.replace(tmp_path, path)
+
+# --------------------------------------------------------------------------------------
+# refresh_inventory: Walks all the subject folders in parallel and updates the index, and the snapshot
+# folder inventory_path if it is given.
+#
+# Returns a dictionary mapping each subject folder to its list of series folders
+# (see series_summary), or to None if the subject folder does not exist.
+# --------------------------------------------------------------------------------------
+def refresh_inventory(index_file, roots, n_threads=DEFAULT_THREADS, inventory_path=None):
+    roots = [os.path.normpath(root) for root in roots]
+    unique_roots = sorted(set(roots))
+    connection = open_index(index_file)
+    try:
+        known = {root: load_records(connection, root) for root in unique_roots}
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            walked = dict(zip(unique_roots, pool.map(lambda root: walk_root(root, known[root]), unique_roots)))
+
+        # Only the main thread writes to the index
+        with connection:
+            for root, records in walked.items():
+                connection.execute("DELETE FROM folders WHERE root = ?", (root,))
+                if records is None:
+                    continue
+                connection.executemany(
+                    f"INSERT INTO folders VALUES ({', '.join('?' * len(FOLDER_COLUMNS))})",
+                    [tuple(json.dumps(r[c]) if c == 'subfolders' else r[c] for c in FOLDER_COLUMNS)
+                     for r in records])
+    finally:
+        connection.close()
+
+    summaries = {root: None if records is None else series_summary(root, records) for root, records in walked.items()}
+    if inventory_path is not None:
+        for root, series in summaries.items():
+            write_snapshot(inventory_path, root, series)
+    return {root: summaries[root] for root in roots}
+
+# --------------------------------------------------------------------------------------
+# read_inventory: Returns the series folders of one subject folder from the snapshot folder inventory_path,
+# without touching the DICOM tree. Returns an empty list if the subject folder is not in the snapshot.
+# --------------------------------------------------------------------------------------
+def read_inventory(inventory_path, root):
+    path = snapshot_file(inventory_path, root)
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return json.load(f)['series']
+
+# --------------------------------------------------------------------------------------
+# series_folders: Returns the absolute paths of the series folders of one subject folder, from the snapshot.
+# If the subject folder is not in the snapshot (or there is no snapshot), the folder is walked instead.
+# --------------------------------------------------------------------------------------
+def series_folders(inventory_path, root):
+    series = read_inventory(inventory_path, root) if inventory_path else []
+    if series:
+        return [os.path.join(os.path.normpath(root), s['folder']) for s in series]
+    return list(iter_series_folders(os.path.normpath(root)))
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 5 and sys.argv[1] == 'refresh':
+        for root, series in refresh_inventory(sys.argv[2], sys.argv[4:], inventory_path=sys.argv[3]).items():
+            if series is None:
+                print(f"{root}: not found")
+            else:
+                print(f"{root}: {len(series)} series, {sum(s['n_files'] for s in series)} files, "
+                      f"{sum(s['n_bytes'] for s in series) / 1e6:.1f} MB")
+    elif len(sys.argv) == 4 and sys.argv[1] == 'series-folders':
+        # One absolute series folder per line
+        for folder in series_folders(sys.argv[2], sys.argv[3]):
+            print(folder)
+    else:
+        sys.stderr.write("Usage: dicom_inventory.py refresh <index_file> <inventory_path> <dicom_path> [<dicom_path> ...]\n"
+                         "       dicom_inventory.py series-folders <inventory_path> <dicom_path>\n")
+        sys.exit(1)
@@ -17,7 +17,16 @@
 # ------------------------------------------------------------
 import os # To check if files and folders exist
 import sys # To exit the script in case of error
-import subprocess # To run shell commands
+import subprocess # To run the dry run in the heudiconv environment
+
+import dicom_inventory # To index the DICOM folders of all subjects (dicom_inventory.py, in the same folder as this script)
+import execution_backends # To run the jobs on SLURM or locally (execution_backends.py, in the same folder as this script)
+import conversion_manifest # To skip sessions that were already converted (conversion_manifest.py, in the same folder as this script)
+import task_manifest # To tell each task what to convert (task_manifest.py, in the same folder as this script)
+import task_metrics # To size the tasks from the metrics of earlier runs (task_metrics.py, in the same folder as this script)
+import conversion_queue # To fill the queue of the long-lived workers (conversion_queue.py, in the same folder as this script)
+import resource_sizing # To size the memory, CPUs and time limit of each task (resource_sizing.py, in the same folder as this script)
+import dicom_watch # To convert new sessions as they land in DICOM_ROOT (dicom_watch.py, in the same folder as this script)
 
 # ------------------------------------------------------------
 #
@@ -66,6 +75,131 @@ SESSION_LIST = [
     'PRISMA1', 'PRISMA1', 'PRISMA1', 'PRISMA1', 'PRISMA1',
     'PRISMA2', 'PRISMA2', 'PRISMA2', 'PRISMA2', 'PRISMA2'
 ]
+
+# Only sessions whose DICOM files or heuristic file changed since their last successful conversion are submitted.
+# Set to True to convert all the sessions in the lists above again.
+FORCE_RECONVERT = False
+
+# Number of hours after which a session submitted by a previous run that did not finish is submitted again.
+# Until then, running this script again does not submit it twice (its conversion is taken as in progress).
+SUBMITTED_TIMEOUT_HOURS = 48
+
+# Number of threads used to walk the DICOM folders of all subjects before submitting the jobs
+INVENTORY_THREADS = 16
+
+# Where to run the conversions: 'slurm' submits a SLURM job array (with sbatch),
+# 'local' runs them on this machine (e.g. a workstation, or to test the pipeline without a cluster)
+EXECUTOR = 'slurm'
+
+# Maximum number of conversions running at the same time with the 'local' executor
+LOCAL_MAX_WORKERS = 4
+
+# Memory (in MB) and time limit (in minutes) of each task, None for the cluster defaults.
+# Tasks that run out of memory or time can be submitted again with more (see the resubmit command below).
+TASK_MEM_MB = None
+TASK_TIME_MINUTES = None
+
+# Number of shards each session is split into (groups of series converted in parallel, see convert_session.py).
+# With 1, each session is converted by a single heudiconv process. With more, each SLURM task asks for N_SHARDS CPUs.
+N_SHARDS = 1
+
+# Set to True to size the memory, CPUs and time limit of each task from the number and size of its DICOM files, and from
+# the metrics of earlier runs in JOB_OUTPUT_PATH when there are some (see resource_sizing.py). The tasks are then
+# submitted as one job array per size class (resource_sizing.SIZE_CLASSES) instead of all with the cluster defaults,
+# TASK_MEM_MB and TASK_TIME_MINUTES are ignored, and each session gets one shard per resource_sizing.BYTES_PER_SHARD
+# of DICOM files, up to N_SHARDS.
+SIZE_RESOURCES = False
+
+# To spare the DICOM store when many tasks are submitted at once (e.g. to convert a whole cohort):
+# the maximum number of tasks of a job array running at the same time (None for no limit),
+MAX_RUNNING_TASKS = None
+# the maximum number of tasks per job array (None to ask SLURM for its MaxArraySize). Larger cohorts are submitted as
+# several job arrays, one per chunk of tasks, each waiting for the previous one to finish if MAX_RUNNING_TASKS is set,
+MAX_ARRAY_SIZE = None
+# and the maximum number of tasks reading DICOM files from each storage root at the same time, e.g. {'/mridata/cbu': 32}
+# (None for no limit, see io_slots.py). Without STAGE_TO_LOCAL_SCRATCH, a task holds its slot for the whole conversion.
+IO_SLOTS = None
+
+# Set to a number of threads to have dcm2niix write uncompressed NIfTI files, and compress all the files of each
+# session afterwards with that many threads (e.g. N_SHARDS), at gzip level COMPRESSION_LEVEL (see nifti_compress.py).
+# The result is the same .nii.gz files, readable by any gzip reader, but dcm2niix no longer compresses each file
+# with a single thread, which takes most of the conversion time of long 4D runs.
+COMPRESSION_THREADS = None
+COMPRESSION_LEVEL = 6
+
+# Number of sessions converted one after the other by each task (in the same heudiconv environment).
+# Packing several small sessions into one task saves the scheduling and start-up time of one task per session.
+SESSIONS_PER_TASK = 1
+
+# Alternatively, pack the sessions by the size of their DICOM files: each task gets sessions up to this many bytes
+# (e.g. 20 * 1024**3 for 20 GB). If set, SESSIONS_PER_TASK is ignored.
+BYTES_PER_TASK = None
+
+# Set to True to copy the DICOM files of each of the sessions to node-local scratch ($TMPDIR) and convert them there.
+# The finished subject folder is then published into OUTPUT_PATH in one step (see run_task.py), which spares the
+# shared file system the many small reads and writes of the conversion.
+STAGE_TO_LOCAL_SCRATCH = False
+
+# Set to a number of workers to convert the sessions with long-lived workers fed by a queue (see conversion_queue.py)
+# instead of one task per group of sessions: each worker (a task of one job array, e.g. one per node) loads heudiconv
+# once and takes the largest session left in the queue until it is empty, so no worker sits idle while others still
+# have large sessions. SESSIONS_PER_TASK, BYTES_PER_TASK and MAX_ARRAY_SIZE are then ignored, and the memory
+# and time of each worker (TASK_MEM_MB, TASK_TIME_MINUTES) must cover all the sessions it converts.
+# To see the queue, and to put the conversions that failed back into it (for workers started again), run:
+#   python conversion_queue.py status <OUTPUT_PATH>/.bids_conversion/queue
+#   python conversion_queue.py retry <OUTPUT_PATH>/.bids_conversion/queue
+N_WORKERS = None
+
+# Set to a lookup table to run in watch mode (see dicom_watch.py): instead of converting the subjects listed above,
+# the launcher keeps polling DICOM_ROOT every WATCH_POLL_SECONDS for {cbu_code}_{PROJECT_CODE} folders, waits until
+# each new one stopped growing, and queues it for the workers (N_WORKERS must be set, with EXECUTOR = 'slurm'),
+# until it is stopped.
+# The lookup table is a TSV file with the columns cbu_code, subject_id and (for multi-session projects) session_id,
+# which can be edited while the launcher runs. To see what was queued, run:
+#   python dicom_watch.py status <OUTPUT_PATH>/.bids_conversion/watch_state.json
+WATCH_LOOKUP_TABLE = None
+WATCH_POLL_SECONDS = 60
+
+# To submit tasks of an earlier submission again (e.g. the ones that failed), set REPLAY_TASK_MANIFEST to its task manifest
+# (the path is printed by the launcher, e.g. f"{OUTPUT_PATH}/.bids_conversion/tasks/tasks_20240101120000.tsv")
+# and REPLAY_TASK_IDS to the list of task IDs to submit (None for all of them). No other sessions are submitted.
+# To see how the tasks of a submission ended (completed, failed, timed out or out of memory), and to submit again only
+# the ones that did not complete (with more time or memory if they ran out of it), run:
+#   python task_manifest.py status <task_manifest>
+#   python task_manifest.py resubmit <task_manifest>
+REPLAY_TASK_MANIFEST = None
+REPLAY_TASK_IDS = None
+
+# Set to True to populate the IntendedFor field of the fieldmaps of the whole dataset once the conversions are done, as
+# one more task that waits for the conversion tasks (see intended_for.py): the sidecars of all the sessions are indexed and
+# matched, INTENDED_FOR_PROCESSES sessions at a time, and only the sidecars whose IntendedFor changed are written.
+# The conversion tasks then leave IntendedFor to this stage instead of populating it themselves.
+# The fieldmaps are matched to the runs with INTENDED_FOR_MATCHING (e.g. ['Shims', 'ModalityAcquisitionLabel']) and
+# INTENDED_FOR_CRITERION ('First' or 'Closest'), or with the POPULATE_INTENDED_FOR_OPTS of the heuristic if they are None,
+# so the matching can be changed for the whole dataset without converting it again. To try a matching by hand, run:
+#   python intended_for.py --matching <parameter>[,<parameter>...] --criterion <criterion> --dry-run <OUTPUT_PATH>
+INTENDED_FOR_STAGE = False
+INTENDED_FOR_MATCHING = None
+INTENDED_FOR_CRITERION = None
+INTENDED_FOR_PROCESSES = 4
+
+# Set to True to check the BIDS dataset once the conversions are done (see bids_validate.py): the file names, the sidecar
+# keys, the IntendedFor of the fieldmaps and that every series the heuristic assigns a conversion key to was converted,
+# for each session converted since the last check (VALIDATE_PROCESSES of them at the same time). The check runs as one more
+# task, which waits for the conversion tasks and fails if any session of the dataset has errors. To check the dataset by hand
+# (e.g. after editing it), run:
+#   python bids_validate.py <OUTPUT_PATH>
+VALIDATE_BIDS = False
+VALIDATE_PROCESSES = 4
+
+# Set to True to only check what the heuristic would convert each session into, without submitting anything (see dry_run.py):
+# the DICOM headers of every session in the list are read (DRY_RUN_PROCESSES sessions at a time, and cached so that they are
+# only read again once the DICOM files changed), the heuristic is run over all of them, and a matrix of the number of
+# series each session would convert into each conversion key is printed, flagging the sessions with fewer or more series
+# than most sessions for a key (e.g. a fieldmap left out because its dim3 differs on another scanner).
+# The matrix is also written to {OUTPUT_PATH}/.bids_conversion/dry_run.tsv.
+DRY_RUN = False
+DRY_RUN_PROCESSES = 4
 # ------------------------------------------------------------
 
 # ------------------------------------------------------------
@@ -82,18 +216,41 @@ SESSION_LIST = [
 # Get the paths to the raw data for each subject
 dicom_paths = [f"{DICOM_ROOT}/{code}_{PROJECT_CODE}" for code in CBU_CODE_LIST]
 
-# Convert subject and dicom lists to space-separated strings as needed for the bash script
-subject_ids_list = ' '.join(SUBJECT_LIST)
-session_ids_list = ' '.join(SESSION_LIST)
-dicom_paths_list = ' '.join(dicom_paths)
-
-# Get the number of subjects to know how many jobs to submit
-n_subjects = len(SUBJECT_LIST)
-
 # Specify and create a folder for the job logs
 JOB_OUTPUT_PATH = f"{OUTPUT_PATH}/job_logs"
 if not os.path.isdir(JOB_OUTPUT_PATH):
     os.makedirs(JOB_OUTPUT_PATH)
+
+# Folder with the conversion manifest (one record per subject and session, see conversion_manifest.py)
+MANIFEST_PATH = f"{OUTPUT_PATH}/.bids_conversion/manifest"
+
+# Index of the DICOM folders of all subjects, on the local disk of this host (see dicom_inventory.py)
+INVENTORY_INDEX = dicom_inventory.local_index_file(OUTPUT_PATH)
+
+# Snapshot of the index read by the jobs, one file per subject folder (see dicom_inventory.py)
+INVENTORY_PATH = f"{OUTPUT_PATH}/.bids_conversion/dicom_inventory"
+
+# Queue folder of the long-lived workers (see N_WORKERS above)
+QUEUE_PATH = f"{OUTPUT_PATH}/.bids_conversion/queue"
+
+# Folder with the task manifests (what each task of a submission converts, see task_manifest.py)
+TASK_PATH = f"{OUTPUT_PATH}/.bids_conversion/tasks"
+
+# Sessions handled by the watch mode (see WATCH_LOOKUP_TABLE above)
+WATCH_STATE_FILE = f"{OUTPUT_PATH}/.bids_conversion/watch_state.json"
+
+# Folder with the conversion scripts (used by the job script to update the manifest)
+CODE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Compression of the NIfTI files after the conversion (see COMPRESSION_THREADS above)
+COMPRESSION = {'level': COMPRESSION_LEVEL, 'threads': COMPRESSION_THREADS} if COMPRESSION_THREADS else None
+
+# Options of the executor (see EXECUTOR above)
+if EXECUTOR == 'local':
+    executor_options = {'max_workers': LOCAL_MAX_WORKERS}
+else:
+    executor_options = {'sbatch_options': []}
+executor_options.update(cpus=N_SHARDS, mem_mb=TASK_MEM_MB, time_minutes=TASK_TIME_MINUTES, max_running=MAX_RUNNING_TASKS)
  
 # ------------------------------------------------------------
 # Do some checks before running the script
@@ -104,11 +261,35 @@ if not os.path.isfile(HEURISTIC_FILE):
     sys.stderr.write(f"Heuristic file not found: {HEURISTIC_FILE}. Exiting...\n")
     sys.exit(1)
 
-# Check if all dicom paths exist. If not, print out which doesn't and exit the script.
-for dicom_path in dicom_paths:
-    if not os.path.isdir(dicom_path):
-        sys.stderr.write(f"Dicom path not found: {dicom_path}. Exiting...\n")
+# ------------------------------------------------------------
+# Watch DICOM_ROOT for new sessions instead, if asked to (see WATCH_LOOKUP_TABLE above)
+# ------------------------------------------------------------
+if WATCH_LOOKUP_TABLE is not None:
+    if not N_WORKERS:
+        sys.stderr.write("The watch mode needs N_WORKERS to be set. Exiting...\n")
+        sys.exit(1)
+    if EXECUTOR == 'local':
+        sys.stderr.write("The watch mode needs the workers to run in the background: set EXECUTOR to 'slurm'. Exiting...\n")
+        sys.exit(1)
+    if not os.path.isfile(WATCH_LOOKUP_TABLE):
+        sys.stderr.write(f"Lookup table not found: {WATCH_LOOKUP_TABLE}. Exiting...\n")
         sys.exit(1)
+    executor = execution_backends.get_executor(EXECUTOR, JOB_OUTPUT_PATH, 'heudiconv_worker', **executor_options)
+    conversion_queue.write_config(QUEUE_PATH, HEURISTIC_FILE, OUTPUT_PATH, MANIFEST_PATH, INVENTORY_PATH, JOB_OUTPUT_PATH, IO_SLOTS, COMPRESSION)
+    watcher = dicom_watch.Watcher(QUEUE_PATH, DICOM_ROOT, PROJECT_CODE, WATCH_LOOKUP_TABLE, WATCH_STATE_FILE,
+                                  N_SHARDS, SIZE_RESOURCES, STAGE_TO_LOCAL_SCRATCH, index_file=INVENTORY_INDEX,
+                                  n_threads=INVENTORY_THREADS)
+    dicom_watch.watch(watcher, executor, CODE_PATH, N_WORKERS, WATCH_POLL_SECONDS)
+
+# Walk all dicom paths in parallel and update the DICOM inventory (only the series whose files changed since the last run are read again).
+# If any dicom path doesn't exist, print out which and exit the script.
+inventory = dicom_inventory.refresh_inventory(INVENTORY_INDEX, dicom_paths, INVENTORY_THREADS, INVENTORY_PATH)
+missing_dicom_paths = [dicom_path for dicom_path in dicom_paths if inventory[os.path.normpath(dicom_path)] is None]
+for dicom_path in missing_dicom_paths:
+    sys.stderr.write(f"Dicom path not found: {dicom_path}\n")
+if missing_dicom_paths:
+    sys.stderr.write("Exiting...\n")
+    sys.exit(1)
 
 # Check if the heudiconv_script exists. If not, exit the script.
 if not os.path.isfile(HEUDICONV_SCRIPT):
@@ -116,20 +297,163 @@ if not os.path.isfile(HEUDICONV_SCRIPT):
     sys.exit(1)
 
 # ------------------------------------------------------------
-# Construct a command to submit a job array to SLURM
-# It will call the heudiconv_script.sh script for each subject and generate a unique task ID.
-# The heudiconv_script will use the task ID to get the subject ID and the path to the raw data from the passed subject and dicom lists.
+# Only run the heuristic over the DICOM headers, if asked to (see DRY_RUN above)
+# ------------------------------------------------------------
+if DRY_RUN:
+    dry_run_status = subprocess.call(
+        ['bash', os.path.join(CODE_PATH, 'dry_run.sh'), CODE_PATH, HEURISTIC_FILE, INVENTORY_PATH,
+         f"{OUTPUT_PATH}/.bids_conversion/dry_run.tsv", str(DRY_RUN_PROCESSES)]
+        + [f"{subject_id}:{session_id}={dicom_path}" for subject_id, session_id, dicom_path in zip(SUBJECT_LIST, SESSION_LIST, dicom_paths)])
+    sys.exit(dry_run_status)
+
+# ------------------------------------------------------------
+# Submit tasks of an earlier submission again, if asked to (see REPLAY_TASK_MANIFEST above)
+# ------------------------------------------------------------
+if REPLAY_TASK_MANIFEST is not None:
+    executor, job_id = task_manifest.submit(REPLAY_TASK_MANIFEST, REPLAY_TASK_IDS)
+    if executor.name == 'local' and executor.report(job_id):
+        sys.exit(1)
+    sys.exit(0)
+
+# ------------------------------------------------------------
+# Select the sessions that need to be (re)converted
+# A session is skipped if its last conversion finished successfully with the same DICOM files and heuristic file,
+# or if it was submitted with them less than SUBMITTED_TIMEOUT_HOURS ago (unless FORCE_RECONVERT is set).
 # ------------------------------------------------------------
-    
-bash_command = (
-    f"sbatch --array=0-{n_subjects - 1} "
-    f"--job-name=heudiconv "
-    f"--output={JOB_OUTPUT_PATH}/heudiconv_job_%A_%a.out "
-    f"--error={JOB_OUTPUT_PATH}/heudiconv_job_%A_%a.err "
-    f"{HEUDICONV_SCRIPT} '{subject_ids_list}' '{session_ids_list}' '{dicom_paths_list}' '{HEURISTIC_FILE}' '{OUTPUT_PATH}'"
-)
+heuristic_sha = conversion_manifest.heuristic_hash(HEURISTIC_FILE)
+
+pending_subject_ids = []
+pending_session_ids = []
+pending_dicom_paths = []
+pending_n_bytes = []
+pending_n_files = []
+pending_max_series_bytes = []
+pending_submissions = []
+for subject_id, session_id, dicom_path in zip(SUBJECT_LIST, SESSION_LIST, dicom_paths):
+    fingerprint = conversion_manifest.session_fingerprint(inventory[os.path.normpath(dicom_path)])
+    record = conversion_manifest.load_record(MANIFEST_PATH, subject_id, session_id)
+    if FORCE_RECONVERT:
+        reason = 'forced'
+    else:
+        reason = conversion_manifest.needs_conversion(record, fingerprint, heuristic_sha, SUBMITTED_TIMEOUT_HOURS)
+    if reason is None:
+        if record['status'] == 'submitted':
+            print(f"Skipping session {session_id} of subject {subject_id}: already submitted on {record['updated']}")
+        else:
+            print(f"Skipping session {session_id} of subject {subject_id}: already converted and unchanged")
+        continue
+    print(f"Submitting session {session_id} of subject {subject_id}: {reason}")
+    conversion_manifest.write_record(MANIFEST_PATH, conversion_manifest.new_record(
+        subject_id, session_id, dicom_path, fingerprint, HEURISTIC_FILE, heuristic_sha))
+    pending_subject_ids.append(subject_id)
+    pending_session_ids.append(session_id)
+    pending_dicom_paths.append(dicom_path)
+    pending_n_bytes.append(sum(series['n_bytes'] for series in fingerprint.values()))
+    pending_n_files.append(sum(series['n_files'] for series in fingerprint.values()))
+    pending_max_series_bytes.append(max((series['n_bytes'] for series in fingerprint.values()), default=0))
+    pending_submissions.append(conversion_manifest.submission_hash(fingerprint, heuristic_sha))
+
+if not pending_subject_ids:
+    print("All sessions are already converted. Nothing to submit.")
+    sys.exit(0)
+
+# Pack the sessions into tasks (see SESSIONS_PER_TASK and BYTES_PER_TASK above)
+tasks = execution_backends.pack_tasks(pending_n_bytes, SESSIONS_PER_TASK, BYTES_PER_TASK)
+print(f"Packed {len(pending_subject_ids)} sessions into {len(tasks)} tasks")
 
-subprocess.run(bash_command, shell=True, check=True)
+# What each task converts
+entries = [
+    {'subject_id': pending_subject_ids[i], 'session_id': pending_session_ids[i], 'dicom_path': pending_dicom_paths[i],
+     'n_bytes': pending_n_bytes[i], 'n_files': pending_n_files[i], 'max_series_bytes': pending_max_series_bytes[i],
+     'n_shards': resource_sizing.subject_shards(pending_n_bytes[i], N_SHARDS) if SIZE_RESOURCES else N_SHARDS,
+     'stage': int(STAGE_TO_LOCAL_SCRATCH), 'intended_for_stage': int(INTENDED_FOR_STAGE),
+     'submission': pending_submissions[i]}
+    for i in range(len(pending_subject_ids))
+]
+
+# ------------------------------------------------------------
+# Run the heudiconv_script once per task, as a SLURM job array or locally (see EXECUTOR above).
+# Each task gets a unique task ID (SLURM_ARRAY_TASK_ID), which the heudiconv_script uses to read its
+# sessions (subject IDs, session IDs and paths to the raw data) from the task manifest.
+# Each task writes its timings, memory and I/O next to its log files in JOB_OUTPUT_PATH; to summarise them, run:
+#   python task_metrics.py report <JOB_OUTPUT_PATH> [<job_id>]
+# A cohort with more tasks than a job array can hold is split into chunks (see MAX_ARRAY_SIZE above), each with its own
+# task manifest and job arrays.
+# ------------------------------------------------------------
+if N_WORKERS:
+    # Put the subjects into the queue and start the workers (see N_WORKERS above)
+    conversion_queue.write_config(QUEUE_PATH, HEURISTIC_FILE, OUTPUT_PATH, MANIFEST_PATH, INVENTORY_PATH, JOB_OUTPUT_PATH, IO_SLOTS, COMPRESSION)
+    conversion_queue.enqueue(QUEUE_PATH, entries)
+    print(f"Queued {len(entries)} conversions in {QUEUE_PATH}, starting {N_WORKERS} workers")
+    executor = execution_backends.get_executor(EXECUTOR, JOB_OUTPUT_PATH, 'heudiconv_worker', **executor_options)
+    job_id = conversion_queue.submit_workers(executor, CODE_PATH, QUEUE_PATH, N_WORKERS)
+    submissions = [(executor, job_id)]
+else:
+    max_array_size = MAX_ARRAY_SIZE or execution_backends.get_executor(EXECUTOR, JOB_OUTPUT_PATH).max_array_size()
+    chunks = task_manifest.split_chunks(tasks, max_array_size)
+    model = resource_sizing.calibrate(task_metrics.read_records(JOB_OUTPUT_PATH)) if SIZE_RESOURCES else None
+
+    submissions = []
+    previous_job_ids = []
+    for chunk, chunk_tasks in enumerate(chunks):
+        # Write the task manifest of the chunk
+        task_manifest_file = task_manifest.new_task_manifest(TASK_PATH, chunk if len(chunks) > 1 else None)
+        task_manifest.write_tasks(task_manifest_file, chunk_tasks, entries)
+        print(f"Task manifest: {task_manifest_file}")
+        task_manifest.write_job(
+            task_manifest_file,
+            HEUDICONV_SCRIPT,
+            [HEURISTIC_FILE, OUTPUT_PATH, CODE_PATH, MANIFEST_PATH, INVENTORY_PATH],
+            EXECUTOR, JOB_OUTPUT_PATH, executor_options, MANIFEST_PATH, io_slots=IO_SLOTS, compression=COMPRESSION,
+        )
+
+        # With MAX_RUNNING_TASKS, a chunk only starts when the previous one is done
+        chunk_options = dict(executor_options, after_job_ids=previous_job_ids) if MAX_RUNNING_TASKS and previous_job_ids else executor_options
+        if SIZE_RESOURCES:
+            # One job array per size class (see SIZE_RESOURCES above)
+            groups = resource_sizing.plan_submissions(task_manifest.read_tasks(task_manifest_file), model)
+        else:
+            groups = [(None, {}, None)]
+        previous_job_ids = []
+        for label, resources, task_ids in groups:
+            if label is not None:
+                print(f"Submitting {len(task_ids)} {label} tasks ({resources['mem_mb']} MB, {resources['time_minutes']} minutes)")
+            executor, job_id = task_manifest.submit(task_manifest_file, task_ids, dict(chunk_options, **resources))
+            submissions.append((executor, job_id))
+            previous_job_ids.append(job_id)
+
+# The local executor returns when all the conversions are done: report the ones that failed
+failed = EXECUTOR == 'local' and any([executor.report(job_id) for executor, job_id in submissions])
+
+# ------------------------------------------------------------
+# Populate the IntendedFor of the fieldmaps once the conversions are done (see INTENDED_FOR_STAGE above)
+# ------------------------------------------------------------
+if INTENDED_FOR_STAGE:
+    intended_for_options = dict(executor_options, cpus=INTENDED_FOR_PROCESSES, after_job_ids=[job_id for _, job_id in submissions])
+    executor = execution_backends.get_executor(EXECUTOR, JOB_OUTPUT_PATH, 'intended_for', **intended_for_options)
+    job_id = executor.submit(os.path.join(CODE_PATH, 'intended_for.sh'),
+                             [CODE_PATH, OUTPUT_PATH, HEURISTIC_FILE, str(INTENDED_FOR_PROCESSES),
+                              ','.join(INTENDED_FOR_MATCHING or []), INTENDED_FOR_CRITERION or ''], [0])
+    print(f"IntendedFor of the fieldmaps: see {executor.log_file(job_id, 0, 'out')}")
+    if EXECUTOR == 'local' and executor.report(job_id):
+        failed = True
+    # The check of the dataset waits for it too
+    submissions.append((executor, job_id))
+
+# ------------------------------------------------------------
+# Check the BIDS dataset once the conversions are done (see VALIDATE_BIDS above)
+# ------------------------------------------------------------
+if VALIDATE_BIDS:
+    validate_options = dict(executor_options, cpus=VALIDATE_PROCESSES, after_job_ids=[job_id for _, job_id in submissions])
+    executor = execution_backends.get_executor(EXECUTOR, JOB_OUTPUT_PATH, 'bids_validate', **validate_options)
+    job_id = executor.submit(os.path.join(CODE_PATH, 'bids_validate.sh'),
+                             [CODE_PATH, OUTPUT_PATH, HEURISTIC_FILE, INVENTORY_PATH, str(VALIDATE_PROCESSES)], [0])
+    print(f"BIDS check of the dataset: see {executor.log_file(job_id, 0, 'out')}")
+    if EXECUTOR == 'local' and executor.report(job_id):
+        failed = True
+
+if failed:
+    sys.exit(1)
 
 # ------------------------------------------------------------
 # End of script
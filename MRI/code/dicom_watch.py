@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Watch mode: converts new sessions shortly after they land in DICOM_ROOT, without anyone editing the launcher.
+#
+# The launchers (with WATCH_LOOKUP_TABLE set) keep polling DICOM_ROOT for {cbu_code}_{PROJECT_CODE} folders:
+#   - the CBU code of each folder is looked up in the lookup table (a TSV file with the columns cbu_code, subject_id
+#     and, for multi-session projects, session_id). Folders whose CBU code is not in the table are left alone (with a
+#     warning) until the table is edited.
+#   - a folder is ready once it stopped growing: the same series, number of files and size as on the previous poll,
+#     and no DICOM file written for SETTLE_SECONDS.
+#   - a ready session is checked against the conversion manifest (see conversion_manifest.py) like in the launchers,
+#     and put into the queue of the long-lived workers (see conversion_queue.py), which are started if needed.
+#   - whenever the queue has pending conversions (new ones, or ones put back after their worker was lost), workers are
+#     started until N_WORKERS of them are pending or running. This needs an executor whose jobs run in the
+#     background (e.g. slurm): the local executor waits for its workers to finish, so it is not allowed here.
+#
+# Each poll costs one stat of DICOM_ROOT (the folder is only listed again when its modification time changed)
+# and an incremental refresh of the DICOM inventory (see dicom_inventory.py) of the folders that are not ready yet.
+# The folders already queued (or found already converted) are recorded in the state file with the modification times
+# of the folder and of its session folders, and are not walked again while these do not change, so the poll only costs
+# a few stats per handled folder. A handled folder whose modification times changed (a session, or a series of a
+# session, was added since) is checked again like a new one, and queued again once it stopped growing (the manifest
+# fingerprint changed). Files added to a series folder that already existed do not change these modification times:
+# they are converted by the next run of the launcher.
+#
+# Usage (to see the sessions the watcher has queued):
+#   python dicom_watch.py status <state_file>
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To list DICOM_ROOT
+import sys # To read the command line arguments
+import csv # To read the lookup table
+import json # To read the state file
+import time # To wait between the polls
+import logging # To log what is found and queued
+
+import dicom_inventory # To walk the new session folders (dicom_inventory.py, in the same folder as this script)
+import conversion_manifest # To skip the sessions that were already converted (conversion_manifest.py, in the same folder as this script)
+import conversion_queue # To queue the sessions for the workers (conversion_queue.py, in the same folder as this script)
+import execution_backends # To see which workers are still running (execution_backends.py, in the same folder as this script)
+import resource_sizing # To size the number of shards of each session (resource_sizing.py, in the same folder as this script)
+
+logger = logging.getLogger('bids_conversion')
+
+# Seconds between two polls
+POLL_SECONDS = 60
+
+# Seconds without a new DICOM file after which a session that stopped growing is converted
+SETTLE_SECONDS = 10 * 60
+
+# --------------------------------------------------------------------------------------
+# read_lookup_table: Returns a dictionary mapping each CBU code of the lookup table to its (subject_id, session_id),
+# with session_id None if the table has no session_id column (or it is empty).
+# --------------------------------------------------------------------------------------
+def read_lookup_table(lookup_table):
+    lookup = {}
+    with open(lookup_table, newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            if row.get('cbu_code'):
+                lookup[row['cbu_code'].strip()] = (row['subject_id'].strip(), (row.get('session_id') or '').strip() or None)
+    return lookup
+
+# --------------------------------------------------------------------------------------
+# session_summary: What must stay the same between two polls for a session to be ready: its number of series,
+# of files, their total size and the latest modification time of its DICOM files.
+# --------------------------------------------------------------------------------------
+def session_summary(series):
+    return (len(series), sum(s['n_files'] for s in series), sum(s['n_bytes'] for s in series),
+            max((s['last_modified'] for s in series), default=0))
+
+# --------------------------------------------------------------------------------------
+# folder_mtimes: The modification times of a {cbu_code}_{PROJECT_CODE} folder ('.') and of its session folders (by name).
+# --------------------------------------------------------------------------------------
+def folder_mtimes(path):
+    mtimes = {'.': os.stat(path).st_mtime}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                mtimes[entry.name] = entry.stat().st_mtime
+    return mtimes
+
+# --------------------------------------------------------------------------------------
+# folder_changed: True if the modification times of a folder are not the recorded ones (see folder_mtimes).
+# Folders recorded without their modification times (by an older watcher) are taken as unchanged.
+# --------------------------------------------------------------------------------------
+def folder_changed(path, mtimes):
+    if not mtimes:
+        return False
+    try:
+        return any(os.stat(os.path.join(path, name)).st_mtime != mtime for name, mtime in mtimes.items())
+    except FileNotFoundError:
+        return True
+
+# --------------------------------------------------------------------------------------
+# Watcher: Finds the new sessions of a project and queues them for the workers (see the top of this file).
+# The heuristic file, conversion manifest and snapshot of the DICOM inventory are read from the configuration of the
+# queue. The index itself (index_file) is kept on the local disk (see dicom_inventory.local_index_file).
+# --------------------------------------------------------------------------------------
+class Watcher:
+
+    def __init__(self, queue_path, dicom_root, project_code, lookup_table, state_file,
+                 max_shards=1, size_shards=False, stage=False, settle_seconds=SETTLE_SECONDS, index_file=None,
+                 n_threads=dicom_inventory.DEFAULT_THREADS):
+        self.queue_path = queue_path
+        self.config = conversion_queue.read_config(queue_path)
+        self.dicom_root = dicom_root
+        self.suffix = f"_{project_code}"
+        self.lookup_table = lookup_table
+        self.state_file = state_file
+        self.max_shards = max_shards
+        self.size_shards = size_shards
+        self.stage = stage
+        self.settle_seconds = settle_seconds
+        self.index_file = index_file or dicom_inventory.local_index_file(self.config['output_path'])
+        self.n_threads = n_threads
+        # Folders queued or found already converted (saved in the state file), and the ones not ready yet
+        self.handled = self.read_state()
+        self.growing = {}
+        # Last listing of DICOM_ROOT, and its modification time
+        self.root_mtime = None
+        self.folders = {}
+        # Lookup table, its modification time, and the folders warned about (not in it)
+        self.lookup_mtime = None
+        self.lookup = {}
+        self.unknown = set()
+
+    # Folders handled by earlier runs of the watcher
+    def read_state(self):
+        if not os.path.isfile(self.state_file):
+            return {}
+        with open(self.state_file) as f:
+            return json.load(f)
+
+    # Dictionary mapping the name of each {cbu_code}_{PROJECT_CODE} folder of DICOM_ROOT to its path,
+    # listed again only if DICOM_ROOT changed since the last poll
+    def list_folders(self):
+        root_mtime = os.stat(self.dicom_root).st_mtime
+        if root_mtime != self.root_mtime:
+            with os.scandir(self.dicom_root) as entries:
+                self.folders = {entry.name: entry.path for entry in entries
+                                if entry.name.endswith(self.suffix) and entry.is_dir()}
+            self.root_mtime = root_mtime
+        return self.folders
+
+    # The lookup table, read again if it was edited since the last poll
+    def read_lookup(self):
+        lookup_mtime = os.stat(self.lookup_table).st_mtime
+        if lookup_mtime != self.lookup_mtime:
+            self.lookup = read_lookup_table(self.lookup_table)
+            self.lookup_mtime = lookup_mtime
+            self.unknown = set()
+        return self.lookup
+
+    # Queue entry of a ready session (the fields of a task manifest row, see task_manifest.TASK_COLUMNS)
+    def entry(self, subject_id, session_id, dicom_path, fingerprint, heuristic_sha):
+        n_bytes = sum(series['n_bytes'] for series in fingerprint.values())
+        return {
+            'subject_id': subject_id, 'session_id': session_id, 'dicom_path': dicom_path, 'n_bytes': n_bytes,
+            'n_files': sum(series['n_files'] for series in fingerprint.values()),
+            'max_series_bytes': max((series['n_bytes'] for series in fingerprint.values()), default=0),
+            'n_shards': resource_sizing.subject_shards(n_bytes, self.max_shards) if self.size_shards else self.max_shards,
+            'stage': int(self.stage),
+            'submission': conversion_manifest.submission_hash(fingerprint, heuristic_sha),
+        }
+
+    # Polls DICOM_ROOT once, and queues the sessions that are ready. Returns their queue entries.
+    def poll(self):
+        lookup = self.read_lookup()
+        candidates = {}
+        changed = False
+        for name, path in self.list_folders().items():
+            if name in self.handled:
+                if not folder_changed(path, self.handled[name].get('mtimes')):
+                    continue
+                logger.info(f"{path} changed since it was found {self.handled[name]['status']}, checking it again")
+                del self.handled[name]
+                changed = True
+            cbu_code = name[:-len(self.suffix)]
+            if cbu_code in lookup:
+                candidates[name] = path
+            elif name not in self.unknown:
+                logger.warning(f"{path}: CBU code {cbu_code} is not in the lookup table {self.lookup_table}, not converted")
+                self.unknown.add(name)
+        # Folders removed since the last poll
+        for name in set(self.growing) - set(candidates):
+            del self.growing[name]
+        if not candidates:
+            if changed:
+                conversion_queue.write_json(self.state_file, self.handled)
+            return []
+
+        # Taken before the walk, so that a change made during it is seen at the next poll
+        mtimes = {name: folder_mtimes(path) for name, path in candidates.items()}
+        inventory = dicom_inventory.refresh_inventory(self.index_file, list(candidates.values()), self.n_threads,
+                                                      self.config['inventory_path'])
+        heuristic_sha = conversion_manifest.heuristic_hash(self.config['heuristic_file'])
+        now = time.time()
+        entries = []
+        handled = []
+        for name, path in sorted(candidates.items()):
+            series = inventory[os.path.normpath(path)]
+            if not series:
+                continue
+            summary = session_summary(series)
+            previous = self.growing.get(name)
+            self.growing[name] = summary
+            if previous is None:
+                logger.info(f"New session folder {path}: {summary[1]} files, waiting for it to stop growing")
+            if summary != previous or now - summary[3] < self.settle_seconds:
+                continue
+
+            del self.growing[name]
+            subject_id, session_id = lookup[name[:-len(self.suffix)]]
+            fingerprint = conversion_manifest.session_fingerprint(series)
+            record = conversion_manifest.load_record(self.config['manifest_path'], subject_id, session_id)
+            reason = conversion_manifest.needs_conversion(record, fingerprint, heuristic_sha)
+            label = f"subject {subject_id}" + (f", session {session_id}" if session_id else '')
+            if reason is None and record['status'] == 'submitted':
+                logger.info(f"{path} ({label}) was already submitted on {record['updated']}")
+                status = 'queued'
+            elif reason is None:
+                logger.info(f"{path} ({label}) is already converted and unchanged")
+                status = 'converted'
+            else:
+                logger.info(f"Queueing {path} ({label}): {reason}")
+                conversion_manifest.write_record(self.config['manifest_path'], conversion_manifest.new_record(
+                    subject_id, session_id, path, fingerprint, self.config['heuristic_file'], heuristic_sha))
+                entries.append(self.entry(subject_id, session_id, path, fingerprint, heuristic_sha))
+                status = 'queued'
+            handled.append(name)
+            self.handled[name] = {'subject_id': subject_id, 'session_id': session_id, 'status': status,
+                                  'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'mtimes': mtimes[name]}
+
+        if entries:
+            conversion_queue.enqueue(self.queue_path, entries)
+        if handled or changed:
+            conversion_queue.write_json(self.state_file, self.handled)
+        return entries
+
+# --------------------------------------------------------------------------------------
+# active_workers: Returns a dictionary mapping each of the given jobs that still has pending or running workers to
+# their number (the jobs whose workers all finished are left out, so that they are not looked up again).
+# --------------------------------------------------------------------------------------
+def active_workers(executor, job_ids):
+    active = {}
+    for job_id in job_ids:
+        n_active = sum(outcome in (execution_backends.PENDING, execution_backends.RUNNING)
+                       for outcome, _ in executor.task_outcomes(job_id).values())
+        if n_active:
+            active[job_id] = n_active
+    return active
+
+# --------------------------------------------------------------------------------------
+# watch: Polls DICOM_ROOT every poll_seconds until stopped. While the queue has pending conversions (including the
+# ones put back after their worker was lost), starts workers with the executor so that up to n_workers of them are
+# running (the workers stop by themselves once the queue is empty).
+# The executor must return once the workers are submitted: with the local executor, submit only returns once the
+# workers stopped, so the watcher would not poll in the meantime. It is therefore rejected.
+# --------------------------------------------------------------------------------------
+def watch(watcher, executor, code_path, n_workers, poll_seconds=POLL_SECONDS):
+    if isinstance(executor, execution_backends.LocalExecutor):
+        raise ValueError("The watch mode needs an executor that does not wait for the workers (e.g. slurm), not the local one")
+    logger.info(f"Watching {watcher.dicom_root} for *{watcher.suffix} folders every {poll_seconds} s")
+    job_ids = []
+    while True:
+        try:
+            watcher.poll()
+        except OSError as e:
+            # e.g. the DICOM store or the lookup table is briefly unavailable: try again at the next poll
+            logger.error(f"Poll failed: {e}")
+        conversion_queue.requeue_stale(watcher.queue_path)
+        n_pending = len(conversion_queue.queue_status(watcher.queue_path)['pending'])
+        if n_pending:
+            active = active_workers(executor, job_ids)
+            job_ids = list(active)
+            n_new = min(n_pending, n_workers - sum(active.values()))
+            if n_new > 0:
+                job_ids.append(conversion_queue.submit_workers(executor, code_path, watcher.queue_path, n_new))
+        time.sleep(poll_seconds)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'status':
+        sys.stderr.write("Usage: dicom_watch.py status <state_file>\n")
+        sys.exit(1)
+    with open(sys.argv[2]) as f:
+        handled = json.load(f)
+    for name, state in sorted(handled.items(), key=lambda item: item[1]['time']):
+        session = f"\tses-{state['session_id']}" if state['session_id'] else ''
+        print(f"{state['time']}\t{state['status']}\t{name}\tsub-{state['subject_id']}{session}")
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Dry run of a heuristic over a whole cohort, before anything is converted.
+#
+# The seqinfo of every subject (or session) is read from the DICOM headers as in dicom_discover.py, in parallel, and
+# cached in {OUTPUT_PATH}/.bids_conversion/seqinfo (the cache of bids_validate.py), so it is only read again once the
+# DICOM files changed. The heuristic's infotodict is then run over all the sessions in this process, and a matrix of the
+# number of series each session would convert into each conversion key is printed, with the sessions to check:
+#   - missing: fewer series assigned to a key than in most sessions of the cohort (e.g. a fieldmap left out because its
+#     dim3 differs on another scanner)
+#   - extra: more series assigned to a key than in most sessions (e.g. a repeated run)
+# and, for these sessions, the series that no key takes although the heuristic assigns their protocol name in other
+# sessions (with their dim3, dim4 and TR, to see why the heuristic left them out).
+# The protocol names that no session assigns (e.g. localizers) are listed once, under the matrix.
+#
+# The matrix is also written as a tab-separated table (one row per session, one column per conversion key), and the
+# script exits with an error status if any session has to be checked.
+#
+# The launchers run this instead of submitting the conversions when DRY_RUN is set (see the launchers).
+#
+# Usage:
+#   python dry_run.py --heuristic <heuristic_file> [--inventory <inventory_path>] [--cache <folder>] [--processes <n>]
+#                     [--output <matrix.tsv>] <subject_id>[:<session_id>]=<dicom_path> [...]
+#
+# It is assumed that you run this in the 'heudiconv' conda environment.
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To handle the file paths
+import sys # To exit with an error status
+import argparse # To parse the command line arguments
+from collections import Counter # To find the most common number of series of each key
+from concurrent.futures import ProcessPoolExecutor # To read the seqinfo of the sessions in parallel
+
+import convert_session # To load the heuristic (convert_session.py, in the same folder as this script)
+import conversion_manifest # To fingerprint the DICOM inputs of the sessions (conversion_manifest.py, in the same folder as this script)
+import dicom_discover # To read the seqinfo of the sessions (dicom_discover.py, in the same folder as this script)
+import dicom_inventory # To read the series folders of the sessions (dicom_inventory.py, in the same folder as this script)
+
+# Default number of processes reading the seqinfo
+DEFAULT_PROCESSES = os.cpu_count() or 1
+
+# --------------------------------------------------------------------------------------
+# key_label: A short name for a conversion key, from its template: the file name without the subject and session
+# (e.g. 'sub-{subject}/func/sub-{subject}_task-video_run-{item:02d}_bold' is 'func/task-video_run-*_bold').
+# --------------------------------------------------------------------------------------
+def key_label(key):
+    template = key[0]
+    parts = [part for part in os.path.basename(template).split('_')
+             if not part.startswith('sub-') and part not in ('{session}', 'ses-{session}')]
+    datatype = os.path.basename(os.path.dirname(template))
+    return convert_session.ITEM_FIELDS.sub('*', f"{datatype}/{'_'.join(parts)}")
+
+# --------------------------------------------------------------------------------------
+# session_seqinfos: The seqinfo of one session, from the cache in cache_path if inventory_path indexes the session
+# (see dicom_discover.cached_session), or read from the headers otherwise.
+# --------------------------------------------------------------------------------------
+def session_seqinfos(task):
+    subject_id, session_id, dicom_path, inventory_path, cache_path = task
+    series = dicom_inventory.read_inventory(inventory_path, dicom_path) if inventory_path else []
+    if not series or cache_path is None:
+        return dicom_discover.discover_session(dicom_path, inventory_path=inventory_path)
+    fingerprint = conversion_manifest.session_fingerprint(series)
+    return dicom_discover.cached_session(cache_path, subject_id, session_id, dicom_path, fingerprint, inventory_path)
+
+# --------------------------------------------------------------------------------------
+# plan_cohort: Runs the heuristic over the sessions, a list of (subject_id, session_id, dicom_path) tuples.
+# Returns the conversion keys of the heuristic (as labels, see key_label) and, for each session, its label, the number
+# of series assigned to each key and the seqinfo entries that no key takes.
+# --------------------------------------------------------------------------------------
+def plan_cohort(heuristic_file, sessions, inventory_path=None, cache_path=None, n_processes=DEFAULT_PROCESSES):
+    tasks = [(subject_id, session_id, dicom_path, inventory_path, cache_path) for subject_id, session_id, dicom_path in sessions]
+    with ProcessPoolExecutor(max_workers=max(1, min(n_processes, len(tasks) or 1))) as pool:
+        seqinfos = list(pool.map(session_seqinfos, tasks))
+
+    heuristic = convert_session.load_heuristic(heuristic_file)
+    labels = []
+    plans = []
+    for (subject_id, session_id, _), session_seqinfo in zip(sessions, seqinfos):
+        info = heuristic.infotodict(session_seqinfo)
+        for key in info:
+            if key_label(key) not in labels:
+                labels.append(key_label(key))
+        counts = Counter()
+        assigned = set()
+        for key, series_ids in info.items():
+            counts[key_label(key)] += len(series_ids)
+            assigned.update(series_id if isinstance(series_id, str) else series_id.get('item') for series_id in series_ids)
+        unassigned = [s for s in session_seqinfo if s.series_id not in assigned]
+        plans.append((convert_session.session_folder(subject_id, session_id), counts, unassigned, session_seqinfo))
+    return labels, plans
+
+# --------------------------------------------------------------------------------------
+# check_plans: Compares the sessions with each other (see the top of this file).
+# Returns the most common number of series of each key, the issues of each session ({session: [issue, ...]}, only for
+# the sessions with issues) and the protocol names that no session assigns.
+# --------------------------------------------------------------------------------------
+def check_plans(labels, plans):
+    expected = {label: Counter(counts[label] for _, counts, _, _ in plans).most_common(1)[0][0] for label in labels}
+    assigned_protocols = set()
+    for _, _, unassigned, seqinfo in plans:
+        unassigned_ids = {s.series_id for s in unassigned}
+        assigned_protocols.update(s.protocol_name for s in seqinfo if s.series_id not in unassigned_ids)
+    never_assigned = sorted({s.protocol_name for _, _, unassigned, _ in plans for s in unassigned} - assigned_protocols)
+    issues = {}
+    for session, counts, unassigned, _ in plans:
+        session_issues = []
+        for label in labels:
+            if counts[label] < expected[label]:
+                session_issues.append(f"missing: {label} ({counts[label]} series instead of {expected[label]})")
+            elif counts[label] > expected[label]:
+                session_issues.append(f"extra: {label} ({counts[label]} series instead of {expected[label]})")
+        for s in unassigned if session_issues else []:
+            if s.protocol_name in assigned_protocols:
+                session_issues.append(f"unassigned: series {s.series_id} (dim3 {s.dim3}, dim4 {s.dim4}, TR {s.TR})")
+        if session_issues:
+            issues[session] = session_issues
+    return expected, issues, never_assigned
+
+# --------------------------------------------------------------------------------------
+# format_matrix: The lines of the matrix printed by the dry run, with the keys as numbered columns.
+# --------------------------------------------------------------------------------------
+def format_matrix(labels, plans, expected, issues):
+    width = max([len('session')] + [len(session) for session, _, _, _ in plans])
+    lines = [f"K{i + 1:<3} {label} (usually {expected[label]})" for i, label in enumerate(labels)]
+    lines.append('')
+    lines.append(f"{'session':<{width}}" + ''.join(f"{f'K{i + 1}':>5}" for i in range(len(labels))) + '  check')
+    for session, counts, _, _ in plans:
+        cells = ''.join(f"{counts[label]:>5}" for label in labels)
+        lines.append(f"{session:<{width}}{cells}  {'!' if session in issues else ''}")
+    return lines
+
+# --------------------------------------------------------------------------------------
+# write_matrix: Writes the matrix as a tab-separated table, with the issues of each session.
+# --------------------------------------------------------------------------------------
+def write_matrix(table_file, labels, plans, issues):
+    tmp_file = f"{table_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write('\t'.join(['session'] + labels + ['issues']) + '\n')
+        for session, counts, _, _ in plans:
+            f.write('\t'.join([session] + [str(counts[label]) for label in labels] + ['; '.join(issues.get(session, []))]) + '\n')
+    os.replace(tmp_file, table_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a heuristic over the seqinfo of a cohort and show what each session would convert into.")
+    parser.add_argument('sessions', nargs='+', metavar='SUBJECT[:SESSION]=DICOM_PATH',
+                        help="subject ID (and session ID) and the path to its DICOM files")
+    parser.add_argument('--heuristic', required=True, help="heuristic file to run")
+    parser.add_argument('--inventory', help="DICOM inventory written by the launchers (see dicom_inventory.py)")
+    parser.add_argument('--cache', help="folder to cache the seqinfo in (default: the seqinfo folder next to the inventory)")
+    parser.add_argument('--processes', type=int, default=DEFAULT_PROCESSES, help="number of processes (default: %(default)s)")
+    parser.add_argument('--output', help="matrix to write as a tab-separated table")
+    args = parser.parse_args()
+
+    sessions = []
+    for spec in args.sessions:
+        ids, _, dicom_path = spec.partition('=')
+        subject_id, _, session_id = ids.partition(':')
+        if not dicom_path or not os.path.isdir(dicom_path):
+            sys.stderr.write(f"Dicom path not found: {dicom_path}. Exiting...\n")
+            sys.exit(1)
+        sessions.append((subject_id, session_id or None, dicom_path))
+    cache_path = args.cache or (os.path.join(os.path.dirname(os.path.abspath(args.inventory)), 'seqinfo') if args.inventory else None)
+
+    labels, plans = plan_cohort(args.heuristic, sessions, args.inventory, cache_path, args.processes)
+    expected, issues, never_assigned = check_plans(labels, plans)
+    print('\n'.join(format_matrix(labels, plans, expected, issues)))
+    if never_assigned:
+        print(f"\nProtocols not assigned in any session: {', '.join(never_assigned)}")
+    for session, session_issues in issues.items():
+        print(f"\n{session}:")
+        for issue in session_issues:
+            print(f"  {issue}")
+    print(f"\n{len(plans)} sessions planned with {args.heuristic}: {len(issues)} to check")
+    if args.output:
+        write_matrix(args.output, labels, plans, issues)
+        print(f"Matrix written to {args.output}")
+    if issues:
+        sys.exit(1)
@@ -0,0 +1,60 @@
+#!/bin/bash
+
+# ============================================================
+# This script runs a heuristic over the DICOM headers of a cohort, without converting anything (see dry_run.py).
+# The launchers run it instead of submitting the conversions when DRY_RUN is set (see DRY_RUN in the launchers).
+#
+# Usage: ./dry_run.sh <code_path> <heuristic_file> <inventory_path> <output_file> <n_processes> <subject_id>[:<session_id>]=<dicom_path> [...]
+#
+# Arguments:
+#   <code_path> is the folder with the conversion scripts (dry_run.py)
+#   <heuristic_file> is the heudiconv heuristic to run
+#   <inventory_path> is the snapshot of the DICOM inventory written by the launcher (see dicom_inventory.py)
+#   <output_file> is the table to write the matrix of the conversion keys of each session into
+#   <n_processes> is the number of sessions whose DICOM headers are read at the same time
+#   <subject_id>[:<session_id>]=<dicom_path> are the sessions of the cohort
+#
+# Notes:
+#   The DICOM headers read are cached next to the inventory (in the seqinfo folder), so a dry run of a cohort that
+#   did not change only runs the heuristic. The script fails if any session has to be checked.
+#
+# Example usage:
+#   ./dry_run.sh /path/to/code /path/to/heuristic.py /path/to/output/.bids_conversion/dicom_inventory /path/to/output/.bids_conversion/dry_run.tsv 4 13_TRIO_1=/mridata/cbu/CBU140905_CAMCAN_CALIBRATIONS
+#
+# It is assumed that you have a conda environment called 'heudiconv' available (check with 'conda env list').
+# If not, create a conda environment with the heudiconv and dcm2niix packages installed.
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Parse the arguments passed to the script
+# ------------------------------------------------------------
+CODE_PATH="${1}"
+HEURISTIC_FILE="${2}"
+INVENTORY_PATH="${3}"
+OUTPUT_FILE="${4}"
+N_PROCESSES="${5}"
+SESSIONS=("${@:6}")
+
+# ------------------------------------------------------------
+# Activate the heudiconv environment
+# ------------------------------------------------------------
+conda activate heudiconv
+
+# ------------------------------------------------------------
+# Run the heuristic over the sessions
+# ------------------------------------------------------------
+python "${CODE_PATH}/dry_run.py" \
+    --heuristic "${HEURISTIC_FILE}" \
+    --inventory "${INVENTORY_PATH}" \
+    --processes "${N_PROCESSES}" \
+    --output "${OUTPUT_FILE}" \
+    "${SESSIONS[@]}"
+dry_run_status=$?
+
+# ------------------------------------------------------------
+# Deactivate the heudiconv environment
+# ------------------------------------------------------------
+conda deactivate
+
+exit ${dry_run_status}
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Execution backends for the conversion jobs.
+#
+# The launchers (dicom_to_bids_multiple_subjects*.py) run the job script (heudiconv_script*.sh) once per
+# array task. Where these tasks run is decided by the executor:
+#   - SlurmExecutor submits them as a SLURM job array with sbatch (the default, on the CBU cluster)
+#   - LocalExecutor runs them on this machine, at most max_workers at the same time
+#
+# Both executors write the output of each task to the same files, {log_path}/heudiconv_job_<job_id>_<task_id>.out/.err
+# (as SLURM's %A_%a pattern), log what they do to {log_path}/launcher.log, and report the exit status of the
+# tasks in the same way (see collect_status), so the rest of the pipeline does not depend on where the tasks ran.
+#
+# Both executors take the CPUs (cpus), memory (mem_mb) and time limit (time_minutes) of each task: SLURM enforces
+# them (--cpus-per-task, --mem, --time), the local executor kills a task that runs out of time and caps the address
+# space of its processes (its CPUs are not reserved: max_workers bounds the number of tasks running at the same time).
+# The outcome of each task (see task_outcomes) is read from the scheduler (sacct, or the status file of the local
+# executor) and from the end of the task's error file: succeeded (COMPLETED), FAILED, TIMEOUT or OUT_OF_MEMORY.
+# A task that timed out or ran out of memory can be submitted again with more time or memory (see escalate and
+# task_manifest.py resubmit), from the limit it was submitted with, or else the one the scheduler gave it (see
+# task_limits: sacct's ReqMem and Timelimit).
+#
+# To spare the shared storage, max_running bounds the number of tasks of a job running at the same time (SLURM's
+# --array=...%N), and a job can be made to wait for earlier jobs (after_job_ids, e.g. the previous chunk of a cohort
+# that does not fit in one job array, see max_array_size).
+#
+# Usage (to check the tasks of a job that was submitted before):
+#   python execution_backends.py status <slurm|local> <log_path> <job_id>
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To set the environment of the local tasks
+import re # To recognise time limits and memory errors in the error files
+import sys # To read the command line arguments
+import math # To round the memory and time limits up for sbatch
+import time # To name the local jobs
+import signal # To stop the local tasks that run out of time
+import itertools # To number the local jobs submitted in the same second
+import logging # To log what the executors do
+import subprocess # To run sbatch/sacct and the local tasks
+from concurrent.futures import ThreadPoolExecutor # To bound the number of local tasks running at the same time
+
+# Logger shared by the launchers and the executors
+logger = logging.getLogger('bids_conversion')
+
+# Task states reported by collect_status (a subset of SLURM's job states)
+COMPLETED = 'COMPLETED'
+FAILED = 'FAILED'
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+TIMEOUT = 'TIMEOUT'
+OUT_OF_MEMORY = 'OUT_OF_MEMORY'
+
+# Messages in the error file of a task that mean it ran out of time or memory, whatever its state
+# (e.g. SLURM reports a task cancelled at its time limit as CANCELLED, and a memory error in Python as FAILED)
+LOG_PATTERNS = (
+    (TIMEOUT, re.compile(r'DUE TO TIME LIMIT')),
+    (OUT_OF_MEMORY, re.compile(r'oom[-_ ]kill|Exceeded (job|step) memory limit|MemoryError|std::bad_alloc|Cannot allocate memory|failed to map segment')),
+)
+
+# Bytes read from the end of an error file to classify its task (the errors that ended the task are at the end)
+LOG_TAIL_BYTES = 64 * 1024
+
+# Largest job array allowed by SLURM when it cannot be asked (its default MaxArraySize: task IDs 0 to 1000)
+DEFAULT_MAX_ARRAY_SIZE = 1001
+
+# Units of the memory limits reported by sacct (ReqMem), in MB
+MEMORY_UNITS_MB = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+
+# --------------------------------------------------------------------------------------
+# setup_logging: Logs to the console and to {log_path}/launcher.log.
+# --------------------------------------------------------------------------------------
+def setup_logging(log_path):
+    if logger.handlers:
+        return logger
+    os.makedirs(log_path, exist_ok=True)
+    formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
+    for handler in (logging.StreamHandler(), logging.FileHandler(os.path.join(log_path, 'launcher.log'))):
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    return logger
+
+# --------------------------------------------------------------------------------------
+# log_file: Path of a file written for a task in the job logs folder: its output (ext='out'), errors (ext='err')
+# or metrics (ext='metrics.json', see task_metrics.py).
+# --------------------------------------------------------------------------------------
+def log_file(log_path, job_name, job_id, task_id, ext):
+    return os.path.join(log_path, f"{job_name}_job_{job_id}_{task_id}.{ext}")
+
+# --------------------------------------------------------------------------------------
+# Executor: What both executors have in common.
+# --------------------------------------------------------------------------------------
+class Executor:
+    name = None
+
+    def __init__(self, log_path, job_name='heudiconv'):
+        self.log_path = log_path
+        self.job_name = job_name
+        setup_logging(log_path)
+
+    # Path of the output (ext='out') or error (ext='err') file of a task
+    def log_file(self, job_id, task_id, ext):
+        return log_file(self.log_path, self.job_name, job_id, task_id, ext)
+
+    # Returns the end of the error file of a task ('' if there is none)
+    def log_tail(self, job_id, task_id):
+        try:
+            with open(self.log_file(job_id, task_id, 'err'), 'rb') as f:
+                f.seek(max(0, os.fstat(f.fileno()).st_size - LOG_TAIL_BYTES))
+                return f.read().decode('utf-8', 'replace')
+        except FileNotFoundError:
+            return ''
+
+    # Runs (or submits) script once per task ID, with the same arguments for every task.
+    # Each task gets its ID in the SLURM_ARRAY_TASK_ID environment variable. Returns the job ID.
+    def submit(self, script, args, task_ids):
+        raise NotImplementedError
+
+    # Returns a dictionary mapping each task ID of a job to its (state, exit_code)
+    def collect_status(self, job_id):
+        raise NotImplementedError
+
+    # Number of task IDs a job can have (task IDs 0 to max_array_size - 1), None if there is no limit
+    def max_array_size(self):
+        return None
+
+    # Returns a dictionary mapping each task ID of a job to the limits the scheduler gave it: {'mem_mb', 'time_minutes'},
+    # None where it has no limit (or the limit is not known)
+    def task_limits(self, job_id):
+        return {}
+
+    # Returns a dictionary mapping each task ID of a job to its (outcome, exit_code), see classify_task
+    def task_outcomes(self, job_id):
+        outcomes = {}
+        for task_id, (state, exit_code) in self.collect_status(job_id).items():
+            log_tail = self.log_tail(job_id, task_id) if state not in (COMPLETED, PENDING, RUNNING) else ''
+            outcomes[task_id] = (classify_task(state, exit_code, log_tail), exit_code)
+        return outcomes
+
+    # Logs a summary of the task outcomes of a job and returns the IDs of the tasks that failed (for any reason)
+    def report(self, job_id):
+        outcomes = self.task_outcomes(job_id)
+        failed = sorted(task_id for task_id, (outcome, _) in outcomes.items() if outcome not in (COMPLETED, PENDING, RUNNING))
+        counts = {}
+        for outcome, _ in outcomes.values():
+            counts[outcome] = counts.get(outcome, 0) + 1
+        logger.info(f"Job {job_id}: " + ', '.join(f"{n} {outcome.lower()}" for outcome, n in sorted(counts.items())))
+        for task_id in failed:
+            outcome, exit_code = outcomes[task_id]
+            logger.error(f"Task {task_id} {outcome.lower()} (exit code {exit_code}), see {self.log_file(job_id, task_id, 'err')}")
+        return failed
+
+# --------------------------------------------------------------------------------------
+# SlurmExecutor: Submits the tasks as a SLURM job array.
+#
+# sbatch_options is a list of extra sbatch options (e.g. ['--cpus-per-task=4']).
+# cpus, mem_mb and time_minutes are the CPUs, memory and time limit of each task (the cluster defaults if None).
+# --------------------------------------------------------------------------------------
+class SlurmExecutor(Executor):
+    name = 'slurm'
+
+    def __init__(self, log_path, job_name='heudiconv', sbatch_options=None, cpus=None, mem_mb=None, time_minutes=None,
+                 max_running=None, after_job_ids=None):
+        super().__init__(log_path, job_name)
+        self.max_running = max_running
+        self.sbatch_options = list(sbatch_options or [])
+        if after_job_ids:
+            self.sbatch_options.append(f"--dependency=afterany:{':'.join(str(job_id) for job_id in after_job_ids)}")
+        if cpus and cpus > 1:
+            self.sbatch_options.append(f"--cpus-per-task={int(cpus)}")
+        if mem_mb:
+            self.sbatch_options.append(f"--mem={math.ceil(mem_mb)}M")
+        if time_minutes:
+            self.sbatch_options.append(f"--time={math.ceil(time_minutes)}")
+
+    def submit(self, script, args, task_ids):
+        command = [
+            'sbatch', '--parsable',
+            f"--array={format_array(task_ids)}" + (f"%{self.max_running}" if self.max_running else ''),
+            f"--job-name={self.job_name}",
+            f"--output={self.log_file('%A', '%a', 'out')}",
+            f"--error={self.log_file('%A', '%a', 'err')}",
+        ] + self.sbatch_options + [script] + list(args)
+        logger.info(f"Submitting {len(task_ids)} tasks to SLURM: {' '.join(command[:len(command) - len(args)])}")
+        result = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        # --parsable prints "<job_id>" or "<job_id>;<cluster>"
+        job_id = result.stdout.strip().split(';')[0]
+        logger.info(f"Submitted job {job_id}. Check its tasks with: python {os.path.abspath(__file__)} status slurm {self.log_path} {job_id}")
+        return job_id
+
+    def collect_status(self, job_id):
+        result = subprocess.run(
+            ['sacct', '-j', str(job_id), '--format=JobID,State,ExitCode', '--parsable2', '--noheader'],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        return parse_sacct(result.stdout)
+
+    def task_limits(self, job_id):
+        result = subprocess.run(
+            ['sacct', '-j', str(job_id), '--format=JobID,ReqMem,Timelimit,ReqCPUS', '--parsable2', '--noheader'],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        return parse_sacct_limits(result.stdout)
+
+    def max_array_size(self):
+        try:
+            result = subprocess.run(['scontrol', 'show', 'config'], check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError):
+            return DEFAULT_MAX_ARRAY_SIZE
+        match = re.search(r'^MaxArraySize\s*=\s*(\d+)', result.stdout, re.M)
+        return int(match.group(1)) if match else DEFAULT_MAX_ARRAY_SIZE
+
+# --------------------------------------------------------------------------------------
+# LocalExecutor: Runs the tasks on this machine, at most max_workers at the same time.
+#
+# Each task is a separate process (bash running the job script), so the thread pool only waits on them.
+# submit() returns when all the tasks have finished, and their states and exit codes are saved in
+# {log_path}/<job_name>_job_<job_id>.status for collect_status (the local stand-in for sacct).
+#
+# A task still running after time_minutes is killed (with all its processes) and reported as TIMEOUT, with the
+# same message in its error file as SLURM. mem_mb caps the address space of each process of the task, so a task
+# that needs more fails with a memory error (this is stricter than SLURM, which limits the resident memory).
+# --------------------------------------------------------------------------------------
+class LocalExecutor(Executor):
+    name = 'local'
+
+    def __init__(self, log_path, job_name='heudiconv', max_workers=None, cpus=None, mem_mb=None, time_minutes=None,
+                 max_running=None, after_job_ids=None):
+        super().__init__(log_path, job_name)
+        # The local jobs run one after the other (submit returns when a job is done), so after_job_ids is always satisfied
+        self.max_workers = min(max_workers or os.cpu_count() or 1, max_running or float('inf'))
+        self.cpus = cpus
+        self.mem_mb = mem_mb
+        self.time_minutes = time_minutes
+
+    def status_file(self, job_id):
+        return os.path.join(self.log_path, f"{self.job_name}_job_{job_id}.status")
+
+    # Runs one task and returns its (state, exit_code)
+    def run_task(self, job_id, script, args, task_id):
+        env = dict(os.environ, SLURM_ARRAY_JOB_ID=str(job_id), SLURM_ARRAY_TASK_ID=str(task_id))
+        logger.info(f"Task {task_id} started")
+        command = ['bash', script] + list(args)
+        if self.mem_mb:
+            # ulimit -v (in kB) is set by the shell, as the processes are started from the threads of submit
+            command = ['bash', '-c', f"ulimit -v {int(self.mem_mb * 1024)} && exec bash \"$0\" \"$@\""] + command[1:]
+        with open(self.log_file(job_id, task_id, 'out'), 'w') as out, open(self.log_file(job_id, task_id, 'err'), 'w') as err:
+            process = subprocess.Popen(command, stdout=out, stderr=err, env=env, start_new_session=True)
+            try:
+                exit_code = process.wait(timeout=self.time_minutes * 60 if self.time_minutes else None)
+                state = COMPLETED if exit_code == 0 else FAILED
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                exit_code = process.wait()
+                state = TIMEOUT
+                err.write(f"*** LOCAL TASK {job_id}_{task_id} CANCELLED AT {time.strftime('%Y-%m-%dT%H:%M:%S')} DUE TO TIME LIMIT ***\n")
+        logger.info(f"Task {task_id} finished with exit code {exit_code}")
+        return state, exit_code
+
+    # A new job ID: the time of the submission, the process ID and a counter, reserved by creating the status file
+    # of the job (so that two submissions in the same second never share their log, status and metrics files)
+    def new_job_id(self):
+        os.makedirs(self.log_path, exist_ok=True)
+        stamp = time.strftime('%Y%m%d%H%M%S')
+        for n in itertools.count():
+            job_id = f"local{stamp}-{os.getpid()}-{n}"
+            try:
+                os.close(os.open(self.status_file(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return job_id
+            except FileExistsError:
+                continue
+
+    def submit(self, script, args, task_ids):
+        job_id = self.new_job_id()
+        logger.info(f"Running {len(task_ids)} tasks locally as job {job_id} ({self.max_workers} at a time)")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            results = list(pool.map(lambda task_id: self.run_task(job_id, script, args, task_id), task_ids))
+        with open(self.status_file(job_id), 'w') as f:
+            for task_id, (state, exit_code) in zip(task_ids, results):
+                f.write(f"{task_id}\t{exit_code}\t{state}\n")
+        return job_id
+
+    def collect_status(self, job_id):
+        status = {}
+        with open(self.status_file(job_id)) as f:
+            for line in f:
+                fields = line.split()
+                # Status files written before the state was saved only have the exit code
+                state = fields[2] if len(fields) > 2 else (COMPLETED if fields[1] == '0' else FAILED)
+                status[int(fields[0])] = (state, int(fields[1]))
+        return status
+
+# --------------------------------------------------------------------------------------
+# get_executor: Creates the executor called name ('slurm' or 'local').
+# --------------------------------------------------------------------------------------
+def get_executor(name, log_path, job_name='heudiconv', **options):
+    executors = {executor.name: executor for executor in (SlurmExecutor, LocalExecutor)}
+    if name not in executors:
+        raise ValueError(f"Unknown executor '{name}' (expected one of: {', '.join(sorted(executors))})")
+    return executors[name](log_path, job_name, **options)
+
+# --------------------------------------------------------------------------------------
+# classify_task: Returns the outcome of a task from its state, exit code and the end of its error file:
+# COMPLETED, PENDING or RUNNING as reported, TIMEOUT or OUT_OF_MEMORY if the scheduler or the error file
+# says so (a task killed by SIGKILL, e.g. by the kernel's OOM killer, is counted as OUT_OF_MEMORY), FAILED otherwise.
+# --------------------------------------------------------------------------------------
+def classify_task(state, exit_code, log_tail=''):
+    if state in (COMPLETED, PENDING, RUNNING, TIMEOUT, OUT_OF_MEMORY):
+        return state
+    for outcome, pattern in LOG_PATTERNS:
+        if pattern.search(log_tail):
+            return outcome
+    if exit_code in (-signal.SIGKILL, 128 + signal.SIGKILL):
+        return OUT_OF_MEMORY
+    return FAILED
+
+# --------------------------------------------------------------------------------------
+# escalate: Returns the executor options to submit a task again with, given its outcome: twice the time for
+# a task that timed out, twice the memory for a task that ran out of memory, the same options otherwise (e.g. for a
+# task that failed because of its data).
+#
+# The time or memory doubled is the one the task was submitted with (executor_options), or else the one the scheduler
+# gave it (limits, see Executor.task_limits). Raises ValueError if neither is known.
+# --------------------------------------------------------------------------------------
+def escalate(executor_options, outcome, limits=None, factor=2):
+    options = dict(executor_options)
+    escalated = {TIMEOUT: ('time_minutes', 'TASK_TIME_MINUTES'), OUT_OF_MEMORY: ('mem_mb', 'TASK_MEM_MB')}
+    if outcome in escalated:
+        key, setting = escalated[outcome]
+        base = options.get(key) or (limits or {}).get(key)
+        if not base:
+            raise ValueError(f"Cannot escalate a task that ended with {outcome}: its {key} is not known (it was submitted "
+                             f"without one, and the scheduler does not report one). Set {setting} in the launcher.")
+        options[key] = base * factor
+    return options
+
+# --------------------------------------------------------------------------------------
+# format_array: Formats task IDs as a SLURM --array specification, merging consecutive IDs
+# into ranges (e.g. [0, 1, 2, 5] -> '0-2,5').
+# --------------------------------------------------------------------------------------
+def format_array(task_ids):
+    task_ids = sorted(task_ids)
+    ranges = []
+    start = previous = task_ids[0]
+    for task_id in task_ids[1:] + [None]:
+        if task_id is not None and task_id == previous + 1:
+            previous = task_id
+            continue
+        ranges.append(str(start) if start == previous else f"{start}-{previous}")
+        start = previous = task_id
+    return ','.join(ranges)
+
+# --------------------------------------------------------------------------------------
+# pack_tasks: Groups subjects into tasks, so that each task converts several subjects one after the other
+# (saving the scheduling and start-up time of one task per subject). sizes are the sizes of the subjects
+# (e.g. their DICOM bytes). Returns one list of subject positions per task.
+#
+# If bytes_per_task is given, the subjects are packed by size: largest first, each into the first task
+# that stays under bytes_per_task (a subject larger than bytes_per_task gets a task of its own).
+# Otherwise, consecutive subjects are packed subjects_per_task at a time.
+# --------------------------------------------------------------------------------------
+def pack_tasks(sizes, subjects_per_task=1, bytes_per_task=None):
+    if not bytes_per_task:
+        n = max(1, subjects_per_task)
+        return [list(range(start, min(start + n, len(sizes)))) for start in range(0, len(sizes), n)]
+    tasks = []
+    loads = []
+    for index in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        for t, load in enumerate(loads):
+            if load + sizes[index] <= bytes_per_task:
+                tasks[t].append(index)
+                loads[t] += sizes[index]
+                break
+        else:
+            tasks.append([index])
+            loads.append(sizes[index])
+    return sorted(sorted(task) for task in tasks)
+
+# --------------------------------------------------------------------------------------
+# parse_sacct: Parses the output of 'sacct --format=JobID,State,ExitCode --parsable2 --noheader'
+# into a dictionary mapping each task ID to its (state, exit_code).
+# Job steps (e.g. 1234_0.batch) are skipped, and tasks that did not start yet (1234_[3-5]) are reported as PENDING.
+# --------------------------------------------------------------------------------------
+def parse_sacct(output):
+    status = {}
+    for line in output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 3 or '.' in fields[0] or '_' not in fields[0]:
+            continue
+        job_task, state, exit_code = fields[:3]
+        tasks = job_task.split('_', 1)[1]
+        # e.g. "CANCELLED by 1234" -> "CANCELLED"
+        state = state.split()[0] if state else PENDING
+        exit_code = int(exit_code.split(':')[0]) if exit_code else 0
+        if tasks.startswith('['):
+            for task_id in task_ids(tasks):
+                status[task_id] = (PENDING, 0)
+        else:
+            status[int(tasks)] = (state, exit_code)
+    return status
+
+# --------------------------------------------------------------------------------------
+# task_ids: The task IDs of the task part of a sacct JobID: one task ('3'), or the tasks that did not start yet
+# ('[3-7,9%2]', the %2 being the limit of tasks running at the same time).
+# --------------------------------------------------------------------------------------
+def task_ids(tasks):
+    if not tasks.startswith('['):
+        return [int(tasks)]
+    ids = []
+    for spec in tasks.strip('[]').split('%')[0].split(','):
+        first, _, last = spec.partition('-')
+        ids.extend(range(int(first), int(last or first) + 1))
+    return ids
+
+# --------------------------------------------------------------------------------------
+# parse_memory: Parses a memory limit reported by sacct (ReqMem, e.g. '16000M', '16G', or '4000Mc' per CPU and
+# '16000Mn' per node with older SLURM) into MB. Returns None for no limit.
+# --------------------------------------------------------------------------------------
+def parse_memory(value, n_cpus=1):
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)([nc]?)$', value.strip())
+    if not match or not float(match.group(1)):
+        return None
+    mem_mb = float(match.group(1)) * MEMORY_UNITS_MB[match.group(2) or 'M']
+    return mem_mb * n_cpus if match.group(3) == 'c' else mem_mb
+
+# --------------------------------------------------------------------------------------
+# parse_time_limit: Parses a time limit reported by sacct (Timelimit: [days-]hours:minutes:seconds, e.g. '08:00:00'
+# or '1-12:00:00') into minutes. Returns None for no limit ('UNLIMITED', 'Partition_Limit', ...).
+# --------------------------------------------------------------------------------------
+def parse_time_limit(value):
+    match = re.match(r'^(?:(\d+)-)?(\d+(?::\d+){0,2})$', value.strip())
+    if not match:
+        return None
+    parts = [int(part) for part in match.group(2).split(':')]
+    # With fewer than three fields, sacct leaves out the hours (minutes:seconds), or prints minutes only
+    hours, minutes, seconds = ([0] * (3 - len(parts)) + parts) if len(parts) > 1 else (0, parts[0], 0)
+    return int(match.group(1) or 0) * 24 * 60 + hours * 60 + minutes + seconds / 60
+
+# --------------------------------------------------------------------------------------
+# parse_sacct_limits: Parses the output of 'sacct --format=JobID,ReqMem,Timelimit,ReqCPUS --parsable2 --noheader'
+# into a dictionary mapping each task ID to its {'mem_mb', 'time_minutes'} (see parse_sacct for the task IDs).
+# --------------------------------------------------------------------------------------
+def parse_sacct_limits(output):
+    limits = {}
+    for line in output.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 4 or '.' in fields[0] or '_' not in fields[0]:
+            continue
+        job_task, req_mem, time_limit, req_cpus = fields[:4]
+        task_limits = {'mem_mb': parse_memory(req_mem, int(req_cpus or 1)), 'time_minutes': parse_time_limit(time_limit)}
+        for task_id in task_ids(job_task.split('_', 1)[1]):
+            limits[task_id] = task_limits
+    return limits
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5 or sys.argv[1] != 'status':
+        sys.stderr.write("Usage: execution_backends.py status <slurm|local> <log_path> <job_id>\n")
+        sys.exit(1)
+    executor = get_executor(sys.argv[2], sys.argv[3])
+    sys.exit(1 if executor.report(sys.argv[4]) else 0)
@@ -3,23 +3,32 @@
 # ============================================================
 # This script runs the HeuDiConv tool to convert DICOM files to NIfTI files and organize them into a BIDS structure.
 # The script is designed to be run on a SLURM cluster.
-# 
-# Usage: sbatch heudiconv_script.sh <subject_id_list> <dicom_path_list> <heuristic_file> <output_path>
-# 
+#
+# Usage: sbatch heudiconv_script_multisession.sh <task_manifest> <heuristic_file> <output_path> <code_path> <manifest_path> <inventory_path>
+#
 # Arguments:
-#   <subject_id_list> is a list of subject IDs to process, separated by spaces
-#   <session_id_list> is a list of session IDs to process, separated by spaces
-#   <dicom_path_list> is a list of paths to the DICOM files for each subject, separated by spaces
+#   <task_manifest> is the task manifest written by the launcher (see task_manifest.py): for each task, the subject IDs, session IDs,
+#                   paths to the DICOM files and number of shards of the sessions it converts
 #   <heuristic_file> is the name of the heuristic file to use (e.g. heuristic.py)
 #   <output_path> is the path to the output directory
+#   <code_path> is the folder with the conversion scripts (run_task.py)
+#   <manifest_path> is the folder with the conversion manifest records (see conversion_manifest.py)
+#   <inventory_path> is the snapshot of the DICOM inventory written by the launcher (see dicom_inventory.py)
 #
 # Notes:
-#   <subject_id_list> and <dicom_path_list> should be the same length.
-# 
-# Example usage: 
-#   sbatch --array=0-1 heudiconv_script.sh "01 02" "/path/to/dicom/sub-01 /path/to/dicom/sub-02" heuristic.py /path/to/output
+#   Each task converts its sessions one after the other with run_task.py, in one Python process in the heudiconv environment.
+#   With more than one shard, a session is converted by convert_session.py, which runs one heudiconv per group of series in parallel.
+#   When a conversion finishes, the session's manifest record is marked as 'done' (or 'failed'),
+#   so that the launcher does not submit it again unless its DICOM files or the heuristic change.
+#   The task fails if any of its sessions failed.
+#   The timings, memory and I/O of the task are written next to its output and error files, in heudiconv_job_<job_id>_<task_id>.metrics.json (see task_metrics.py).
+#   The series folders to convert are read from <inventory_path> (or found by walking the DICOM folder if it is not
+#   in the inventory) and passed to heudiconv as folders, so no list of DICOM files is expanded on the command line.
+#
+# Example usage:
+#   sbatch --array=0-1 heudiconv_script_multisession.sh /path/to/output/.bids_conversion/tasks/tasks_20240101120000.tsv heuristic.py /path/to/output /path/to/code /path/to/output/.bids_conversion/manifest /path/to/output/.bids_conversion/dicom_inventory
 #
-# It is assumed that you have a conda environment called 'heudiconv' available (check with 'conda env list'). 
+# It is assumed that you have a conda environment called 'heudiconv' available (check with 'conda env list').
 # If not, create a conda environment with the heudiconv and dcm2niix packages installed.
 #
 # ============================================================
@@ -27,11 +36,12 @@
 # ------------------------------------------------------------
 # Parse the arguments passed to the script
 # ------------------------------------------------------------
-SUBJECT_ID_LIST=($1)
-SESSION_ID_LIST=($2)
-DICOM_PATH_LIST=($3)
-HEURISTIC_FILE="${4}"
-OUTPUT_PATH="${5}"
+TASK_MANIFEST="${1}"
+HEURISTIC_FILE="${2}"
+OUTPUT_PATH="${3}"
+CODE_PATH="${4}"
+MANIFEST_PATH="${5}"
+INVENTORY_PATH="${6}"
 
 # ------------------------------------------------------------
 # Get the SLURM job task ID
@@ -39,52 +49,40 @@ OUTPUT_PATH="${5}"
 task_id=$SLURM_ARRAY_TASK_ID
 
 # ------------------------------------------------------------
-# Set the DICOM path, session, and subject ID for this task
-# ------------------------------------------------------------
-SUBJECT_ID=${SUBJECT_ID_LIST[$task_id]}
-SESSION_ID=${SESSION_ID_LIST[$task_id]}
-DICOM_PATH=${DICOM_PATH_LIST[$task_id]}
-
-# ------------------------------------------------------------
-# Print out some information about the script (it will be saved in the SLURM output file)
-# ------------------------------------------------------------
-echo "Processing session ${SESSION_ID} for subject ${SUBJECT_ID}"
-echo "DICOM path: ${DICOM_PATH}"
-
-# ------------------------------------------------------------
-# Activate the heudiconv environment
+# Activate the heudiconv environment (once for all the sessions of this task)
 # ------------------------------------------------------------
 conda activate heudiconv
 
 # ------------------------------------------------------------
-# Run the heudiconv
+# Convert the sessions of this task
 # ------------------------------------------------------------
-heudiconv \
-    --files "${DICOM_PATH}"/*/*/*.dcm \
-    --outdir "${OUTPUT_PATH}" \
-    --heuristic "${HEURISTIC_FILE}" \
-    --subjects "${SUBJECT_ID}" \
-    --ses "${SESSION_ID}" \
-    --converter dcm2niix \
-    --bids \
-    --overwrite
+python "${CODE_PATH}/run_task.py" \
+    "${TASK_MANIFEST}" \
+    "${task_id}" \
+    "${HEURISTIC_FILE}" \
+    "${OUTPUT_PATH}" \
+    "${MANIFEST_PATH}" \
+    "${INVENTORY_PATH}"
+task_status=$?
 
 # ------------------------------------------------------------
 # Deactivate the heudiconv environment
 # ------------------------------------------------------------
 conda deactivate
 
+exit ${task_status}
+
 # ============================================================
-# HeudiConv parameters:
-# --files: Files or directories containing files to process
-# --outdir: Output directory
-# --heuristic: Name of a known heuristic or path to the Python script containing heuristic
-# --subjects: Subject ID
-# --session: Session ID
-# --converter : dicom to nii converter (dcm2niix or none)
-# --bids: Flag for output into BIDS structure
-# --overwrite: Flag to overwrite existing files
-# 
-# For a full list of parameters, see: https://heudiconv.readthedocs.io/en/latest/usage.html 
+# run_task.py runs heudiconv with the following parameters, for each subject (and session) of the task:
+# files: the series folders of the subject
+# outdir: <output_path>
+# heuristic: <heuristic_file>
+# subjs: the subject ID
+# session: the session ID
+# converter: dcm2niix
+# bids_options: output into BIDS structure
+# overwrite: overwrite existing files (only subjects whose inputs or heuristic changed are submitted)
+#
+# For a full list of parameters, see: https://heudiconv.readthedocs.io/en/latest/usage.html
 #
-# ============================================================
\ No newline at end of file
+# ============================================================
@@ -0,0 +1,60 @@
+#!/bin/bash
+
+# ============================================================
+# This script runs a long-lived conversion worker, which converts the subjects (or sessions) of a queue folder one
+# after the other until the queue is empty (see conversion_queue.py and conversion_worker.py).
+# The script is designed to be run on a SLURM cluster, once per node (as a job array with one task per worker).
+#
+# Usage: sbatch heudiconv_worker.sh <code_path> <queue_path> [<idle_seconds>]
+#
+# Arguments:
+#   <code_path> is the folder with the conversion scripts (conversion_worker.py)
+#   <queue_path> is the queue folder filled by the launcher (e.g. /path/to/output/.bids_conversion/queue), with the
+#                heuristic file, output path, conversion manifest and DICOM inventory to use in its config.json
+#   <idle_seconds> is how long the worker waits for new conversions once the queue is empty (default: 60)
+#
+# Notes:
+#   The heudiconv environment is activated, and heudiconv and the heuristic are imported, once for all the conversions of the worker.
+#   Each worker takes the largest conversion left in the queue, so the workers stay busy until the queue is empty
+#   however the sizes of the subjects are spread.
+#   When a conversion finishes, the subject's manifest record is marked as 'done' (or 'failed'), and its queue file is
+#   moved to done/ (or failed/). To see the queue, and to put the failed conversions back into it, run:
+#     python conversion_queue.py status <queue_path>
+#     python conversion_queue.py retry <queue_path>
+#   The worker fails if any of its conversions failed.
+#   The timings, memory and I/O of the worker are written next to its output and error files, in heudiconv_worker_job_<job_id>_<task_id>.metrics.json (see task_metrics.py).
+#
+# Example usage:
+#   sbatch --array=0-7 heudiconv_worker.sh /path/to/code /path/to/output/.bids_conversion/queue
+#
+# It is assumed that you have a conda environment called 'heudiconv' available (check with 'conda env list').
+# If not, create a conda environment with the heudiconv and dcm2niix packages installed.
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Parse the arguments passed to the script
+# ------------------------------------------------------------
+CODE_PATH="${1}"
+QUEUE_PATH="${2}"
+IDLE_SECONDS="${3:-60}"
+
+# ------------------------------------------------------------
+# Activate the heudiconv environment (once for all the conversions of this worker)
+# ------------------------------------------------------------
+conda activate heudiconv
+
+# ------------------------------------------------------------
+# Convert the subjects of the queue until it is empty
+# ------------------------------------------------------------
+python "${CODE_PATH}/conversion_worker.py" \
+    "${QUEUE_PATH}" \
+    "${IDLE_SECONDS}"
+worker_status=$?
+
+# ------------------------------------------------------------
+# Deactivate the heudiconv environment
+# ------------------------------------------------------------
+conda deactivate
+
+exit ${worker_status}
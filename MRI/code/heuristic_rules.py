@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Rule engine for the heudiconv heuristics (bids_heuristic*.py).
+#
+# Instead of writing infotodict as a chain of 'if' tests on every series, a heuristic declares its conversion keys
+# and a table of rules, e.g.:
+#   KEYS = {
+#       'anat': create_key('sub-{subject}/anat/sub-{subject}_T1w'),
+#       'func_task': create_key('sub-{subject}/func/sub-{subject}_task-video_run-{item:02d}_bold'),
+#       'func_sbref': create_key('sub-{subject}/func/sub-{subject}_task-video_run-{item:02d}_sbref'),
+#   }
+#   RULES = [
+#       {'key': 'anat', 'protocol': 'MPRAGE'},
+#       {'key': 'func_task', 'dim4': (101, None)},
+#       {'key': 'func_sbref', 'protocol': 'MB2_AP_2', 'dim4': 1, 'pair_with': 'func_task'},
+#   ]
+#   infotodict = RuleSet(KEYS, RULES).infotodict
+#
+# Each rule assigns the series that match all its conditions to the conversion key named by 'key':
+#   - 'protocol': a substring (or a list of substrings, any of which) of the protocol name
+#   - 'protocol_regex': a regular expression searched in the protocol name
+#   - any other seqinfo field (see SEQINFO_FIELDS, e.g. 'dim3', 'dim4', 'TR', 'series_description', 'is_derived'): a value
+#     the field must be equal to, or a (min, max) pair it must be within (inclusive, None for no bound). For a tuple field
+#     (image_type), a value it must contain.
+#   - 'pair_with': the key of the series this one is the reference of. The series is not assigned on its own: it is
+#     assigned when a later series is assigned to that key (e.g. a BOLD run), if it is the latest series matching the
+#     rule since the previous one (e.g. the sbref taken just before the run), so the reference of a cancelled run is
+#     replaced by the one of the next run. The references are listed in the order of the series they belong to.
+# A series can be assigned to several keys, as with the 'if' chains, and rules can share a key.
+#
+# The protocol conditions are the same for all the series with the same protocol name, and a cohort only has a few
+# distinct protocol names (one per sequence of each scanner). The rule set therefore indexes its rules by protocol
+# name: the protocol conditions are evaluated once per distinct name, and each series is only checked against the
+# remaining conditions of the rules its protocol name selects. Matching stays fast for sessions with hundreds of series
+# and in one process going through thousands of sessions (e.g. a dry run over a cohort).
+#
+# Usage (in a heuristic file, see bids_heuristic_sbref.py):
+#   from heuristic_rules import create_key, RuleSet
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import re # To match the protocol names
+
+# Fields of heudiconv's seqinfo entries that the rules can test
+SEQINFO_FIELDS = (
+    'total_files_till_now', 'example_dcm_file', 'series_id', 'dcm_dir_name', 'series_files', 'unspecified',
+    'dim1', 'dim2', 'dim3', 'dim4', 'TR', 'TE', 'protocol_name', 'is_motion_corrected', 'is_derived', 'patient_id',
+    'study_description', 'referring_physician_name', 'series_description', 'sequence_name', 'image_type',
+    'accession_number', 'patient_age', 'patient_sex', 'date', 'series_uid', 'time',
+)
+
+# Entries of a rule that are not seqinfo fields
+RULE_ENTRIES = ('key', 'protocol', 'protocol_regex', 'pair_with')
+
+# --------------------------------------------------------------------------------------
+# create_key: A common helper function used to create the conversion key in infotodict.
+# But it is not used directly by HeuDiConv.
+# --------------------------------------------------------------------------------------
+def create_key(template, outtype=('nii.gz',), annotation_classes=None):
+    if template is None or not template:
+        raise ValueError('Template must be a valid format string')
+    return template, outtype, annotation_classes
+
+# --------------------------------------------------------------------------------------
+# field_test: Returns a function testing one seqinfo value against the condition of a rule (see the top of this file).
+# --------------------------------------------------------------------------------------
+def field_test(condition):
+    if isinstance(condition, (tuple, list)):
+        if len(condition) != 2:
+            raise ValueError(f"A range must be a (min, max) pair, got {condition!r}")
+        low, high = condition
+        return lambda value: value is not None and (low is None or value >= low) and (high is None or value <= high)
+    return lambda value: condition in value if isinstance(value, tuple) else value == condition
+
+# --------------------------------------------------------------------------------------
+# Rule: One rule of a rule set, with its conditions compiled.
+# --------------------------------------------------------------------------------------
+class Rule:
+
+    def __init__(self, spec, keys):
+        unknown = [name for name in spec if name not in RULE_ENTRIES and name not in SEQINFO_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown entries in rule {spec!r}: {', '.join(unknown)}")
+        for name in ('key', 'pair_with'):
+            if name in spec and spec[name] not in keys:
+                raise ValueError(f"Rule {spec!r}: '{spec[name]}' is not a conversion key")
+        if 'key' not in spec:
+            raise ValueError(f"Rule {spec!r} has no key")
+        self.key = spec['key']
+        self.pair_with = spec.get('pair_with')
+        protocol = spec.get('protocol')
+        self.substrings = () if protocol is None else (protocol,) if isinstance(protocol, str) else tuple(protocol)
+        self.regex = re.compile(spec['protocol_regex']) if spec.get('protocol_regex') else None
+        self.tests = [(name, field_test(condition)) for name, condition in spec.items() if name in SEQINFO_FIELDS]
+
+    # True if a protocol name passes the protocol conditions of the rule
+    def matches_protocol(self, protocol_name):
+        if self.substrings and not any(substring in protocol_name for substring in self.substrings):
+            return False
+        return self.regex is None or self.regex.search(protocol_name) is not None
+
+    # True if a series passes the other conditions of the rule
+    def matches(self, seqinfo):
+        return all(test(getattr(seqinfo, name)) for name, test in self.tests)
+
+# --------------------------------------------------------------------------------------
+# RuleSet: The rules of a heuristic, indexed by protocol name (see the top of this file).
+# keys maps the name of each conversion key to the key (see create_key), rules is the list of rules.
+# --------------------------------------------------------------------------------------
+class RuleSet:
+
+    def __init__(self, keys, rules):
+        self.keys = dict(keys)
+        self.rules = [Rule(spec, self.keys) for spec in rules]
+        # Rules selected by each protocol name seen so far
+        self.index = {}
+
+    # The rules whose protocol conditions a protocol name passes
+    def candidates(self, protocol_name):
+        rules = self.index.get(protocol_name)
+        if rules is None:
+            rules = [rule for rule in self.rules if rule.matches_protocol(protocol_name or '')]
+            self.index[protocol_name] = rules
+        return rules
+
+    # The infotodict of the heuristic: assigns the series of a session to the conversion keys
+    def infotodict(self, seqinfo):
+        info = {key: [] for key in self.keys.values()}
+        latest = {}
+        paired = {}
+        for s in seqinfo:
+            matched = [rule for rule in self.candidates(s.protocol_name) if rule.matches(s)]
+            assigned = set()
+            for rule in matched:
+                if rule.pair_with is None:
+                    info[self.keys[rule.key]].append(s.series_id)
+                    assigned.add(rule.key)
+            # References taken before a series of the key they belong to
+            for i, rule in enumerate(self.rules):
+                if rule.pair_with in assigned and latest.get(i) is not None:
+                    paired.setdefault(i, []).append(latest.pop(i))
+            for i, rule in enumerate(self.rules):
+                if rule.pair_with is not None and rule in matched:
+                    latest[i] = s.series_id
+        for i, series_ids in sorted(paired.items()):
+            info[self.keys[self.rules[i].key]].extend(series_ids)
+        return info
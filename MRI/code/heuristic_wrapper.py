@@ -0,0 +1,55 @@
+# Heuristic wrapper used by convert_session.py
+# This file is passed to heudiconv (-f/--heuristic) instead of the project's heuristic when a session
+# is converted in shards (several heudiconv processes, each converting a subset of the series), or when the
+# IntendedFor fields are left to the IntendedFor stage (see intended_for.py).
+#
+# It reads the conversion plan written by convert_session.py (the path is given in the
+# BIDS_CONVERSION_PLAN environment variable). The plan holds the path to the project's heuristic and the
+# conversion keys that the project's infotodict assigned to each series of the whole session, with the
+# {item} (run number) already filled in. This way, each shard names its series exactly as a conversion of
+# the whole session would, even though it only sees some of them.
+#
+# Everything else (e.g. infotoids, filter_files, DEFAULT_FIELDS) is taken from the project's heuristic,
+# except POPULATE_INTENDED_FOR_OPTS: IntendedFor is populated once per session, after all the shards are merged
+# (or once for the whole dataset, by the IntendedFor stage).
+#
+# Without conversion keys in the plan ('units' is None), the project's infotodict is used as it is: the session is
+# converted as heudiconv would with the project's heuristic, only without populating IntendedFor.
+#
+# see https://heudiconv.readthedocs.io/en/latest/heuristics.html
+
+import os
+import json
+import importlib.util
+
+# --------------------------------------------------------------------------------------
+# Load the conversion plan and the project's heuristic
+# --------------------------------------------------------------------------------------
+with open(os.environ['BIDS_CONVERSION_PLAN']) as f:
+    PLAN = json.load(f)
+
+_spec = importlib.util.spec_from_file_location('project_heuristic', PLAN['heuristic_file'])
+_heuristic = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(_heuristic)
+
+for _name in dir(_heuristic):
+    if not _name.startswith('__') and _name not in ('infotodict', 'POPULATE_INTENDED_FOR_OPTS', 'filename'):
+        globals()[_name] = getattr(_heuristic, _name)
+
+# --------------------------------------------------------------------------------------
+# infotodict: Returns the conversion keys of the planned series that are present in this shard.
+# --------------------------------------------------------------------------------------
+def infotodict(seqinfo):
+    if PLAN['units'] is None:
+        return _heuristic.infotodict(seqinfo)
+    present = {s.series_id for s in seqinfo}
+    info = {}
+    for unit in PLAN['units']:
+        if unit['series_id'] not in present:
+            continue
+        annotation_classes = unit['annotation_classes']
+        if isinstance(annotation_classes, list):
+            annotation_classes = tuple(annotation_classes)
+        key = (unit['template'], tuple(unit['outtype']), annotation_classes)
+        info.setdefault(key, []).append(unit['item'])
+    return info
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Populates the IntendedFor field of the fieldmaps of a whole BIDS dataset, as a stage of its own after the conversions.
+#
+# heudiconv fills IntendedFor in while it converts each subject (or session), from the POPULATE_INTENDED_FOR_OPTS of the
+# heuristic, so changing how the fieldmaps are matched to the runs would mean converting every subject again. This script
+# computes IntendedFor from the converted files only, in two steps:
+#   1) Index: the JSON sidecars of every subject (or session) are read once, in parallel, into an in-memory index
+#      holding for each of them what the matching needs: its datatype, entities (acq, task, dir, ...), acquisition
+#      time (from the scans.tsv of the session), ShimSetting, imaging volume (affine and shape of its NIfTI file, only
+#      read if the matching uses it) and current IntendedFor (for the fieldmaps)
+#   2) Match: the fieldmaps of each session are matched to its runs from the index, for all the sessions in parallel,
+#      and only the sidecars whose IntendedFor changed are written again
+# The matching follows heudiconv's populate_intended_for, with the same matching parameters (Shims, ImagingVolume,
+# ModalityAcquisitionLabel, CustomAcquisitionLabel, PlainAcquisitionLabel, Force) and criteria (First, Closest), so
+# with the options of the heuristic the IntendedFor fields are the ones heudiconv writes. One difference: a fieldmap
+# that no run is matched to any more loses its IntendedFor (heudiconv leaves it as it was), so that a stricter matching
+# does not leave stale references behind.
+#
+# The launchers run this once all the conversions of a submission are done (see INTENDED_FOR_STAGE in the launchers),
+# and their conversion tasks then do not populate IntendedFor themselves (see the intended_for_stage column of the task
+# manifests).
+# To try another matching without writing anything, use --dry-run: the sidecars that would change are listed.
+#
+# Usage:
+#   python intended_for.py [--heuristic <heuristic_file>] [--matching <parameter>[,<parameter>...]] [--criterion <criterion>]
+#                          [--processes <n>] [--dry-run] <bids_path>
+#
+# It is assumed that you run this in the 'heudiconv' conda environment.
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To walk the BIDS folders
+import re # To group the fieldmaps
+import sys # To exit with an error status
+import csv # To read the scans.tsv files
+import json # To read the sidecars
+import logging # To log the progress
+import argparse # To parse the command line arguments
+from concurrent.futures import ProcessPoolExecutor # To index and match the sessions in parallel
+
+import numpy as np # To compare the shims and imaging volumes
+import nibabel # To read the imaging volumes of the runs, for the ImagingVolume matching
+from heudiconv.utils import save_json, strptime_bids # To write the sidecars and read the acquisition times as heudiconv does
+
+import bids_validate # To split the file names into entities (bids_validate.py, in the same folder as this script)
+import convert_session # To load the heuristic (convert_session.py, in the same folder as this script)
+
+logger = logging.getLogger('bids_conversion')
+
+# Default number of processes indexing and matching the sessions
+DEFAULT_PROCESSES = os.cpu_count() or 1
+
+# Matching parameters and criteria (as in heudiconv)
+MATCHING_PARAMETERS = ('Shims', 'ImagingVolume', 'ModalityAcquisitionLabel', 'CustomAcquisitionLabel', 'PlainAcquisitionLabel', 'Force')
+CRITERIA = ('First', 'Closest')
+
+# Parts of the fieldmap names removed to find the fieldmaps that go together (as in heudiconv's find_fmap_groups)
+FMAP_GROUP = re.compile(r'(_dir-[0-9,a-z,A-Z]*)*(_phase[12])*(_phasediff)*(_magnitude[12])*(_fieldmap)*')
+
+# --------------------------------------------------------------------------------------
+# find_sessions: The session folders of the dataset, relative to its root (sub-<label>/ses-<label>, or sub-<label> for
+# subjects without sessions).
+# --------------------------------------------------------------------------------------
+def find_sessions(bids_path):
+    sessions = []
+    for subject in sorted(os.listdir(bids_path)):
+        subject_path = os.path.join(bids_path, subject)
+        if not subject.startswith('sub-') or not os.path.isdir(subject_path):
+            continue
+        subject_sessions = [name for name in sorted(os.listdir(subject_path))
+                            if name.startswith('ses-') and os.path.isdir(os.path.join(subject_path, name))]
+        sessions.extend(f"{subject}/{session}" for session in subject_sessions)
+        if not subject_sessions:
+            sessions.append(subject)
+    return sessions
+
+# --------------------------------------------------------------------------------------
+# read_acq_times: The acquisition time of each file listed in the scans.tsv file of a session (relative to the session).
+# --------------------------------------------------------------------------------------
+def read_acq_times(bids_path, session_rel):
+    scans_file = os.path.join(bids_path, session_rel, f"{session_rel.replace('/', '_')}_scans.tsv")
+    if not os.path.isfile(scans_file):
+        return {}
+    with open(scans_file, newline='') as f:
+        return {row['filename']: row['acq_time'] for row in csv.DictReader(f, delimiter='\t')
+                if row.get('filename') and row.get('acq_time') not in (None, '', 'n/a')}
+
+# --------------------------------------------------------------------------------------
+# index_session: Reads the sidecars of one session into index entries (see the top of this file), one per JSON file
+# of its datatype folders. The imaging volumes are only read with volumes=True.
+# Returns the session and its entries.
+# --------------------------------------------------------------------------------------
+def index_session(task):
+    bids_path, session_rel, volumes = task
+    session_path = os.path.join(bids_path, session_rel)
+    acq_times = read_acq_times(bids_path, session_rel)
+    entries = []
+    for datatype in sorted(os.listdir(session_path)):
+        folder = os.path.join(session_path, datatype)
+        if not os.path.isdir(folder):
+            continue
+        names = set(os.listdir(folder))
+        for name in sorted(names):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(folder, name)) as f:
+                    sidecar = json.load(f)
+            except (OSError, ValueError) as error:
+                logger.warning(f"{session_rel}/{datatype}/{name}: not read ({error})")
+                continue
+            stem = name[:-len('.json')]
+            nifti = next((f"{stem}{extension}" for extension in bids_validate.NIFTI_EXTENSIONS if f"{stem}{extension}" in names), None)
+            parts = bids_validate.split_name(name)
+            entry = {
+                'file': f"{datatype}/{name}",
+                'datatype': datatype,
+                'stem': stem,
+                'entities': dict(parts[0]) if parts else {},
+                'nifti': f"{datatype}/{nifti or stem + '.nii.gz'}",
+                'acq_time': acq_times.get(f"{datatype}/{stem}.nii.gz", acq_times.get(f"{datatype}/{nifti}")),
+                'shims': sidecar.get('ShimSetting') if isinstance(sidecar, dict) else None,
+            }
+            if datatype == 'fmap' and isinstance(sidecar, dict) and 'IntendedFor' in sidecar:
+                entry['intended_for'] = sidecar['IntendedFor']
+            if volumes and nifti:
+                header = nibabel.load(os.path.join(folder, nifti)).header
+                entry['volume'] = [header.get_best_affine(), header.get_data_shape()[:3]]
+            entries.append(entry)
+    return session_rel, entries
+
+# --------------------------------------------------------------------------------------
+# key_info: What of a sidecar has to be the same for a fieldmap and a run to match, for one matching parameter
+# (as in heudiconv's get_key_info_for_fmap_assignment). A None item never matches.
+# --------------------------------------------------------------------------------------
+def key_info(entry, parameter):
+    entities = entry['entities']
+    if parameter == 'Shims':
+        return [entry['shims']]
+    if parameter == 'ImagingVolume':
+        return entry.get('volume') or [None]
+    if parameter == 'ModalityAcquisitionLabel':
+        if entry['datatype'] != 'fmap':
+            return [entry['datatype']]
+        acq_label = (entities.get('acq') or '').lower()
+        for modality, labels in (('func', ('fmri', 'bold', 'func')), ('dwi', ('diff', 'dwi')), ('anat', ('anat', 'struct'))):
+            if any(label in acq_label for label in labels):
+                return [modality]
+        return [None]
+    if parameter == 'CustomAcquisitionLabel':
+        return [entities.get('task') if entry['datatype'] == 'func' else entities.get('acq')]
+    if parameter == 'PlainAcquisitionLabel':
+        return [entities.get('acq')]
+    if parameter == 'Force':
+        return ['Force']
+    return []
+
+# --------------------------------------------------------------------------------------
+# compatible: True if a run and a fieldmap match for all the matching parameters (as in heudiconv's
+# find_compatible_fmaps_for_run: labels must be equal, numbers within 5% of each other).
+# --------------------------------------------------------------------------------------
+def compatible(run, fieldmap, matching_parameters):
+    for parameter in matching_parameters:
+        run_info, fmap_info = key_info(run, parameter), key_info(fieldmap, parameter)
+        if run_info and isinstance(run_info[0], str):
+            if run_info != fmap_info:
+                return False
+        elif not run_info or run_info[0] is None or any(item is None for item in fmap_info):
+            return False
+        else:
+            try:
+                if not all(np.allclose(x, y, rtol=0.05) for x, y in zip(run_info, fmap_info)):
+                    return False
+            except (TypeError, ValueError):
+                return False
+    return True
+
+# --------------------------------------------------------------------------------------
+# select_group: The fieldmap group selected for a run among its compatible groups ({prefix: [entry, ...]}, in order),
+# by the criterion (as in heudiconv's select_fmap_from_compatible_groups). The groups without an acquisition time are
+# left out when there is a choice to make.
+# --------------------------------------------------------------------------------------
+def select_group(run, groups, criterion):
+    if len(groups) <= 1:
+        return next(iter(groups), None)
+    times = {prefix: strptime_bids(group[0]['acq_time']) for prefix, group in groups.items() if group[0]['acq_time']}
+    if not times:
+        return None
+    if criterion == 'First':
+        return min(times, key=lambda prefix: times[prefix])
+    if not run['acq_time']:
+        return None
+    run_time = strptime_bids(run['acq_time'])
+    return min(times, key=lambda prefix: abs(times[prefix] - run_time))
+
+# --------------------------------------------------------------------------------------
+# match_session: Computes the IntendedFor of the fieldmaps of one session from its index entries (see the top of this file).
+# Returns the session and a dictionary mapping the sidecar of each fieldmap (relative to the session) to its IntendedFor
+# (a sorted list of files relative to the subject folder), or to None if no run is matched to it.
+# --------------------------------------------------------------------------------------
+def match_session(task):
+    session_rel, entries, matching_parameters, criterion = task
+    groups = {}
+    for entry in entries:
+        if entry['datatype'] == 'fmap':
+            groups.setdefault(FMAP_GROUP.sub('', entry['stem']), []).append(entry)
+    groups = {prefix: groups[prefix] for prefix in sorted(groups)}
+    runs = [entry for entry in entries if entry['datatype'] != 'fmap' and not entry['stem'].endswith('_sbref')]
+
+    # Files relative to the subject folder
+    session_prefix = f"{session_rel.split('/', 1)[1]}/" if '/' in session_rel else ''
+    selected = []
+    matched = set()
+    for run in runs:
+        run_groups = {prefix: group for prefix, group in groups.items() if compatible(run, group[0], matching_parameters)}
+        selected.append((run, select_group(run, run_groups, criterion)))
+        matched.update(run_groups)
+    # As in heudiconv, a group compatible with some run is intended for the runs of the groups whose prefix contains its
+    # own (e.g. the magnitude and phasediff of acq-func are intended for the runs of the acq-func sbref, acq-func_sbref)
+    intended_for = {prefix: [f"{session_prefix}{run['nifti']}" for run, group in selected if group is not None and prefix in group]
+                    for prefix in matched}
+    return session_rel, {
+        entry['file']: sorted(intended_for.get(prefix, [])) or None for prefix, group in groups.items() for entry in group
+    }
+
+# --------------------------------------------------------------------------------------
+# populate_dataset: Indexes the dataset and computes the IntendedFor of the fieldmaps of all its sessions, in n_processes
+# processes, then writes the sidecars whose IntendedFor changed (unless dry_run is True).
+# Returns the number of sessions and fieldmaps, and the changes: a list of (sidecar relative to the dataset, old IntendedFor,
+# new IntendedFor), where None stands for no IntendedFor.
+# --------------------------------------------------------------------------------------
+def populate_dataset(bids_path, matching_parameters, criterion, n_processes=DEFAULT_PROCESSES, dry_run=False):
+    for parameter in matching_parameters:
+        if parameter not in MATCHING_PARAMETERS:
+            raise ValueError(f"Unknown matching parameter '{parameter}' (expected some of: {', '.join(MATCHING_PARAMETERS)})")
+    if criterion not in CRITERIA:
+        raise ValueError(f"Unknown criterion '{criterion}' (expected one of: {', '.join(CRITERIA)})")
+
+    sessions = find_sessions(bids_path)
+    volumes = 'ImagingVolume' in matching_parameters
+    with ProcessPoolExecutor(max_workers=max(1, min(n_processes, len(sessions) or 1))) as pool:
+        index = dict(pool.map(index_session, [(bids_path, session_rel, volumes) for session_rel in sessions]))
+        logger.info(f"Indexed {sum(len(entries) for entries in index.values())} sidecars of {len(index)} sessions")
+        matched = list(pool.map(match_session, [(session_rel, entries, matching_parameters, criterion)
+                                                for session_rel, entries in index.items()]))
+
+    changes = []
+    n_fieldmaps = 0
+    for session_rel, fieldmaps in matched:
+        current = {entry['file']: entry.get('intended_for') for entry in index[session_rel]}
+        for sidecar, value in sorted(fieldmaps.items()):
+            n_fieldmaps += 1
+            old = current[sidecar]
+            if ([old] if isinstance(old, str) else old) != value:
+                changes.append((f"{session_rel}/{sidecar}", old, value))
+    if not dry_run:
+        for sidecar, _, value in changes:
+            sidecar_file = os.path.join(bids_path, sidecar)
+            with open(sidecar_file) as f:
+                data = json.load(f)
+            if value is None:
+                data.pop('IntendedFor', None)
+            else:
+                data['IntendedFor'] = value
+            save_json(sidecar_file, data, pretty=True)
+    return len(sessions), n_fieldmaps, changes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Populate the IntendedFor field of the fieldmaps of a whole BIDS dataset.")
+    parser.add_argument('bids_path', help="BIDS output folder (OUTPUT_PATH of the launchers)")
+    parser.add_argument('--heuristic', help="heuristic whose POPULATE_INTENDED_FOR_OPTS give the matching (unless --matching is given)")
+    parser.add_argument('--matching', help=f"comma-separated matching parameters, from: {', '.join(MATCHING_PARAMETERS)}")
+    parser.add_argument('--criterion', help=f"criterion to select a fieldmap among the compatible ones: {' or '.join(CRITERIA)} (default: Closest)")
+    parser.add_argument('--processes', type=int, default=DEFAULT_PROCESSES, help="number of processes (default: %(default)s)")
+    parser.add_argument('--dry-run', action='store_true', help="only list the sidecars that would change")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    options = {}
+    if args.heuristic:
+        options = getattr(convert_session.load_heuristic(args.heuristic), 'POPULATE_INTENDED_FOR_OPTS', None) or {}
+    matching_parameters = args.matching.split(',') if args.matching else options.get('matching_parameters')
+    if isinstance(matching_parameters, str):
+        matching_parameters = [matching_parameters]
+    if not matching_parameters:
+        sys.stderr.write("No matching parameters: use --matching, or a heuristic with POPULATE_INTENDED_FOR_OPTS. Exiting...\n")
+        sys.exit(1)
+    criterion = args.criterion or options.get('criterion', 'Closest')
+
+    n_sessions, n_fieldmaps, changes = populate_dataset(args.bids_path, matching_parameters, criterion, args.processes, args.dry_run)
+    for sidecar, old, new in changes:
+        print(f"{sidecar}: {json.dumps(old)} -> {json.dumps(new)}")
+    print(f"{n_sessions} sessions, {n_fieldmaps} fieldmap sidecars matched with {', '.join(matching_parameters)} ({criterion}): "
+          f"{len(changes)} {'would change' if args.dry_run else 'written'}")
@@ -0,0 +1,67 @@
+#!/bin/bash
+
+# ============================================================
+# This script populates the IntendedFor field of the fieldmaps of the whole BIDS dataset once the conversions of a
+# submission are done (see intended_for.py). The launchers submit it as a single task that waits for the conversion
+# jobs (see INTENDED_FOR_STAGE in the launchers).
+#
+# Usage: sbatch intended_for.sh <code_path> <output_path> <heuristic_file> [<n_processes> [<matching_parameters> [<criterion>]]]
+#
+# Arguments:
+#   <code_path> is the folder with the conversion scripts (intended_for.py)
+#   <output_path> is the BIDS output folder
+#   <heuristic_file> is the heudiconv heuristic whose POPULATE_INTENDED_FOR_OPTS give the matching
+#   <n_processes> is the number of sessions indexed and matched at the same time (default: 1)
+#   <matching_parameters> are the comma-separated matching parameters to use instead of the heuristic's (e.g. Shims,ModalityAcquisitionLabel)
+#   <criterion> is the criterion to use instead of the heuristic's (First or Closest)
+#
+# Notes:
+#   Only the sidecars whose IntendedFor changed are written. The changes are listed in the output file of the task.
+#
+# Example usage:
+#   sbatch --cpus-per-task=4 intended_for.sh /path/to/code /path/to/output /path/to/heuristic.py 4
+#
+# It is assumed that you have a conda environment called 'heudiconv' available (check with 'conda env list').
+# If not, create a conda environment with the heudiconv and dcm2niix packages installed.
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Parse the arguments passed to the script
+# ------------------------------------------------------------
+CODE_PATH="${1}"
+OUTPUT_PATH="${2}"
+HEURISTIC_FILE="${3}"
+N_PROCESSES="${4:-1}"
+MATCHING_PARAMETERS="${5}"
+CRITERION="${6}"
+
+OPTIONS=()
+if [ -n "${MATCHING_PARAMETERS}" ]; then
+    OPTIONS+=(--matching "${MATCHING_PARAMETERS}")
+fi
+if [ -n "${CRITERION}" ]; then
+    OPTIONS+=(--criterion "${CRITERION}")
+fi
+
+# ------------------------------------------------------------
+# Activate the heudiconv environment
+# ------------------------------------------------------------
+conda activate heudiconv
+
+# ------------------------------------------------------------
+# Populate the IntendedFor of the fieldmaps of the dataset
+# ------------------------------------------------------------
+python "${CODE_PATH}/intended_for.py" \
+    --heuristic "${HEURISTIC_FILE}" \
+    --processes "${N_PROCESSES}" \
+    "${OPTIONS[@]}" \
+    "${OUTPUT_PATH}"
+intended_for_status=$?
+
+# ------------------------------------------------------------
+# Deactivate the heudiconv environment
+# ------------------------------------------------------------
+conda deactivate
+
+exit ${intended_for_status}
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# I/O budget of the conversion tasks: at most N tasks read from each storage root (e.g. /mridata/cbu) at the same time.
+#
+# The budget is set by the launchers (IO_SLOTS, e.g. {'/mridata/cbu': 32}) and saved with the task manifest
+# (see task_manifest.write_job). Before reading the DICOM files of a subject, a task (run_task.py) takes one of the
+# N slots of the storage root holding them: a lock file in {OUTPUT_PATH}/.bids_conversion/io_slots/<root>/,
+# locked with flock. If all the slots are taken, the task waits for one to be free. The lock is released when the
+# DICOM files are read (after staging them to node-local scratch, or after the conversion), or by the operating
+# system if the task is killed, so a failed task never keeps its slot.
+#
+# With staging (STAGE_TO_LOCAL_SCRATCH in the launchers), a slot is only held while the DICOM files are copied to
+# node-local scratch. Without it, dcm2niix reads the DICOM files from the storage root all through the conversion, so
+# the slot is held for the whole conversion of the subject (or session): the budget then caps the number of
+# conversions running at the same time per storage root, not only their reads.
+#
+# The lock files must be on a file system shared by the nodes that supports flock (e.g. NFS v4, or Lustre
+# mounted with -o flock).
+#
+# Usage (to see which slots are taken):
+#   python io_slots.py <slot_path>
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To create the lock files
+import sys # To read the command line arguments
+import time # To wait for a free slot
+import fcntl # To lock the slots
+import logging # To log the waits
+from contextlib import contextmanager # To hold a slot with a 'with' block
+
+import task_metrics # To time the waits (task_metrics.py, in the same folder as this script)
+
+logger = logging.getLogger('bids_conversion')
+
+# Seconds between two attempts to take a slot
+POLL_SECONDS = 5
+
+# --------------------------------------------------------------------------------------
+# storage_root: The storage root (a key of io_slots) holding path, i.e. the longest root that path is under,
+# or None if it is under none of them.
+# --------------------------------------------------------------------------------------
+def storage_root(path, io_slots):
+    path = os.path.normpath(os.path.abspath(path))
+    roots = [root for root in (io_slots or {}) if path == os.path.normpath(root) or path.startswith(os.path.normpath(root) + os.sep)]
+    return max(roots, key=len) if roots else None
+
+# --------------------------------------------------------------------------------------
+# slot_folder: Folder with the lock files of the slots of a storage root.
+# --------------------------------------------------------------------------------------
+def slot_folder(slot_path, root):
+    return os.path.join(slot_path, os.path.normpath(root).strip(os.sep).replace(os.sep, '_') or 'root')
+
+# --------------------------------------------------------------------------------------
+# take_slot: Waits for a free slot among the n_slots lock files of folder, and returns the locked file.
+# --------------------------------------------------------------------------------------
+def take_slot(folder, n_slots, poll_seconds=POLL_SECONDS):
+    os.makedirs(folder, exist_ok=True)
+    start = time.time()
+    waiting = False
+    while True:
+        for slot in range(n_slots):
+            f = open(os.path.join(folder, f"slot-{slot}.lock"), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            if waiting:
+                logger.info(f"Took I/O slot {slot} of {folder} after waiting {time.time() - start:.0f} s")
+            return f
+        if not waiting:
+            logger.info(f"All {n_slots} I/O slots of {folder} are taken, waiting for one")
+            waiting = True
+        time.sleep(poll_seconds)
+
+# --------------------------------------------------------------------------------------
+# reader_slot: Holds one of the slots of the storage root holding path while the block runs (see the top of this
+# file). Does nothing if path is not under one of the roots of io_slots. The wait is timed as the 'io_wait' phase
+# of the subject being converted (see task_metrics.py).
+# --------------------------------------------------------------------------------------
+@contextmanager
+def reader_slot(slot_path, path, io_slots, poll_seconds=POLL_SECONDS):
+    root = storage_root(path, io_slots)
+    if root is None:
+        yield
+        return
+    with task_metrics.phase('io_wait'):
+        f = take_slot(slot_folder(slot_path, root), io_slots[root], poll_seconds)
+    try:
+        yield
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+# --------------------------------------------------------------------------------------
+# taken_slots: Returns a dictionary mapping each storage root folder in slot_path to the number of its slots that are taken.
+# --------------------------------------------------------------------------------------
+def taken_slots(slot_path):
+    taken = {}
+    for folder in sorted(os.listdir(slot_path)):
+        taken[folder] = 0
+        for name in os.listdir(os.path.join(slot_path, folder)):
+            with open(os.path.join(slot_path, folder, name), 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                except BlockingIOError:
+                    taken[folder] += 1
+    return taken
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: io_slots.py <slot_path>\n")
+        sys.exit(1)
+    for folder, n_taken in taken_slots(sys.argv[1]).items():
+        print(f"{folder}\t{n_taken} taken")
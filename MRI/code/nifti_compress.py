@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Compresses the NIfTI files of a converted session with several threads.
+#
+# dcm2niix compresses each NIfTI file with a single gzip stream, which is a large part of the conversion time of
+# 4D runs with hundreds of volumes. With COMPRESSION_THREADS set in the launchers, dcm2niix writes uncompressed .nii
+# files instead (see convert_session.uncompressed_outputs), and all the files of the session are then compressed here,
+# in the same way as pigz:
+#   - each file is cut into blocks of BLOCK_BYTES, compressed in parallel by a pool of threads (zlib releases the GIL),
+#     each block primed with the last DICTIONARY_BYTES of the previous one so that the compression ratio is kept
+#   - the compressed blocks are written one after the other as a single deflate stream, in a standard gzip file
+#     (with the CRC-32 and size of the whole file), readable by gzip, nibabel, FSL, etc.
+# Files smaller than a block are compressed whole, several at a time.
+#
+# Each compressed file replaces its .nii file (with the same permissions and times) only once it is complete.
+# The references to the .nii files in the scans.tsv files and in the IntendedFor fields of the sidecars of the
+# session are then renamed to .nii.gz (heudiconv already names them .nii.gz in most cases).
+#
+# Usage (e.g. to compress a session converted with outtype 'nii'):
+#   python nifti_compress.py [--level <1-9>] [--threads <n>] <session_folder> [<session_folder> ...]
+#
+# It is assumed that you run this in the 'heudiconv' conda environment.
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To find the NIfTI files
+import sys # To exit with an error status
+import json # To read the sidecars
+import zlib # To compress the blocks
+import shutil # To keep the permissions and times of the files
+import struct # To write the gzip header and trailer
+import logging # To log what is compressed
+import argparse # To parse the command line arguments
+from collections import deque # To write the compressed blocks in order
+from concurrent.futures import ThreadPoolExecutor # To compress the blocks in parallel
+
+from heudiconv.utils import update_json # To rewrite the sidecars as heudiconv writes them
+
+logger = logging.getLogger('bids_conversion')
+
+# gzip level (as dcm2niix's default)
+DEFAULT_LEVEL = 6
+
+# Size of the blocks compressed in parallel, and of the end of the previous block each block is primed with
+# (the deflate window)
+BLOCK_BYTES = 1024**2
+DICTIONARY_BYTES = 32 * 1024
+
+# --------------------------------------------------------------------------------------
+# gzip_header: Header of a gzip file (no file name, modification time 0, so the output only depends on the data).
+# --------------------------------------------------------------------------------------
+def gzip_header(level):
+    extra_flags = 2 if level == 9 else 4 if level == 1 else 0
+    return struct.pack('<BBBBIBB', 0x1f, 0x8b, zlib.DEFLATED, 0, 0, extra_flags, 3)
+
+# --------------------------------------------------------------------------------------
+# compress_block: Compresses one block into raw deflate data, primed with dictionary (the end of the previous block).
+# The last block ends the deflate stream, the others end on a byte boundary so that they can be concatenated.
+# --------------------------------------------------------------------------------------
+def compress_block(block, dictionary, level, last):
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+# --------------------------------------------------------------------------------------
+# compress_file: Compresses path into path.gz and removes path. The blocks are compressed by pool (a thread pool
+# with n_threads threads) or, without a pool, one after the other. Returns the path of the compressed file.
+# --------------------------------------------------------------------------------------
+def compress_file(path, level=DEFAULT_LEVEL, pool=None, n_threads=1):
+    target = f"{path}.gz"
+    tmp_target = f"{target}.{os.getpid()}.tmp"
+    crc = 0
+    size = 0
+    try:
+        with open(path, 'rb') as source, open(tmp_target, 'wb') as f:
+            f.write(gzip_header(level))
+            pending = deque()
+            dictionary = b''
+            block = source.read(BLOCK_BYTES)
+            while True:
+                next_block = source.read(BLOCK_BYTES)
+                last = not next_block
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                if pool is None:
+                    f.write(compress_block(block, dictionary, level, last))
+                else:
+                    pending.append(pool.submit(compress_block, block, dictionary, level, last))
+                    # Keep the pool busy without holding the whole file in memory
+                    while pending and (last or len(pending) > 2 * n_threads):
+                        f.write(pending.popleft().result())
+                if last:
+                    break
+                dictionary = block[-DICTIONARY_BYTES:]
+                block = next_block
+            f.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+        # heudiconv makes the NIfTI files read-only: keep that (and the times) on the compressed file
+        shutil.copystat(path, tmp_target)
+        os.replace(tmp_target, target)
+    except BaseException:
+        if os.path.exists(tmp_target):
+            os.remove(tmp_target)
+        raise
+    os.remove(path)
+    return target
+
+# --------------------------------------------------------------------------------------
+# compress_files: Compresses the files with n_threads threads (see the top of this file). Returns the compressed files.
+# --------------------------------------------------------------------------------------
+def compress_files(paths, level=DEFAULT_LEVEL, n_threads=1):
+    sizes = {path: os.path.getsize(path) for path in paths}
+    large = sorted((path for path in paths if sizes[path] > BLOCK_BYTES), key=lambda path: -sizes[path])
+    small = [path for path in paths if sizes[path] <= BLOCK_BYTES]
+    with ThreadPoolExecutor(max_workers=max(1, n_threads)) as pool:
+        small_futures = [pool.submit(compress_file, path, level) for path in small]
+        compressed = [compress_file(path, level, pool, n_threads) for path in large]
+        compressed.extend(future.result() for future in small_futures)
+    return compressed
+
+# --------------------------------------------------------------------------------------
+# rename_references: Renames the references to the compressed files (by file name) from .nii to .nii.gz in the
+# scans.tsv files and in the IntendedFor fields of the sidecars under folder.
+# --------------------------------------------------------------------------------------
+def rename_references(folder, compressed):
+    names = {os.path.basename(path)[:-len('.gz')] for path in compressed}
+
+    def renamed(reference):
+        return f"{reference}.gz" if reference.split('/')[-1] in names else reference
+
+    for path, _, files in os.walk(folder):
+        for name in files:
+            file_path = os.path.join(path, name)
+            if name.endswith('_scans.tsv'):
+                with open(file_path, newline='') as f:
+                    lines = f.readlines()
+                new_lines = []
+                for line in lines:
+                    reference, tab, rest = line.partition('\t')
+                    new_lines.append(renamed(reference) + tab + rest)
+                if new_lines != lines:
+                    with open(file_path, 'w', newline='') as f:
+                        f.writelines(new_lines)
+            elif name.endswith('.json'):
+                with open(file_path) as f:
+                    sidecar = json.load(f)
+                intended_for = sidecar.get('IntendedFor') if isinstance(sidecar, dict) else None
+                if not intended_for:
+                    continue
+                new_intended_for = [renamed(reference) for reference in intended_for] if isinstance(intended_for, list) else renamed(intended_for)
+                if new_intended_for != intended_for:
+                    update_json(file_path, {'IntendedFor': new_intended_for}, pretty=True)
+
+# --------------------------------------------------------------------------------------
+# compress_session: Compresses the uncompressed NIfTI files of a session folder and renames the references to them.
+# If prefixes is given, only the files whose path (relative to output_path) starts with one of them are compressed
+# (see convert_session.uncompressed_outputs). Returns the compressed files.
+# --------------------------------------------------------------------------------------
+def compress_session(output_path, session_rel, level=DEFAULT_LEVEL, n_threads=1, prefixes=None):
+    session_path = os.path.join(output_path, session_rel)
+    paths = []
+    for path, _, files in os.walk(session_path):
+        for name in files:
+            file_path = os.path.join(path, name)
+            if name.endswith('.nii') and (prefixes is None or os.path.relpath(file_path, output_path).startswith(tuple(prefixes))):
+                paths.append(file_path)
+    compressed = compress_files(paths, level, n_threads)
+    rename_references(session_path, compressed)
+    logger.info(f"{session_rel}: compressed {len(compressed)} NIfTI files with {n_threads} threads")
+    return compressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compress the NIfTI files of converted sessions with several threads.")
+    parser.add_argument('folders', nargs='+', help="session (or subject) folders")
+    parser.add_argument('--level', type=int, default=DEFAULT_LEVEL, choices=range(1, 10), help="gzip level (default: %(default)s)")
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1, help="number of threads (default: %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    try:
+        for folder in args.folders:
+            folder = os.path.normpath(folder)
+            compress_session(os.path.dirname(folder), os.path.basename(folder), args.level, args.threads)
+    except Exception:
+        logger.exception("Compression failed")
+        sys.exit(1)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Sizes the memory, CPUs and time limit of each conversion task from its DICOM files.
+#
+# Each subject (or session) of a task is estimated from its row in the task manifest (see task_manifest.py):
+#   - memory: a base (Python, heudiconv) plus the DICOM headers heudiconv keeps for every file, plus the largest
+#     series that dcm2niix holds in memory at once (once per shard, as the shards run at the same time)
+#   - time: a base (start-up, BIDS files) plus the time per DICOM file and per GB, divided between the shards
+#   - CPUs: the number of shards of the subject (see convert_session.py)
+# A task converts its subjects one after the other: it needs the memory of its largest subject and the time of
+# all of them. The estimates are raised by SAFETY_FACTOR and each task is given the smallest of SIZE_CLASSES
+# that fits, so the tasks are submitted as a few job arrays (one per class and number of CPUs) instead of
+# one request per task.
+#
+# The coefficients of DEFAULT_MODEL are rough values for the CBU scanners. When earlier runs left metrics in the
+# job logs folder (see task_metrics.py), calibrate() scales the estimates so that they cover most (CALIBRATION_QUANTILE)
+# of the measured times and peak memory.
+#
+# Usage (to see how the tasks of a task manifest would be sized):
+#   python resource_sizing.py <task_manifest> [<log_path>]
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import sys # To read the command line arguments
+import math # To round the estimates up
+
+import task_manifest # To read the tasks (task_manifest.py, in the same folder as this script)
+import task_metrics # To read the metrics of earlier runs (task_metrics.py, in the same folder as this script)
+
+# Coefficients of the estimates (see the top of this file)
+DEFAULT_MODEL = {
+    'base_mem_mb': 1500,
+    'mem_mb_per_file': 0.02,
+    'mem_per_series_byte': 3.0,
+    'base_seconds': 120,
+    'seconds_per_file': 0.02,
+    'seconds_per_gb': 90,
+    'time_scale': 1.0,
+    'mem_scale': 1.0,
+}
+
+# Margin added on top of the estimates
+SAFETY_FACTOR = 1.5
+
+# Size classes, from the smallest: (name, memory in MB, time limit in minutes)
+SIZE_CLASSES = (
+    ('small', 4000, 60),
+    ('medium', 8000, 4 * 60),
+    ('large', 16000, 12 * 60),
+    ('xlarge', 32000, 24 * 60),
+)
+
+# Subjects converted in earlier runs needed to calibrate the model, and the share of them the estimates should cover
+MIN_CALIBRATION_SUBJECTS = 5
+CALIBRATION_QUANTILE = 0.9
+
+# Bytes of DICOM files per shard when the number of shards of each subject is sized (see subject_shards)
+BYTES_PER_SHARD = 2 * 1024**3
+
+# --------------------------------------------------------------------------------------
+# subject_shards: Number of shards to convert a subject with: one per BYTES_PER_SHARD of DICOM files, at most max_shards
+# (small anatomical sessions get one CPU, large multiband sessions up to max_shards).
+# --------------------------------------------------------------------------------------
+def subject_shards(n_bytes, max_shards, bytes_per_shard=BYTES_PER_SHARD):
+    return max(1, min(max_shards, math.ceil(n_bytes / bytes_per_shard)))
+
+# --------------------------------------------------------------------------------------
+# subject_estimate: Estimated (memory in MB, time in seconds) of one subject (or session), without the safety factor.
+# n_files, n_bytes and max_series_bytes describe its DICOM files, n_shards is the number of shards it is converted with.
+# --------------------------------------------------------------------------------------
+def subject_estimate(n_files, n_bytes, max_series_bytes, n_shards=1, model=DEFAULT_MODEL):
+    n_shards = max(1, n_shards)
+    mem_mb = (model['base_mem_mb'] + model['mem_mb_per_file'] * n_files
+              + n_shards * model['mem_per_series_byte'] * max_series_bytes / 1024**2)
+    seconds = model['base_seconds'] + (model['seconds_per_file'] * n_files + model['seconds_per_gb'] * n_bytes / 1024**3) / n_shards
+    return mem_mb * model['mem_scale'], seconds * model['time_scale']
+
+# --------------------------------------------------------------------------------------
+# row_estimate: subject_estimate of a row of a task manifest (task manifests written before the number of files
+# and the largest series were recorded only give the total size).
+# --------------------------------------------------------------------------------------
+def row_estimate(row, model=DEFAULT_MODEL):
+    n_bytes = int(row.get('n_bytes') or 0)
+    return subject_estimate(int(row.get('n_files') or 0), n_bytes, int(row.get('max_series_bytes') or n_bytes),
+                            int(row.get('n_shards') or 1), model)
+
+# --------------------------------------------------------------------------------------
+# quantile: The q quantile of a list of numbers (nearest rank).
+# --------------------------------------------------------------------------------------
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+# --------------------------------------------------------------------------------------
+# calibrate: Returns the model with its time and memory scaled to the metrics of earlier runs (see task_metrics.read_records).
+# Only the subjects that were converted successfully, with the size of their DICOM files recorded, are used.
+# The model is returned unchanged if there are fewer than MIN_CALIBRATION_SUBJECTS of them.
+# --------------------------------------------------------------------------------------
+def calibrate(records, model=DEFAULT_MODEL):
+    unscaled = dict(model, time_scale=1.0, mem_scale=1.0)
+    time_ratios = []
+    mem_ratios = []
+    for record in records:
+        subjects = [s for s in record.get('subjects', []) if s['status'] == 'done' and 'dicom_files' in s]
+        if not subjects:
+            continue
+        estimates = [subject_estimate(s['dicom_files'], s['dicom_bytes'], s['max_series_bytes'], s.get('n_shards', 1), unscaled)
+                     for s in subjects]
+        time_ratios.extend(s['wall_time'] / seconds for s, (_, seconds) in zip(subjects, estimates))
+        # The peak memory is only known for the whole task: compare it with its largest subject
+        if len(subjects) == len(record['subjects']):
+            peak_mb = max(record['peak_rss_mb']['self'], record['peak_rss_mb']['children'])
+            mem_ratios.append(peak_mb / max(mem_mb for mem_mb, _ in estimates))
+    if len(time_ratios) < MIN_CALIBRATION_SUBJECTS:
+        return model
+    calibrated = dict(model, time_scale=quantile(time_ratios, CALIBRATION_QUANTILE))
+    if mem_ratios:
+        calibrated['mem_scale'] = quantile(mem_ratios, CALIBRATION_QUANTILE)
+    return calibrated
+
+# --------------------------------------------------------------------------------------
+# task_resources: Estimated resources of a task (its rows in the task manifest), with the safety factor:
+# {'cpus', 'mem_mb', 'time_minutes'}.
+# --------------------------------------------------------------------------------------
+def task_resources(rows, model=DEFAULT_MODEL):
+    estimates = [row_estimate(row, model) for row in rows]
+    return {
+        'cpus': max(int(row.get('n_shards') or 1) for row in rows),
+        'mem_mb': math.ceil(SAFETY_FACTOR * max(mem_mb for mem_mb, _ in estimates)),
+        'time_minutes': math.ceil(SAFETY_FACTOR * sum(seconds for _, seconds in estimates) / 60),
+    }
+
+# --------------------------------------------------------------------------------------
+# size_class: The smallest of the size classes that fits the resources of a task (the largest class if none does).
+# --------------------------------------------------------------------------------------
+def size_class(resources, classes=SIZE_CLASSES):
+    for size in classes:
+        _, mem_mb, time_minutes = size
+        if resources['mem_mb'] <= mem_mb and resources['time_minutes'] <= time_minutes:
+            return size
+    return classes[-1]
+
+# --------------------------------------------------------------------------------------
+# plan_submissions: Groups the tasks of a task manifest (a dictionary mapping each task ID to its rows, see
+# task_manifest.read_tasks) by size class and number of CPUs. Returns a list of (name, resources, task_ids),
+# where resources are the executor options of the group: {'cpus', 'mem_mb', 'time_minutes'}.
+# --------------------------------------------------------------------------------------
+def plan_submissions(tasks, model=DEFAULT_MODEL, classes=SIZE_CLASSES):
+    groups = {}
+    for task_id, rows in sorted(tasks.items()):
+        resources = task_resources(rows, model)
+        name, mem_mb, time_minutes = size_class(resources, classes)
+        cpus = resources['cpus']
+        key = (mem_mb, time_minutes, cpus)
+        if key not in groups:
+            label = name if cpus == 1 else f"{name}, {cpus} CPUs"
+            groups[key] = (label, {'cpus': cpus, 'mem_mb': mem_mb, 'time_minutes': time_minutes}, [])
+        groups[key][2].append(task_id)
+    return [groups[key] for key in sorted(groups)]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.stderr.write("Usage: resource_sizing.py <task_manifest> [<log_path>]\n")
+        sys.exit(1)
+    model = calibrate(task_metrics.read_records(sys.argv[2])) if len(sys.argv) == 3 else DEFAULT_MODEL
+    print(f"Time scale: {model['time_scale']:.2f}, memory scale: {model['mem_scale']:.2f}")
+    for label, resources, task_ids in plan_submissions(task_manifest.read_tasks(sys.argv[1]), model):
+        print(f"{label}: {len(task_ids)} tasks ({resources['mem_mb']} MB, {resources['time_minutes']} min): {task_ids}")
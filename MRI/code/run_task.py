@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Runs one array task: converts the subjects (or sessions) of the task from DICOM to BIDS, one after the other,
+# in this Python process (heudiconv is imported once per task, not once per subject).
+#
+# For each subject (or session) of the task (read from the task manifest, see task_manifest.py):
+#   - the series folders are read from the DICOM inventory (see dicom_inventory.py), or found by walking the
+#     DICOM folder if it is not in the inventory. The series folders are passed to heudiconv, which lists their
+#     files itself: no file list is expanded on a command line.
+#   - the DICOM files that are exact duplicates of another file (a series, or some of its files, sent twice) are left
+#     out: their folder is dropped, or replaced by its other files (see dicom_duplicates.py)
+#   - heudiconv is run with dcm2niix, or convert_session.py is used if the subject is converted in several shards
+#   - the subject's manifest record is marked as 'done' or 'failed', unless it was submitted again since
+#     (see conversion_manifest.py)
+#
+# The timings, memory and I/O of the task are written to {log_path}/heudiconv_job_<job_id>_<task_id>.metrics.json
+# next to the task's output and error files (see task_metrics.py).
+#
+# With staging (the 'stage' column of the task manifest), the series folders are first copied to node-local scratch
+# ($TMPDIR), the subject is converted there, and the finished subject (or session) folder is then published into the
+# BIDS folder: it is copied next to its final place and renamed into it, so a half-written subject is never visible
+# and the thousands of small DICOM reads do not go through the shared file system during the conversion. Replacing an
+# existing folder takes two renames (the old folder aside, the new one into place), so the folder is missing for the
+# instant between them; if the task dies then, the old folder is left next to it and put back by the next publish
+# (see publish_folder).
+#
+# With compression (COMPRESSION_THREADS in the launchers), dcm2niix writes uncompressed NIfTI files and the files of
+# the subject (or session) are then compressed in parallel (see nifti_compress.py), before they are published.
+#
+# With an I/O budget (IO_SLOTS in the launchers, see io_slots.py), a subject is only converted (or staged) once the
+# task holds one of the reader slots of the storage root of its DICOM files: while they are staged, or for the whole
+# conversion without staging (dcm2niix then reads them from the storage root as it converts).
+#
+# The task fails (exit status 1) if any of its subjects failed.
+#
+# Usage (from the job scripts, heudiconv_script*.sh):
+#   python run_task.py <task_manifest> <task_id> <heuristic_file> <output_path> <manifest_path> <inventory_path>
+#
+# It is assumed that you run this in the 'heudiconv' conda environment.
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To handle the file paths
+import sys # To read the command line arguments and exit with an error status
+import shutil # To copy the DICOM files to and the BIDS files from node-local scratch
+import logging # To log what is done
+import tempfile # To create the node-local scratch folder
+import json # To restore the DICOM paths in the files heudiconv keeps about the conversion
+import contextlib # To convert without an I/O slot
+import functools # To pass the I/O slot of a subject
+from concurrent.futures import ThreadPoolExecutor # To copy the DICOM files in parallel
+
+import task_manifest # To read the subjects of the task (task_manifest.py, in the same folder as this script)
+import dicom_inventory # To get the series folders (dicom_inventory.py, in the same folder as this script)
+import conversion_manifest # To record the result of each conversion (conversion_manifest.py, in the same folder as this script)
+import convert_session # To run heudiconv (convert_session.py, in the same folder as this script)
+import task_metrics # To record the performance of the task (task_metrics.py, in the same folder as this script)
+import io_slots # To limit the number of tasks reading from the same storage (io_slots.py, in the same folder as this script)
+import execution_backends # To name the metrics file like the task's log files (execution_backends.py, in the same folder as this script)
+import dicom_discover # To read the age and sex of the subject for participants.tsv (dicom_discover.py, in the same folder as this script)
+import dicom_duplicates # To leave out the series sent twice (dicom_duplicates.py, in the same folder as this script)
+import nifti_compress # To compress the NIfTI files of the subject (nifti_compress.py, in the same folder as this script)
+
+logger = logging.getLogger('bids_conversion')
+
+# Number of threads copying the DICOM files to node-local scratch (bound by the latency of the shared file system)
+STAGE_THREADS = 8
+
+# --------------------------------------------------------------------------------------
+# stage_dicoms: Copies the inputs of a conversion (series folders and files under dicom_path, see find_series_folders)
+# to stage_path, keeping their relative paths. Returns the paths of the copied inputs.
+# --------------------------------------------------------------------------------------
+def stage_dicoms(inputs, dicom_path, stage_path, n_threads=STAGE_THREADS):
+    copies = []
+    staged_inputs = []
+    for path in inputs:
+        staged_path = os.path.join(stage_path, os.path.relpath(path, dicom_path))
+        staged_inputs.append(staged_path)
+        if os.path.isdir(path):
+            os.makedirs(staged_path, exist_ok=True)
+            with os.scandir(path) as entries:
+                copies.extend((entry.path, os.path.join(staged_path, entry.name)) for entry in entries if entry.is_file())
+        else:
+            os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+            copies.append((path, staged_path))
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        list(pool.map(lambda copy: shutil.copyfile(*copy), copies))
+    logger.info(f"Staged {len(copies)} files from {len(dicom_duplicates.input_folders(inputs))} series folders into {stage_path}")
+    return staged_inputs
+
+# --------------------------------------------------------------------------------------
+# restore_path: Returns value with the paths under stage_path (in its strings, lists and dictionaries, recursively)
+# replaced by the same paths under dicom_path.
+# --------------------------------------------------------------------------------------
+def restore_path(value, stage_path, dicom_path):
+    if isinstance(value, str):
+        if value == stage_path or value.startswith(stage_path + os.sep):
+            return dicom_path + value[len(stage_path):]
+        return value
+    if isinstance(value, list):
+        return [restore_path(item, stage_path, dicom_path) for item in value]
+    if isinstance(value, dict):
+        return {key: restore_path(item, stage_path, dicom_path) for key, item in value.items()}
+    return value
+
+# --------------------------------------------------------------------------------------
+# restore_dicom_paths: Replaces the paths of the staged DICOM files by their original paths in the files that
+# heudiconv keeps about the conversion (e.g. .heudiconv/<subject>/info/filegroup.json). Only the JSON values that
+# are paths under stage_path are changed, and the files are written back as heudiconv writes them.
+# --------------------------------------------------------------------------------------
+def restore_dicom_paths(folder, stage_path, dicom_path):
+    for path, _, files in os.walk(folder):
+        for name in files:
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(path, name)) as f:
+                try:
+                    content = json.load(f)
+                except ValueError:
+                    logger.warning(f"Could not restore the DICOM paths in {os.path.join(path, name)}: not a JSON file")
+                    continue
+            restored = restore_path(content, stage_path, dicom_path)
+            if restored != content:
+                with open(os.path.join(path, name), 'w') as f:
+                    json.dump(restored, f, indent=2, sort_keys=True)
+
+# --------------------------------------------------------------------------------------
+# recover_folder: Puts back the old folder of target left aside by a publish that died between its two renames
+# (see publish_folder), if target is missing. The partial copies of the publishes that died are removed.
+# --------------------------------------------------------------------------------------
+def recover_folder(target):
+    parent, name = os.path.split(target)
+    if not os.path.isdir(parent):
+        return
+    for leftover in sorted(os.listdir(parent)):
+        path = os.path.join(parent, leftover)
+        if leftover.startswith(f"{name}.old."):
+            if not os.path.exists(target):
+                os.rename(path, target)
+                logger.warning(f"Restored {target} from {path}, left by a publish that did not finish")
+            else:
+                shutil.rmtree(path)
+        elif leftover.startswith(f"{name}.publish."):
+            shutil.rmtree(path)
+
+# --------------------------------------------------------------------------------------
+# publish_folder: Replaces target with a copy of source. The copy is written next to target (in the same file
+# system) and renamed into place, so target is never a partial copy. An existing target is first renamed aside and
+# removed once the copy is in place: target is missing for the instant between the two renames, and put back if the
+# second rename fails (or, if the task dies in between, by the next publish, see recover_folder).
+# --------------------------------------------------------------------------------------
+def publish_folder(source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    recover_folder(target)
+    tmp_target = f"{target}.publish.{os.getpid()}"
+    old_target = f"{target}.old.{os.getpid()}"
+    shutil.copytree(source, tmp_target)
+    if os.path.exists(target):
+        os.rename(target, old_target)
+    try:
+        os.rename(tmp_target, target)
+    except OSError:
+        if os.path.exists(old_target):
+            os.rename(old_target, target)
+        shutil.rmtree(tmp_target, ignore_errors=True)
+        raise
+    if os.path.exists(old_target):
+        shutil.rmtree(old_target)
+
+# --------------------------------------------------------------------------------------
+# find_series_folders: The inputs of the conversion of a subject (or session): its series folders, from the DICOM
+# inventory (or by walking dicom_path), without the exact duplicate files. A folder with duplicates is replaced by its
+# other files, if any (see dicom_duplicates.drop_duplicates).
+# --------------------------------------------------------------------------------------
+def find_series_folders(inventory_path, dicom_path):
+    with task_metrics.phase('discovery'):
+        series_folders = dicom_inventory.series_folders(inventory_path, dicom_path)
+        inputs, duplicates = dicom_duplicates.drop_duplicates(series_folders, inventory_path, dicom_path)
+    if duplicates:
+        task_metrics.record(duplicate_series_folders=sum(entry['status'] == 'dropped' for entry in duplicates),
+                            duplicate_files=sum(entry['n_duplicates'] for entry in duplicates))
+    return inputs
+
+# --------------------------------------------------------------------------------------
+# convert_row: Converts the subject (or session) of one row of the task manifest into output_path.
+# With compression ({'level', 'threads'}), the NIfTI files are compressed after the conversion (see nifti_compress.py).
+# --------------------------------------------------------------------------------------
+def convert_row(row, heuristic_file, output_path, inventory_path, dicom_path=None, series_folders=None, bids_options=None,
+                compression=None):
+    subject_id = row['subject_id']
+    session_id = row['session_id'] or None
+    n_shards = int(row['n_shards'] or 1)
+    # IntendedFor is left to the IntendedFor stage if it runs after the conversions (see intended_for.py)
+    intended_for = not int(row.get('intended_for_stage') or 0)
+    dicom_path = dicom_path or row['dicom_path']
+    if series_folders is None:
+        series_folders = find_series_folders(inventory_path, dicom_path)
+    if n_shards > 1:
+        convert_session.convert_session(dicom_path, subject_id, session_id, heuristic_file, output_path,
+                                        n_shards, inventory_path, series_folders, compression, intended_for)
+        return
+    n_series_folders = len(dicom_duplicates.input_folders(series_folders))
+    task_metrics.record(n_series_folders=n_series_folders)
+    logger.info(f"Series folders passed to heudiconv: {n_series_folders}")
+    if not series_folders:
+        raise RuntimeError(f"No DICOM files found in {dicom_path}")
+    if compression is None:
+        convert_session.run_heudiconv(series_folders, subject_id, session_id, heuristic_file, output_path, bids_options,
+                                      intended_for=intended_for)
+        return
+    with convert_session.uncompressed_outputs(output_path) as prefixes:
+        convert_session.run_heudiconv(series_folders, subject_id, session_id, heuristic_file, output_path, bids_options,
+                                      intended_for=intended_for)
+    with task_metrics.phase('compress'):
+        nifti_compress.compress_session(output_path, convert_session.session_folder(subject_id, session_id),
+                                        compression['level'], compression['threads'], prefixes)
+
+# --------------------------------------------------------------------------------------
+# no_slot: Stands for io_slots.reader_slot when the DICOM files are read without an I/O slot.
+# --------------------------------------------------------------------------------------
+@contextlib.contextmanager
+def no_slot():
+    yield
+
+# --------------------------------------------------------------------------------------
+# convert_row_staged: Converts the subject (or session) of one row of the task manifest in node-local scratch,
+# then publishes it into output_path (see the top of this file). reader_slot holds an I/O slot while the DICOM
+# files are copied (see io_slots.reader_slot).
+# --------------------------------------------------------------------------------------
+def convert_row_staged(row, heuristic_file, output_path, inventory_path, reader_slot=no_slot, compression=None):
+    subject_id = row['subject_id']
+    session_id = row['session_id'] or None
+    session_rel = convert_session.session_folder(subject_id, session_id)
+    scratch = tempfile.mkdtemp(prefix=f"{session_rel.replace(os.sep, '_')}_", dir=os.environ.get('TMPDIR'))
+    try:
+        series_folders = find_series_folders(inventory_path, row['dicom_path'])
+        if not series_folders:
+            raise RuntimeError(f"No DICOM files found in {row['dicom_path']}")
+        stage_path = os.path.join(scratch, 'dicom')
+        with reader_slot(), task_metrics.phase('staging'):
+            staged_folders = stage_dicoms(series_folders, os.path.normpath(row['dicom_path']), stage_path)
+
+        # The top-level BIDS files are written once the subject is published
+        stage_output = os.path.join(scratch, 'bids')
+        convert_row(row, heuristic_file, stage_output, None, stage_path, staged_folders, bids_options=['notop'],
+                    compression=compression)
+
+        with task_metrics.phase('publish'):
+            publish_folder(os.path.join(stage_output, session_rel), os.path.join(output_path, session_rel))
+            heudiconv_info = os.path.join(stage_output, '.heudiconv', convert_session.bids_label(subject_id),
+                                          f"ses-{convert_session.bids_label(session_id)}" if session_id else '')
+            if os.path.isdir(heudiconv_info):
+                restore_dicom_paths(heudiconv_info, stage_path, os.path.normpath(row['dicom_path']))
+                publish_folder(heudiconv_info, os.path.join(output_path, os.path.relpath(heudiconv_info, stage_output)))
+        logger.info(f"Published {session_rel} into {output_path}")
+
+        with task_metrics.phase('bids'):
+            seqinfos = dicom_discover.discover_session(stage_path, staged_folders[:1])
+            convert_session.finalise_session(output_path, subject_id, session_id, convert_session.load_heuristic(heuristic_file),
+                                             seqinfos, intended_for=False)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+# --------------------------------------------------------------------------------------
+# convert_subject: Converts the subject (or session) of one row of the task manifest, records its metrics in the
+# TaskMetrics metrics and marks its manifest record. Returns its status ('done' or 'failed').
+# io_budget maps storage roots to their number of reader slots (see io_slots.py), compression gives the level and
+# threads of the compression of the NIfTI files, if they are compressed after the conversion (see nifti_compress.py).
+# --------------------------------------------------------------------------------------
+def convert_subject(metrics, row, heuristic_file, output_path, manifest_path, inventory_path, io_budget=None, compression=None):
+    subject_id = row['subject_id']
+    session_id = row['session_id'] or None
+    label = convert_session.session_folder(subject_id, session_id)
+    logger.info(f"Processing {label}, DICOM path: {row['dicom_path']}")
+    with metrics.subject(subject_id, session_id) as subject_metrics:
+        subject_metrics['dicom_bytes'] = int(row.get('n_bytes') or 0)
+        subject_metrics['dicom_files'] = int(row.get('n_files') or 0)
+        subject_metrics['max_series_bytes'] = int(row.get('max_series_bytes') or 0)
+        subject_metrics['n_shards'] = int(row.get('n_shards') or 1)
+        reader_slot = functools.partial(io_slots.reader_slot, os.path.join(output_path, '.bids_conversion', 'io_slots'),
+                                        row['dicom_path'], io_budget)
+        try:
+            if int(row.get('stage') or 0):
+                convert_row_staged(row, heuristic_file, output_path, inventory_path, reader_slot, compression)
+            else:
+                with reader_slot():
+                    convert_row(row, heuristic_file, output_path, inventory_path, compression=compression)
+            status = 'done'
+            subject_metrics['output_bytes'] = task_metrics.folder_size(os.path.join(output_path, label))
+        except (Exception, SystemExit):
+            logger.exception(f"Conversion of {label} failed")
+            status = 'failed'
+        subject_metrics['status'] = status
+    conversion_manifest.mark_status(manifest_path, subject_id, session_id, status, row.get('submission') or None)
+    return status
+
+# --------------------------------------------------------------------------------------
+# write_metrics: Writes the metrics of a task (or worker) to metrics_file. The conversions are not affected if it fails.
+# --------------------------------------------------------------------------------------
+def write_metrics(metrics, metrics_file):
+    try:
+        metrics.write(metrics_file)
+        logger.info(f"Metrics written to {metrics_file}")
+    except OSError:
+        logger.exception(f"Could not write the metrics to {metrics_file}")
+
+# --------------------------------------------------------------------------------------
+# run_task: Converts the subjects (or sessions) of one task. Returns the number of conversions that failed.
+# If metrics_file is given, the metrics of the task are written to it (see task_metrics.py). io_budget and
+# compression are passed to convert_subject.
+# --------------------------------------------------------------------------------------
+def run_task(task_manifest_file, task_id, heuristic_file, output_path, manifest_path, inventory_path, metrics_file=None,
+             io_budget=None, compression=None):
+    metrics = task_metrics.TaskMetrics(os.environ.get('SLURM_ARRAY_JOB_ID'), task_id)
+    metrics.instrument_heudiconv()
+    rows = task_manifest.task_rows(task_manifest_file, task_id)
+    logger.info(f"Task {task_id}: {len(rows)} to convert")
+    n_failed = 0
+    for row in rows:
+        status = convert_subject(metrics, row, heuristic_file, output_path, manifest_path, inventory_path, io_budget, compression)
+        n_failed += status == 'failed'
+
+    if metrics_file is not None:
+        write_metrics(metrics, metrics_file)
+    return n_failed
+
+if __name__ == '__main__':
+    if len(sys.argv) != 7:
+        sys.stderr.write("Usage: run_task.py <task_manifest> <task_id> <heuristic_file> <output_path> <manifest_path> <inventory_path>\n")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    task_manifest_file, task_id, heuristic_file, output_path, manifest_path, inventory_path = sys.argv[1:]
+
+    # The metrics are written next to the task's log files (if the job was submitted by the launchers)
+    metrics_file = None
+    io_budget = None
+    compression = None
+    if os.path.isfile(task_manifest.job_file(task_manifest_file)):
+        job = task_manifest.read_job(task_manifest_file)
+        io_budget = job.get('io_slots')
+        compression = job.get('compression')
+        if 'SLURM_ARRAY_JOB_ID' in os.environ:
+            metrics_file = execution_backends.log_file(job['log_path'], 'heudiconv', os.environ['SLURM_ARRAY_JOB_ID'], task_id, 'metrics.json')
+
+    sys.exit(1 if run_task(task_manifest_file, int(task_id), heuristic_file, output_path, manifest_path, inventory_path,
+                           metrics_file, io_budget, compression) else 0)
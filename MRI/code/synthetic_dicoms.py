@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Generates a synthetic cohort of DICOM sessions, to test and benchmark the pipeline without /mridata/cbu
+# (see benchmark.py).
+#
+# The sessions have the layout of the CBU DICOM store, {dicom_root}/{cbu_code}_{project_code}/<date>_<time>/
+# Series_<number>_<protocol>/<file>.dcm, and the series of a CamCAN session that bids_heuristic_sbref.py expects:
+#   - an MPRAGE (one file per slice)
+#   - a dual-echo fieldmap: the magnitude images of both echoes (dim3 76) and the phase difference (dim3 38)
+#   - the functional runs, each a single-band reference (sbref) followed by a multiband (MB2, AP) BOLD run with one
+#     Siemens mosaic file per volume. Cancelled runs (an sbref and a short BOLD run) can be added before the runs.
+#   - a short BOLD run with the opposite phase encoding (PA, 8 volumes) and its sbref, for distortion correction
+# The images are random noise, but the headers hold what heudiconv and dcm2niix need (geometry, timing, protocol
+# names, mosaic information, phase encoding and readout), so the sessions go through the whole conversion and the
+# sidecars have the keys bids_validate.py checks (e.g. PhaseEncodingDirection and TotalReadoutTime of the PA run).
+#
+# The UIDs and the pixel data are derived from the seed, the CBU code and the series, so the same arguments always
+# give the same files. The subjects are written in parallel with a process pool.
+#
+# Usage:
+#   python synthetic_dicoms.py [--subjects <n>] [--runs <n>] [--volumes <n>] [--cancelled <n>] [--slices <n>]
+#                              [--matrix <n>] [--project-code <code>] [--seed <n>] [--processes <n>] <dicom_root>
+#
+# It is assumed that you run this in the 'heudiconv' conda environment (which provides pydicom and numpy).
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To create the session folders
+import math # To lay out the mosaics
+import struct # To write the Siemens CSA header of the mosaics
+import zlib # To seed the pixel data of each session
+import argparse # To parse the command line arguments
+from concurrent.futures import ProcessPoolExecutor # To write the subjects in parallel
+
+import numpy as np # To generate the pixel data
+import pydicom # To write the DICOM files
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import generate_uid, ExplicitVRLittleEndian, MRImageStorage
+
+# Project code of the synthetic sessions, and the first of their CBU codes
+DEFAULT_PROJECT_CODE = 'SYNTHETIC'
+FIRST_CBU_CODE = 900001
+
+# Number of slices of the fieldmap (bids_heuristic_sbref.py tells the magnitude from the phase by dim3: 2 x 38 and 38)
+FIELDMAP_SLICES = 38
+
+# Number of volumes of a cancelled run, and of the PA run (see the top of this file)
+CANCELLED_VOLUMES = 20
+PA_VOLUMES = 8
+
+# Date of the sessions
+SESSION_DATE = '20140101'
+
+# Bandwidth per pixel in the phase-encoding direction of the BOLD runs (Hz), from which dcm2niix derives their
+# EffectiveEchoSpacing and TotalReadoutTime
+BANDWIDTH_PER_PIXEL_PHASE_ENCODE = 30.0
+
+# --------------------------------------------------------------------------------------
+# csa_header: A Siemens CSA image header (SV10 format) holding the given (name, VR, value) elements, which is where
+# dcm2niix and nibabel read the number of images of a mosaic from.
+# --------------------------------------------------------------------------------------
+def csa_header(elements):
+    data = b'SV10' + b'\4\3\2\1' + struct.pack('<2I', len(elements), 77)
+    for name, vr, value in elements:
+        value = value.encode() + b'\0'
+        data += struct.pack('<64si4s3i', name.encode(), 1, vr.encode(), 0, 1, 77)
+        data += struct.pack('<4i', len(value), len(value), 77, len(value))
+        data += value + b'\0' * ((4 - len(value) % 4) % 4)
+    return data
+
+# --------------------------------------------------------------------------------------
+# save: Writes a dataset as a DICOM file (with pydicom 2 or 3).
+# --------------------------------------------------------------------------------------
+def save(ds, path):
+    try:
+        ds.save_as(path, enforce_file_format=True)
+    except TypeError:
+        ds.save_as(path, write_like_original=False)
+
+# --------------------------------------------------------------------------------------
+# write_series: Writes one series of a session into its folder. Each file is one slice (for 2D series) or one volume
+# of n_slices slices (for mosaics). echo_times gives the echo time of each file, in turn. The phase encoding of the
+# mosaics is along the columns, in the BIDS phase_direction of the NIfTI image: 'j-' (AP) or 'j' (PA). dcm2niix flips
+# the rows of the DICOM images, so 'j-' is a positive phase-encoding direction in the CSA header.
+# --------------------------------------------------------------------------------------
+def write_series(folder, uid_source, study_uid, patient_id, number, protocol, n_files, matrix, echo_times, repetition_time,
+                 image_type='M', mosaic_slices=None, phase_direction='j-', rng=None):
+    os.makedirs(folder, exist_ok=True)
+    series_uid = generate_uid(entropy_srcs=[uid_source, str(number)])
+    tiles = math.ceil(math.sqrt(mosaic_slices)) if mosaic_slices else 1
+    n_positions = n_files // len(echo_times)
+    for i in range(n_files):
+        echo = i // n_positions if not mosaic_slices else i % len(echo_times)
+        ds = Dataset()
+        ds.file_meta = FileMetaDataset()
+        ds.file_meta.MediaStorageSOPClassUID = MRImageStorage
+        ds.file_meta.MediaStorageSOPInstanceUID = generate_uid(entropy_srcs=[uid_source, str(number), str(i)])
+        ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        ds.SOPClassUID = MRImageStorage
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.Modality = 'MR'
+        ds.Manufacturer = 'SIEMENS'
+        ds.ManufacturerModelName = 'Prisma_fit'
+        ds.MagneticFieldStrength = 3
+        ds.PatientID = patient_id
+        ds.PatientSex = 'O'
+        ds.PatientAge = '030Y'
+        ds.StudyDate = ds.SeriesDate = ds.AcquisitionDate = SESSION_DATE
+        ds.StudyTime = '120000'
+        ds.SeriesNumber = number
+        ds.InstanceNumber = i + 1
+        ds.ProtocolName = ds.SeriesDescription = protocol
+        ds.ImageType = ['ORIGINAL', 'PRIMARY', image_type, 'ND'] + (['MOSAIC'] if mosaic_slices else [])
+        ds.RepetitionTime = repetition_time
+        ds.EchoTime = echo_times[echo]
+        ds.EchoNumbers = echo + 1
+        ds.FlipAngle = 78 if mosaic_slices else 9
+        ds.InPlanePhaseEncodingDirection = 'COL'
+        # The series follow each other, a minute apart, and the volumes of a run are one TR apart
+        seconds = number * 60 + (i * repetition_time / 1000 if mosaic_slices else 0)
+        ds.AcquisitionTime = ds.SeriesTime = f"{12 + int(seconds // 3600):02d}{int(seconds % 3600 // 60):02d}{seconds % 60:09.6f}"
+        ds.Rows = ds.Columns = matrix * tiles
+        ds.PixelSpacing = [3, 3]
+        ds.SliceThickness = 3
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.ImagePositionPatient = [0, 0, 0.0 if mosaic_slices else 3.0 * (i % n_positions)]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 12
+        ds.HighBit = 11
+        ds.PixelRepresentation = 0
+        if mosaic_slices:
+            ds.AcquisitionMatrix = [0, matrix, matrix, 0]
+            ds.NumberOfPhaseEncodingSteps = matrix
+            ds.add_new((0x0019, 0x0010), 'LO', 'SIEMENS MR HEADER')
+            ds.add_new((0x0019, 0x1028), 'FD', BANDWIDTH_PER_PIXEL_PHASE_ENCODE)
+            ds.add_new((0x0029, 0x0010), 'LO', 'SIEMENS CSA HEADER')
+            ds.add_new((0x0029, 0x1010), 'OB', csa_header([('NumberOfImagesInMosaic', 'US', str(mosaic_slices)),
+                                                            ('AcquisitionMatrixText', 'SH', f"{matrix}p*{matrix}"),
+                                                            ('PhaseEncodingDirectionPositive', 'IS', str(int(phase_direction == 'j-')))]))
+        ds.PixelData = rng.randint(0, 4000, (ds.Rows, ds.Columns), dtype=np.uint16).tobytes()
+        save(ds, os.path.join(folder, f"{i + 1:04d}.dcm"))
+
+# --------------------------------------------------------------------------------------
+# write_session: Writes the series of one session (see the top of this file) into dicom_path.
+# Returns the number of series written.
+# --------------------------------------------------------------------------------------
+def write_session(dicom_path, n_runs=2, n_volumes=110, n_cancelled=0, n_slices=16, matrix=32, seed=0):
+    cbu_code = os.path.basename(os.path.normpath(dicom_path))
+    uid_source = f"{seed}/{cbu_code}"
+    rng = np.random.RandomState(zlib.crc32(uid_source.encode()))
+    study_uid = generate_uid(entropy_srcs=[uid_source])
+    folder = os.path.join(dicom_path, f"{SESSION_DATE}_120000")
+    series = [('MPRAGE_GRAPPA2', n_slices * 4, dict(echo_times=[2.98], repetition_time=2250))]
+    series.append(('gre_fieldmap', 2 * FIELDMAP_SLICES, dict(echo_times=[5.19, 7.65], repetition_time=400)))
+    series.append(('gre_fieldmap', FIELDMAP_SLICES, dict(echo_times=[7.65], repetition_time=400, image_type='P')))
+    bold = dict(echo_times=[30.0], repetition_time=2000, mosaic_slices=n_slices)
+    for _ in range(n_cancelled):
+        series.append(('bold_MB2_AP_2_SBRef', 1, bold))
+        series.append(('bold_MB2_AP_2', CANCELLED_VOLUMES, bold))
+    for _ in range(n_runs):
+        series.append(('bold_MB2_AP_2_SBRef', 1, bold))
+        series.append(('bold_MB2_AP_2', n_volumes, bold))
+    series.append(('bold_MB2_PA_2_SBRef', 1, dict(bold, phase_direction='j')))
+    series.append(('bold_MB2_PA_2', PA_VOLUMES, dict(bold, phase_direction='j')))
+    for number, (protocol, n_files, options) in enumerate(series, start=1):
+        write_series(os.path.join(folder, f"Series_{number:03d}_{protocol}"), uid_source, study_uid, cbu_code, number, protocol,
+                     n_files, matrix, rng=rng, **options)
+    return len(series)
+
+# --------------------------------------------------------------------------------------
+# _write_session_task: write_session for the process pool.
+# --------------------------------------------------------------------------------------
+def _write_session_task(task):
+    dicom_path, options = task
+    return write_session(dicom_path, **options)
+
+# --------------------------------------------------------------------------------------
+# generate_cohort: Writes n_subjects sessions into dicom_root, in n_processes processes (the other options are those of
+# write_session). Returns a dictionary mapping the subject IDs (001, ...) to their CBU codes, as the SUBJECT_LIST
+# of the launchers, and the dicom paths in the same order.
+# --------------------------------------------------------------------------------------
+def generate_cohort(dicom_root, n_subjects, project_code=DEFAULT_PROJECT_CODE, n_processes=os.cpu_count() or 1, **options):
+    subject_list = {f"{i + 1:03d}": f"CBU{FIRST_CBU_CODE + i}" for i in range(n_subjects)}
+    dicom_paths = [os.path.join(dicom_root, f"{cbu_code}_{project_code}") for cbu_code in subject_list.values()]
+    with ProcessPoolExecutor(max_workers=n_processes) as pool:
+        list(pool.map(_write_session_task, [(dicom_path, options) for dicom_path in dicom_paths]))
+    return subject_list, dicom_paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic cohort of CamCAN-like DICOM sessions.")
+    parser.add_argument('dicom_root', help="folder to write the sessions into (DICOM_ROOT of the launchers)")
+    parser.add_argument('--subjects', type=int, default=4, help="number of subjects (default: %(default)s)")
+    parser.add_argument('--runs', type=int, default=2, help="number of BOLD runs per session (default: %(default)s)")
+    parser.add_argument('--volumes', type=int, default=110, help="number of volumes per BOLD run (default: %(default)s)")
+    parser.add_argument('--cancelled', type=int, default=1, help=f"number of cancelled runs ({CANCELLED_VOLUMES} volumes) per session (default: %(default)s)")
+    parser.add_argument('--slices', type=int, default=16, help="number of slices of the BOLD volumes (default: %(default)s)")
+    parser.add_argument('--matrix', type=int, default=32, help="in-plane matrix size (default: %(default)s)")
+    parser.add_argument('--project-code', default=DEFAULT_PROJECT_CODE, help="project code of the session folders (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the UIDs and pixel data (default: %(default)s)")
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help="number of processes (default: %(default)s)")
+    args = parser.parse_args()
+
+    subject_list, dicom_paths = generate_cohort(
+        args.dicom_root, args.subjects, args.project_code, args.processes, n_runs=args.runs, n_volumes=args.volumes,
+        n_cancelled=args.cancelled, n_slices=args.slices, matrix=args.matrix, seed=args.seed)
+    print(f"{len(dicom_paths)} sessions written into {args.dicom_root}, pydicom {pydicom.__version__}")
+    print(f"PROJECT_CODE = '{args.project_code}'")
+    print(f"SUBJECT_LIST = {subject_list!r}")
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Task manifests: what each array task of a submission converts.
+#
+# For every submission, the launchers (dicom_to_bids_multiple_subjects*.py) write two files into
+# {OUTPUT_PATH}/.bids_conversion/tasks:
+#   - tasks_<timestamp>.tsv: one row per subject (or session), with the task that converts it, its subject ID,
+#     session ID, path to the raw data, size and number of its DICOM files and size of its largest series (to size
+#     the resources of the task, see resource_sizing.py), the number of shards to convert it with
+#     (see convert_session.py), whether to convert it in node-local scratch (1) or not (0, see run_task.py) and
+#     whether its IntendedFor fields are left to the IntendedFor stage (1) or populated by the task (0, see intended_for.py).
+#     The rows are sorted by task ID.
+#   - tasks_<timestamp>.offsets: where the rows of each task start in the .tsv file and how many there are, one
+#     fixed-width line per task ID, so that a task reads its own rows without reading the rows before them
+#     (see task_rows)
+#   - tasks_<timestamp>.json: how the tasks were submitted (job script, its arguments and the executor, see
+#     execution_backends.py), so that any of the tasks can be submitted again later, and the job ID of every
+#     submission of its tasks, so that their outcome can be checked later.
+#
+# Each task (heudiconv_script*.sh, run_task.py) gets the path to the task manifest instead of the full lists of subjects,
+# so the command line does not grow with the size of the cohort and paths may contain spaces.
+#
+# A cohort with more tasks than a job array can hold (see execution_backends.Executor.max_array_size) is split into
+# several task manifests, tasks_<timestamp>_<chunk>.tsv, each submitted as its own job array (see split_chunks).
+#
+# Usage:
+#   python task_manifest.py rows <task_manifest> <task_id> <column> [<column> ...]
+#       prints the given columns of the rows of a task, separated by tabs (e.g. to check what a task converts)
+#   python task_manifest.py replay <task_manifest> [<task_id> ...]
+#       submits the given tasks (all of them by default) again, in the same way as the launcher did
+#   python task_manifest.py status <task_manifest>
+#       prints the outcome of the last submission of each task: COMPLETED, FAILED, TIMEOUT, OUT_OF_MEMORY (or
+#       PENDING/RUNNING), from sacct (or the status file of the local executor) and the error files of the tasks
+#   python task_manifest.py resubmit <task_manifest>
+#       submits the tasks that did not complete again, with twice the time if they timed out and twice the memory
+#       if they ran out of memory (than they were submitted with, or else than sacct reports; it stops with an error
+#       if neither is known). Only their subjects (or sessions) that are not converted yet are submitted, in
+#       a new task manifest (which can be resubmitted in turn, up to MAX_ATTEMPTS submissions in all).
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To handle the file paths
+import sys # To read the command line arguments
+import io # To write the rows of the task manifests into memory before knowing their offsets
+import csv # To read and write the task manifests
+import json # To read and write how the tasks were submitted
+import time # To name the task manifests
+
+import execution_backends # To submit the tasks again (execution_backends.py, in the same folder as this script)
+import conversion_manifest # To skip the subjects that are converted when resubmitting (conversion_manifest.py, in the same folder as this script)
+
+# Columns of the task manifests. 'submission' identifies the manifest record each row was submitted for
+# (see conversion_manifest.submission_hash).
+TASK_COLUMNS = ('task_id', 'subject_id', 'session_id', 'dicom_path', 'n_bytes', 'n_files', 'max_series_bytes', 'n_shards', 'stage',
+                'intended_for_stage', 'submission')
+
+# Number of times the tasks of a cohort are submitted at most (the first submission and the resubmissions)
+MAX_ATTEMPTS = 3
+
+# Width of the lines of the offsets files: '<offset> <number of rows>\n' (see write_tasks)
+OFFSET_LINE = 32
+
+# Outcomes of the tasks that are not submitted again
+NOT_RESUBMITTED = (execution_backends.COMPLETED, execution_backends.PENDING, execution_backends.RUNNING)
+
+# --------------------------------------------------------------------------------------
+# new_task_manifest: Returns the path of a new task manifest in task_path.
+# --------------------------------------------------------------------------------------
+def new_task_manifest(task_path, chunk=None):
+    os.makedirs(task_path, exist_ok=True)
+    suffix = '' if chunk is None else f"_{chunk}"
+    task_manifest = os.path.join(task_path, f"tasks_{time.strftime('%Y%m%d%H%M%S')}{suffix}.tsv")
+    while os.path.exists(task_manifest):
+        time.sleep(1)
+        task_manifest = os.path.join(task_path, f"tasks_{time.strftime('%Y%m%d%H%M%S')}{suffix}.tsv")
+    return task_manifest
+
+# --------------------------------------------------------------------------------------
+# split_chunks: Splits the tasks (see write_tasks) into chunks of at most max_array_size tasks, so that each chunk
+# can be written into its own task manifest and submitted as one job array (with task IDs from 0).
+# --------------------------------------------------------------------------------------
+def split_chunks(tasks, max_array_size=None):
+    if not max_array_size or len(tasks) <= max_array_size:
+        return [tasks]
+    return [tasks[start:start + max_array_size] for start in range(0, len(tasks), max_array_size)]
+
+# --------------------------------------------------------------------------------------
+# job_file: The file describing how the tasks of a task manifest are submitted.
+# --------------------------------------------------------------------------------------
+def job_file(task_manifest):
+    return os.path.splitext(task_manifest)[0] + '.json'
+
+# --------------------------------------------------------------------------------------
+# offsets_file: The file with the offsets of the rows of each task in a task manifest.
+# --------------------------------------------------------------------------------------
+def offsets_file(task_manifest):
+    return os.path.splitext(task_manifest)[0] + '.offsets'
+
+# --------------------------------------------------------------------------------------
+# write_tasks: Writes the task manifest.
+#
+# tasks is a list with the positions of the entries converted by each task (see execution_backends.pack_tasks),
+# entries is a list of dictionaries with the other TASK_COLUMNS. The tasks are numbered from 0, unless their
+# (increasing) task_ids are given. The offsets of the rows of each task are written next to it (see offsets_file).
+# --------------------------------------------------------------------------------------
+def write_tasks(task_manifest, tasks, entries, task_ids=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter='\t', lineterminator='\n')
+    writer.writerow(TASK_COLUMNS)
+    lines = [buffer.getvalue().encode()]
+    offsets = {}
+    position = len(lines[0])
+    for task_id, task in zip(task_ids or range(len(tasks)), tasks):
+        offsets[task_id] = (position, len(task))
+        for index in task:
+            row = dict(entries[index], task_id=task_id)
+            values = ['' if row.get(column) is None else str(row[column]) for column in TASK_COLUMNS]
+            if any('\t' in value or '\n' in value for value in values):
+                raise ValueError(f"Tabs and new lines are not allowed in the task manifest: {values}")
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(values)
+            lines.append(buffer.getvalue().encode())
+            position += len(lines[-1])
+
+    tmp_offsets = f"{offsets_file(task_manifest)}.{os.getpid()}.tmp"
+    with open(tmp_offsets, 'w') as f:
+        for task_id in range(max(offsets, default=-1) + 1):
+            f.write(f"{offsets.get(task_id, (0, 0))[0]:20d} {offsets.get(task_id, (0, 0))[1]:10d}\n")
+    tmp_file = f"{task_manifest}.{os.getpid()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.writelines(lines)
+    os.replace(tmp_offsets, offsets_file(task_manifest))
+    os.replace(tmp_file, task_manifest)
+
+# --------------------------------------------------------------------------------------
+# iter_rows: Yields the rows of a task manifest, as dictionaries.
+# --------------------------------------------------------------------------------------
+def iter_rows(task_manifest):
+    with open(task_manifest) as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader)
+        for values in reader:
+            row = dict(zip(header, values))
+            row['task_id'] = int(row['task_id'])
+            yield row
+
+# --------------------------------------------------------------------------------------
+# read_tasks: Returns a dictionary mapping each task ID to its rows.
+# --------------------------------------------------------------------------------------
+def read_tasks(task_manifest):
+    tasks = {}
+    for row in iter_rows(task_manifest):
+        tasks.setdefault(row['task_id'], []).append(row)
+    return tasks
+
+# --------------------------------------------------------------------------------------
+# task_rows: Returns the rows of one task. Its line of the offsets file gives where its rows start in the task
+# manifest, so only the header and the rows of the task are read. Without an offsets file (task manifests written
+# before they existed), the rows are sorted by task ID, so the file is only read up to the last row of the task.
+# --------------------------------------------------------------------------------------
+def task_rows(task_manifest, task_id):
+    if os.path.isfile(offsets_file(task_manifest)):
+        with open(offsets_file(task_manifest), 'rb') as f:
+            f.seek(task_id * OFFSET_LINE)
+            line = f.read(OFFSET_LINE).split()
+        if len(line) != 2 or not int(line[1]):
+            return []
+        with open(task_manifest, 'rb') as f:
+            header = next(csv.reader([f.readline().decode()], delimiter='\t'))
+            f.seek(int(line[0]))
+            lines = [f.readline().decode() for _ in range(int(line[1]))]
+        rows = [dict(zip(header, values)) for values in csv.reader(lines, delimiter='\t')]
+        for row in rows:
+            row['task_id'] = int(row['task_id'])
+        return rows
+    rows = []
+    for row in iter_rows(task_manifest):
+        if row['task_id'] > task_id:
+            break
+        if row['task_id'] == task_id:
+            rows.append(row)
+    return rows
+
+# --------------------------------------------------------------------------------------
+# write_job: Saves how the tasks of a task manifest are submitted: the job script and its arguments
+# (the task manifest is always passed as the first argument), the executor with its options, the folder
+# of the conversion manifest (to skip the converted subjects when resubmitting), the attempt number
+# (1 for the launcher's submission), the I/O budget of the tasks (see io_slots.py) and the compression of their
+# NIfTI files (see nifti_compress.py).
+# The submissions of the tasks are added by submit.
+# --------------------------------------------------------------------------------------
+def write_job(task_manifest, script, args, executor, log_path, executor_options=None, manifest_path=None, attempt=1,
+              io_slots=None, compression=None):
+    job = {
+        'script': script,
+        'args': list(args),
+        'executor': executor,
+        'log_path': log_path,
+        'executor_options': executor_options or {},
+        'manifest_path': manifest_path,
+        'attempt': attempt,
+        'io_slots': io_slots,
+        'compression': compression,
+        'submissions': [],
+    }
+    save_job(task_manifest, job)
+
+# --------------------------------------------------------------------------------------
+# save_job: Writes the job file of a task manifest.
+# --------------------------------------------------------------------------------------
+def save_job(task_manifest, job):
+    tmp_file = f"{job_file(task_manifest)}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(job, f, indent=2)
+    os.replace(tmp_file, job_file(task_manifest))
+
+# --------------------------------------------------------------------------------------
+# read_job: Returns how the tasks of a task manifest are submitted, as saved by write_job.
+# --------------------------------------------------------------------------------------
+def read_job(task_manifest):
+    with open(job_file(task_manifest)) as f:
+        return json.load(f)
+
+# --------------------------------------------------------------------------------------
+# submit: Submits tasks of a task manifest (all of them by default), as saved by write_job, with the given
+# executor options instead of the saved ones if any. The submission is added to the job file.
+# Returns the executor and the job ID.
+# --------------------------------------------------------------------------------------
+def submit(task_manifest, task_ids=None, executor_options=None):
+    job = read_job(task_manifest)
+    if task_ids is None:
+        task_ids = sorted(read_tasks(task_manifest))
+    if executor_options is None:
+        executor_options = job['executor_options']
+    executor = execution_backends.get_executor(job['executor'], job['log_path'], **executor_options)
+    job_id = executor.submit(job['script'], [os.path.abspath(task_manifest)] + job['args'], list(task_ids))
+
+    job = read_job(task_manifest)
+    job.setdefault('submissions', []).append({
+        'job_id': job_id,
+        'task_ids': list(task_ids),
+        'executor_options': executor_options,
+    })
+    save_job(task_manifest, job)
+    return executor, job_id
+
+# --------------------------------------------------------------------------------------
+# task_status: Returns a dictionary mapping each submitted task of a task manifest to the outcome of its
+# last submission: (outcome, exit_code, submission), see execution_backends.Executor.task_outcomes.
+# --------------------------------------------------------------------------------------
+def task_status(task_manifest):
+    job = read_job(task_manifest)
+    status = {}
+    for submission in job.get('submissions', []):
+        executor = execution_backends.get_executor(job['executor'], job['log_path'])
+        outcomes = executor.task_outcomes(submission['job_id'])
+        for task_id in submission['task_ids']:
+            # A task not listed yet by the scheduler is waiting to start
+            outcome, exit_code = outcomes.get(task_id, (execution_backends.PENDING, 0))
+            status[task_id] = (outcome, exit_code, submission)
+    return status
+
+# --------------------------------------------------------------------------------------
+# resubmit: Submits the tasks of a task manifest that did not complete again, in a new task manifest with
+# their subjects (or sessions) that are not converted yet. The tasks keep their IDs, and are submitted with
+# the executor options of their last submission, escalated for their outcome (see execution_backends.escalate),
+# one job per set of options. Raises ValueError (before writing anything) if the time or memory of a task to escalate
+# is not known. Returns the new task manifest (None if nothing is resubmitted) and a list of
+# (executor, job_id) of its submissions.
+# --------------------------------------------------------------------------------------
+def resubmit(task_manifest, max_attempts=MAX_ATTEMPTS):
+    job = read_job(task_manifest)
+    status = task_status(task_manifest)
+    failed = sorted(task_id for task_id, (outcome, _, _) in status.items() if outcome not in NOT_RESUBMITTED)
+    if not failed:
+        print(f"No task of {task_manifest} to resubmit")
+        return None, []
+    if job.get('attempt', 1) >= max_attempts:
+        print(f"Tasks {execution_backends.format_array(failed)} of {task_manifest} failed, "
+              f"but they were already submitted {job.get('attempt', 1)} times (see MAX_ATTEMPTS)")
+        return None, []
+
+    # The rows of the failed tasks, without the subjects that were converted before the task stopped
+    tasks = read_tasks(task_manifest)
+    entries = []
+    positions = {}
+    for task_id in failed:
+        for row in tasks[task_id]:
+            if job.get('manifest_path'):
+                record = conversion_manifest.load_record(job['manifest_path'], row['subject_id'], row['session_id'] or None)
+                if record is not None and record.get('status') == 'done':
+                    continue
+            positions.setdefault(task_id, []).append(len(entries))
+            entries.append(row)
+    if not entries:
+        print(f"All the subjects of the failed tasks of {task_manifest} are converted. Nothing to resubmit.")
+        return None, []
+
+    # One submission per set of escalated options, escalated before anything is written, so that a task whose limits
+    # are not known leaves no task manifest behind
+    task_ids = sorted(positions)
+    executor = execution_backends.get_executor(job['executor'], job['log_path'])
+    limits = {}
+    groups = {}
+    for task_id in task_ids:
+        outcome, _, submission = status[task_id]
+        if outcome in (execution_backends.TIMEOUT, execution_backends.OUT_OF_MEMORY) and submission['job_id'] not in limits:
+            limits[submission['job_id']] = executor.task_limits(submission['job_id'])
+        options = execution_backends.escalate(submission['executor_options'], outcome,
+                                              limits.get(submission['job_id'], {}).get(task_id))
+        # The jobs the first submission waited for are over
+        options.pop('after_job_ids', None)
+        print(f"Task {task_id}: {outcome.lower()}, resubmitting {len(positions[task_id])} of its "
+              f"{len(tasks[task_id])} subjects with {options}")
+        groups.setdefault(json.dumps(options, sort_keys=True), []).append(task_id)
+
+    new_manifest = new_task_manifest(os.path.dirname(task_manifest))
+    write_tasks(new_manifest, [positions[task_id] for task_id in task_ids], entries, task_ids)
+    write_job(new_manifest, job['script'], job['args'], job['executor'], job['log_path'], job['executor_options'],
+              job.get('manifest_path'), job.get('attempt', 1) + 1, job.get('io_slots'),
+              job.get('compression'))
+    submissions = [submit(new_manifest, group, json.loads(options)) for options, group in sorted(groups.items())]
+    print(f"Task manifest of the resubmitted tasks: {new_manifest}")
+    return new_manifest, submissions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 5 and sys.argv[1] == 'rows':
+        for row in task_rows(sys.argv[2], int(sys.argv[3])):
+            print('\t'.join(str(row[column]) for column in sys.argv[4:]))
+    elif len(sys.argv) >= 3 and sys.argv[1] == 'replay':
+        executor, job_id = submit(sys.argv[2], [int(task_id) for task_id in sys.argv[3:]] or None)
+        if executor.name == 'local' and executor.report(job_id):
+            sys.exit(1)
+    elif len(sys.argv) == 3 and sys.argv[1] == 'status':
+        job = read_job(sys.argv[2])
+        counts = {}
+        for task_id, (outcome, exit_code, submission) in sorted(task_status(sys.argv[2]).items()):
+            counts[outcome] = counts.get(outcome, 0) + 1
+            err_file = execution_backends.log_file(job['log_path'], 'heudiconv', submission['job_id'], task_id, 'err')
+            print(f"{task_id}\t{outcome}\t{exit_code}\t{submission['job_id']}\t{err_file}")
+        print(', '.join(f"{n} {outcome.lower()}" for outcome, n in sorted(counts.items())) or 'No task was submitted')
+        if any(outcome not in NOT_RESUBMITTED for outcome in counts):
+            sys.exit(1)
+    elif len(sys.argv) == 3 and sys.argv[1] == 'resubmit':
+        try:
+            _, submissions = resubmit(sys.argv[2])
+        except ValueError as error:
+            sys.stderr.write(f"{error}\n")
+            sys.exit(1)
+        failed = [executor.report(job_id) for executor, job_id in submissions if executor.name == 'local']
+        if any(failed):
+            sys.exit(1)
+    else:
+        sys.stderr.write("Usage: task_manifest.py rows <task_manifest> <task_id> <column> [<column> ...]\n"
+                         "       task_manifest.py replay <task_manifest> [<task_id> ...]\n"
+                         "       task_manifest.py status <task_manifest>\n"
+                         "       task_manifest.py resubmit <task_manifest>\n")
+        sys.exit(1)
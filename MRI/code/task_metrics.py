@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+# ============================================================
+# Requires Python 3.6 or higher! (because of f-strings)
+#
+# Performance metrics of the conversion tasks.
+#
+# Each task (run_task.py) writes a JSON record next to its output and error files in the job logs folder:
+#   {log_path}/heudiconv_job_<job_id>_<task_id>.metrics.json
+# holding, for the task:
+#   - its wall time, peak memory (RSS of the Python process and of the largest child process, e.g. dcm2niix)
+#     and I/O counters (from /proc/self/io and getrusage, when available)
+# and for each subject (or session) it converted:
+#   - its status, wall time and the wall time of each phase: 'io_wait' (waiting for an I/O slot of the DICOM
+#     store, see io_slots.py), 'staging' (copy to node-local scratch),
+#     'discovery' (finding the series folders), 'seqinfo' (grouping the DICOM files into series),
+#     'dcm2niix' (conversion of each series, also listed one by one in 'series') and 'bids' (BIDS files:
+#     sidecars, scans.tsv, participants.tsv, top-level files, IntendedFor), 'compress' (compression of the NIfTI
+#     files after the conversion, see nifti_compress.py), 'publish' (copy from scratch)
+#   - the number of series folders, DICOM files and bytes (and bytes of its largest series) it was converted from,
+#     the number of shards it was converted with and the number of bytes written (used to size later runs, see resource_sizing.py)
+#   - the number of DICOM files left out as exact duplicates of another file, and of series folders left out because
+#     all their files were, if any (see dicom_duplicates.py)
+#
+# The heudiconv phases are timed by wrapping heudiconv's own functions (see instrument_heudiconv). When a
+# subject is converted in shards (convert_session.py), the shards run in other processes and only their
+# total time is recorded ('shards').
+#
+# Usage (to summarise the records of a cohort run):
+#   python task_metrics.py report <log_path> [<job_id> ...]
+#
+# ============================================================
+
+# ------------------------------------------------------------
+# Import packages
+# ------------------------------------------------------------
+import os # To find the records and measure the output size
+import sys # To read the command line arguments
+import glob # To find the records
+import json # To read and write the records
+import time # To time the phases
+import socket # To record where the task ran
+import resource # To read the peak memory
+import functools # To wrap heudiconv's functions
+from contextlib import contextmanager # To time the phases with 'with' blocks
+
+# Phases reported by the report command, in order
+PHASES = ('io_wait', 'staging', 'discovery', 'seqinfo', 'dcm2niix', 'shards', 'compress', 'bids', 'publish')
+
+# heudiconv functions timed by instrument_heudiconv: (module, function name, phase)
+HEUDICONV_FUNCTIONS = (
+    ('heudiconv.parser', 'group_dicoms_into_seqinfos', 'seqinfo'),
+    ('heudiconv.convert', 'group_dicoms_into_seqinfos', 'seqinfo'),
+    ('heudiconv.convert', 'nipype_convert', 'dcm2niix'),
+    ('heudiconv.convert', 'tuneup_bids_json_files', 'bids'),
+    ('heudiconv.convert', 'save_scans_key', 'bids'),
+    ('heudiconv.convert', 'add_participant_record', 'bids'),
+    ('heudiconv.convert', 'populate_bids_templates', 'bids'),
+    ('heudiconv.convert', 'populate_intended_for', 'bids'),
+)
+
+# The TaskMetrics of the subject being converted in this process, if any (see phase)
+_active = None
+
+# --------------------------------------------------------------------------------------
+# phase: Times a block of code as a phase of the subject being converted, if metrics are being collected
+# in this process (so that other modules, e.g. convert_session.py, can be timed without passing the metrics around).
+# --------------------------------------------------------------------------------------
+@contextmanager
+def phase(name):
+    if _active is None:
+        yield
+        return
+    with _active.phase(name):
+        yield
+
+# --------------------------------------------------------------------------------------
+# record: Adds values (e.g. n_series_folders) to the record of the subject being converted, if metrics are being collected.
+# --------------------------------------------------------------------------------------
+def record(**values):
+    if _active is not None and _active.current is not None:
+        _active.current.update(values)
+
+# --------------------------------------------------------------------------------------
+# folder_size: Total size of the files under a folder, in bytes.
+# --------------------------------------------------------------------------------------
+def folder_size(folder):
+    total = 0
+    for path, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(path, name)).st_size
+            except FileNotFoundError:
+                continue
+    return total
+
+# --------------------------------------------------------------------------------------
+# process_io: I/O counters of this process (bytes, from /proc/self/io) and of its finished child processes
+# (blocks of 512 bytes, from getrusage). The /proc counters are not available on every system.
+# --------------------------------------------------------------------------------------
+def process_io():
+    io = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('rchar', 'wchar', 'read_bytes', 'write_bytes'):
+                    io[name] = int(value)
+    except OSError:
+        pass
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io['children_read_bytes'] = children.ru_inblock * 512
+    io['children_write_bytes'] = children.ru_oublock * 512
+    return io
+
+# --------------------------------------------------------------------------------------
+# peak_rss_mb: Peak resident memory of this process and of its largest finished child process, in MB.
+# --------------------------------------------------------------------------------------
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+# --------------------------------------------------------------------------------------
+# TaskMetrics: Collects the metrics of one task (see the top of this file).
+# --------------------------------------------------------------------------------------
+class TaskMetrics:
+
+    def __init__(self, job_id, task_id):
+        self.start = time.time()
+        self.current = None
+        self.record = {
+            'job_id': job_id,
+            'task_id': task_id,
+            'hostname': socket.gethostname(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start)),
+            'subjects': [],
+        }
+
+    # Adds seconds to a phase of the subject being converted
+    def add_time(self, phase, seconds):
+        if self.current is not None:
+            self.current['phases'][phase] = self.current['phases'].get(phase, 0) + seconds
+
+    # Times a block of code as a phase of the subject being converted
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - start)
+
+    # Times the conversion of one subject (or session); the record can be updated inside the block
+    @contextmanager
+    def subject(self, subject_id, session_id=None):
+        global _active
+        _active = self
+        self.current = {
+            'subject_id': subject_id,
+            'session_id': session_id,
+            'status': 'failed',
+            'phases': {},
+            'series': [],
+        }
+        self.record['subjects'].append(self.current)
+        start = time.time()
+        try:
+            yield self.current
+        finally:
+            self.current['wall_time'] = time.time() - start
+            self.current = None
+            _active = None
+
+    # Wraps heudiconv's functions (HEUDICONV_FUNCTIONS) so that they are timed as phases of the subject being converted.
+    # The conversion of each series (nipype_convert) is also recorded in the subject's 'series' list.
+    def instrument_heudiconv(self):
+        for module_name, function_name, phase in HEUDICONV_FUNCTIONS:
+            module = sys.modules.get(module_name) or __import__(module_name, fromlist=[function_name])
+            function = getattr(module, function_name, None)
+            if function is None or getattr(function, '_task_metrics', False):
+                continue
+            setattr(module, function_name, self._timed(function, phase))
+
+    def _timed(self, function, phase):
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds = time.time() - start
+                self.add_time(phase, seconds)
+                if phase == 'dcm2niix' and self.current is not None:
+                    prefix = kwargs.get('prefix', args[1] if len(args) > 1 else '')
+                    self.current['series'].append({'name': os.path.basename(str(prefix)), 'seconds': seconds})
+        timed._task_metrics = True
+        return timed
+
+    # Writes the record, with the task totals
+    def write(self, metrics_file):
+        self.record['wall_time'] = time.time() - self.start
+        self.record['peak_rss_mb'] = peak_rss_mb()
+        self.record['io'] = process_io()
+        tmp_file = f"{metrics_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(self.record, f, indent=2)
+        os.replace(tmp_file, metrics_file)
+
+# --------------------------------------------------------------------------------------
+# read_records: Reads the records of the tasks in log_path (only the ones of the given jobs, if any).
+# --------------------------------------------------------------------------------------
+def read_records(log_path, job_ids=None):
+    records = []
+    for metrics_file in sorted(glob.glob(os.path.join(log_path, '*.metrics.json'))):
+        with open(metrics_file) as f:
+            record = json.load(f)
+        if not job_ids or str(record.get('job_id')) in job_ids:
+            records.append(record)
+    return records
+
+# --------------------------------------------------------------------------------------
+# summarise: Aggregates task records into the lines of the report.
+# --------------------------------------------------------------------------------------
+def summarise(records, n_slowest=10):
+    subjects = [s for record in records for s in record['subjects']]
+    done = [s for s in subjects if s['status'] == 'done']
+    lines = [
+        f"Tasks: {len(records)}, subjects: {len(subjects)} ({len(done)} done, {len(subjects) - len(done)} failed)",
+    ]
+    if not records:
+        return lines
+
+    task_times = sorted(record['wall_time'] for record in records)
+    lines.append(f"Task wall time: total {sum(task_times) / 3600:.2f} h, "
+                 f"median {task_times[len(task_times) // 2]:.0f} s, max {task_times[-1]:.0f} s")
+    lines.append(f"Peak RSS: python {max(r['peak_rss_mb']['self'] for r in records):.0f} MB, "
+                 f"children {max(r['peak_rss_mb']['children'] for r in records):.0f} MB")
+
+    dicom_bytes = sum(s.get('dicom_bytes', 0) for s in done)
+    output_bytes = sum(s.get('output_bytes', 0) for s in done)
+    subject_time = sum(s['wall_time'] for s in done)
+    lines.append(f"DICOM read: {dicom_bytes / 1e9:.2f} GB, BIDS written: {output_bytes / 1e9:.2f} GB, "
+                 f"throughput: {dicom_bytes / 1e6 / subject_time if subject_time else 0:.1f} MB/s per task")
+
+    lines.append('')
+    lines.append(f"{'phase':<12}{'total (s)':>12}{'mean (s)':>12}{'max (s)':>12}{'share':>8}")
+    total_time = sum(s['wall_time'] for s in subjects) or 1
+    for phase in PHASES:
+        times = [s['phases'][phase] for s in subjects if phase in s['phases']]
+        if times:
+            lines.append(f"{phase:<12}{sum(times):>12.1f}{sum(times) / len(times):>12.1f}{max(times):>12.1f}"
+                         f"{100 * sum(times) / total_time:>7.0f}%")
+
+    series = sorted(((s['seconds'], s['name'], subject['subject_id'], subject['session_id'])
+                     for subject in subjects for s in subject['series']), reverse=True)
+    if series:
+        lines.append('')
+        lines.append(f"Slowest series ({len(series)} converted):")
+        for seconds, name, subject_id, session_id in series[:n_slowest]:
+            session = f" ses-{session_id}" if session_id else ''
+            lines.append(f"  {seconds:8.1f} s  sub-{subject_id}{session}  {name}")
+    return lines
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != 'report':
+        sys.stderr.write("Usage: task_metrics.py report <log_path> [<job_id> ...]\n")
+        sys.exit(1)
+    print('\n'.join(summarise(read_records(sys.argv[2], sys.argv[3:]))))
@@ -0,0 +1,14 @@
+# ============================================================
+# Shared set-up of the unit tests of the conversion scripts.
+#
+# The scripts are flat modules in MRI/code that import each other by name, so that folder is put on the path.
+#
+# Usage (in the 'heudiconv' conda environment, from MRI/code):
+#   python -m pytest tests
+#
+# ============================================================
+
+import os # To find the folder of the scripts
+import sys # To put it on the path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
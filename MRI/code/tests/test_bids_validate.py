@@ -0,0 +1,112 @@
+# ============================================================
+# Tests of the BIDS checks (bids_validate.py): on a tiny subject folder, the file names, sidecars, sbrefs, IntendedFor
+# and scans.tsv problems are reported, and a converted file only accounts for the conversion key it was named after.
+# ============================================================
+
+import csv # To write the scans.tsv file
+import json # To write the sidecars
+import os # To lay out the subject folder
+
+import pytest # To parametrise the problems
+
+import bids_validate # The BIDS checks (bids_validate.py)
+
+CODE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOLD = 'func/sub-001_task-rest_run-1_bold'
+
+# Sidecar of each NIfTI file of the subject folder (without extension)
+SIDECARS = {
+    'anat/sub-001_T1w': {},
+    BOLD: {'RepetitionTime': 2.0, 'TaskName': 'rest'},
+    'func/sub-001_task-rest_run-1_sbref': {},
+    'fmap/sub-001_acq-func_dir-PA_epi': {'PhaseEncodingDirection': 'j', 'TotalReadoutTime': 0.05,
+                                         'IntendedFor': [f"{BOLD}.nii.gz"]},
+}
+
+
+# --------------------------------------------------------------------------------------
+# check_subject: Writes the subject folder sub-001 of the given NIfTI files and sidecars, with a scans.tsv file
+# listing the given files (all of them by default), and returns the errors and warnings of bids_validate.check_session.
+# --------------------------------------------------------------------------------------
+def check_subject(output_path, sidecars, listed=None):
+    for stem, sidecar in sidecars.items():
+        os.makedirs(os.path.join(output_path, 'sub-001', os.path.dirname(stem)), exist_ok=True)
+        with open(os.path.join(output_path, 'sub-001', f"{stem}.nii.gz"), 'wb') as f:
+            f.write(b'\0' * 352)
+        with open(os.path.join(output_path, 'sub-001', f"{stem}.json"), 'w') as f:
+            json.dump(sidecar, f)
+    with open(os.path.join(output_path, 'sub-001', 'sub-001_scans.tsv'), 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['filename', 'acq_time'])
+        writer.writerows([f"{stem}.nii.gz", '2024-01-01T10:00:00'] for stem in (sidecars if listed is None else listed))
+    record = {'subject_id': '001', 'session_id': None, 'dicom_path': None}
+    task = (output_path, record, os.path.join(CODE_PATH, 'bids_heuristic.py'), None,
+            bids_validate.top_level_sidecars(output_path), [])
+    session_rel, (errors, warnings) = bids_validate.check_session(task)
+    assert session_rel == 'sub-001'
+    # Without DICOM folder, the series are not checked against the heuristic
+    assert warnings[:1] == ["sub-001: DICOM folder None not found, the series were not checked against the heuristic"]
+    return errors, warnings[1:]
+
+
+def test_valid_subject(tmp_path):
+    assert check_subject(str(tmp_path), SIDECARS) == ([], [])
+
+
+def test_entities_not_in_order(tmp_path):
+    sidecars = dict(SIDECARS, **{'anat/sub-001_run-1_acq-mprage_T1w': {}})
+    assert check_subject(str(tmp_path), sidecars) == (
+        [f"sub-001/anat/sub-001_run-1_acq-mprage_T1w.{extension}: entities not in the BIDS order (sub_acq_run)"
+         for extension in ('json', 'nii.gz')], [])
+
+
+def test_missing_task_name(tmp_path):
+    sidecars = dict(SIDECARS, **{BOLD: {'RepetitionTime': 2.0}})
+    assert check_subject(str(tmp_path), sidecars) == ([f"sub-001/{BOLD}.nii.gz: required sidecar keys missing: TaskName"], [])
+
+
+def test_task_name_inherited(tmp_path):
+    # The top-level task-rest_bold.json gives the TaskName
+    sidecars = dict(SIDECARS, **{BOLD: {'RepetitionTime': 2.0}})
+    with open(str(tmp_path / 'task-rest_bold.json'), 'w') as f:
+        json.dump({'TaskName': 'rest'}, f)
+    assert check_subject(str(tmp_path), sidecars) == ([], [])
+
+
+def test_orphan_sbref(tmp_path):
+    sidecars = dict(SIDECARS, **{'func/sub-001_task-rest_run-2_sbref': {}})
+    assert check_subject(str(tmp_path), sidecars) == (
+        ["sub-001/func/sub-001_task-rest_run-2_sbref: no image with the same entities for this sbref"], [])
+
+
+def test_dangling_intended_for(tmp_path):
+    fieldmap = dict(SIDECARS['fmap/sub-001_acq-func_dir-PA_epi'], IntendedFor=['func/sub-001_task-rest_run-2_bold.nii.gz'])
+    sidecars = dict(SIDECARS, **{'fmap/sub-001_acq-func_dir-PA_epi': fieldmap})
+    assert check_subject(str(tmp_path), sidecars) == (
+        ["sub-001/fmap/sub-001_acq-func_dir-PA_epi.nii.gz: IntendedFor func/sub-001_task-rest_run-2_bold.nii.gz does not exist"], [])
+
+
+def test_missing_from_scans(tmp_path):
+    listed = [stem for stem in SIDECARS if stem != 'anat/sub-001_T1w'] + ['anat/sub-001_T2w']
+    assert check_subject(str(tmp_path), SIDECARS, listed) == (
+        ["sub-001/sub-001_scans.tsv: anat/sub-001_T2w.nii.gz does not exist"],
+        ["sub-001/anat/sub-001_T1w.nii.gz: not listed in sub-001_scans.tsv"])
+
+
+@pytest.mark.parametrize('stem, prefix, named', [
+    ('sub-001/func/sub-001_task-rest_run-1_bold', 'sub-001/func/sub-001_task-rest_run-1_bold', True),
+    # Another conversion key that starts with the same characters
+    ('sub-001/func/sub-001_task-rest_run-10_bold', 'sub-001/func/sub-001_task-rest_run-1_bold', False),
+    ('sub-001/func/sub-001_task-rest_run-1_bold', 'sub-001/func/sub-001_task-rest_run-1', False),
+    # The entities and suffix numbers heudiconv adds when a series gives several files
+    ('sub-001/func/sub-001_task-rest_echo-2_bold', 'sub-001/func/sub-001_task-rest_bold', True),
+    ('sub-001/fmap/sub-001_acq-func_magnitude1', 'sub-001/fmap/sub-001_acq-func_magnitude', True),
+    # The __dup suffix of a series converted again
+    ('sub-001/func/sub-001_task-rest_run-1_bold__dup-01', 'sub-001/func/sub-001_task-rest_run-1_bold', True),
+    ('sub-001/func/sub-001_task-rest_run-1_bold__dup-01', 'sub-001/func/sub-001_task-rest_run-1_bold__dup-01', True),
+    ('sub-001/fmap/sub-001_acq-func_magnitude2__dup02', 'sub-001/fmap/sub-001_acq-func_magnitude', True),
+    ('sub-001/func/sub-001_task-rest_run-1_bold__dup-01', 'sub-001/func/sub-001_task-rest_run-1_bold__dup-02', False),
+])
+def test_named_after(stem, prefix, named):
+    assert bids_validate.named_after(stem, prefix) == named
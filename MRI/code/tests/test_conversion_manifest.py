@@ -0,0 +1,70 @@
+# ============================================================
+# Tests of the conversion manifest (conversion_manifest.py): a subject submitted with the same inputs is taken as in
+# progress until the timeout, and a job only marks the record it was submitted for.
+# ============================================================
+
+import time # To age the records
+
+import pytest # To parametrise the records
+
+import conversion_manifest # The conversion manifest (conversion_manifest.py)
+
+FINGERPRINT = {'20240101_120000/Series_001_MPRAGE': {'series_uid': '1.2.3', 'n_files': 192, 'n_bytes': 1000, 'mtime': 1.5}}
+NEW_FINGERPRINT = {'20240101_120000/Series_001_MPRAGE': {'series_uid': '1.2.3', 'n_files': 193, 'n_bytes': 1010, 'mtime': 2.5}}
+
+
+# --------------------------------------------------------------------------------------
+# record: The record of subject 001 submitted with FINGERPRINT and heuristic 'sha', in the given status, updated
+# the given number of hours ago.
+# --------------------------------------------------------------------------------------
+def record(status, hours_ago=0, fingerprint=FINGERPRINT, heuristic_sha='sha'):
+    new = conversion_manifest.new_record('001', None, '/mridata/cbu/CBU000001', fingerprint, 'bids_heuristic.py', heuristic_sha)
+    new['status'] = status
+    new['updated'] = time.strftime(conversion_manifest.TIME_FORMAT, time.localtime(time.time() - hours_ago * 3600))
+    return new
+
+
+@pytest.mark.parametrize('previous, reason', [
+    (None, 'not converted yet'),
+    (record('done', heuristic_sha='old'), 'heuristic changed'),
+    (record('done', fingerprint=NEW_FINGERPRINT), 'DICOM inputs changed'),
+    (record('submitted', fingerprint=NEW_FINGERPRINT), 'DICOM inputs changed'),
+    (record('failed'), 'previous conversion failed'),
+    (record('done', hours_ago=1000), None),
+    (record('submitted'), None),
+    (record('submitted', hours_ago=conversion_manifest.SUBMITTED_TIMEOUT_HOURS - 1), None),
+    (record('submitted', hours_ago=conversion_manifest.SUBMITTED_TIMEOUT_HOURS + 1),
+     f"submitted {conversion_manifest.SUBMITTED_TIMEOUT_HOURS + 1} hours ago and not finished"),
+])
+def test_needs_conversion(previous, reason):
+    assert conversion_manifest.needs_conversion(previous, FINGERPRINT, 'sha') == reason
+
+
+def test_needs_conversion_timeout():
+    assert conversion_manifest.needs_conversion(record('submitted', hours_ago=3), FINGERPRINT, 'sha', 2) == \
+        "submitted 3 hours ago and not finished"
+
+
+def test_mark_status_of_its_submission(tmp_path):
+    manifest_path = str(tmp_path / 'manifest')
+    conversion_manifest.write_record(manifest_path, record('submitted'))
+    submission = conversion_manifest.submission_hash(FINGERPRINT, 'sha')
+    assert conversion_manifest.mark_status(manifest_path, '001', None, 'done', submission)
+    assert conversion_manifest.load_record(manifest_path, '001')['status'] == 'done'
+
+
+@pytest.mark.parametrize('fingerprint, heuristic_sha', [(NEW_FINGERPRINT, 'sha'), (FINGERPRINT, 'new')])
+def test_mark_status_of_a_stale_job(tmp_path, fingerprint, heuristic_sha):
+    # The subject was submitted again (with other inputs or another heuristic) while the first job was running
+    manifest_path = str(tmp_path / 'manifest')
+    conversion_manifest.write_record(manifest_path, record('submitted', fingerprint=fingerprint, heuristic_sha=heuristic_sha))
+    stale = conversion_manifest.submission_hash(FINGERPRINT, 'sha')
+    assert not conversion_manifest.mark_status(manifest_path, '001', None, 'done', stale)
+    assert conversion_manifest.load_record(manifest_path, '001')['status'] == 'submitted'
+    # Without a submission (e.g. marked by hand), the record is marked
+    assert conversion_manifest.mark_status(manifest_path, '001', None, 'done')
+    assert conversion_manifest.load_record(manifest_path, '001')['status'] == 'done'
+
+
+def test_mark_status_without_record(tmp_path):
+    assert not conversion_manifest.mark_status(str(tmp_path / 'manifest'), '001', None, 'done')
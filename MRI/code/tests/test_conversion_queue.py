@@ -0,0 +1,63 @@
+# ============================================================
+# Tests of the conversion queue (conversion_queue.py): conversions are claimed largest first, once each, and the
+# ones abandoned by their worker are put back into the queue.
+# ============================================================
+
+import os # To age the running conversions
+
+import conversion_queue # The conversion queue (conversion_queue.py)
+
+
+def new_queue(tmp_path):
+    queue_path = str(tmp_path / 'queue')
+    conversion_queue.write_config(queue_path, 'bids_heuristic.py', str(tmp_path), str(tmp_path / 'manifest'),
+                                  str(tmp_path / 'dicom_inventory'), str(tmp_path / 'job_logs'))
+    return queue_path
+
+
+def entry(subject_id, n_bytes, session_id=None):
+    return {'subject_id': subject_id, 'session_id': session_id, 'dicom_path': f"/mridata/cbu/{subject_id}", 'n_bytes': n_bytes}
+
+
+def test_claim_largest_first(tmp_path):
+    queue_path = new_queue(tmp_path)
+    conversion_queue.enqueue(queue_path, [entry('001', 10), entry('002', 3000), entry('003', 200)])
+    claimed = [conversion_queue.claim(queue_path)[1]['subject_id'] for _ in range(3)]
+    assert claimed == ['002', '003', '001']
+    assert conversion_queue.claim(queue_path) is None
+    assert len(conversion_queue.queue_status(queue_path)['running']) == 3
+
+
+def test_enqueue_replaces_waiting_conversion(tmp_path):
+    queue_path = new_queue(tmp_path)
+    conversion_queue.enqueue(queue_path, [entry('001', 10), entry('001', 10, '1')])
+    conversion_queue.enqueue(queue_path, [entry('001', 20)])
+    assert conversion_queue.queue_status(queue_path)['pending'] == ['000000000000010_sub-001_ses-1.json',
+                                                                    '000000000000020_sub-001.json']
+
+
+def test_finish(tmp_path):
+    queue_path = new_queue(tmp_path)
+    conversion_queue.enqueue(queue_path, [entry('001', 10), entry('002', 20)])
+    for status in ('done', 'failed'):
+        name, claimed = conversion_queue.claim(queue_path)
+        conversion_queue.finish(queue_path, name, claimed, status, {'worker': 'node:1'})
+    status = conversion_queue.queue_status(queue_path)
+    assert (status['running'], len(status['done']), len(status['failed'])) == ([], 1, 1)
+    assert conversion_queue.retry_failed(queue_path) == 1
+    assert conversion_queue.claim(queue_path)[1]['subject_id'] == '001'
+
+
+def test_requeue_stale(tmp_path):
+    queue_path = new_queue(tmp_path)
+    conversion_queue.enqueue(queue_path, [entry('001', 10), entry('002', 20)])
+    stale_name, _ = conversion_queue.claim(queue_path)
+    live_name, _ = conversion_queue.claim(queue_path)
+    stale_file = os.path.join(conversion_queue.state_folder(queue_path, 'running'), stale_name)
+    old = os.stat(stale_file).st_mtime - 2 * conversion_queue.STALE_SECONDS
+    os.utime(stale_file, (old, old))
+    assert conversion_queue.requeue_stale(queue_path) == [stale_name]
+    assert conversion_queue.queue_status(queue_path)['running'] == [live_name]
+    # Claimed again, it is no longer stale
+    assert conversion_queue.claim(queue_path)[0] == stale_name
+    assert conversion_queue.requeue_stale(queue_path) == []
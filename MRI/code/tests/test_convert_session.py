@@ -0,0 +1,114 @@
+# ============================================================
+# Tests of the shard planner of the in-process conversion (convert_session.py): the units of a session are split
+# into shards of similar size without separating the files heudiconv has to convert together, and the scans.tsv
+# files and .heudiconv info folders of the shards are merged back.
+# ============================================================
+
+import os # To write the scans.tsv files
+import shutil # To find dcm2niix
+
+import pytest # To skip the conversions without dcm2niix
+
+import convert_session # The shard planner (convert_session.py)
+
+CODE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# --------------------------------------------------------------------------------------
+# unit: A conversion unit (see convert_session.plan_units) of the given template and series.
+# --------------------------------------------------------------------------------------
+def unit(template, series_id):
+    return {'template': template, 'outtype': ['nii.gz'], 'annotation_classes': None, 'item': series_id, 'series_id': series_id}
+
+UNITS = [
+    unit('sub-{subject}/anat/sub-{subject}_T1w', 'anat'),
+    unit('sub-{subject}/fmap/sub-{subject}_acq-func_magnitude', 'magnitude'),
+    unit('sub-{subject}/fmap/sub-{subject}_acq-func_phasediff', 'phasediff'),
+    unit('sub-{subject}/fmap/sub-{subject}_acq-func_dir-PA_epi', 'pa'),
+    unit('sub-{subject}/func/sub-{subject}_task-video_run-01_bold', 'bold1'),
+    unit('sub-{subject}/func/sub-{subject}_task-video_run-02_bold', 'bold2'),
+]
+SERIES_FILES = {'anat': 192, 'magnitude': 76, 'phasediff': 38, 'pa': 8, 'bold1': 110, 'bold2': 110}
+
+
+def test_unit_group_keeps_fieldmaps_together():
+    groups = [convert_session.unit_group(index, u) for index, u in enumerate(UNITS)]
+    assert groups[1] == groups[2] == 'sub-{subject}/fmap/sub-{subject}_acq-func'
+    assert groups[3] == 'sub-{subject}/fmap/sub-{subject}_acq-func_dir-PA'
+    assert groups[0] == 0 and groups[4] == 4 and groups[5] == 5
+
+
+def test_split_shards_keeps_fieldmaps_together():
+    for n_shards in range(1, 8):
+        shards = convert_session.split_shards(UNITS, SERIES_FILES, n_shards)
+        assert sorted(u['series_id'] for shard in shards for u in shard) == sorted(SERIES_FILES)
+        assert len(shards) == min(n_shards, 5)
+        assert any({'magnitude', 'phasediff'} <= {u['series_id'] for u in shard} for shard in shards)
+
+
+def test_split_shards_balances_files():
+    shards = convert_session.split_shards(UNITS, SERIES_FILES, 3)
+    sizes = sorted(sum(SERIES_FILES[u['series_id']] for u in shard) for shard in shards)
+    # Groups of 192 (anat), 114 (magnitude and phasediff), 110, 110 and 8 files, each given to the smallest shard
+    assert sizes == [114 + 8, 192, 110 + 110]
+
+
+def test_split_shards_without_units():
+    assert convert_session.split_shards([], {}, 4) == []
+    assert convert_session.split_shards(UNITS[:1], {}, 0) == [UNITS[:1]]
+
+
+def write_scans(path, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('filename\tacq_time\toperator\trandstr\n')
+        for row in rows:
+            f.write('\t'.join(row) + '\n')
+
+
+def read_scans(path):
+    with open(path) as f:
+        return [line.rstrip('\n').split('\t') for line in f]
+
+
+def test_merge_scans(tmp_path):
+    target = str(tmp_path / 'sub-001' / 'sub-001_scans.tsv')
+    shard1 = str(tmp_path / 'shard1' / 'sub-001_scans.tsv')
+    shard2 = str(tmp_path / 'shard2' / 'sub-001_scans.tsv')
+    write_scans(target, [('func/sub-001_task-video_run-01_bold.nii.gz', '2014-01-01T12:05:00', 'n/a', 'old')])
+    write_scans(shard1, [('func/sub-001_task-video_run-01_bold.nii.gz', '2014-01-01T12:05:00', 'n/a', 'new'),
+                         ('anat/sub-001_T1w.nii.gz', '2014-01-01T12:01:00', 'n/a', 'a')])
+    write_scans(shard2, [('fmap/sub-001_acq-func_phasediff.nii.gz', '2014-01-01T12:03:00', 'n/a', 'b')])
+    convert_session.merge_scans([shard1, shard2, str(tmp_path / 'missing_scans.tsv')], target)
+    assert read_scans(target) == [
+        ['filename', 'acq_time', 'operator', 'randstr'],
+        ['anat/sub-001_T1w.nii.gz', '2014-01-01T12:01:00', 'n/a', 'a'],
+        ['fmap/sub-001_acq-func_phasediff.nii.gz', '2014-01-01T12:03:00', 'n/a', 'b'],
+        ['func/sub-001_task-video_run-01_bold.nii.gz', '2014-01-01T12:05:00', 'n/a', 'new'],
+    ]
+
+
+def test_merge_scans_without_files(tmp_path):
+    target = str(tmp_path / 'sub-001_scans.tsv')
+    convert_session.merge_scans([], target)
+    assert not os.path.exists(target)
+
+
+@pytest.mark.skipif(shutil.which('dcm2niix') is None, reason="needs dcm2niix")
+def test_sharded_conversion_keeps_heudiconv_info(tmp_path):
+    synthetic_dicoms = pytest.importorskip('synthetic_dicoms')
+    dicom_path = str(tmp_path / 'dicoms' / 'CBU900001_SYNTHETIC')
+    synthetic_dicoms.write_session(dicom_path, n_runs=1, n_volumes=101, n_slices=4, matrix=8)
+    heuristic_file = os.path.join(CODE_PATH, 'bids_heuristic_sbref.py')
+
+    convert_session.convert_session(dicom_path, '001', None, heuristic_file, str(tmp_path / 'sharded'), 2)
+    session_folder = os.path.join(dicom_path, os.listdir(dicom_path)[0])
+    series_folders = sorted(entry.path for entry in os.scandir(session_folder))
+    convert_session.run_heudiconv(series_folders, '001', None, heuristic_file, str(tmp_path / 'unsharded'))
+
+    sharded_info = tmp_path / 'sharded' / '.heudiconv' / '001' / 'info'
+    unsharded_info = tmp_path / 'unsharded' / '.heudiconv' / '001' / 'info'
+    assert sorted(os.listdir(str(sharded_info))) == sorted(os.listdir(str(unsharded_info))) == \
+        ['001.auto.txt', '001.edit.txt', 'dicominfo.tsv', 'filegroup.json', 'heuristic.py']
+    for name in os.listdir(str(unsharded_info)):
+        assert (sharded_info / name).read_text() == (unsharded_info / name).read_text(), name
+    assert not os.path.exists(str(tmp_path / 'sharded' / '.bids_conversion' / 'shards'))
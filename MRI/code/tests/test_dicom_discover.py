@@ -0,0 +1,69 @@
+# ============================================================
+# Tests of the header-only discovery of the series (dicom_discover.py): a folder is only taken as one series from
+# its first and last file when that is what heudiconv would find, and is otherwise grouped file by file as heudiconv
+# does (interleaved series, several echoes).
+# ============================================================
+
+import os # To lay out the series folders
+
+import numpy as np # To seed the pixel data of the synthetic series
+from pydicom.uid import generate_uid # To give the synthetic series a study
+
+import dicom_discover # The discovery of the series (dicom_discover.py)
+import synthetic_dicoms # To write the DICOM files (synthetic_dicoms.py)
+
+STUDY_UID = generate_uid(entropy_srcs=['test_dicom_discover'])
+
+# --------------------------------------------------------------------------------------
+# write_series: Writes a 2D series with synthetic_dicoms.write_series into folder and returns its files, renamed
+# to <prefix><number>.dcm (so that the files of several series can be interleaved in one folder).
+# --------------------------------------------------------------------------------------
+def write_series(folder, number, protocol, n_files, echo_times=(2.98,), prefix=None):
+    synthetic_dicoms.write_series(folder, 'test', STUDY_UID, 'CBU000001', number, protocol, n_files, 8, list(echo_times),
+                                  2000, rng=np.random.RandomState(number))
+    files = []
+    for i in range(n_files):
+        path = os.path.join(folder, f"{i + 1:04d}.dcm")
+        if prefix is not None:
+            os.rename(path, os.path.join(folder, prefix(i)))
+            path = os.path.join(folder, prefix(i))
+        files.append(path)
+    return files
+
+
+def test_single_series_reads_two_headers(tmp_path, monkeypatch):
+    folder = str(tmp_path / 'Series_001_MPRAGE')
+    write_series(folder, 1, 'MPRAGE_GRAPPA2', 12)
+    read = []
+    read_header = dicom_discover.read_header
+    monkeypatch.setattr(dicom_discover, 'read_header', lambda path: read.append(path) or read_header(path))
+    seqinfos = dicom_discover.folder_seqinfos(folder)
+    assert [(s.series_id, s.dim3, s.series_files) for s in seqinfos] == [('1-MPRAGE_GRAPPA2', 12, 12)]
+    assert len(read) == 2
+
+
+def test_interleaved_series(tmp_path):
+    # Sorted, the files go A1 B1 A2 B2 A3 B3 A4 A5 A6: the first and the last file are both in series A
+    folder = str(tmp_path / 'mixed')
+    write_series(folder, 1, 'MPRAGE_GRAPPA2', 6, prefix=lambda i: f"{2 * i if i < 3 else 3 + i:02d}.dcm")
+    write_series(str(tmp_path / 'other'), 2, 'localiser', 3)
+    for i in range(3):
+        os.rename(str(tmp_path / 'other' / f"{i + 1:04d}.dcm"), os.path.join(folder, f"{2 * i + 1:02d}.dcm"))
+    seqinfos = dicom_discover.folder_seqinfos(folder)
+    assert [(s.series_id, s.dim3, s.series_files) for s in seqinfos] == [('1-MPRAGE_GRAPPA2', 6, 6), ('2-localiser', 3, 3)]
+
+
+def test_several_echoes(tmp_path):
+    # heudiconv describes the series by its last echo, with the files of both echoes
+    folder = str(tmp_path / 'Series_002_gre_fieldmap')
+    write_series(folder, 2, 'gre_fieldmap', 8, echo_times=(5.19, 7.65))
+    seqinfos = dicom_discover.folder_seqinfos(folder)
+    assert [(s.series_id, s.dim3, s.series_files, s.TE) for s in seqinfos] == [('2-gre_fieldmap', 8, 8, 7.65)]
+
+
+def test_missing_file(tmp_path):
+    folder = str(tmp_path / 'Series_001_MPRAGE')
+    files = write_series(folder, 1, 'MPRAGE_GRAPPA2', 6)
+    os.remove(files[2])
+    seqinfos = dicom_discover.folder_seqinfos(folder)
+    assert [(s.series_id, s.dim3, s.series_files) for s in seqinfos] == [('1-MPRAGE_GRAPPA2', 5, 5)]
@@ -0,0 +1,101 @@
+# ============================================================
+# Tests of the duplicate check (dicom_duplicates.py): the exact duplicate files are left out of the inputs of the
+# conversion, whether they fill a folder, part of a folder or sit next to their original, and a file sharing the
+# SOPInstanceUID of another one with other contents is kept.
+# ============================================================
+
+import os # To lay out the series folders
+import shutil # To copy the DICOM files
+
+import numpy as np # To seed the pixel data of the synthetic series
+import pydicom # To change the copied file
+from pydicom.uid import generate_uid # To give the synthetic series a study
+
+import dicom_discover # To discover the series of the inputs (dicom_discover.py)
+import dicom_duplicates # The duplicate check (dicom_duplicates.py)
+import synthetic_dicoms # To write the DICOM files (synthetic_dicoms.py)
+
+STUDY_UID = generate_uid(entropy_srcs=['test_dicom_duplicates'])
+
+
+# --------------------------------------------------------------------------------------
+# write_series: Writes a 2D series of n_files files (0001.dcm, ...) into folder and returns its files.
+# --------------------------------------------------------------------------------------
+def write_series(folder, number, n_files):
+    synthetic_dicoms.write_series(folder, 'test', STUDY_UID, 'CBU000001', number, 'MPRAGE_GRAPPA2', n_files, 8, [2.98], 2000,
+                                  rng=np.random.RandomState(number))
+    return [os.path.join(folder, f"{i + 1:04d}.dcm") for i in range(n_files)]
+
+
+def copy_files(files, folder, prefix=''):
+    os.makedirs(folder, exist_ok=True)
+    copies = [os.path.join(folder, prefix + os.path.basename(path)) for path in files]
+    for path, copy in zip(files, copies):
+        shutil.copyfile(path, copy)
+    return copies
+
+
+def test_without_duplicates(tmp_path):
+    folders = [str(tmp_path / 'Series_001_MPRAGE'), str(tmp_path / 'Series_002_MPRAGE')]
+    write_series(folders[0], 1, 4)
+    write_series(folders[1], 2, 5)
+    assert dicom_duplicates.drop_duplicates(folders) == (folders, [])
+
+
+def test_fully_duplicated_folder(tmp_path):
+    original = str(tmp_path / 'Series_001_MPRAGE')
+    resent = str(tmp_path / 'Series_001_MPRAGE_resent')
+    copy_files(write_series(original, 1, 6), resent)
+    inputs, report = dicom_duplicates.drop_duplicates([original, resent])
+    assert inputs == [original]
+    assert report == [{'folder': resent, 'status': 'dropped', 'n_files': 6, 'n_duplicates': 6, 'n_conflicts': 0,
+                       'duplicate_of': [original]}]
+
+
+def test_partly_duplicated_folder(tmp_path):
+    # The second folder holds files 3 to 6 of the series, the first one files 1 to 4
+    first = str(tmp_path / 'Series_001_MPRAGE')
+    second = str(tmp_path / 'Series_001_MPRAGE_resent')
+    files = write_series(first, 1, 6)
+    copy_files(files[2:], second)
+    for path in files[4:]:
+        os.remove(path)
+    inputs, report = dicom_duplicates.drop_duplicates([first, second])
+    assert inputs == [first, os.path.join(second, '0005.dcm'), os.path.join(second, '0006.dcm')]
+    assert report == [{'folder': second, 'status': 'partial', 'n_files': 4, 'n_duplicates': 2, 'n_conflicts': 0,
+                       'duplicate_of': [first]}]
+    # The series is discovered whole, once
+    assert [(s.series_id, s.series_files) for s in dicom_discover.discover_session(str(tmp_path), inputs)] == \
+        [('1-MPRAGE_GRAPPA2', 6)]
+
+
+def test_duplicates_within_one_folder(tmp_path):
+    folder = str(tmp_path / 'Series_001_MPRAGE')
+    files = write_series(folder, 1, 6)
+    # Sorted after the originals, the copies are the ones left out
+    copy_files(files[1:3], folder, prefix='copy_')
+    inputs, report = dicom_duplicates.drop_duplicates([folder])
+    assert inputs == files
+    assert report == [{'folder': folder, 'status': 'partial', 'n_files': 8, 'n_duplicates': 2, 'n_conflicts': 0,
+                       'duplicate_of': [folder]}]
+
+
+def test_same_uid_with_other_contents_is_kept(tmp_path):
+    original = str(tmp_path / 'Series_001_MPRAGE')
+    resent = str(tmp_path / 'Series_001_MPRAGE_resent')
+    copies = copy_files(write_series(original, 1, 3), resent)
+    dcm = pydicom.dcmread(copies[1])
+    dcm.PatientName = 'Other'
+    dcm.save_as(copies[1])
+    inputs, report = dicom_duplicates.drop_duplicates([original, resent])
+    assert inputs == [original, copies[1]]
+    assert report == [{'folder': resent, 'status': 'conflict', 'n_files': 3, 'n_duplicates': 2, 'n_conflicts': 1,
+                       'duplicate_of': [original]}]
+
+
+def test_input_folders(tmp_path):
+    folder = str(tmp_path / 'Series_001_MPRAGE')
+    other = str(tmp_path / 'Series_002_MPRAGE')
+    files = write_series(folder, 1, 3)
+    write_series(other, 2, 2)
+    assert dicom_duplicates.input_folders([files[0], other, files[2]]) == [(folder, [files[0], files[2]]), (other, None)]
@@ -0,0 +1,117 @@
+# ============================================================
+# Tests of the DICOM inventory (dicom_inventory.py): a refresh only lists the folders whose modification time
+# changed, and only reads the header of the series whose files changed.
+# ============================================================
+
+import os # To lay out the DICOM folders
+import time # To age the folders
+
+import dicom_inventory # The DICOM inventory (dicom_inventory.py)
+
+
+# --------------------------------------------------------------------------------------
+# age: Sets the modification time of the given files and folders to an hour ago, so that they are no longer within
+# dicom_inventory.MTIME_GRANULARITY of a listing.
+# --------------------------------------------------------------------------------------
+def age(*paths):
+    old = time.time() - 3600
+    for path in paths:
+        os.utime(path, (old, old))
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+# --------------------------------------------------------------------------------------
+# new_root: A subject folder of two series, aged, with the SeriesInstanceUID of each series taken from its files.
+# --------------------------------------------------------------------------------------
+def new_root(tmp_path, monkeypatch):
+    root = str(tmp_path / 'CBU000001_SYNTHETIC')
+    session = os.path.join(root, '20240101_120000')
+    for series in ('Series_001_MPRAGE', 'Series_002_bold'):
+        for i in range(3):
+            write_file(os.path.join(session, series, f"{i:04d}.dcm"), f"{series}\n")
+    age(*(os.path.join(folder, name) for folder, _, names in os.walk(root) for name in names))
+    age(*(folder for folder, _, _ in os.walk(root)))
+    reads = []
+    monkeypatch.setattr(dicom_inventory, 'read_series_uid', lambda path: reads.append(path) or open(path).read().strip())
+    return root, session, reads
+
+
+# --------------------------------------------------------------------------------------
+# count_listings: Counts the folders listed by dicom_inventory.list_folder.
+# --------------------------------------------------------------------------------------
+def count_listings(monkeypatch):
+    listed = []
+    list_folder = dicom_inventory.list_folder
+    monkeypatch.setattr(dicom_inventory, 'list_folder', lambda path, *args: listed.append(path) or list_folder(path, *args))
+    return listed
+
+
+def summary(inventory, root):
+    return [(s['folder'], s['series_uid'], s['n_files']) for s in inventory[root]]
+
+
+def test_cold_and_warm_refresh(tmp_path, monkeypatch):
+    root, session, reads = new_root(tmp_path, monkeypatch)
+    index_file = str(tmp_path / 'index.sqlite')
+    listed = count_listings(monkeypatch)
+    expected = [('20240101_120000/Series_001_MPRAGE', 'Series_001_MPRAGE', 3),
+                ('20240101_120000/Series_002_bold', 'Series_002_bold', 3)]
+    # Cold: every folder is listed and the header of each series read
+    assert summary(dicom_inventory.refresh_inventory(index_file, [root]), root) == expected
+    assert (len(listed), len(reads)) == (4, 2)
+    # Warm: nothing is listed or read
+    del listed[:], reads[:]
+    assert summary(dicom_inventory.refresh_inventory(index_file, [root]), root) == expected
+    assert (listed, reads) == ([], [])
+
+
+def test_refresh_finds_new_series_folder(tmp_path, monkeypatch):
+    root, session, reads = new_root(tmp_path, monkeypatch)
+    index_file = str(tmp_path / 'index.sqlite')
+    dicom_inventory.refresh_inventory(index_file, [root])
+    listed = count_listings(monkeypatch)
+    del reads[:]
+    write_file(os.path.join(session, 'Series_003_fieldmap', '0000.dcm'), 'Series_003_fieldmap\n')
+    assert summary(dicom_inventory.refresh_inventory(index_file, [root]), root)[-1] == \
+        ('20240101_120000/Series_003_fieldmap', 'Series_003_fieldmap', 1)
+    # Only the session folder and the new series folder are listed, and only the new series is read
+    assert sorted(listed) == [session, os.path.join(session, 'Series_003_fieldmap')]
+    assert reads == [os.path.join(session, 'Series_003_fieldmap', '0000.dcm')]
+
+
+def test_refresh_finds_replaced_file(tmp_path, monkeypatch):
+    root, session, reads = new_root(tmp_path, monkeypatch)
+    index_file = str(tmp_path / 'index.sqlite')
+    dicom_inventory.refresh_inventory(index_file, [root])
+    # Written next to the file and renamed over it, as a transfer does: the folder changes
+    folder = os.path.join(session, 'Series_002_bold')
+    write_file(os.path.join(folder, 'tmp'), 'Series_002_bold_resent\n')
+    os.replace(os.path.join(folder, 'tmp'), os.path.join(folder, '0000.dcm'))
+    series = dicom_inventory.refresh_inventory(index_file, [root])[root]
+    assert (series[1]['series_uid'], series[1]['n_bytes']) == ('Series_002_bold_resent', 2 * 16 + 23)
+
+
+def test_refresh_misses_file_rewritten_in_place(tmp_path, monkeypatch):
+    # The documented limit: rewriting a file in place does not change its folder, which is not listed again
+    root, session, reads = new_root(tmp_path, monkeypatch)
+    index_file = str(tmp_path / 'index.sqlite')
+    before = dicom_inventory.refresh_inventory(index_file, [root])[root]
+    folder = os.path.join(session, 'Series_002_bold')
+    write_file(os.path.join(folder, '0000.dcm'), 'Series_002_bold_resent\n')
+    assert dicom_inventory.refresh_inventory(index_file, [root])[root] == before
+
+
+def test_recently_modified_folder_is_listed_again(tmp_path, monkeypatch):
+    root, session, reads = new_root(tmp_path, monkeypatch)
+    index_file = str(tmp_path / 'index.sqlite')
+    folder = os.path.join(session, 'Series_002_bold')
+    os.utime(folder)
+    dicom_inventory.refresh_inventory(index_file, [root])
+    listed = count_listings(monkeypatch)
+    dicom_inventory.refresh_inventory(index_file, [root])
+    assert listed == [folder]
@@ -0,0 +1,112 @@
+# ============================================================
+# Tests of the watch mode (dicom_watch.py): a session folder is queued once it stopped growing, a folder whose CBU code
+# is not in the lookup table is left alone until the table is edited, and a queued folder is only walked again once
+# a series was added to it.
+# ============================================================
+
+import os # To lay out DICOM_ROOT
+
+import numpy as np # To seed the pixel data of the synthetic series
+from pydicom.uid import generate_uid # To give the synthetic series a study
+
+import conversion_queue # To read the queue (conversion_queue.py)
+import dicom_inventory # To count the walks (dicom_inventory.py)
+import dicom_watch # The watch mode (dicom_watch.py)
+import synthetic_dicoms # To write the DICOM files (synthetic_dicoms.py)
+
+CODE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT_CODE = 'MR24001'
+
+
+def write_lookup_table(path, cbu_codes):
+    with open(path, 'w') as f:
+        f.write('cbu_code\tsubject_id\n' + ''.join(f"{cbu_code}\t{cbu_code[-3:]}\n" for cbu_code in cbu_codes))
+
+
+# --------------------------------------------------------------------------------------
+# write_series: Writes a 2D series of n_files files into the session folder of a CBU code in dicom_root.
+# --------------------------------------------------------------------------------------
+def write_series(dicom_root, cbu_code, number, n_files):
+    folder = os.path.join(dicom_root, f"{cbu_code}_{PROJECT_CODE}", '20240101_120000', f"Series_{number:03d}_MPRAGE")
+    synthetic_dicoms.write_series(folder, cbu_code, generate_uid(entropy_srcs=[cbu_code]), cbu_code, number,
+                                  'MPRAGE_GRAPPA2', n_files, 8, [2.98], 2000, rng=np.random.RandomState(number))
+
+
+# --------------------------------------------------------------------------------------
+# new_watcher: A watcher of dicom_root (settling as soon as a folder stopped growing), whose inventory walks are counted.
+# --------------------------------------------------------------------------------------
+def new_watcher(tmp_path, monkeypatch, dicom_root, lookup_table):
+    queue_path = str(tmp_path / 'queue')
+    conversion_queue.write_config(queue_path, os.path.join(CODE_PATH, 'bids_heuristic.py'), str(tmp_path / 'bids'),
+                                  str(tmp_path / 'manifest'), str(tmp_path / 'dicom_inventory'), str(tmp_path / 'job_logs'))
+    walked = []
+    refresh_inventory = dicom_inventory.refresh_inventory
+    monkeypatch.setattr(dicom_inventory, 'refresh_inventory',
+                        lambda index_file, roots, *args: walked.append(sorted(roots)) or refresh_inventory(index_file, roots, *args))
+    watcher = dicom_watch.Watcher(queue_path, dicom_root, PROJECT_CODE, lookup_table, str(tmp_path / 'watch_state.json'),
+                                  settle_seconds=0, index_file=str(tmp_path / 'index.sqlite'))
+    return watcher, walked
+
+
+def summary(entries):
+    return [(entry['subject_id'], entry['n_files']) for entry in entries]
+
+
+def test_poll(tmp_path, monkeypatch):
+    dicom_root = str(tmp_path / 'dicom')
+    lookup_table = str(tmp_path / 'lookup.tsv')
+    write_lookup_table(lookup_table, ['CBU000001'])
+    write_series(dicom_root, 'CBU000001', 1, 3)
+    write_series(dicom_root, 'CBU000009', 1, 2)
+    watcher, walked = new_watcher(tmp_path, monkeypatch, dicom_root, lookup_table)
+    known = os.path.join(dicom_root, f"CBU000001_{PROJECT_CODE}")
+    unknown = os.path.join(dicom_root, f"CBU000009_{PROJECT_CODE}")
+
+    # Growing: found, then still growing
+    assert watcher.poll() == []
+    write_series(dicom_root, 'CBU000001', 1, 4)
+    assert watcher.poll() == []
+    assert watcher.unknown == {f"CBU000009_{PROJECT_CODE}"}
+    # Settled: queued
+    assert summary(watcher.poll()) == [('001', 4)]
+    assert len(conversion_queue.queue_status(watcher.queue_path)['pending']) == 1
+    assert watcher.handled[f"CBU000001_{PROJECT_CODE}"]['status'] == 'queued'
+    assert walked == [[known]] * 3
+
+    # Handled and unchanged: not walked again; the unknown CBU code is never walked
+    del walked[:]
+    assert watcher.poll() == []
+    assert walked == []
+
+    # A series added to the queued session: walked again, and queued again once it settled
+    write_series(dicom_root, 'CBU000001', 2, 2)
+    assert watcher.poll() == []
+    assert f"CBU000001_{PROJECT_CODE}" not in watcher.handled
+    assert summary(watcher.poll()) == [('001', 6)]
+    assert walked == [[known]] * 2
+    # The new conversion replaced the one waiting in the queue
+    assert len(conversion_queue.queue_status(watcher.queue_path)['pending']) == 1
+
+    # The unknown CBU code, once added to the lookup table
+    del walked[:]
+    write_lookup_table(lookup_table, ['CBU000001', 'CBU000009'])
+    assert watcher.poll() == []
+    assert summary(watcher.poll()) == [('009', 2)]
+    assert walked == [[unknown]] * 2
+
+
+def test_poll_after_restart(tmp_path, monkeypatch):
+    # The state file keeps the handled folders (and their modification times) across restarts of the watcher
+    dicom_root = str(tmp_path / 'dicom')
+    lookup_table = str(tmp_path / 'lookup.tsv')
+    write_lookup_table(lookup_table, ['CBU000001'])
+    write_series(dicom_root, 'CBU000001', 1, 3)
+    watcher, walked = new_watcher(tmp_path, monkeypatch, dicom_root, lookup_table)
+    watcher.poll()
+    assert summary(watcher.poll()) == [('001', 3)]
+
+    watcher, walked = new_watcher(tmp_path, monkeypatch, dicom_root, lookup_table)
+    assert (watcher.poll(), walked) == ([], [])
+    write_series(dicom_root, 'CBU000001', 2, 2)
+    watcher.poll()
+    assert summary(watcher.poll()) == [('001', 5)]
@@ -0,0 +1,218 @@
+# ============================================================
+# Tests of the execution backends (execution_backends.py): the outcome of a task from sacct and its error file, and
+# the time or memory a task that timed out or ran out of memory is submitted again with, taken from its submission
+# or from sacct, the parsing of sacct's output and formatting of the --array specifications (canned sacct output,
+# no SLURM needed), and the packing of the subjects into tasks.
+# ============================================================
+
+import os # To find the task manifests
+import signal # For the exit code of a task killed by SIGKILL
+import subprocess # To fake sacct and sbatch
+
+import pytest # To parametrise the outcomes
+
+import execution_backends # The execution backends (execution_backends.py)
+import task_manifest # To resubmit the failed tasks of a job (task_manifest.py)
+
+# sacct --format=JobID,State,ExitCode --parsable2 --noheader
+SACCT_STATUS = """\
+1234_0|TIMEOUT|0:0
+1234_0.batch|CANCELLED|0:15
+1234_0.extern|COMPLETED|0:0
+1234_1|OUT_OF_MEMORY|0:125
+1234_1.batch|OUT_OF_MEMORY|0:125
+1234_2|FAILED|1:0
+1234_2.batch|FAILED|1:0
+1234_3|COMPLETED|0:0
+"""
+
+# sacct --format=JobID,ReqMem,Timelimit,ReqCPUS --parsable2 --noheader
+SACCT_LIMITS = """\
+1234_0|16000M|08:00:00|1
+1234_0.batch|16000M||1
+1234_1|16G|08:00:00|1
+1234_2|4000Mc|1-00:00:00|4
+1234_3|0|UNLIMITED|1
+"""
+
+
+# --------------------------------------------------------------------------------------
+# fake_slurm: Makes sacct print the given status and limits, and sbatch submit jobs 2000, 2001, ... Returns the
+# sbatch commands.
+# --------------------------------------------------------------------------------------
+def fake_slurm(monkeypatch, status=SACCT_STATUS, limits=SACCT_LIMITS):
+    submitted = []
+
+    def run(command, **kwargs):
+        if command[0] == 'sbatch':
+            submitted.append(command)
+            return subprocess.CompletedProcess(command, 0, stdout=f"{1999 + len(submitted)}\n")
+        assert command[0] == 'sacct'
+        output = limits if '--format=JobID,ReqMem,Timelimit,ReqCPUS' in command else status
+        return subprocess.CompletedProcess(command, 0, stdout=output)
+    monkeypatch.setattr(execution_backends.subprocess, 'run', run)
+    return submitted
+
+
+# --------------------------------------------------------------------------------------
+# new_job: A task manifest of four tasks of one subject each, submitted to SLURM as job 1234 with the given options.
+# --------------------------------------------------------------------------------------
+def new_job(tmp_path, executor_options):
+    manifest = task_manifest.new_task_manifest(str(tmp_path / 'tasks'))
+    entries = [{'subject_id': f"00{i}", 'session_id': '', 'dicom_path': f"/mridata/cbu/CBU00000{i}", 'n_bytes': 1000,
+                'n_files': 10, 'max_series_bytes': 500, 'n_shards': 1, 'stage': '', 'intended_for_stage': '',
+                'submission': ''} for i in range(4)]
+    task_manifest.write_tasks(manifest, [[i] for i in range(4)], entries)
+    task_manifest.write_job(manifest, 'heudiconv_script.sh', [], 'slurm', str(tmp_path / 'logs'), executor_options)
+    job = task_manifest.read_job(manifest)
+    job['submissions'].append({'job_id': '1234', 'task_ids': [0, 1, 2, 3], 'executor_options': executor_options})
+    task_manifest.save_job(manifest, job)
+    return manifest
+
+
+@pytest.mark.parametrize('state, exit_code, log_tail, outcome', [
+    ('COMPLETED', 0, '', execution_backends.COMPLETED),
+    ('TIMEOUT', 0, '', execution_backends.TIMEOUT),
+    ('OUT_OF_MEMORY', 125, '', execution_backends.OUT_OF_MEMORY),
+    ('CANCELLED', 0, 'slurmstepd: error: *** JOB 1234 ON node CANCELLED AT 2024-01-01T12:00:00 DUE TO TIME LIMIT ***',
+     execution_backends.TIMEOUT),
+    ('FAILED', 1, 'slurmstepd: error: Detected 1 oom_kill event in StepId=1234.batch.', execution_backends.OUT_OF_MEMORY),
+    ('FAILED', 1, 'MemoryError', execution_backends.OUT_OF_MEMORY),
+    ('FAILED', 128 + signal.SIGKILL, '', execution_backends.OUT_OF_MEMORY),
+    ('FAILED', 1, 'heudiconv: error: no DICOM files found', execution_backends.FAILED),
+])
+def test_classify_task(state, exit_code, log_tail, outcome):
+    assert execution_backends.classify_task(state, exit_code, log_tail) == outcome
+
+
+def test_task_outcomes_from_sacct(tmp_path, monkeypatch):
+    fake_slurm(monkeypatch)
+    executor = execution_backends.get_executor('slurm', str(tmp_path))
+    with open(executor.log_file('1234', 2, 'err'), 'w') as f:
+        f.write('Traceback (most recent call last):\nMemoryError\n')
+    assert executor.task_outcomes('1234') == {0: (execution_backends.TIMEOUT, 0), 1: (execution_backends.OUT_OF_MEMORY, 0),
+                                              2: (execution_backends.OUT_OF_MEMORY, 1), 3: (execution_backends.COMPLETED, 0)}
+
+
+def test_task_limits_from_sacct(tmp_path, monkeypatch):
+    fake_slurm(monkeypatch)
+    assert execution_backends.get_executor('slurm', str(tmp_path)).task_limits('1234') == {
+        0: {'mem_mb': 16000, 'time_minutes': 480},
+        1: {'mem_mb': 16384, 'time_minutes': 480},
+        2: {'mem_mb': 16000, 'time_minutes': 1440},
+        3: {'mem_mb': None, 'time_minutes': None},
+    }
+
+
+@pytest.mark.parametrize('options, outcome, limits, escalated', [
+    # From the options the task was submitted with, before the limits reported by sacct
+    ({'mem_mb': 8000, 'time_minutes': 60}, execution_backends.TIMEOUT, {'time_minutes': 480}, {'mem_mb': 8000, 'time_minutes': 120}),
+    ({'mem_mb': 8000, 'time_minutes': 60}, execution_backends.OUT_OF_MEMORY, None, {'mem_mb': 16000, 'time_minutes': 60}),
+    # From the limits reported by sacct, for a task submitted with the cluster defaults
+    ({'mem_mb': None}, execution_backends.OUT_OF_MEMORY, {'mem_mb': 16384, 'time_minutes': 480}, {'mem_mb': 32768}),
+    ({}, execution_backends.TIMEOUT, {'mem_mb': 16384, 'time_minutes': 480}, {'time_minutes': 960}),
+    # Nothing to escalate
+    ({'max_running': 4}, execution_backends.FAILED, None, {'max_running': 4}),
+])
+def test_escalate(options, outcome, limits, escalated):
+    assert execution_backends.escalate(options, outcome, limits) == escalated
+
+
+@pytest.mark.parametrize('outcome, limits', [
+    (execution_backends.TIMEOUT, None),
+    (execution_backends.OUT_OF_MEMORY, {'mem_mb': None, 'time_minutes': 480}),
+])
+def test_escalate_unknown_limit(outcome, limits):
+    with pytest.raises(ValueError, match='is not known'):
+        execution_backends.escalate({}, outcome, limits)
+
+
+def test_resubmit_escalates(tmp_path, monkeypatch):
+    submitted = fake_slurm(monkeypatch)
+    manifest = new_job(tmp_path, {'time_minutes': 60, 'max_running': 4, 'after_job_ids': ['1000']})
+    new_manifest, submissions = task_manifest.resubmit(manifest)
+    # One job per set of options: task 0 with twice its time, task 1 with twice the memory sacct reports, task 2
+    # (failed, exit code 1) as it was. Task 3 completed.
+    job = task_manifest.read_job(new_manifest)
+    assert [(s['task_ids'], s['executor_options']) for s in job['submissions']] == [
+        ([1], {'max_running': 4, 'mem_mb': 32768, 'time_minutes': 60}),
+        ([0], {'max_running': 4, 'time_minutes': 120}),
+        ([2], {'max_running': 4, 'time_minutes': 60}),
+    ]
+    assert [job_id for _, job_id in submissions] == ['2000', '2001', '2002']
+    assert [[option for option in command if option.startswith(('--mem', '--time', '--dependency'))] for command in submitted] == \
+        [['--mem=32768M', '--time=60'], ['--time=120'], ['--time=60']]
+    assert sorted(task_manifest.read_tasks(new_manifest)) == [0, 1, 2]
+
+
+def test_resubmit_unknown_limit(tmp_path, monkeypatch):
+    # Task 0 timed out and task 1 ran out of memory, submitted without limits, and sacct reports none for task 1
+    fake_slurm(monkeypatch, limits='1234_1|0|08:00:00|1\n')
+    manifest = new_job(tmp_path, {})
+    with pytest.raises(ValueError, match='is not known'):
+        task_manifest.resubmit(manifest)
+    # Nothing was written or submitted
+    assert len([name for name in os.listdir(os.path.dirname(manifest)) if name.endswith('.tsv')]) == 1
+
+
+@pytest.mark.parametrize('output, status', [
+    # The steps of a task (.batch, .extern, .0) are left out: the task line has its state
+    ('1234_0|COMPLETED|0:0\n1234_0.batch|COMPLETED|0:0\n1234_0.extern|COMPLETED|0:0\n1234_0.0|COMPLETED|0:0\n',
+     {0: (execution_backends.COMPLETED, 0)}),
+    ('1234_5|FAILED|2:0\n1234_5.batch|FAILED|2:0\n', {5: (execution_backends.FAILED, 2)}),
+    ('1234_1|TIMEOUT|0:0\n1234_1.batch|CANCELLED|0:15\n', {1: (execution_backends.TIMEOUT, 0)}),
+    # The tasks that did not start yet are listed as one range, with the limit of tasks running at the same time
+    ('1234_[3-7%2]|PENDING|0:0\n', {task_id: (execution_backends.PENDING, 0) for task_id in range(3, 8)}),
+    ('1234_[0,2-3]|PENDING|0:0\n1234_1|RUNNING|0:0\n1234_1.batch|RUNNING|0:0\n',
+     {0: (execution_backends.PENDING, 0), 1: (execution_backends.RUNNING, 0), 2: (execution_backends.PENDING, 0),
+      3: (execution_backends.PENDING, 0)}),
+    # The user who cancelled the task is left out of its state
+    ('1234_2|CANCELLED by 51234|0:0\n1234_2.batch|CANCELLED|0:15\n', {2: ('CANCELLED', 0)}),
+    # Not an array task (a job submitted by hand with the same ID), and blank lines
+    ('1234|COMPLETED|0:0\n1234.batch|COMPLETED|0:0\n\n', {}),
+    ('1234_4|OUT_OF_MEMORY|0:125\n1234_4.batch|OUT_OF_MEMORY|0:125\n1234_4.extern|COMPLETED|0:0\n',
+     {4: (execution_backends.OUT_OF_MEMORY, 0)}),
+])
+def test_parse_sacct(output, status):
+    assert execution_backends.parse_sacct(output) == status
+
+
+@pytest.mark.parametrize('task_ids, array', [
+    ([0], '0'),
+    ([0, 1, 2, 5], '0-2,5'),
+    ([5, 0, 2, 1], '0-2,5'),
+    ([1, 3, 5], '1,3,5'),
+    ([0, 1, 2, 3, 10, 11, 20], '0-3,10-11,20'),
+    (range(1000), '0-999'),
+])
+def test_format_array(task_ids, array):
+    assert execution_backends.format_array(task_ids) == array
+
+
+@pytest.mark.parametrize('n_subjects, subjects_per_task, tasks', [
+    (5, 2, [[0, 1], [2, 3], [4]]),
+    (3, 1, [[0], [1], [2]]),
+    (3, 0, [[0], [1], [2]]),
+    (4, 10, [[0, 1, 2, 3]]),
+    (0, 2, []),
+])
+def test_pack_tasks_by_count(n_subjects, subjects_per_task, tasks):
+    # The sizes are ignored without bytes_per_task
+    assert execution_backends.pack_tasks([100 * (i + 1) for i in range(n_subjects)], subjects_per_task) == tasks
+
+
+@pytest.mark.parametrize('sizes, tasks', [
+    # Largest first, each into the first task it fits in: 70 and 30, 50, 40 and 10, then 20 fits nowhere
+    ([50, 30, 70, 20, 40, 10], [[0, 4, 5], [1, 2], [3]]),
+    ([100, 100, 100], [[0], [1], [2]]),
+    ([25, 25, 25, 25], [[0, 1, 2, 3]]),
+    # A subject larger than the budget gets a task of its own, and no other subject joins it
+    ([250, 40, 60], [[0], [1, 2]]),
+    ([150, 10, 300], [[0], [1], [2]]),
+])
+def test_pack_tasks_by_bytes(sizes, tasks):
+    packed = execution_backends.pack_tasks(sizes, 1, bytes_per_task=100)
+    assert packed == tasks
+    # Every subject is in one task, and every task of several subjects is within the budget
+    assert sorted(index for task in packed for index in task) == list(range(len(sizes)))
+    assert all(sum(sizes[index] for index in task) <= 100 for task in packed if len(task) > 1)
@@ -0,0 +1,112 @@
+# ============================================================
+# Tests of the rule engine of the heuristics (heuristic_rules.py): the rule table of bids_heuristic_sbref.py must
+# assign the series of a session exactly like the if chain it replaced (legacy_infotodict below).
+# ============================================================
+
+import collections # To build seqinfo entries
+
+import pytest # To parametrise the sessions
+
+import heuristic_rules # The rule engine (heuristic_rules.py)
+import bids_heuristic_sbref # The heuristic declared as a rule table (bids_heuristic_sbref.py)
+
+SeqInfo = collections.namedtuple('SeqInfo', heuristic_rules.SEQINFO_FIELDS)
+
+# --------------------------------------------------------------------------------------
+# legacy_infotodict: The infotodict of bids_heuristic_sbref.py before the rule engine.
+# --------------------------------------------------------------------------------------
+def legacy_infotodict(seqinfo):
+    create_key = heuristic_rules.create_key
+    anat = create_key('sub-{subject}/anat/sub-{subject}_T1w')
+    fmap_mag = create_key('sub-{subject}/fmap/sub-{subject}_acq-func_magnitude')
+    fmap_phase = create_key('sub-{subject}/fmap/sub-{subject}_acq-func_phasediff')
+    fmap_rev_phase = create_key('sub-{subject}/fmap/sub-{subject}_acq-func_dir-PA_epi')
+    fmap_sbref = create_key('sub-{subject}/fmap/sub-{subject}_acq-func_dir-PA_sbref')
+    func_task = create_key('sub-{subject}/func/sub-{subject}_task-video_run-{item:02d}_bold')
+    func_sbref = create_key('sub-{subject}/func/sub-{subject}_task-video_run-{item:02d}_sbref')
+    info = {anat: [], fmap_mag: [], fmap_phase: [], fmap_rev_phase: [], fmap_sbref: [], func_task: [], func_sbref: []}
+    latest_sbref = None
+    func2sbref = {}
+    for s in seqinfo:
+        if "MPRAGE" in s.protocol_name:
+            info[anat].append(s.series_id)
+        if (s.dim3 == 76) and ('fieldmap' in s.protocol_name):
+            info[fmap_mag].append(s.series_id)
+        if (s.dim3 == 38) and ('fieldmap' in s.protocol_name):
+            info[fmap_phase].append(s.series_id)
+        if (s.dim4 == 8) and ('_MB2_PA_2' in s.protocol_name):
+            info[fmap_rev_phase].append(s.series_id)
+        if (s.dim4 == 1) and ('_MB2_PA_2' in s.protocol_name):
+            info[fmap_sbref].append(s.series_id)
+        if (s.dim4 == 1) and ("MB2_AP_2" in s.protocol_name):
+            latest_sbref = s.series_id
+        elif s.dim4 > 100:
+            info[func_task].append(s.series_id)
+            if latest_sbref is not None:
+                func2sbref[s.series_id] = latest_sbref
+                latest_sbref = None
+    for func_series_id in info[func_task]:
+        sbref_series_id = func2sbref.get(func_series_id)
+        if sbref_series_id is not None:
+            info[func_sbref].append(sbref_series_id)
+    return info
+
+# --------------------------------------------------------------------------------------
+# session: seqinfo entries for the given (protocol_name, dim3, dim4) series, numbered in turn.
+# --------------------------------------------------------------------------------------
+def session(*series):
+    empty = SeqInfo(**dict.fromkeys(heuristic_rules.SEQINFO_FIELDS))
+    return [empty._replace(series_id=f"{i}-{protocol}", protocol_name=protocol, dim3=dim3, dim4=dim4)
+            for i, (protocol, dim3, dim4) in enumerate(series, start=1)]
+
+MPRAGE = ('MPRAGE_GRAPPA2', 192, 1)
+MAGNITUDE = ('gre_fieldmap', 76, 1)
+PHASE = ('gre_fieldmap', 38, 1)
+AP_SBREF = ('bold_MB2_AP_2_SBRef', 16, 1)
+AP_BOLD = ('bold_MB2_AP_2', 16, 110)
+CANCELLED = ('bold_MB2_AP_2', 16, 20)
+PA_SBREF = ('bold_MB2_PA_2_SBRef', 16, 1)
+PA_BOLD = ('bold_MB2_PA_2', 16, 8)
+
+SESSIONS = {
+    'camcan': session(MPRAGE, MAGNITUDE, PHASE, AP_SBREF, AP_BOLD, AP_SBREF, AP_BOLD, PA_SBREF, PA_BOLD),
+    'cancelled run': session(MPRAGE, MAGNITUDE, PHASE, AP_SBREF, CANCELLED, AP_SBREF, AP_BOLD, PA_SBREF, PA_BOLD),
+    'sbref without run': session(AP_SBREF, AP_BOLD, AP_SBREF, CANCELLED, PA_SBREF, PA_BOLD),
+    'two sbrefs before a run': session(AP_SBREF, AP_SBREF, AP_BOLD),
+    'run without sbref': session(AP_BOLD, AP_SBREF, AP_BOLD),
+    'repeated fieldmaps': session(MAGNITUDE, PHASE, MAGNITUDE, PHASE, MPRAGE, MPRAGE),
+    'unknown series': session(('localiser', 3, 1), ('AAHead_Scout', 128, 1), ('dwi_64dir', 60, 65)),
+    'empty': session(),
+}
+
+
+@pytest.mark.parametrize('name', sorted(SESSIONS))
+def test_rule_table_matches_legacy_infotodict(name):
+    assert bids_heuristic_sbref.infotodict(SESSIONS[name]) == legacy_infotodict(SESSIONS[name])
+
+
+def test_rule_set_reuses_protocol_index():
+    rule_set = heuristic_rules.RuleSet(bids_heuristic_sbref.KEYS, bids_heuristic_sbref.RULES)
+    seqinfo = SESSIONS['camcan']
+    assert rule_set.infotodict(seqinfo) == legacy_infotodict(seqinfo)
+    assert set(rule_set.index) == {s.protocol_name for s in seqinfo}
+    assert rule_set.infotodict(seqinfo) == legacy_infotodict(seqinfo)
+
+
+def test_range_conditions():
+    keys = {'bold': heuristic_rules.create_key('sub-{subject}/func/sub-{subject}_task-rest_run-{item:02d}_bold')}
+    rule_set = heuristic_rules.RuleSet(keys, [{'key': 'bold', 'protocol_regex': r'^bold', 'dim4': (101, None)}])
+    seqinfo = session(('bold_MB2_AP_2', 16, 100), ('bold_MB2_AP_2', 16, 101), ('x_bold', 16, 200))
+    assert rule_set.infotodict(seqinfo) == {keys['bold']: ['2-bold_MB2_AP_2']}
+
+
+@pytest.mark.parametrize('spec', [
+    {'protocol': 'MPRAGE'},
+    {'key': 'missing'},
+    {'key': 'anat', 'pair_with': 'missing'},
+    {'key': 'anat', 'dim5': 1},
+    {'key': 'anat', 'dim4': (1, 2, 3)},
+])
+def test_invalid_rules(spec):
+    with pytest.raises(ValueError):
+        heuristic_rules.RuleSet(bids_heuristic_sbref.KEYS, [spec])
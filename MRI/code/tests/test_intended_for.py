@@ -0,0 +1,111 @@
+# ============================================================
+# Tests of the IntendedFor stage (intended_for.py): on a session with a magnitude/phasediff fieldmap, a dir-PA epi
+# fieldmap, an sbref and two bold runs, the IntendedFor fields are the ones heudiconv's populate_intended_for writes,
+# and --dry-run writes nothing.
+# ============================================================
+
+import json # To write and read the sidecars
+import os # To lay out the BIDS session
+import shutil # To copy the session for heudiconv
+
+import nibabel # To write the NIfTI files
+import numpy as np # For the NIfTI data
+import pytest # To parametrise the criteria
+from heudiconv.bids import populate_intended_for # The reference
+
+import intended_for # The IntendedFor stage (intended_for.py)
+
+SESSION = 'sub-001/ses-01'
+
+# File of the session (without extension) and its acquisition time
+FILES = (
+    ('fmap/sub-001_ses-01_acq-func_magnitude1', '2024-01-01T10:00:00.000000'),
+    ('fmap/sub-001_ses-01_acq-func_magnitude2', '2024-01-01T10:00:00.000000'),
+    ('fmap/sub-001_ses-01_acq-func_phasediff', '2024-01-01T10:00:30.000000'),
+    ('fmap/sub-001_ses-01_acq-fmri_dir-PA_epi', '2024-01-01T10:30:00.000000'),
+    ('anat/sub-001_ses-01_T1w', '2024-01-01T10:10:00.000000'),
+    ('func/sub-001_ses-01_task-rest_run-1_sbref', '2024-01-01T10:04:00.000000'),
+    ('func/sub-001_ses-01_task-rest_run-1_bold', '2024-01-01T10:05:00.000000'),
+    ('func/sub-001_ses-01_task-rest_run-2_bold', '2024-01-01T10:40:00.000000'),
+)
+
+
+# --------------------------------------------------------------------------------------
+# write_session: Writes the session of FILES (tiny NIfTI files, their sidecars and the scans.tsv file) into bids_path.
+# --------------------------------------------------------------------------------------
+def write_session(bids_path):
+    session_path = os.path.join(bids_path, SESSION)
+    for stem, _ in FILES:
+        os.makedirs(os.path.join(session_path, os.path.dirname(stem)), exist_ok=True)
+        nibabel.save(nibabel.Nifti1Image(np.zeros((4, 4, 2), dtype=np.int16), np.eye(4)), os.path.join(session_path, f"{stem}.nii.gz"))
+        sidecar = {'ShimSetting': [1, 2, 3]}
+        if '_bold' in stem or '_sbref' in stem:
+            sidecar['TaskName'] = 'rest'
+        with open(os.path.join(session_path, f"{stem}.json"), 'w') as f:
+            json.dump(sidecar, f)
+    with open(os.path.join(session_path, 'sub-001_ses-01_scans.tsv'), 'w') as f:
+        f.write('filename\tacq_time\n' + ''.join(f"{stem}.nii.gz\t{acq_time}\n" for stem, acq_time in FILES))
+
+
+def read_intended_for(bids_path):
+    fmap = os.path.join(bids_path, SESSION, 'fmap')
+    result = {}
+    for name in sorted(os.listdir(fmap)):
+        if name.endswith('.json'):
+            with open(os.path.join(fmap, name)) as f:
+                result[name] = json.load(f).get('IntendedFor')
+    return result
+
+
+# --------------------------------------------------------------------------------------
+# snapshot: The contents of every file of a folder.
+# --------------------------------------------------------------------------------------
+def snapshot(folder):
+    contents = {}
+    for path, _, names in os.walk(folder):
+        for name in names:
+            with open(os.path.join(path, name), 'rb') as f:
+                contents[os.path.join(path, name)] = f.read()
+    return contents
+
+
+@pytest.mark.parametrize('criterion', ['Closest', 'First'])
+def test_same_as_heudiconv(tmp_path, criterion):
+    ours, reference = str(tmp_path / 'ours'), str(tmp_path / 'heudiconv')
+    write_session(ours)
+    shutil.copytree(ours, reference)
+    populate_intended_for(os.path.join(reference, SESSION), ['ModalityAcquisitionLabel'], criterion)
+    n_sessions, n_fieldmaps, _ = intended_for.populate_dataset(ours, ['ModalityAcquisitionLabel'], criterion, 1)
+    assert (n_sessions, n_fieldmaps) == (1, 4)
+    assert read_intended_for(ours) == read_intended_for(reference)
+
+
+def test_criteria(tmp_path):
+    # Closest: each run gets the fieldmap acquired nearest to it; First: both runs get the first fieldmap
+    bids_path = str(tmp_path / 'bids')
+    write_session(bids_path)
+    intended_for.populate_dataset(bids_path, ['ModalityAcquisitionLabel'], 'Closest', 1)
+    run_1, run_2 = (f"ses-01/func/sub-001_ses-01_task-rest_run-{run}_bold.nii.gz" for run in (1, 2))
+    assert read_intended_for(bids_path) == {
+        'sub-001_ses-01_acq-fmri_dir-PA_epi.json': [run_2],
+        'sub-001_ses-01_acq-func_magnitude1.json': [run_1],
+        'sub-001_ses-01_acq-func_magnitude2.json': [run_1],
+        'sub-001_ses-01_acq-func_phasediff.json': [run_1],
+    }
+    # The epi fieldmap no run is matched to any more loses its IntendedFor
+    intended_for.populate_dataset(bids_path, ['ModalityAcquisitionLabel'], 'First', 1)
+    assert read_intended_for(bids_path) == {
+        'sub-001_ses-01_acq-fmri_dir-PA_epi.json': None,
+        'sub-001_ses-01_acq-func_magnitude1.json': [run_1, run_2],
+        'sub-001_ses-01_acq-func_magnitude2.json': [run_1, run_2],
+        'sub-001_ses-01_acq-func_phasediff.json': [run_1, run_2],
+    }
+
+
+def test_dry_run_writes_nothing(tmp_path):
+    bids_path = str(tmp_path / 'bids')
+    write_session(bids_path)
+    before = snapshot(bids_path)
+    _, _, changes = intended_for.populate_dataset(bids_path, ['ModalityAcquisitionLabel'], 'Closest', 1, dry_run=True)
+    assert len(changes) == 4
+    assert snapshot(bids_path) == before
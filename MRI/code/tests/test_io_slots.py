@@ -0,0 +1,87 @@
+# ============================================================
+# Tests of the I/O budget (io_slots.py): with one slot, a second process waits (polling) until the first one releases
+# its slot, which it does when the block holding it raises, not only when the process exits.
+# ============================================================
+
+import multiprocessing # To hold the slot from another process
+import os # To find the lock files
+import sys # To report how the holding process ended
+import threading # To wait for the slot while the test watches
+
+import pytest # To check that the exceptions go through
+
+import io_slots # The I/O budget (io_slots.py)
+
+DICOM_PATH = '/mridata/cbu/CBU000001_SYNTHETIC'
+IO_BUDGET = {'/mridata/cbu': 1}
+POLL_SECONDS = 0.05
+
+
+# --------------------------------------------------------------------------------------
+# hold_slot: Takes the slot of DICOM_PATH, says so (held), and once told to (release) fails inside the block, as a
+# conversion that raises. Then says that the exception went through (failed) and stays alive until done, so that the
+# slot can only have been released by reader_slot.
+# --------------------------------------------------------------------------------------
+def hold_slot(slot_path, held, release, failed, done):
+    try:
+        with io_slots.reader_slot(slot_path, DICOM_PATH, IO_BUDGET, POLL_SECONDS):
+            held.set()
+            release.wait(10)
+            raise RuntimeError('conversion failed')
+    except RuntimeError:
+        failed.set()
+    done.wait(10)
+    sys.exit(0)
+
+
+def test_second_process_waits_for_the_slot(tmp_path):
+    slot_path = str(tmp_path / 'io_slots')
+    context = multiprocessing.get_context('fork')
+    held, release, failed, done = (context.Event() for _ in range(4))
+    holder = context.Process(target=hold_slot, args=(slot_path, held, release, failed, done))
+    holder.start()
+    try:
+        assert held.wait(10)
+        assert io_slots.taken_slots(slot_path) == {'mridata_cbu': 1}
+
+        # This process polls for the slot while the other one holds it
+        acquired, finished = threading.Event(), threading.Event()
+
+        def wait_for_slot():
+            with io_slots.reader_slot(slot_path, DICOM_PATH, IO_BUDGET, POLL_SECONDS):
+                acquired.set()
+                finished.wait(10)
+        waiter = threading.Thread(target=wait_for_slot)
+        waiter.start()
+        assert not acquired.wait(10 * POLL_SECONDS)
+
+        # The other process fails inside the block: its slot is released while it is still running
+        release.set()
+        assert failed.wait(10)
+        assert acquired.wait(10)
+        assert holder.is_alive()
+        finished.set()
+        waiter.join()
+        assert io_slots.taken_slots(slot_path) == {'mridata_cbu': 0}
+    finally:
+        release.set()
+        done.set()
+        holder.join(10)
+    assert holder.exitcode == 0
+
+
+def test_slot_released_after_exception(tmp_path):
+    slot_path = str(tmp_path / 'io_slots')
+    with pytest.raises(RuntimeError):
+        with io_slots.reader_slot(slot_path, DICOM_PATH, IO_BUDGET, POLL_SECONDS):
+            assert io_slots.taken_slots(slot_path) == {'mridata_cbu': 1}
+            raise RuntimeError('conversion failed')
+    assert io_slots.taken_slots(slot_path) == {'mridata_cbu': 0}
+
+
+def test_no_slot_outside_the_budget(tmp_path):
+    slot_path = str(tmp_path / 'io_slots')
+    for budget in (None, IO_BUDGET):
+        with io_slots.reader_slot(slot_path, '/imaging/other/CBU000001', budget, POLL_SECONDS):
+            pass
+    assert not os.path.exists(slot_path)
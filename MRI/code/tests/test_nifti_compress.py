@@ -0,0 +1,50 @@
+# ============================================================
+# Tests of the parallel gzip stage (nifti_compress.py): the compressed files are standard gzip files holding the
+# original data, whether the blocks are compressed in a thread pool or one after the other.
+# ============================================================
+
+import os # To check the files
+import gzip # To read the compressed files back
+import stat # To check the permissions of the compressed files
+import random # To generate the data
+from concurrent.futures import ThreadPoolExecutor # To compress the blocks in parallel
+
+import pytest # To parametrise the sizes
+
+import nifti_compress # The parallel gzip stage (nifti_compress.py)
+
+
+def write_data(path, size):
+    rng = random.Random(size)
+    # Half random, half repeated bytes, so that the blocks both compress and refer to the previous block
+    data = bytes(rng.getrandbits(8) for _ in range(size // 2)) + b'\0\1\2\3' * (size // 8)
+    data += b'x' * (size - len(data))
+    with open(path, 'wb') as f:
+        f.write(data)
+    return data
+
+
+@pytest.mark.parametrize('size', [0, 1, nifti_compress.BLOCK_BYTES, 3 * nifti_compress.BLOCK_BYTES + 17])
+@pytest.mark.parametrize('n_threads', [1, 3])
+def test_compress_file_round_trip(tmp_path, size, n_threads):
+    path = str(tmp_path / 'sub-001_T1w.nii')
+    data = write_data(path, size)
+    os.chmod(path, 0o444)
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        target = nifti_compress.compress_file(path, pool=pool if n_threads > 1 else None, n_threads=n_threads)
+    assert target == f"{path}.gz"
+    assert not os.path.exists(path)
+    assert os.listdir(str(tmp_path)) == ['sub-001_T1w.nii.gz']
+    assert stat.S_IMODE(os.stat(target).st_mode) == 0o444
+    with gzip.open(target, 'rb') as f:
+        assert f.read() == data
+
+
+def test_compress_files(tmp_path):
+    paths = [str(tmp_path / f"file{i}.nii") for i in range(4)]
+    data = [write_data(path, size) for path, size in zip(paths, [10, 2 * nifti_compress.BLOCK_BYTES + 5, 1000, 0])]
+    compressed = nifti_compress.compress_files(paths, n_threads=3)
+    assert sorted(compressed) == sorted(f"{path}.gz" for path in paths)
+    for path, expected in zip(paths, data):
+        with gzip.open(f"{path}.gz", 'rb') as f:
+            assert f.read() == expected
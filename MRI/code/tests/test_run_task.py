@@ -0,0 +1,48 @@
+# ============================================================
+# Tests of the conversion of the subjects of a task (run_task.py): the paths of the staged DICOM files are put back
+# in the files heudiconv keeps about the conversion, and nothing else is changed.
+# ============================================================
+
+import json # To write and read the files heudiconv keeps
+import os # To lay out the .heudiconv folder
+
+import run_task # The conversion of the subjects of a task (run_task.py)
+
+STAGE_PATH = '/tmp/sub-001_abcd/dicom'
+DICOM_PATH = '/mridata/cbu/CBU000001_SYNTHETIC'
+
+
+def write_json(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(content, f, indent=2, sort_keys=True)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_restore_dicom_paths(tmp_path):
+    info = tmp_path / '.heudiconv' / '001' / 'info'
+    write_json(str(info / 'filegroup.json'), {
+        'anat/sub-001_T1w': [f"{STAGE_PATH}/20240101_120000/Series_001_MPRAGE/0001.dcm",
+                             f"{STAGE_PATH}/20240101_120000/Series_001_MPRAGE/0002.dcm"],
+        # A folder next to the staged one, and a path in a sentence, are not staged paths
+        'other': [f"{STAGE_PATH}_old/0001.dcm", f"copied from {STAGE_PATH}/x", {'nested': [STAGE_PATH, 3, None]}],
+    })
+    write_json(str(info / 'untouched.json'), {'TaskName': 'rest'})
+    run_task.restore_dicom_paths(str(tmp_path / '.heudiconv'), STAGE_PATH, DICOM_PATH)
+    assert read_json(str(info / 'filegroup.json')) == {
+        'anat/sub-001_T1w': [f"{DICOM_PATH}/20240101_120000/Series_001_MPRAGE/0001.dcm",
+                             f"{DICOM_PATH}/20240101_120000/Series_001_MPRAGE/0002.dcm"],
+        'other': [f"{STAGE_PATH}_old/0001.dcm", f"copied from {STAGE_PATH}/x", {'nested': [DICOM_PATH, 3, None]}],
+    }
+    assert read_json(str(info / 'untouched.json')) == {'TaskName': 'rest'}
+
+
+def test_restore_dicom_paths_skips_invalid_json(tmp_path):
+    path = tmp_path / 'broken.json'
+    path.write_text(f'{{"files": ["{STAGE_PATH}/0001.dcm"')
+    run_task.restore_dicom_paths(str(tmp_path), STAGE_PATH, DICOM_PATH)
+    assert path.read_text() == f'{{"files": ["{STAGE_PATH}/0001.dcm"'
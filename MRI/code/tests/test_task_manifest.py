@@ -0,0 +1,57 @@
+# ============================================================
+# Tests of the task manifests (task_manifest.py): the rows of each task are read back through the offsets file,
+# and without it for the task manifests written before it existed.
+# ============================================================
+
+import os # To remove the offsets file
+
+import pytest # To test the rejected values
+
+import task_manifest # The task manifests (task_manifest.py)
+
+ENTRIES = [{'subject_id': f"{i:03d}", 'session_id': 'ses-1' if i % 2 else None, 'dicom_path': f"/mridata/cbu/CBU{i}_é",
+            'n_bytes': 1000 * i, 'n_files': i, 'stage': 0} for i in range(7)]
+TASKS = [[0, 1], [2], [3, 4, 5], [6]]
+
+
+def test_task_rows_match_read_tasks(tmp_path):
+    manifest = str(tmp_path / 'tasks_20240101120000.tsv')
+    task_manifest.write_tasks(manifest, TASKS, ENTRIES)
+    tasks = task_manifest.read_tasks(manifest)
+    assert [[row['subject_id'] for row in tasks[task_id]] for task_id in range(len(TASKS))] == \
+           [[ENTRIES[index]['subject_id'] for index in task] for task in TASKS]
+    for task_id in range(len(TASKS) + 2):
+        assert task_manifest.task_rows(manifest, task_id) == tasks.get(task_id, [])
+
+
+def test_task_rows_with_task_ids(tmp_path):
+    manifest = str(tmp_path / 'tasks_20240101120000.tsv')
+    task_manifest.write_tasks(manifest, TASKS, ENTRIES, task_ids=[1, 4, 5, 9])
+    tasks = task_manifest.read_tasks(manifest)
+    assert sorted(tasks) == [1, 4, 5, 9]
+    for task_id in range(11):
+        assert task_manifest.task_rows(manifest, task_id) == tasks.get(task_id, [])
+    assert [row['dicom_path'] for row in task_manifest.task_rows(manifest, 5)] == [ENTRIES[i]['dicom_path'] for i in TASKS[2]]
+
+
+def test_task_rows_without_offsets_file(tmp_path):
+    manifest = str(tmp_path / 'tasks_20240101120000.tsv')
+    task_manifest.write_tasks(manifest, TASKS, ENTRIES)
+    tasks = task_manifest.read_tasks(manifest)
+    os.remove(task_manifest.offsets_file(manifest))
+    for task_id in range(len(TASKS) + 1):
+        assert task_manifest.task_rows(manifest, task_id) == tasks.get(task_id, [])
+
+
+def test_write_tasks_rejects_tabs(tmp_path):
+    manifest = str(tmp_path / 'tasks_20240101120000.tsv')
+    with pytest.raises(ValueError):
+        task_manifest.write_tasks(manifest, [[0]], [dict(ENTRIES[0], dicom_path='/mridata/cbu/a\tb')])
+    assert not os.path.exists(manifest)
+
+
+def test_split_chunks():
+    tasks = [[i] for i in range(7)]
+    assert task_manifest.split_chunks(tasks) == [tasks]
+    assert task_manifest.split_chunks(tasks, 7) == [tasks]
+    assert task_manifest.split_chunks(tasks, 3) == [tasks[0:3], tasks[3:6], tasks[6:7]]